@@ -1,8 +1,13 @@
+import io
 import os
 import json
+import shutil
 import logging
 from abc import ABC, abstractmethod
-from typing import List, Optional, Any
+from typing import IO, Iterator, List, Optional, Any
+import services.tracing
+import services.circuit_breaker
+import config
 
 # Optional imports for GCP (only needed if in production/GCP mode)
 try:
@@ -14,6 +19,9 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+# レジューム可能アップロードのチャンクサイズ (256 KiB の倍数)
+GCS_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
 class StorageAdapter(ABC):
     @abstractmethod
     def save_file(self, bucket_name: str, file_path: str, data: bytes, content_type: Optional[str] = None) -> str:
@@ -22,6 +30,43 @@ class StorageAdapter(ABC):
         """
         pass
 
+    def save_fileobj(self, bucket_name: str, file_path: str, fileobj: IO[bytes], content_type: Optional[str] = None,
+                     size: Optional[int] = None) -> str:
+        """
+        Saves a file from a readable stream and returns its access URL.
+        Implementations should stream in chunks; the default reads the whole stream.
+        size is the stream length if known (the stream need not be seekable).
+        """
+        return self.save_file(bucket_name, file_path, fileobj.read(), content_type)
+
+    @abstractmethod
+    def exists(self, bucket_name: str, file_path: str) -> bool:
+        """
+        Returns True if the object exists.
+        """
+        pass
+
+    @abstractmethod
+    def copy_file(self, bucket_name: str, source_path: str, destination_path: str) -> str:
+        """
+        Copies an object within the bucket and returns the destination URL.
+        """
+        pass
+
+    @abstractmethod
+    def list_files(self, bucket_name: str, prefix: str = "") -> Iterator[str]:
+        """
+        Yields object paths under the prefix.
+        """
+        pass
+
+    @abstractmethod
+    def open_file(self, bucket_name: str, file_path: str) -> IO[bytes]:
+        """
+        Opens an object for streaming reads (the caller closes it).
+        """
+        pass
+
 class BigQueryAdapter(ABC):
     @abstractmethod
     def insert_rows(self, table_id: str, rows: List[dict], row_ids: Optional[List[str]] = None) -> List[dict]:
@@ -37,8 +82,39 @@ class BigQueryAdapter(ABC):
         """
         pass
 
+    @abstractmethod
+    def query_rows(self, table_id: str, start: str, end: str, sender: Optional[str] = None) -> Iterator[dict]:
+        """
+        Yields rows received in [start, end) (YYYY-MM-DD), oldest first.
+        sender filters by a case-insensitive substring of sender_address or sender_name.
+        """
+        pass
+
 # --- GCP Implementations ---
 
+class _PositionTrackingReader(io.RawIOBase):
+    """
+    シークできないストリーム (ZIP メンバー・パイプ) の読み出し位置を tell() で返すラッパー。
+    アップロードライブラリは開始時とチャンクごとに tell() を呼ぶため。
+    """
+
+    def __init__(self, stream: IO[bytes]):
+        self._stream = stream
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._stream.read(len(buffer))
+        n = len(data)
+        buffer[:n] = data
+        self._position += n
+        return n
+
+    def tell(self) -> int:
+        return self._position
+
 class GCPStorageAdapter(StorageAdapter):
     def __init__(self):
         if not storage:
@@ -46,11 +122,43 @@ class GCPStorageAdapter(StorageAdapter):
         self.client = storage.Client()
 
     def save_file(self, bucket_name: str, file_path: str, data: bytes, content_type: Optional[str] = None) -> str:
-        bucket = self.client.bucket(bucket_name)
-        blob = bucket.blob(file_path)
-        blob.upload_from_string(data, content_type=content_type)
+        with services.tracing.span("gcs.upload", bucket=bucket_name, path=file_path, bytes=len(data)):
+            bucket = self.client.bucket(bucket_name)
+            blob = bucket.blob(file_path)
+            blob.upload_from_string(data, content_type=content_type)
         return f"https://storage.cloud.google.com/{bucket_name}/{file_path}"
 
+    def save_fileobj(self, bucket_name: str, file_path: str, fileobj: IO[bytes], content_type: Optional[str] = None,
+                     size: Optional[int] = None) -> str:
+        with services.tracing.span("gcs.upload", bucket=bucket_name, path=file_path, streamed=True, bytes=size):
+            bucket = self.client.bucket(bucket_name)
+            blob = bucket.blob(file_path)
+            # 大きいストリーム・サイズ不明のストリームは chunk_size 単位のレジューム可能アップロードになる
+            blob.chunk_size = GCS_UPLOAD_CHUNK_SIZE
+            if not (hasattr(fileobj, "seekable") and fileobj.seekable()):
+                fileobj = _PositionTrackingReader(fileobj)
+            blob.upload_from_file(fileobj, size=size, content_type=content_type)
+        return f"https://storage.cloud.google.com/{bucket_name}/{file_path}"
+
+    def exists(self, bucket_name: str, file_path: str) -> bool:
+        with services.tracing.span("gcs.exists", bucket=bucket_name, path=file_path):
+            return self.client.bucket(bucket_name).blob(file_path).exists()
+
+    def copy_file(self, bucket_name: str, source_path: str, destination_path: str) -> str:
+        with services.tracing.span("gcs.copy", bucket=bucket_name, source=source_path, path=destination_path):
+            bucket = self.client.bucket(bucket_name)
+            # サーバー側コピー (データはダウンロードしない)
+            bucket.copy_blob(bucket.blob(source_path), bucket, destination_path)
+        return f"https://storage.cloud.google.com/{bucket_name}/{destination_path}"
+
+    def list_files(self, bucket_name: str, prefix: str = "") -> Iterator[str]:
+        for blob in self.client.list_blobs(bucket_name, prefix=prefix):
+            yield blob.name
+
+    def open_file(self, bucket_name: str, file_path: str) -> IO[bytes]:
+        # チャンク単位で読み出す (オブジェクト全体をメモリに載せない)
+        return self.client.bucket(bucket_name).blob(file_path).open("rb", chunk_size=8 * 1024 * 1024)
+
 class GCPBigQueryAdapter(BigQueryAdapter):
     def __init__(self):
         if not bigquery:
@@ -58,7 +166,8 @@ class GCPBigQueryAdapter(BigQueryAdapter):
         self.client = bigquery.Client()
 
     def insert_rows(self, table_id: str, rows: List[dict], row_ids: Optional[List[str]] = None) -> List[dict]:
-        return self.client.insert_rows_json(table_id, rows, row_ids=row_ids)
+        with services.tracing.span("bigquery.insert", table=table_id, rows=len(rows)):
+            return self.client.insert_rows_json(table_id, rows, row_ids=row_ids)
 
     def get_processed_count(self, target_date_iso: str) -> int:
         import config
@@ -67,12 +176,37 @@ class GCPBigQueryAdapter(BigQueryAdapter):
             FROM `{config.BQ_TABLE_ID}`
             WHERE DATE(processed_at) = '{target_date_iso}'
         """
-        job = self.client.query(query)
-        result = job.result()
+        with services.tracing.span("bigquery.query"):
+            job = self.client.query(query)
+            result = job.result()
         for row in result:
             return row.count
         return 0
 
+    def query_rows(self, table_id: str, start: str, end: str, sender: Optional[str] = None) -> Iterator[dict]:
+        # received_at のパーティションで絞り込む (範囲外はスキャンしない)
+        query = f"""
+            SELECT *
+            FROM `{table_id}`
+            WHERE received_at >= TIMESTAMP(@start) AND received_at < TIMESTAMP(@end)
+              AND (@sender IS NULL
+                   OR STRPOS(LOWER(sender_address), LOWER(@sender)) > 0
+                   OR STRPOS(LOWER(sender_name), LOWER(@sender)) > 0)
+            ORDER BY received_at
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("start", "STRING", start),
+            bigquery.ScalarQueryParameter("end", "STRING", end),
+            bigquery.ScalarQueryParameter("sender", "STRING", sender),
+        ])
+        with services.tracing.span("bigquery.query", table=table_id):
+            result = self.client.query(query, job_config=job_config).result()
+        for row in result:
+            record = dict(row.items())
+            if hasattr(record.get("received_at"), "isoformat"):
+                record["received_at"] = record["received_at"].isoformat()
+            yield record
+
 # --- Local Emulation Implementations ---
 
 class LocalStorageAdapter(StorageAdapter):
@@ -89,12 +223,46 @@ class LocalStorageAdapter(StorageAdapter):
         # Ensure directories exist
         os.makedirs(os.path.dirname(full_path), exist_ok=True)
         
-        with open(full_path, "wb") as f:
-            f.write(data)
+        with services.tracing.span("local_storage.save", path=full_path, bytes=len(data)):
+            with open(full_path, "wb") as f:
+                f.write(data)
             
         logger.info(f"[ローカルエミュレーション] ファイルを保存しました: {full_path}")
         return f"file://{os.path.abspath(full_path)}"
 
+    def save_fileobj(self, bucket_name: str, file_path: str, fileobj: IO[bytes], content_type: Optional[str] = None,
+                     size: Optional[int] = None) -> str:
+        full_path = os.path.join(self.base_dir, bucket_name, file_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        with services.tracing.span("local_storage.save", path=full_path, streamed=True):
+            with open(full_path, "wb") as f:
+                shutil.copyfileobj(fileobj, f, 1024 * 1024)
+
+        logger.info(f"[ローカルエミュレーション] ファイルを保存しました: {full_path}")
+        return f"file://{os.path.abspath(full_path)}"
+
+    def exists(self, bucket_name: str, file_path: str) -> bool:
+        return os.path.isfile(os.path.join(self.base_dir, bucket_name, file_path))
+
+    def copy_file(self, bucket_name: str, source_path: str, destination_path: str) -> str:
+        full_path = os.path.join(self.base_dir, bucket_name, destination_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        shutil.copyfile(os.path.join(self.base_dir, bucket_name, source_path), full_path)
+        return f"file://{os.path.abspath(full_path)}"
+
+    def list_files(self, bucket_name: str, prefix: str = "") -> Iterator[str]:
+        root = os.path.join(self.base_dir, bucket_name)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.relpath(os.path.join(dirpath, filename), root).replace(os.sep, "/")
+                if path.startswith(prefix):
+                    yield path
+
+    def open_file(self, bucket_name: str, file_path: str) -> IO[bytes]:
+        return open(os.path.join(self.base_dir, bucket_name, file_path), "rb")
+
 class LocalBigQueryAdapter(BigQueryAdapter):
     def __init__(self, log_file: str = "local_bq_log.jsonl"):
         self.log_file = log_file
@@ -102,7 +270,7 @@ class LocalBigQueryAdapter(BigQueryAdapter):
     def insert_rows(self, table_id: str, rows: List[dict], row_ids: Optional[List[str]] = None) -> List[dict]:
         # Append rows to a JSONL file
         try:
-            with open(self.log_file, "a", encoding="utf-8") as f:
+            with services.tracing.span("local_bq.insert", rows=len(rows)), open(self.log_file, "a", encoding="utf-8") as f:
                 for i, row in enumerate(rows):
                     record = {
                         "table_id": table_id,
@@ -138,6 +306,27 @@ class LocalBigQueryAdapter(BigQueryAdapter):
             logger.error(f"[ローカルエミュレーション] ログ読み込みエラー: {e}")
         return count
 
+    def query_rows(self, table_id: str, start: str, end: str, sender: Optional[str] = None) -> Iterator[dict]:
+        if not os.path.exists(self.log_file):
+            return
+        rows = {}
+        with open(self.log_file, "r", encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                data = record.get("data", {})
+                received_at = data.get("received_at", "")
+                if record.get("table_id") != table_id or not start <= received_at < end:
+                    continue
+                if sender and not any(sender.lower() in (data.get(k) or "").lower()
+                                      for k in ("sender_address", "sender_name")):
+                    continue
+                # 同じ row_id (重複挿入防止キー) の行は1件にまとめる (BigQuery の重複排除と同様)
+                rows[record.get("row_id") or i] = data
+        yield from sorted(rows.values(), key=lambda data: data.get("received_at", ""))
+
 def import_datetime():
     import datetime
     return datetime
@@ -147,11 +336,21 @@ def import_datetime():
 def get_storage_adapter() -> StorageAdapter:
     env = os.getenv("APP_ENV", "production")
     if env == "local":
-        return LocalStorageAdapter()
-    return GCPStorageAdapter()
+        adapter = LocalStorageAdapter()
+    else:
+        adapter = GCPStorageAdapter()
+    return _guarded(adapter, "storage")
 
 def get_bigquery_adapter() -> BigQueryAdapter:
     env = os.getenv("APP_ENV", "production")
     if env == "local":
-        return LocalBigQueryAdapter()
-    return GCPBigQueryAdapter()
+        adapter = LocalBigQueryAdapter()
+    else:
+        adapter = GCPBigQueryAdapter()
+    return _guarded(adapter, "bigquery")
+
+def _guarded(adapter, name: str):
+    """CIRCUIT_BREAKER_ENABLED の場合、呼び出しをサーキットブレーカーで保護します。"""
+    if not config.CIRCUIT_BREAKER_ENABLED:
+        return adapter
+    return services.circuit_breaker.GuardedAdapter(adapter, name)
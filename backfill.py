@@ -0,0 +1,311 @@
+"""
+過去メールの一括取り込み (バックフィル) CLI
+
+- 対象: 期間 (--start / --end) または Gmail 検索クエリ (--query)
+- 1. 一覧フェーズ: messages.list をページングしてメッセージIDを全件列挙し、チェックポイントに保存
+     (処理中のラベル変更で検索結果がずれ、ページを取りこぼすのを防ぐため、処理より先に列挙し切る)
+- 2. 処理フェーズ: ワーカープールで process_email_task を並行実行
+     Gmail API 呼び出しはクォータ (ユニット/秒) に合わせてトークンバケットで平準化する
+- 進捗はチェックポイントファイルに定期的に保存し、中断後は同じコマンドで再開できる
+- BigQuery の重複挿入防止キー (insert_id) と保存キーが決定的なため、再実行しても重複しない
+
+使い方:
+    python backfill.py --start 2022-01-01 --end 2024-12-31 --workers 8
+    python backfill.py --query 'from:billing@example.com has:attachment' --checkpoint example.json
+    python backfill.py --start 2022-01-01 --end 2024-12-31 --retry-failed
+"""
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import datetime
+import logging
+import threading
+import dataclasses
+import concurrent.futures
+from typing import List, Optional
+import services.gmail
+import services.accounts
+import services.ratelimit
+import services.structured_logging
+from services.filtering import build_query_filters
+from services.processor import process_email_task
+import config
+
+# ロガー設定
+services.structured_logging.configure(logging.INFO, fmt='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
+
+# messages.list の1ページの件数 (API の上限)
+LIST_PAGE_SIZE = 500
+# チェックポイントを保存する間隔
+CHECKPOINT_INTERVAL_SECONDS = 5.0
+# 進捗を表示する間隔
+REPORT_INTERVAL_SECONDS = 10.0
+
+def build_backfill_query(start: Optional[datetime.date] = None, end: Optional[datetime.date] = None,
+                         query: Optional[str] = None, include_processed: bool = False,
+                         use_filters: bool = True) -> str:
+    """
+    バックフィル用の検索クエリを組み立てます。
+
+    Args:
+        start / end: 受信日の範囲 (end を含む)
+        query: 追加の検索条件
+        include_processed: 処理済み (PROCESSED / ERROR / DEAD_LETTER ラベル付き) のメールも対象にする
+        use_filters: ALLOWED_DOMAINS / SUBJECT_KEYWORDS (またはルールセット) を検索条件に含める
+    """
+    terms = ["has:attachment"]
+    if start:
+        terms.append(f"after:{start.strftime('%Y/%m/%d')}")
+    if end:
+        # before: は指定日を含まないため翌日を指定する
+        terms.append(f"before:{(end + datetime.timedelta(days=1)).strftime('%Y/%m/%d')}")
+    if query:
+        terms.append(query)
+    if not include_processed:
+        terms.append(f"-label:{config.PROCESSED_LABEL_NAME} -label:{config.ERROR_LABEL_NAME} "
+                     f"-label:{config.DEAD_LETTER_LABEL_NAME}")
+    base = " ".join(terms)
+
+    if use_filters:
+        # バックフィルは1本のクエリで列挙する (長さで分割しない)
+        # 件名キーワードはクレーム時と同じく FILTER_QUERY_PUSHDOWN_SUBJECTS の場合のみ含める
+        # (subject: は単語単位の一致のため、部分一致の後段フィルタが許可するメールを取りこぼす)
+        filters = build_query_filters(sys.maxsize, include_subjects=config.FILTER_QUERY_PUSHDOWN_SUBJECTS)
+        if filters:
+            base = f"{base} {filters[0]}"
+    return base
+
+class Checkpoint:
+    """
+    進捗の保存 (JSON ファイル)
+
+    - ids: 一覧フェーズで列挙したメッセージID (順序どおり)
+    - list_page_token: 一覧フェーズの続きのページ (列挙完了後は None)
+    - done / failed: 処理を終えた / 失敗したメッセージID
+    """
+
+    def __init__(self, path: str, query: str):
+        self.path = path
+        self.query = query
+        self.ids: List[str] = []
+        self.list_page_token: Optional[str] = None
+        self.listing_done = False
+        self.result_size_estimate = 0
+        self.done: set = set()
+        self.failed: set = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path: str, query: str) -> "Checkpoint":
+        checkpoint = cls(path, query)
+        if not os.path.exists(path):
+            return checkpoint
+        with open(path, "r", encoding="utf-8") as f:
+            doc = json.load(f)
+        if doc.get("query") != query:
+            raise ValueError(
+                f"チェックポイント {path} は別のクエリ用です: {doc.get('query')!r} "
+                f"(別の --checkpoint を指定するか、ファイルを削除してください)")
+        checkpoint.ids = doc.get("ids", [])
+        checkpoint.list_page_token = doc.get("list_page_token")
+        checkpoint.listing_done = doc.get("listing_done", False)
+        checkpoint.result_size_estimate = doc.get("result_size_estimate", 0)
+        checkpoint.done = set(doc.get("done", []))
+        checkpoint.failed = set(doc.get("failed", []))
+        return checkpoint
+
+    def mark(self, msg_id: str, ok: bool):
+        with self._lock:
+            self.done.add(msg_id)
+            if ok:
+                self.failed.discard(msg_id)
+            else:
+                self.failed.add(msg_id)
+
+    def pending(self, retry_failed: bool = False) -> List[str]:
+        with self._lock:
+            return [i for i in self.ids if i not in self.done or (retry_failed and i in self.failed)]
+
+    def save(self):
+        """一時ファイルに書いてから置き換える (書き込み中に中断しても壊れない)"""
+        with self._lock:
+            doc = {
+                "query": self.query,
+                "ids": self.ids,
+                "list_page_token": self.list_page_token,
+                "listing_done": self.listing_done,
+                "result_size_estimate": self.result_size_estimate,
+                "done": sorted(self.done),
+                "failed": sorted(self.failed),
+                "updated_at": datetime.datetime.now().isoformat(),
+            }
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(doc, f)
+        os.replace(tmp_path, self.path)
+
+def list_message_ids(checkpoint: Checkpoint, stop: threading.Event):
+    """一覧フェーズ: 検索結果のメッセージIDを全件チェックポイントに追加します (中断・再開可能)。"""
+    if checkpoint.listing_done:
+        return
+    srv = services.gmail.get_gmail_service()
+    seen = set(checkpoint.ids)
+    while not stop.is_set():
+        results = services.gmail.execute(srv.users().messages().list(
+            userId='me',
+            q=checkpoint.query,
+            maxResults=LIST_PAGE_SIZE,
+            pageToken=checkpoint.list_page_token
+        ), "messages.list")
+        for msg in results.get('messages', []):
+            if msg['id'] not in seen:
+                seen.add(msg['id'])
+                checkpoint.ids.append(msg['id'])
+        checkpoint.result_size_estimate = max(checkpoint.result_size_estimate, results.get('resultSizeEstimate', 0))
+        checkpoint.list_page_token = results.get('nextPageToken')
+        if not checkpoint.list_page_token:
+            checkpoint.listing_done = True
+        checkpoint.save()
+        logger.info(f"一覧取得中: {len(checkpoint.ids)} 件")
+        if checkpoint.listing_done:
+            return
+
+class ProgressReporter:
+    """処理件数・スループット・残り時間の表示"""
+
+    def __init__(self, total: int, clock=time.monotonic):
+        self.total = total
+        self.completed = 0
+        self.failed = 0
+        self._clock = clock
+        self._start = clock()
+        self._last_report = self._start
+
+    def record(self, ok: bool):
+        self.completed += 1
+        if not ok:
+            self.failed += 1
+
+    def summary(self) -> str:
+        elapsed = max(self._clock() - self._start, 1e-9)
+        rate = self.completed / elapsed
+        remaining = self.total - self.completed
+        eta = datetime.timedelta(seconds=int(remaining / rate)) if rate > 0 else "-"
+        return (f"{self.completed}/{self.total} 件 (失敗 {self.failed}) | "
+                f"{rate:.2f} 件/秒 | 残り約 {eta}")
+
+    def maybe_report(self):
+        now = self._clock()
+        if now - self._last_report >= REPORT_INTERVAL_SECONDS:
+            self._last_report = now
+            logger.info(f"進捗: {self.summary()}")
+
+def run_backfill(checkpoint: Checkpoint, workers: int, retry_failed: bool = False,
+                 stop: Optional[threading.Event] = None,
+                 account: Optional[services.accounts.Account] = None) -> ProgressReporter:
+    """
+    処理フェーズ: 未処理のメッセージをワーカープールで処理します。
+    同時に投入するタスクはワーカー数の2倍までに抑える (中断時に捨てる仕事を少なくするため)。
+    account 指定時 (複数アカウントモード) はそのメールボックスを対象にします。
+    """
+    stop = stop or threading.Event()
+    with services.accounts.use_account(account):
+        list_message_ids(checkpoint, stop)
+
+    pending = checkpoint.pending(retry_failed)
+    progress = ProgressReporter(len(pending))
+    logger.info(f"処理対象: {len(pending)} 件 (列挙済み {len(checkpoint.ids)} 件 / 処理済み {len(checkpoint.done)} 件)")
+
+    last_save = time.monotonic()
+    in_flight = set()
+    ids = iter(pending)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as pool:
+        while True:
+            while not stop.is_set() and len(in_flight) < workers * 2:
+                msg_id = next(ids, None)
+                if msg_id is None:
+                    break
+                message_data = {'id': msg_id, 'account': account.email} if account else {'id': msg_id}
+                future = pool.submit(process_email_task, message_data)
+                future.msg_id = msg_id
+                in_flight.add(future)
+            if not in_flight:
+                break
+
+            finished, in_flight = concurrent.futures.wait(
+                in_flight, timeout=1.0, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                try:
+                    # parked (依存サービスの障害中) も失敗として記録し、--retry-failed で再処理する
+                    ok = future.result() not in ("error", "parked")
+                except Exception as e:
+                    logger.error(f"メッセージ {future.msg_id} の処理に失敗しました: {e}")
+                    ok = False
+                checkpoint.mark(future.msg_id, ok)
+                progress.record(ok)
+
+            progress.maybe_report()
+            if time.monotonic() - last_save >= CHECKPOINT_INTERVAL_SECONDS:
+                checkpoint.save()
+                last_save = time.monotonic()
+
+    checkpoint.save()
+    logger.info(f"{'中断' if stop.is_set() else '完了'}: {progress.summary()}")
+    return progress
+
+def main():
+    parser = argparse.ArgumentParser(description="過去の請求書メールを一括で取り込みます")
+    parser.add_argument("--start", type=datetime.date.fromisoformat, help="受信日の開始 (YYYY-MM-DD)")
+    parser.add_argument("--end", type=datetime.date.fromisoformat, help="受信日の終了 (YYYY-MM-DD, この日を含む)")
+    parser.add_argument("--query", help="追加の Gmail 検索条件")
+    parser.add_argument("--workers", type=int, default=8, help="並行処理数")
+    parser.add_argument("--quota", type=float, default=config.GMAIL_QUOTA_UNITS_PER_SECOND or 200,
+                        help="Gmail API のクォータユニット/秒 (上限 250)")
+    parser.add_argument("--checkpoint", help="チェックポイントファイル (既定: backfill_checkpoint[_アカウント].json)")
+    parser.add_argument("--include-processed", action="store_true", help="処理済み・エラーのメールも対象にする")
+    parser.add_argument("--no-filters", action="store_true", help="送信者/件名フィルタを検索条件に含めない")
+    parser.add_argument("--retry-failed", action="store_true", help="前回失敗したメッセージを再処理する")
+    parser.add_argument("--account", help="対象のメールボックス (複数アカウントモード時は必須)")
+    args = parser.parse_args()
+
+    if not (args.start or args.end or args.query):
+        parser.error("--start / --end または --query を指定してください")
+
+    account = None
+    if services.accounts.is_multi_account():
+        account = services.accounts.get_account(args.account)
+        if account is None:
+            parser.error(f"--account には ACCOUNTS_FILE のメールアドレスを指定してください: {args.account}")
+    elif args.account:
+        parser.error("--account は複数アカウントモード (ACCOUNTS_FILE) でのみ指定できます")
+
+    query = build_backfill_query(args.start, args.end, args.query, args.include_processed, not args.no_filters)
+    logger.info(f"検索クエリ: {query}")
+    checkpoint_path = args.checkpoint or (
+        f"backfill_checkpoint_{account.key}.json" if account else "backfill_checkpoint.json")
+    checkpoint = Checkpoint.load(checkpoint_path, query)
+    services.gmail.set_rate_limiter(services.ratelimit.TokenBucket(args.quota))
+    if account is not None:
+        # バックフィル中はこのアカウントのクォータを --quota で上書きする
+        account = dataclasses.replace(account, quota_units_per_second=args.quota)
+        services.accounts.set_accounts(
+            [account if a.key == account.key else a for a in services.accounts.get_accounts()])
+
+    # Ctrl+C / SIGTERM では実行中のメッセージを終えてからチェックポイントを保存して終了する
+    stop = threading.Event()
+    def request_stop(signum, frame):
+        logger.info("停止要求を受け付けました。実行中の処理の完了を待っています...")
+        stop.set()
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    progress = run_backfill(checkpoint, args.workers, args.retry_failed, stop, account)
+    if stop.is_set() or progress.failed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -20,6 +20,8 @@ GMAIL_SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
 TARGET_LABEL = os.getenv("TARGET_LABEL", "TARGET")
 PROCESSED_LABEL_NAME = os.getenv("PROCESSED_LABEL_NAME", "INVOICE_PROCESSED")
 ERROR_LABEL_NAME = os.getenv("ERROR_LABEL_NAME", "INVOICE_ERROR")
+# 再処理の上限に達したメールのラベル (services.retry)
+DEAD_LETTER_LABEL_NAME = os.getenv("DEAD_LETTER_LABEL_NAME", "INVOICE_DEAD_LETTER")
 
 # OAuth Config
 GMAIL_CLIENT_ID = os.getenv("GMAIL_CLIENT_ID")
@@ -29,3 +31,174 @@ GMAIL_REFRESH_TOKEN = os.getenv("GMAIL_REFRESH_TOKEN")
 # Filtering Config
 ALLOWED_DOMAINS = [d.strip() for d in os.getenv("ALLOWED_DOMAINS", "").split(",") if d.strip()]
 SUBJECT_KEYWORDS = [k.strip() for k in os.getenv("SUBJECT_KEYWORDS", "").split(",") if k.strip()]
+
+# Gmail検索クエリへのフィルタ押し下げ (Query Pushdown)
+# true の場合、ALLOWED_DOMAINS / SUBJECT_KEYWORDS を検索クエリに含め、
+# 対象外のメールはロックもダウンロードもしない (事後フィルタは安全網として残る)
+FILTER_QUERY_PUSHDOWN = os.getenv("FILTER_QUERY_PUSHDOWN", "false").lower() == "true"
+# 件名キーワードも押し下げるか。Gmail の subject: は語単位で一致するため、事後フィルタ (部分一致) と
+# 結果が異なる ("Invoice" は "Invoices" に一致しない、日本語の複合語の一部に一致しない など)。
+# false の場合、件名キーワードがあれば押し下げを行わない (送信者ドメインだけでは OR 条件を表せないため)
+FILTER_QUERY_PUSHDOWN_SUBJECTS = os.getenv("FILTER_QUERY_PUSHDOWN_SUBJECTS", "false").lower() == "true"
+# Gmail検索クエリ1本あたりの最大文字数 (超える場合は複数クエリに分割)
+GMAIL_QUERY_MAX_LENGTH = int(os.getenv("GMAIL_QUERY_MAX_LENGTH", "1500"))
+
+# 動的フィルタルール (Optional)
+# ローカルファイルパス or gs://bucket/path.json 。設定時は ALLOWED_DOMAINS / SUBJECT_KEYWORDS より優先
+RULES_SOURCE = os.getenv("RULES_SOURCE")
+# ルールソースの変更確認間隔 (秒)
+RULES_POLL_SECONDS = int(os.getenv("RULES_POLL_SECONDS", "60"))
+
+# トレーシング
+# none / jsonl (ローカルファイル) / otlp (OTLP/HTTP コレクター)
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+# トレース単位のサンプリング率 (0.0 - 1.0)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+TRACE_JSONL_PATH = os.getenv("TRACE_JSONL_PATH", "local_traces.jsonl")
+OTLP_TRACES_ENDPOINT = os.getenv("OTLP_TRACES_ENDPOINT", "http://localhost:4318/v1/traces")
+
+# オンデマンド・プロファイリング
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+# sampling (低オーバーヘッド) / deterministic (全関数呼び出しを計測)
+PROFILING_MODE = os.getenv("PROFILING_MODE", "sampling")
+PROFILING_INTERVAL_MS = float(os.getenv("PROFILING_INTERVAL_MS", "10"))
+# 集計結果を Storage に書き出す間隔 (秒)
+PROFILING_FLUSH_SECONDS = int(os.getenv("PROFILING_FLUSH_SECONDS", "300"))
+# 出力先 (未指定時はアーカイブ用バケットの PROFILING_PREFIX 配下)
+PROFILING_BUCKET = os.getenv("PROFILING_BUCKET")
+PROFILING_PREFIX = os.getenv("PROFILING_PREFIX", "_profiles")
+# リクエスト単位で有効化するヘッダー (値が 1 / true の場合)
+PROFILING_HEADER = "X-Invoice-Profile"
+# /admin/profiling とリクエスト単位の有効化に必要な共有シークレット (未設定の場合はどちらも使えない)
+PROFILING_ADMIN_TOKEN = os.getenv("PROFILING_ADMIN_TOKEN", "")
+PROFILING_ADMIN_TOKEN_HEADER = "X-Profiling-Token"
+
+# メール取得モード
+# full: format='full' + 添付ファイルごとに attachments.get (1 + k 回)
+# raw: format='raw' を1回取得してローカルで MIME 解析
+# auto: sizeEstimate が RAW_FETCH_MAX_BYTES 以下なら raw、それ以外は full
+INGEST_MODE = os.getenv("INGEST_MODE", "full")
+RAW_FETCH_MAX_BYTES = int(os.getenv("RAW_FETCH_MAX_BYTES", str(10 * 1024 * 1024)))
+
+# 請求書項目の抽出 (PDF の登録番号・発行日・支払期限・請求金額)
+EXTRACTION_ENABLED = os.getenv("EXTRACTION_ENABLED", "false").lower() == "true"
+# 抽出用プロセスプールのワーカー数 (未指定時は CPU 数)
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", "0")) or None
+# 1文書あたりの制限時間 (秒) と、テキストを読む最大ページ数
+EXTRACTION_TIMEOUT_SECONDS = float(os.getenv("EXTRACTION_TIMEOUT_SECONDS", "10"))
+EXTRACTION_MAX_PAGES = int(os.getenv("EXTRACTION_MAX_PAGES", "5"))
+
+# 添付ファイルの分類 (署名ロゴ・埋め込み画像などをアーカイブ前に除外)
+ATTACHMENT_CLASSIFIER_ENABLED = os.getenv("ATTACHMENT_CLASSIFIER_ENABLED", "false").lower() == "true"
+# 以下は既定ポリシー (ルールファイルの attachment_policy で送信者ごとに上書き可能)
+CLASSIFIER_SKIP_INLINE_IMAGES = os.getenv("CLASSIFIER_SKIP_INLINE_IMAGES", "true").lower() == "true"
+CLASSIFIER_MIN_IMAGE_BYTES = int(os.getenv("CLASSIFIER_MIN_IMAGE_BYTES", "20480"))
+# 常にスキップする種別 (例: html,ics,vcf)
+CLASSIFIER_SKIP_TYPES = [t.strip().lower() for t in os.getenv("CLASSIFIER_SKIP_TYPES", "ics,vcf").split(",") if t.strip()]
+CLASSIFIER_EXPAND_ARCHIVES = os.getenv("CLASSIFIER_EXPAND_ARCHIVES", "true").lower() == "true"
+
+# ZIP 添付ファイルの展開 (メンバーごとに個別のオブジェクト・invoice_log 行として保存)
+ZIP_EXPANSION_ENABLED = os.getenv("ZIP_EXPANSION_ENABLED", "false").lower() == "true"
+# ZIP bomb 対策の制限 (超えた場合は展開せず ZIP ごとアーカイブ)
+ZIP_MAX_MEMBERS = int(os.getenv("ZIP_MAX_MEMBERS", "200"))
+ZIP_MAX_TOTAL_BYTES = int(os.getenv("ZIP_MAX_TOTAL_BYTES", str(200 * 1024 * 1024)))
+ZIP_MAX_COMPRESSION_RATIO = float(os.getenv("ZIP_MAX_COMPRESSION_RATIO", "100"))
+
+# 保存キーのレイアウト (services.object_keys)
+# date: YYYY/MM/DD/名前 (従来) / hash_prefix: ハッシュ/YYYY/MM/DD/名前 / date_shard: YYYY/MM/DD/シャード/名前
+BLOB_KEY_LAYOUT = os.getenv("BLOB_KEY_LAYOUT", "date")
+BLOB_KEY_HASH_LENGTH = int(os.getenv("BLOB_KEY_HASH_LENGTH", "4"))
+BLOB_KEY_SHARDS = int(os.getenv("BLOB_KEY_SHARDS", "16"))
+
+# Gmail API のクォータ平準化 (1秒あたりのクォータユニット, 0 で無効)
+# ユーザーあたりの上限は 250 ユニット/秒 (messages.get などは 1回 5 ユニット)
+GMAIL_QUOTA_UNITS_PER_SECOND = float(os.getenv("GMAIL_QUOTA_UNITS_PER_SECOND", "0"))
+
+# watch_gmail (ローカル/常駐ワーカー) のポーリング
+# 新着があれば最短間隔で、無ければ倍々に最長間隔まで延ばす
+WATCH_MIN_INTERVAL_SECONDS = float(os.getenv("WATCH_MIN_INTERVAL_SECONDS", "5"))
+WATCH_MAX_INTERVAL_SECONDS = float(os.getenv("WATCH_MAX_INTERVAL_SECONDS", "300"))
+WATCH_WORKERS = int(os.getenv("WATCH_WORKERS", "4"))
+# 履歴の差分に関係なく、この間隔で検索による全件確認を行う (取りこぼし対策)
+WATCH_FULL_SYNC_SECONDS = float(os.getenv("WATCH_FULL_SYNC_SECONDS", "900"))
+
+# 複数メールボックス (services.accounts)
+# アカウント定義の JSON (ローカルパス or gs://bucket/path.json)。未設定時は上記の認証情報で1つのメールボックスを扱う
+ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE")
+
+# クレームのリース (services.leases)
+# 処理中に落ちたメールを、リースの期限切れ後に再クレーム可能に戻す
+LEASES_ENABLED = os.getenv("LEASES_ENABLED", "false").lower() == "true"
+LEASE_DB_PATH = os.getenv("LEASE_DB_PATH", "leases.sqlite3")
+LEASE_TTL_SECONDS = float(os.getenv("LEASE_TTL_SECONDS", "300"))
+LEASE_HEARTBEAT_SECONDS = float(os.getenv("LEASE_HEARTBEAT_SECONDS", "60"))
+# 1回のスイープで回収する最大件数
+LEASE_SWEEP_BATCH = int(os.getenv("LEASE_SWEEP_BATCH", "500"))
+# watch_gmail がスイープを実行する間隔
+LEASE_SWEEP_SECONDS = float(os.getenv("LEASE_SWEEP_SECONDS", "300"))
+
+# INVOICE_ERROR メールの自動再処理 (services.retry)
+RETRY_ENABLED = os.getenv("RETRY_ENABLED", "false").lower() == "true"
+RETRY_DB_PATH = os.getenv("RETRY_DB_PATH", "retry_state.sqlite3")
+# 元の処理を含む試行回数の上限 (超えたら DEAD_LETTER_LABEL_NAME に移す)
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+# 待ち時間: BASE * 2^(失敗回数-1) (上限 MAX) の 50〜100%
+RETRY_BASE_DELAY_SECONDS = float(os.getenv("RETRY_BASE_DELAY_SECONDS", "300"))
+RETRY_MAX_DELAY_SECONDS = float(os.getenv("RETRY_MAX_DELAY_SECONDS", "21600"))
+# 1サイクルで再処理する最大件数 (アカウントごと) と並行数
+RETRY_BATCH_SIZE = int(os.getenv("RETRY_BATCH_SIZE", "20"))
+RETRY_WORKERS = int(os.getenv("RETRY_WORKERS", "4"))
+# watch_gmail が再処理サイクルを実行する間隔
+RETRY_INTERVAL_SECONDS = float(os.getenv("RETRY_INTERVAL_SECONDS", "300"))
+
+# クレームしたメールの優先度付きスケジューリング (services.scheduler)
+# 受信時刻 + サイズに応じた猶予 - 主要取引先の優遇 の早い順に処理する
+PRIORITY_SCHEDULING_ENABLED = os.getenv("PRIORITY_SCHEDULING_ENABLED", "false").lower() == "true"
+# 主要な取引先 (アドレスまたはドメイン, カンマ区切り)
+PRIORITY_SENDERS = [s.strip() for s in os.getenv("PRIORITY_SENDERS", "").split(",") if s.strip()]
+PRIORITY_SENDER_ADVANTAGE_SECONDS = float(os.getenv("PRIORITY_SENDER_ADVANTAGE_SECONDS", "300"))
+# sizeEstimate 1MB あたりの猶予と、その上限 (大きなメールが待たされる最大時間)
+PRIORITY_SIZE_PENALTY_SECONDS_PER_MB = float(os.getenv("PRIORITY_SIZE_PENALTY_SECONDS_PER_MB", "30"))
+PRIORITY_MAX_DELAY_SECONDS = float(os.getenv("PRIORITY_MAX_DELAY_SECONDS", "900"))
+
+# 添付ファイル処理のメモリ予算 (services.admission)
+# ダウンロードからアップロードまでの添付ファイルが同時に使うメモリの上限 (0 で無効)
+# 目安: インスタンスのメモリの半分程度 (512MiB なら 268435456)
+MEMORY_BUDGET_BYTES = int(os.getenv("MEMORY_BUDGET_BYTES", "0"))
+
+# アーカイブ済み添付ファイルの台帳 (services.ledger)
+# 再処理時に、アップロード・記録が完了した添付ファイルの手順を飛ばす
+LEDGER_ENABLED = os.getenv("LEDGER_ENABLED", "false").lower() == "true"
+LEDGER_DB_PATH = os.getenv("LEDGER_DB_PATH", "ledger.sqlite3")
+
+# 請求書のエクスポート (services.export, POST /export, export_invoices.py)
+# 書き出し先 (バケット内のプレフィックス) と元ファイルを並行して取得する数
+EXPORT_PREFIX = os.getenv("EXPORT_PREFIX", "exports")
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "4"))
+
+# アーカイブ済み請求書のローカル検索インデックス (services.search_index, GET /search)
+SEARCH_INDEX_ENABLED = os.getenv("SEARCH_INDEX_ENABLED", "false").lower() == "true"
+SEARCH_INDEX_DIR = os.getenv("SEARCH_INDEX_DIR", "search_index")
+# バッファをセグメントファイルに書き出す件数・間隔
+SEARCH_INDEX_FLUSH_DOCS = int(os.getenv("SEARCH_INDEX_FLUSH_DOCS", "100"))
+SEARCH_INDEX_FLUSH_SECONDS = float(os.getenv("SEARCH_INDEX_FLUSH_SECONDS", "60"))
+# セグメント数がこれを超えたら1つに併合する
+SEARCH_INDEX_MAX_SEGMENTS = int(os.getenv("SEARCH_INDEX_MAX_SEGMENTS", "8"))
+
+# 依存サービス (Gmail, GCS, BigQuery, Slack) のサーキットブレーカー (services.circuit_breaker)
+CIRCUIT_BREAKER_ENABLED = os.getenv("CIRCUIT_BREAKER_ENABLED", "false").lower() == "true"
+# 連続でこの回数失敗したら open にする
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+# open にしてから試行 (half_open) を許可するまでの秒数
+CIRCUIT_RESET_SECONDS = float(os.getenv("CIRCUIT_RESET_SECONDS", "30"))
+
+# ログ出力 (services.structured_logging)
+# text (従来の1行テキスト) / json (Cloud Logging 向けの構造化ログ, キュー経由の非同期出力)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")
+# 大量に出る INFO 以下のログのサンプリング率 (0.0 - 1.0)。同じメッセージは窓ごとに最初の
+# LOG_SAMPLE_BURST 件を残し、以降はこの割合だけ残す。WARNING 以上は常に出力する
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))
+LOG_SAMPLE_BURST = int(os.getenv("LOG_SAMPLE_BURST", "10"))
+LOG_SAMPLE_WINDOW_SECONDS = float(os.getenv("LOG_SAMPLE_WINDOW_SECONDS", "60"))
+# 出力待ちのログの上限 (json のみ。溢れた INFO 以下は破棄し、WARNING 以上は待って出力する)
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
@@ -0,0 +1,48 @@
+"""
+請求書のエクスポート CLI (月次締め用)
+
+条件に一致する請求書の元ファイルを ZIP にまとめ、CSV の明細と一緒にバケット
+(APP_ENV=local の場合は local_storage) に書き出します。詳細は services/export.py を参照。
+
+使い方:
+    python export_invoices.py --month 2024-03
+    python export_invoices.py --start 2024-01-01 --end 2024-03-31 --sender billing@example.com
+"""
+import sys
+import argparse
+import datetime
+import logging
+import services.export
+import config
+
+# ロガー設定
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(description="請求書の ZIP と明細 (CSV) を書き出します")
+    parser.add_argument("--month", help="対象月 (YYYY-MM)")
+    parser.add_argument("--start", type=datetime.date.fromisoformat, help="受信日の開始 (YYYY-MM-DD)")
+    parser.add_argument("--end", type=datetime.date.fromisoformat, help="受信日の終了 (YYYY-MM-DD, この日を含む)")
+    parser.add_argument("--sender", help="送信者 (アドレス・名前の部分一致)")
+    parser.add_argument("--workers", type=int, default=config.EXPORT_WORKERS, help="元ファイルを並行して取得する数")
+    args = parser.parse_args()
+
+    if args.month:
+        request = services.export.ExportRequest.for_month(args.month, args.sender)
+    elif args.start and args.end and args.start <= args.end:
+        request = services.export.ExportRequest(args.start, args.end + datetime.timedelta(days=1), args.sender)
+    else:
+        parser.error("--month または --start と --end を指定してください")
+
+    summary = services.export.run_export(request, workers=args.workers)
+    print(f"ZIP: {summary['zip_url']}")
+    print(f"明細: {summary['manifest_url']}")
+    print(f"{summary['files']} 件 ({summary['bytes']} bytes), 取得失敗 {summary['missing']} 件")
+    return 1 if summary["missing"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,19 +1,41 @@
 import base64
+import datetime
 import logging
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, BackgroundTasks, Depends, HTTPException, Header
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 from services.locking import lock_and_get_messages
 from services.processor import process_email_task
 import services.gmail
+import services.accounts
+import services.leases
+import services.retry
+import services.scheduler
+import services.search_index
+import services.export
 import services.slack
+import services.rules
+import services.metrics
+import services.tracing
+import services.profiling
+import services.structured_logging
 import report_daily
 import config
 
 # Logging Setup
-logging.basicConfig(level=logging.INFO)
+services.structured_logging.configure(logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 動的フィルタルールの監視を開始 (RULES_SOURCE 設定時のみ)
+    services.rules.start_rule_watcher()
+    yield
+    # 検索インデックスの未書き出し分を保存する
+    services.search_index.flush()
+
+app = FastAPI(lifespan=lifespan)
 
 class PubSubMessage(BaseModel):
     data: str | None = None
@@ -23,69 +45,90 @@ class PubSubBody(BaseModel):
     message: PubSubMessage
     subscription: str
 
+class ProfilingRequest(BaseModel):
+    enabled: bool | None = None
+    duration_seconds: float | None = None
+
+class ExportBody(BaseModel):
+    month: str | None = None  # YYYY-MM
+    start: datetime.date | None = None
+    end: datetime.date | None = None  # この日を含む
+    sender: str | None = None
+
 @app.post("/")
-async def receive_gmail_notification(body: PubSubBody, background_tasks: BackgroundTasks):
-    logger.info(f"★通知を受信しました! Pub/Sub MessageID: {body.message.messageId}")
+async def receive_gmail_notification(
+    body: PubSubBody,
+    background_tasks: BackgroundTasks,
+    x_invoice_profile: str | None = Header(default=None, alias=config.PROFILING_HEADER),
+    x_profiling_token: str | None = Header(default=None, alias=config.PROFILING_ADMIN_TOKEN_HEADER)
+):
+    logger.info("★通知を受信しました! Pub/Sub MessageID: %s", body.message.messageId)
+    # ヘッダー指定時はこのリクエスト (とバックグラウンド処理) のみプロファイリング (共有シークレットが必要)
+    if isinstance(x_invoice_profile, str) and x_invoice_profile.lower() in ("1", "true"):
+        if services.profiling.authorize(x_profiling_token):
+            services.profiling.enable_for_request()
+        else:
+            logger.warning("%s が無効のため、プロファイリングの指定を無視します", config.PROFILING_ADMIN_TOKEN_HEADER)
+    # 以降のスパン (バックグラウンド処理を含む) に Pub/Sub messageId を付与する
+    services.tracing.set_correlation(pubsub_message_id=body.message.messageId)
 
-    # Decode data for logging
+    # Decode data for logging (複数アカウントモードでは emailAddress で振り分ける)
+    decoded_data = None
     if body.message.data:
         try:
             decoded_data = base64.b64decode(body.message.data).decode("utf-8")
-            logger.info(f"★データ内容: {decoded_data}")
+            # 通知ごとに出るため DEBUG で出力する
+            logger.debug("★データ内容: %s", decoded_data)
         except Exception as e:
-            logger.warning(f"データのデコードに失敗しました: {e}")
+            logger.warning("データのデコードに失敗しました: %s", e)
 
     # 1. Claim Check (Lock)
-    locked_msgs = lock_and_get_messages()
+    locked_msgs = []
+    for account in services.accounts.accounts_for_notification(decoded_data):
+        with services.accounts.use_account(account), services.tracing.start_trace("receive_notification"):
+            locked_msgs.extend(lock_and_get_messages())
     
     if not locked_msgs:
         logger.info("未読のメッセージは見つかりませんでした。")
         return {"status": "ok"}
 
     # 2. Process (Background)
-    for msg in locked_msgs:
-        background_tasks.add_task(process_email_task, msg)
+    # バックグラウンドタスクは追加順に実行されるため、優先度の高いメールから追加する
+    for msg in services.scheduler.sort_by_priority(locked_msgs):
+        services.metrics.TASKS_QUEUED.inc()
+        background_tasks.add_task(_process_queued_message, msg)
 
     return {"status": "ok", "locked_count": len(locked_msgs)}
 
+def _process_queued_message(msg: dict):
+    """バックグラウンドタスク: キュー待ち件数を減らしてから処理する"""
+    services.metrics.TASKS_QUEUED.dec()
+    process_email_task(msg)
+
 @app.post("/refresh-watch")
 async def refresh_watch_subscription():
     """
     Cloud Scheduler から毎日叩かれるエンドポイント。
     Gmail の Watch 設定（有効期限7日）を更新します。
+    複数アカウントモードでは全アカウントの Watch を更新します。
     """
     logger.info("Gmail Watch設定の更新を開始します...")
-    try:
-        srv = services.gmail.get_gmail_service()
-        
-        # TARGETラベル (ID) の通知のみを受け取る設定
-        # 注意: 本番環境では config.TARGET_LABEL に 'Label_...' 形式のIDが入っていることを期待します
-        label_ids = [config.TARGET_LABEL] if config.TARGET_LABEL and config.TARGET_LABEL != "TARGET" else ['UNREAD']
-        
-        topic_name = f'projects/{config.PROJECT_ID}/topics/gmail-notification'
-        
-        request = {
-            'labelIds': label_ids,
-            'topicName': topic_name,
-            'labelFilterAction': 'include'
-        }
-        
-        response = srv.users().watch(userId='me', body=request).execute()
-        history_id = response.get('historyId')
-        logger.info(f"Gmail Watch設定を更新しました。History ID: {history_id}")
-        
-        # 成功通知
-        services.slack.send_slack_alert(
-            f"Gmail Watch更新成功 ✅\nHistory ID: `{history_id}`",
-            level="success"
-        )
-        
-        return {"status": "ok", "historyId": history_id}
-        
-    except Exception as e:
-        error_msg = str(e)
-        logger.error(f"Gmail Watch設定の更新に失敗しました: {error_msg}")
-        
+    accounts = services.accounts.get_accounts()
+    history_ids = {}
+    errors = {}
+    for account in accounts or [None]:
+        name = account.email if account else "me"
+        try:
+            with services.accounts.use_account(account):
+                history_ids[name] = _watch_mailbox()
+            logger.info(f"Gmail Watch設定を更新しました ({name})。History ID: {history_ids[name]}")
+        except Exception as e:
+            errors[name] = str(e)
+            logger.error(f"Gmail Watch設定の更新に失敗しました ({name}): {e}")
+
+    if errors:
+        error_msg = "\n".join(f"{name}: {msg}" for name, msg in errors.items()) if accounts else errors["me"]
+
         # エラー通知 (OAuth問題の可能性を含む)
         alert_msg = f"Gmail Watch更新失敗 🚨\n```{error_msg}```"
         if "invalid_grant" in error_msg.lower() or "token" in error_msg.lower():
@@ -94,6 +137,97 @@ async def refresh_watch_subscription():
         services.slack.send_slack_alert(alert_msg, level="error")
         raise HTTPException(status_code=500, detail=error_msg)
 
+    # 成功通知
+    if accounts:
+        summary = "\n".join(f"{name}: `{history_id}`" for name, history_id in history_ids.items())
+        services.slack.send_slack_alert(f"Gmail Watch更新成功 ✅ ({len(accounts)} アカウント)\n{summary}", level="success")
+        return {"status": "ok", "historyIds": history_ids}
+
+    history_id = history_ids["me"]
+    services.slack.send_slack_alert(
+        f"Gmail Watch更新成功 ✅\nHistory ID: `{history_id}`",
+        level="success"
+    )
+    return {"status": "ok", "historyId": history_id}
+
+def _watch_mailbox() -> str:
+    """現在のアカウントのメールボックスに Watch を設定し、History ID を返します。"""
+    srv = services.gmail.get_gmail_service()
+    
+    # TARGETラベル (ID) の通知のみを受け取る設定
+    # 注意: 本番環境では config.TARGET_LABEL に 'Label_...' 形式のIDが入っていることを期待します
+    if not config.TARGET_LABEL or config.TARGET_LABEL == "TARGET":
+        label_ids = ['UNREAD']
+    elif services.accounts.current_account() is not None and not config.TARGET_LABEL.startswith("Label_"):
+        # 複数アカウントモード: ラベルIDはメールボックスごとに異なるため、名前から引く
+        label_ids = [services.gmail.get_or_create_label_id(config.TARGET_LABEL)]
+    else:
+        label_ids = [config.TARGET_LABEL]
+    
+    topic_name = f'projects/{config.PROJECT_ID}/topics/gmail-notification'
+    
+    request = {
+        'labelIds': label_ids,
+        'topicName': topic_name,
+        'labelFilterAction': 'include'
+    }
+    
+    response = services.gmail.execute(srv.users().watch(userId='me', body=request), "watch")
+    return response.get('historyId')
+
+@app.post("/sweep-leases")
+async def sweep_expired_leases():
+    """
+    Cloud Scheduler から定期的に叩かれるエンドポイント。
+    期限切れのリース (処理中に落ちたメール) を回収し、再クレームできるようにします。
+    """
+    if not config.LEASES_ENABLED:
+        raise HTTPException(status_code=400, detail="LEASES_ENABLED is not set.")
+    stats = services.leases.sweep()
+    return {"status": "ok", **stats}
+
+@app.post("/retry-errors")
+async def retry_error_messages(background_tasks: BackgroundTasks):
+    """
+    Cloud Scheduler から定期的に叩かれるエンドポイント。
+    INVOICE_ERROR のメールのうち、次回試行時刻を過ぎたものを再処理します (バックグラウンド)。
+    """
+    if not config.RETRY_ENABLED:
+        raise HTTPException(status_code=400, detail="RETRY_ENABLED is not set.")
+    background_tasks.add_task(services.retry.run_retry_cycle)
+    return {"status": "accepted"}
+
+@app.get("/search")
+async def search_invoices(q: str = "", date_from: datetime.date | None = None, date_to: datetime.date | None = None,
+                          amount_min: int | None = None, amount_max: int | None = None, limit: int = 50):
+    """
+    アーカイブ済みの請求書をローカルの検索インデックスから検索します。
+    q: 空白区切りの語 (AND)。末尾 * で前方一致、"subject:語" のようにフィールドを限定できる
+    date_from / date_to: 受信日の範囲 (YYYY-MM-DD, 両端を含む)
+    """
+    index = services.search_index.get_index()
+    if index is None:
+        raise HTTPException(status_code=400, detail="SEARCH_INDEX_ENABLED is not set.")
+    return index.search(q, date_from=date_from, date_to=date_to,
+                        amount_min=amount_min, amount_max=amount_max, limit=max(1, min(limit, 500)))
+
+@app.post("/export")
+async def export_invoices(body: ExportBody, background_tasks: BackgroundTasks):
+    """
+    月 (または期間と送信者) を指定して、請求書の ZIP と CSV の明細をバケットに書き出します (バックグラウンド)。
+    """
+    try:
+        if body.month:
+            request = services.export.ExportRequest.for_month(body.month, body.sender)
+        elif body.start and body.end and body.start <= body.end:
+            request = services.export.ExportRequest(body.start, body.end + datetime.timedelta(days=1), body.sender)
+        else:
+            raise ValueError("month or start/end is required.")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    background_tasks.add_task(services.export.run_export, request)
+    return {"status": "accepted", "label": request.label}
+
 @app.post("/report")
 async def trigger_daily_report(background_tasks: BackgroundTasks):
     """
@@ -104,6 +238,55 @@ async def trigger_daily_report(background_tasks: BackgroundTasks):
     background_tasks.add_task(report_daily.send_daily_report)
     return {"status": "accepted", "message": "Report generation started in background."}
 
+@app.post("/reload-rules")
+async def reload_filter_rules():
+    """
+    フィルタルールを即時に再読み込みします (ルールファイル更新後に叩く)。
+    """
+    if not config.RULES_SOURCE:
+        raise HTTPException(status_code=400, detail="RULES_SOURCE is not configured.")
+    services.rules.request_reload()
+    return {"status": "accepted", **services.rules.get_reload_stats()}
+
+def require_profiling_token(
+    x_profiling_token: str | None = Header(default=None, alias=config.PROFILING_ADMIN_TOKEN_HEADER)
+):
+    """プロファイリングの管理エンドポイントは共有シークレット (PROFILING_ADMIN_TOKEN) を要求する"""
+    if not config.PROFILING_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="PROFILING_ADMIN_TOKEN is not configured.")
+    if not services.profiling.authorize(x_profiling_token):
+        raise HTTPException(status_code=401, detail="Invalid profiling token.")
+
+@app.post("/admin/profiling", dependencies=[Depends(require_profiling_token)])
+async def update_profiling(req: ProfilingRequest):
+    """
+    プロファイリングを実行時に切り替えます。
+    enabled=null で環境変数 (PROFILING_ENABLED) の設定に戻します。
+    """
+    services.profiling.set_enabled(req.enabled, req.duration_seconds)
+    logger.info(f"プロファイリング設定を変更しました: enabled={req.enabled}, duration={req.duration_seconds}")
+    return {"status": "ok", **services.profiling.get_status()}
+
+@app.get("/admin/profiling", dependencies=[Depends(require_profiling_token)])
+async def get_profiling_status():
+    return services.profiling.get_status()
+
+@app.post("/admin/profiling/flush", dependencies=[Depends(require_profiling_token)])
+def flush_profiles():
+    """
+    集計済みのプロファイル (collapsed stacks) を Storage に書き出します。
+    (アップロード中にイベントループを止めないよう、スレッドプールで実行する)
+    """
+    saved = services.profiling.flush()
+    return {"status": "ok", "profiles": saved}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    """
+    Prometheus / OpenMetrics 形式のメトリクスを返します。
+    """
+    return PlainTextResponse(services.metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 if __name__ == "__main__":
     import uvicorn
     # Local dev
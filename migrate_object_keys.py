@@ -0,0 +1,105 @@
+"""
+保存済みオブジェクトを新しいキーレイアウト (BLOB_KEY_LAYOUT) へコピーするスクリプト
+
+- 元のオブジェクトは削除しない (BigQuery に記録済みの gs:// パスはそのまま有効)
+- コピーはサーバー側で行い、移行先に既に存在するものはスキップする (再実行可能)
+- 移行後の文書は services.object_keys.locate でどちらのレイアウトからでも探せる
+
+使い方:
+    python migrate_object_keys.py --start 2025-01-01 --end 2025-01-31 --layout hash_prefix --dry-run
+    python migrate_object_keys.py --start 2025-01-01 --end 2025-01-31 --layout hash_prefix --workers 16
+"""
+import argparse
+import datetime
+import logging
+import concurrent.futures
+from typing import Iterator, Tuple
+import adapters
+import config
+import services.object_keys
+
+# ロガー設定
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def _dates(start: datetime.date, end: datetime.date) -> Iterator[datetime.date]:
+    day = start
+    while day <= end:
+        yield day
+        day += datetime.timedelta(days=1)
+
+def plan_copies(storage_adapter, bucket_name: str, start: datetime.date, end: datetime.date,
+                layout: str, source_layout: str = "date") -> Iterator[Tuple[str, str]]:
+    """
+    移行元 (source_layout) のキーを列挙し、(移行元キー, 移行先キー) を返します。
+    移行元が date レイアウトの場合は日付プレフィックスで絞り込んで一覧します。
+    """
+    if source_layout == "date" or source_layout == "date_shard":
+        prefixes = [day.strftime('%Y/%m/%d/') for day in _dates(start, end)]
+    else:
+        # hash_prefix は日付で絞り込めないため全件を一覧する
+        prefixes = [""]
+
+    for prefix in prefixes:
+        for key in storage_adapter.list_files(bucket_name, prefix):
+            parsed = services.object_keys.parse_object_key(key)
+            if parsed is None or parsed[0] != source_layout:
+                continue
+            _, received_date, name = parsed
+            if not (start <= received_date <= end):
+                continue
+            received_at = datetime.datetime.combine(received_date, datetime.time())
+            destination = services.object_keys.build_object_key(received_at, name, layout)
+            if destination != key:
+                yield key, destination
+
+def _copy_one(storage_adapter, bucket_name: str, source: str, destination: str) -> str:
+    if storage_adapter.exists(bucket_name, destination):
+        return "skipped"
+    storage_adapter.copy_file(bucket_name, source, destination)
+    return "copied"
+
+def migrate(bucket_name: str, start: datetime.date, end: datetime.date, layout: str,
+            source_layout: str = "date", workers: int = 8, dry_run: bool = False) -> dict:
+    """移行を実行し、件数の集計を返します。"""
+    storage_adapter = adapters.get_storage_adapter()
+    stats = {"copied": 0, "skipped": 0, "failed": 0, "planned": 0}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for source, destination in plan_copies(storage_adapter, bucket_name, start, end, layout, source_layout):
+            stats["planned"] += 1
+            if dry_run:
+                logger.info(f"[dry-run] {source} -> {destination}")
+                continue
+            futures[pool.submit(_copy_one, storage_adapter, bucket_name, source, destination)] = source
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                stats[future.result()] += 1
+            except Exception as e:
+                stats["failed"] += 1
+                logger.error(f"コピーに失敗しました: {futures[future]} ({e})")
+
+    logger.info(f"移行完了: {stats}")
+    return stats
+
+def main():
+    parser = argparse.ArgumentParser(description="保存済みオブジェクトを新しいキーレイアウトへコピーします")
+    parser.add_argument("--start", required=True, type=datetime.date.fromisoformat, help="受信日の開始 (YYYY-MM-DD)")
+    parser.add_argument("--end", required=True, type=datetime.date.fromisoformat, help="受信日の終了 (YYYY-MM-DD)")
+    parser.add_argument("--layout", default=config.BLOB_KEY_LAYOUT, choices=services.object_keys.LAYOUTS,
+                        help="移行先のレイアウト (既定: BLOB_KEY_LAYOUT)")
+    parser.add_argument("--source-layout", default="date", choices=services.object_keys.LAYOUTS,
+                        help="移行元のレイアウト (既定: date)")
+    parser.add_argument("--bucket", default=config.BUCKET_NAME_TEMPLATE.format(config.PROJECT_ID))
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--dry-run", action="store_true", help="コピーせずに対象を表示する")
+    args = parser.parse_args()
+
+    stats = migrate(args.bucket, args.start, args.end, args.layout, args.source_layout, args.workers, args.dry_run)
+    if stats["failed"]:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
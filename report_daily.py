@@ -22,11 +22,11 @@ def get_processed_count_yesterday() -> int:
         logger.error(f"集計エラー: {e}")
         return -1
 
-def get_error_count_all() -> int:
-    """Gmailから現在の未解決エラー件数を取得"""
+def get_error_count_all(label_name: str = None) -> int:
+    """Gmailから現在の未解決エラー件数 (label_name のメール総数) を取得"""
     try:
         srv = services.gmail.get_gmail_service()
-        error_label_id = services.gmail.get_or_create_label_id(config.ERROR_LABEL_NAME)
+        error_label_id = services.gmail.get_or_create_label_id(label_name or config.ERROR_LABEL_NAME)
         
         # エラーラベル付きのメール総数
         results = srv.users().labels().get(userId='me', id=error_label_id).execute()
@@ -41,6 +41,8 @@ def send_daily_report():
     
     success_count = get_processed_count_yesterday()
     error_count = get_error_count_all()
+    # 自動再処理の上限に達したもの (人手での対応が必要)
+    dead_letter_count = get_error_count_all(config.DEAD_LETTER_LABEL_NAME) if config.RETRY_ENABLED else 0
     
     # メッセージの作成
     today_str = datetime.date.today().isoformat()
@@ -48,11 +50,15 @@ def send_daily_report():
     
     status_emoji = "🟢" if error_count == 0 else "🔴"
     
+    dead_letter_line = ""
+    if config.RETRY_ENABLED:
+        dead_letter_line = f"\n☠️ 再処理上限 ({config.DEAD_LETTER_LABEL_NAME}): *{dead_letter_count if dead_letter_count >= 0 else '取得失敗'}* 件 (現在)"
+
     report_text = f"""*📊 Invoice Process Daily Report ({today_str})*
 対象期間: {yesterday_str}
 
 {status_emoji} 成功件数: *{success_count if success_count >=0 else '取得失敗'}* 件 (昨日)
-🔴 未解決エラー: *{error_count if error_count >=0 else '取得失敗'}* 件 (現在)
+🔴 未解決エラー: *{error_count if error_count >=0 else '取得失敗'}* 件 (現在){dead_letter_line}
 
 <https://mail.google.com/mail/u/0/#search/label%3A{config.ERROR_LABEL_NAME}|🔗 Gmailでエラーを確認>
 <https://console.cloud.google.com/logs/query?project={config.PROJECT_ID}|🔗 Cloud Loggingでログを確認>"""
@@ -0,0 +1,159 @@
+"""
+複数メールボックス (アカウント) の管理
+
+- ACCOUNTS_FILE (ローカルファイル or gs://bucket/path.json) にアカウント一覧を定義する
+- 未設定時は従来どおり config の認証情報で1つのメールボックスを扱う (単一アカウントモード)
+- Gmail API 呼び出しは「現在のアカウント」(use_account で切り替え) の認証情報・ラベルID・クォータで行う
+
+ファイル形式:
+{
+  "accounts": [
+    {"email": "ap@example.com", "refresh_token_env": "GMAIL_REFRESH_TOKEN_AP"},
+    {"email": "billing@example.com", "delegated": true, "quota_units_per_second": 100}
+  ]
+}
+
+- refresh_token / refresh_token_env: OAuth リフレッシュトークン (または格納した環境変数名)
+- client_id / client_secret: 省略時は GMAIL_CLIENT_ID / GMAIL_CLIENT_SECRET
+- delegated: true の場合、ADC のサービスアカウントでドメイン全体の委任を使う
+- quota_units_per_second: 省略時は GMAIL_QUOTA_UNITS_PER_SECOND
+"""
+import os
+import json
+import logging
+import threading
+import contextlib
+import contextvars
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import config
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class Account:
+    email: str
+    refresh_token: Optional[str] = None
+    client_id: Optional[str] = None
+    client_secret: Optional[str] = None
+    delegated: bool = False
+    quota_units_per_second: Optional[float] = None
+
+    @property
+    def key(self) -> str:
+        return self.email.lower()
+
+def _parse_account(item: dict) -> Account:
+    email = item.get("email")
+    if not email:
+        raise ValueError(f"Account entry without email: {item}")
+    refresh_token = item.get("refresh_token")
+    if not refresh_token and item.get("refresh_token_env"):
+        refresh_token = os.getenv(item["refresh_token_env"])
+    delegated = bool(item.get("delegated", False))
+    if not refresh_token and not delegated:
+        raise ValueError(f"Account {email} needs refresh_token, refresh_token_env or delegated")
+    quota = item.get("quota_units_per_second")
+    return Account(
+        email=email,
+        refresh_token=refresh_token,
+        client_id=item.get("client_id"),
+        client_secret=item.get("client_secret"),
+        delegated=delegated,
+        quota_units_per_second=float(quota) if quota is not None else None,
+    )
+
+def parse_accounts(raw: bytes) -> List[Account]:
+    """アカウント定義 (JSON) を読み込みます。"""
+    doc = json.loads(raw)
+    items = doc.get("accounts", []) if isinstance(doc, dict) else doc
+    accounts = [_parse_account(item) for item in items]
+    keys = [a.key for a in accounts]
+    if len(set(keys)) != len(keys):
+        raise ValueError("Duplicate email in accounts file")
+    return accounts
+
+# --- 内部状態 ---
+_accounts: Optional[Dict[str, Account]] = None
+_load_lock = threading.Lock()
+_current: contextvars.ContextVar[Optional[Account]] = contextvars.ContextVar("gmail_account", default=None)
+
+def get_accounts() -> List[Account]:
+    """
+    設定されたアカウント一覧を返します (初回のみ ACCOUNTS_FILE を読み込む)。
+    ACCOUNTS_FILE 未設定時は空リスト (単一アカウントモード)。
+    """
+    global _accounts
+    if _accounts is None:
+        with _load_lock:
+            if _accounts is None:
+                if config.ACCOUNTS_FILE:
+                    import services.rules
+                    _, raw = services.rules._read_source(config.ACCOUNTS_FILE, None)
+                    accounts = parse_accounts(raw)
+                    logger.info(f"{len(accounts)} 件のアカウントを読み込みました: {config.ACCOUNTS_FILE}")
+                else:
+                    accounts = []
+                _accounts = {a.key: a for a in accounts}
+    return list(_accounts.values())
+
+def set_accounts(accounts: Optional[List[Account]]):
+    """アカウント一覧を差し替えます (None で次回 ACCOUNTS_FILE から読み直す)。"""
+    global _accounts
+    with _load_lock:
+        _accounts = None if accounts is None else {a.key: a for a in accounts}
+
+def is_multi_account() -> bool:
+    return bool(get_accounts())
+
+def get_account(email: Optional[str]) -> Optional[Account]:
+    """メールアドレスからアカウントを引きます (大文字小文字は区別しない)。"""
+    if not email:
+        return None
+    get_accounts()
+    return _accounts.get(email.lower())
+
+def current_account() -> Optional[Account]:
+    """現在のアカウント (単一アカウントモードでは None) を返します。"""
+    return _current.get()
+
+@contextlib.contextmanager
+def use_account(account: Optional[Account]):
+    """このブロック内の Gmail API 呼び出しを指定アカウントで行います。"""
+    token = _current.set(account)
+    try:
+        yield account
+    finally:
+        _current.reset(token)
+
+def account_for_message(message_data: dict) -> Optional[Account]:
+    """クレーム時に付与した 'account' からアカウントを引きます。"""
+    email = message_data.get('account')
+    if not email:
+        return None
+    account = get_account(email)
+    if account is None:
+        raise KeyError(f"Unknown account: {email}")
+    return account
+
+def accounts_for_notification(decoded_data: Optional[str]) -> List[Optional[Account]]:
+    """
+    Gmail のプッシュ通知 (Pub/Sub のデータ部) から対象のアカウントを決めます。
+
+    - 単一アカウントモード: [None]
+    - emailAddress が設定済みのアカウント: そのアカウントのみ
+    - emailAddress が未登録: [] (処理しない)
+    - データが読めない場合: 全アカウント (取りこぼさないため)
+    """
+    accounts = get_accounts()
+    if not accounts:
+        return [None]
+    try:
+        email = json.loads(decoded_data)["emailAddress"]
+    except (TypeError, ValueError, KeyError):
+        return accounts
+    account = get_account(email)
+    if account is None:
+        logger.warning(f"未登録のメールボックスからの通知です: {email}")
+        return []
+    return [account]
@@ -0,0 +1,139 @@
+"""
+添付ファイル処理のメモリ予算 (アドミッション制御)
+
+添付ファイルは 20KB〜25MB と幅があるが、並行数は内容に関係なく固定のため、
+大きな請求書の束が同時に届くと 512MiB の Cloud Run インスタンスがメモリ不足で落ちる。
+ダウンロードの前に Attachment.size から見積もったバイト数を予約し、アップロード後に解放する。
+
+- 予算に空きがなければ待つ (落ちる代わりに待たせる)
+- 空きに収まる小さな添付ファイルは、大きな添付ファイルの待ちを追い越して先に進める
+  (ただし STARVATION_SECONDS 以上待っている予約があれば、後から来た予約は追い越さない)
+- 予算を超える添付ファイルは予算全体を予約する (単独で処理する)
+- MEMORY_BUDGET_BYTES=0 の場合は何もしない
+"""
+import time
+import logging
+import threading
+import contextlib
+from collections import OrderedDict
+from typing import Iterator, Optional
+import services.metrics
+import config
+
+logger = logging.getLogger(__name__)
+
+# ダウンロード中の実メモリの見積もり倍率 (base64 の応答 + デコード後のデータ)
+MEMORY_OVERHEAD_FACTOR = 2.5
+
+# これ以上待っている予約があれば、小さな予約にも追い越させない
+STARVATION_SECONDS = 30.0
+
+# 予約を持ったまま追加で予約する場合 (ZIP メンバーの読み込みなど) の待ち時間の上限
+NESTED_RESERVE_TIMEOUT_SECONDS = 30.0
+
+class MemoryBudget:
+    def __init__(self, capacity: int, starvation_seconds: float = STARVATION_SECONDS, clock=time.monotonic):
+        self.capacity = capacity
+        self.starvation_seconds = starvation_seconds
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._reserved = 0
+        # 待っている予約 (到着順): id -> 待ち始めた時刻
+        self._waiters: "OrderedDict[int, float]" = OrderedDict()
+        self._next_id = 0
+
+    @property
+    def reserved(self) -> int:
+        return self._reserved
+
+    def _admissible(self, waiter_id: int, nbytes: int) -> bool:
+        if self._reserved + nbytes > self.capacity:
+            return False
+        # 長く待っている予約より後から来た予約は、その予約が通るまで待つ
+        now = self._clock()
+        for other_id, since in self._waiters.items():
+            if other_id == waiter_id:
+                return True
+            if now - since >= self.starvation_seconds:
+                return False
+        return True
+
+    def acquire(self, nbytes: int, timeout: Optional[float] = None) -> int:
+        """
+        nbytes を予約します (空きができるまで待つ)。
+
+        Returns:
+            実際に予約したバイト数 (release に渡す)
+        Raises:
+            TimeoutError: timeout 秒以内に予約できなかった場合
+        """
+        nbytes = max(0, min(nbytes, self.capacity))
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            waiter_id = self._next_id
+            self._next_id += 1
+            self._waiters[waiter_id] = self._clock()
+            try:
+                while not self._admissible(waiter_id, nbytes):
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise TimeoutError(f"メモリ予算の予約がタイムアウトしました ({nbytes} bytes)")
+                    # 追い越し禁止の判定は時間経過で変わるため、定期的に見直す
+                    self._cond.wait(min(remaining, 1.0) if remaining is not None else 1.0)
+                self._reserved += nbytes
+            finally:
+                del self._waiters[waiter_id]
+                # 先頭の予約が抜けると後続が通れる場合がある
+                self._cond.notify_all()
+        services.metrics.MEMORY_RESERVED_BYTES.set(self._reserved)
+        return nbytes
+
+    def release(self, nbytes: int):
+        with self._cond:
+            self._reserved -= nbytes
+            self._cond.notify_all()
+        services.metrics.MEMORY_RESERVED_BYTES.set(self._reserved)
+
+# --- 内部状態 ---
+_budget: Optional[MemoryBudget] = None
+_budget_lock = threading.Lock()
+
+def get_budget() -> Optional[MemoryBudget]:
+    """プロセス全体のメモリ予算を返します (MEMORY_BUDGET_BYTES=0 の場合は None)。"""
+    global _budget
+    if config.MEMORY_BUDGET_BYTES <= 0:
+        return None
+    if _budget is None:
+        with _budget_lock:
+            if _budget is None:
+                _budget = MemoryBudget(config.MEMORY_BUDGET_BYTES)
+    return _budget
+
+def set_budget(budget: Optional[MemoryBudget]):
+    """メモリ予算を差し替えます (テスト用, None で MEMORY_BUDGET_BYTES から作り直す)。"""
+    global _budget
+    with _budget_lock:
+        _budget = budget
+
+@contextlib.contextmanager
+def reserve(size: int, timeout: Optional[float] = None) -> Iterator[int]:
+    """
+    添付ファイル1件分 (size はデコード後のバイト数) のメモリを予約し、ブロックを抜けたら解放します。
+
+    Raises:
+        TimeoutError: timeout 秒以内に予約できなかった場合
+    """
+    budget = get_budget()
+    if budget is None:
+        yield 0
+        return
+    start = time.perf_counter()
+    reserved = budget.acquire(int(size * MEMORY_OVERHEAD_FACTOR), timeout=timeout)
+    waited = time.perf_counter() - start
+    services.metrics.ADMISSION_WAIT_SECONDS.observe(waited)
+    if waited >= 1.0:
+        logger.info("メモリ予算の空きを %.1f 秒待ちました (%s bytes)", waited, reserved)
+    try:
+        yield reserved
+    finally:
+        budget.release(reserved)
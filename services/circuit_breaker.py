@@ -0,0 +1,292 @@
+"""
+依存サービスごとのサーキットブレーカー
+
+BigQuery や GCS の障害中に、クレームしたメールが添付ファイルをダウンロードしては同じ箇所で失敗し、
+INVOICE_ERROR が量産される (Gmail のクォータも無駄に消費する) のを防ぐ。
+
+- 状態: closed (通常) → 連続 CIRCUIT_FAILURE_THRESHOLD 回の失敗で open (呼び出しを即座に拒否)
+        → CIRCUIT_RESET_SECONDS 経過後 half_open (試行を1件だけ通す) → 成功で closed / 失敗で open
+- 失敗として数えるのは依存サービス側の障害 (5xx, 429, 接続エラー, タイムアウト) のみ
+  (404 などの 4xx は呼び出し側の問題のため、サービスは生きているとみなす)
+- 対象: gmail, storage, bigquery, slack
+- CIRCUIT_BREAKER_ENABLED=false の場合は何もしない
+"""
+import io
+import time
+import inspect
+import logging
+import threading
+import contextlib
+from typing import Dict, Iterable, Optional
+import services.metrics
+import config
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# メトリクス用の数値 (invoice_circuit_state)
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# 処理に必須の依存サービス (どれかが open ならクレームを止める)
+PROCESSING_DEPENDENCIES = ("gmail", "storage", "bigquery")
+
+class CircuitOpenError(Exception):
+    """依存サービスのブレーカーが open のため、呼び出しを拒否した"""
+
+    def __init__(self, name: str, retry_after: float = 0.0):
+        super().__init__(f"circuit '{name}' is open (retry after {retry_after:.0f}s)")
+        self.name = name
+        self.retry_after = retry_after
+
+def is_dependency_failure(exc: BaseException) -> bool:
+    """依存サービス側の障害による例外かどうか"""
+    if isinstance(exc, CircuitOpenError):
+        return False
+    status = getattr(getattr(exc, "resp", None), "status", None)  # googleapiclient.errors.HttpError
+    if status is None:
+        status = getattr(exc, "code", None)  # google.api_core.exceptions
+    if status is None:
+        status = getattr(getattr(exc, "response", None), "status_code", None)  # requests
+    try:
+        status = int(status) if status is not None else None
+    except (TypeError, ValueError):
+        status = None
+    if status is not None:
+        return status >= 500 or status == 429
+    # ステータスの無い例外 (接続エラー・タイムアウトなど) は障害とみなす
+    return True
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_threshold: int, reset_seconds: float, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+        services.metrics.CIRCUIT_STATE.set(STATE_VALUES[CLOSED], dependency=name)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self) -> str:
+        if self._state == OPEN and self._clock() - self._opened_at >= self.reset_seconds:
+            self._transition(HALF_OPEN)
+        return self._state
+
+    def _transition(self, state: str):
+        if state == self._state:
+            return
+        logger.warning(f"サーキットブレーカー '{self.name}': {self._state} -> {state}")
+        self._state = state
+        if state == OPEN:
+            self._opened_at = self._clock()
+        if state != HALF_OPEN:
+            self._probing = False
+        services.metrics.CIRCUIT_STATE.set(STATE_VALUES[state], dependency=self.name)
+        services.metrics.CIRCUIT_TRANSITIONS.inc(dependency=self.name, state=state)
+
+    def is_open(self) -> bool:
+        """呼び出しを拒否する状態か (half_open は試行を受け付けるため False)"""
+        return self.state == OPEN
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._current_state() != OPEN:
+                return 0.0
+            return max(0.0, self.reset_seconds - (self._clock() - self._opened_at))
+
+    def allow(self) -> bool:
+        """呼び出してよければ True (half_open では同時に1件だけ試行を通す)"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+        services.metrics.CIRCUIT_REJECTED.inc(dependency=self.name)
+        return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._transition(CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._transition(OPEN)
+
+    def record_release(self):
+        """試行の結果が判定できなかった場合 (呼び出し側の問題) に試行枠を返す"""
+        with self._lock:
+            self._probing = False
+
+    @contextlib.contextmanager
+    def guard(self):
+        """
+        ブロック内の呼び出しを保護します。
+        ブロック内で outcome.deferred = True にした場合、正常終了しても成功として数えない
+        (実際の I/O が後で行われる遅延ストリーム・ジェネレーターを返した場合)。
+
+        Raises:
+            CircuitOpenError: open の場合 (ブロックは実行しない)
+        """
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_after())
+        outcome = _Outcome()
+        try:
+            yield outcome
+        except Exception as e:
+            if is_dependency_failure(e):
+                self.record_failure()
+            else:
+                # 4xx などはサービスが応答できている
+                self.record_success()
+            raise
+        except BaseException:
+            self.record_release()
+            raise
+        if outcome.deferred:
+            self.record_release()
+        else:
+            self.record_success()
+
+class _Outcome:
+    __slots__ = ("deferred",)
+
+    def __init__(self):
+        self.deferred = False
+
+# --- 内部状態 ---
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name: str) -> CircuitBreaker:
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(name, config.CIRCUIT_FAILURE_THRESHOLD, config.CIRCUIT_RESET_SECONDS)
+                _breakers[name] = breaker
+    return breaker
+
+def reset():
+    """全てのブレーカーを破棄します (テスト用)。"""
+    with _breakers_lock:
+        _breakers.clear()
+
+@contextlib.contextmanager
+def guard(name: str):
+    """依存サービス name の呼び出しを保護します (CIRCUIT_BREAKER_ENABLED=false の場合は素通し)。"""
+    if not config.CIRCUIT_BREAKER_ENABLED:
+        yield _Outcome()
+        return
+    with get_breaker(name).guard() as outcome:
+        yield outcome
+
+def open_dependencies(names: Iterable[str] = PROCESSING_DEPENDENCIES) -> list:
+    """open 状態の依存サービス名を返します。"""
+    if not config.CIRCUIT_BREAKER_ENABLED:
+        return []
+    return [name for name in names if get_breaker(name).is_open()]
+
+def check_available(names: Iterable[str] = PROCESSING_DEPENDENCIES):
+    """
+    依存サービスが open でないことを確認します (処理を始める前に呼ぶ)。
+
+    Raises:
+        CircuitOpenError: いずれかが open の場合
+    """
+    for name in open_dependencies(names):
+        raise CircuitOpenError(name, get_breaker(name).retry_after())
+
+def get_states() -> Dict[str, str]:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {b.name: b.state for b in breakers}
+
+_END = object()
+
+def _guarded_iter(iterator, name: str):
+    """ジェネレーターの各要素の取得 (ページ単位の API 呼び出しなど) を保護します。"""
+    while True:
+        with guard(name):
+            item = next(iterator, _END)
+        if item is _END:
+            return
+        yield item
+
+class _GuardedStream:
+    """ストリームの読み出し (遅延して行われるダウンロード) を保護するラッパー"""
+
+    def __init__(self, stream, name: str):
+        self._stream = stream
+        self._name = name
+
+    def _guarded(self, method, *args):
+        with guard(self._name):
+            return method(*args)
+
+    def read(self, *args):
+        return self._guarded(self._stream.read, *args)
+
+    def read1(self, *args):
+        return self._guarded(self._stream.read1, *args)
+
+    def readinto(self, buffer):
+        return self._guarded(self._stream.readinto, buffer)
+
+    def readline(self, *args):
+        return self._guarded(self._stream.readline, *args)
+
+    def __iter__(self):
+        return _guarded_iter(iter(self._stream), self._name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stream.close()
+        return False
+
+    def __getattr__(self, attr):
+        return getattr(self._stream, attr)
+
+class GuardedAdapter:
+    """
+    アダプターのメソッド呼び出しをサーキットブレーカーで保護するラッパー。
+    ジェネレーター (query_rows, list_files) やストリーム (open_file) を返すメソッドは、
+    呼び出し後に行われる反復・読み出しを保護する (呼び出し自体は成功として数えない)。
+    """
+
+    def __init__(self, adapter, name: str):
+        self._adapter = adapter
+        self._name = name
+
+    def __getattr__(self, attr):
+        value = getattr(self._adapter, attr)
+        if not callable(value) or attr.startswith("_"):
+            return value
+
+        def call(*args, **kwargs):
+            with guard(self._name) as outcome:
+                result = value(*args, **kwargs)
+                if inspect.isgenerator(result):
+                    outcome.deferred = True
+                    result = _guarded_iter(result, self._name)
+                elif isinstance(result, io.IOBase):
+                    outcome.deferred = True
+                    result = _GuardedStream(result, self._name)
+            return result
+        return call
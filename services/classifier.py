@@ -0,0 +1,143 @@
+"""
+添付ファイル分類モジュール
+署名ロゴ・トラッキングピクセル・本文埋め込み画像など、請求書ではない添付ファイルを
+ダウンロード / アップロード / BigQuery 記録の前に除外する
+
+- 判定材料: パーサーの MIME タイプ・ファイル名・サイズ・Content-Disposition と、実データ先頭のマジックナンバー
+- 判定結果: archive (保存) / skip (除外) / expand (アーカイブを展開)
+- ポリシーは送信者ごとにルールファイル (services.rules の attachment_policy) で上書きできる
+- メタデータだけで除外できるものはダウンロード前に判定し、それ以外はダウンロード後に
+  マジックナンバーで確定する (拡張子と中身が食い違うファイルも検出できる)
+"""
+import os
+import re
+import logging
+from dataclasses import dataclass
+from typing import Optional
+import services.rules
+import config
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE = "archive"
+SKIP = "skip"
+EXPAND = "expand"
+
+# マジックナンバー判定に使う先頭バイト数
+HEAD_BYTES = 64
+
+# (先頭バイト, 種別)
+_MAGIC = (
+    (b"%PDF-", "pdf"),
+    (b"PK\x03\x04", "zip"),
+    (b"PK\x05\x06", "zip"),  # 空の ZIP
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+    (b"BM", "bmp"),
+    (b"II*\x00", "tiff"),
+    (b"MM\x00*", "tiff"),
+    (b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "ole"),  # 旧 Office (xls/doc)
+    (b"BEGIN:VCALENDAR", "ics"),
+    (b"BEGIN:VCARD", "vcf"),
+)
+
+_EXTENSIONS = {
+    ".pdf": "pdf", ".zip": "zip",
+    ".png": "png", ".jpg": "jpeg", ".jpeg": "jpeg", ".gif": "gif", ".bmp": "bmp",
+    ".tif": "tiff", ".tiff": "tiff", ".webp": "webp", ".svg": "svg",
+    ".xls": "ole", ".doc": "ole", ".xlsx": "zip", ".docx": "zip",
+    ".xml": "xml", ".html": "html", ".htm": "html",
+    ".ics": "ics", ".vcf": "vcf", ".csv": "text", ".txt": "text",
+}
+
+_MIME_TYPES = {
+    "application/pdf": "pdf",
+    "application/zip": "zip", "application/x-zip-compressed": "zip",
+    "image/png": "png", "image/jpeg": "jpeg", "image/gif": "gif", "image/bmp": "bmp",
+    "image/tiff": "tiff", "image/webp": "webp", "image/svg+xml": "svg",
+    "application/xml": "xml", "text/xml": "xml", "text/html": "html",
+    "text/calendar": "ics", "text/vcard": "vcf", "text/x-vcard": "vcf",
+}
+
+IMAGE_KINDS = frozenset(("png", "jpeg", "gif", "bmp", "tiff", "webp", "svg"))
+# Office Open XML (xlsx/docx) も ZIP だが、これは展開しない
+OOXML_EXTENSIONS = frozenset((".xlsx", ".docx", ".pptx"))
+
+# Outlook などが本文埋め込み画像に付けるファイル名 (image001.png, Outlook-abc123.png など)
+_INLINE_NAME_RE = re.compile(r"^(image\d{3}|outlook-[\w-]+)\.(png|jpe?g|gif|bmp)$", re.IGNORECASE)
+
+@dataclass(frozen=True)
+class Classification:
+    decision: str
+    kind: str
+    reason: str
+
+def detect_kind(head: bytes) -> Optional[str]:
+    """先頭バイトのマジックナンバーから種別を判定します (不明なら None)。"""
+    if head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "webp"
+    for magic, kind in _MAGIC:
+        if head.startswith(magic):
+            return kind
+    stripped = head.lstrip(b"\xef\xbb\xbf \t\r\n").lower()
+    if stripped.startswith(b"<?xml"):
+        return "xml"
+    if stripped.startswith(b"<!doctype html") or stripped.startswith(b"<html"):
+        return "html"
+    return None
+
+def kind_from_metadata(filename: str, mime_type: str) -> str:
+    """ファイル名の拡張子・MIME タイプから種別を推定します。"""
+    ext = os.path.splitext(filename)[1].lower()
+    return _EXTENSIONS.get(ext) or _MIME_TYPES.get((mime_type or "").lower()) or "unknown"
+
+def get_policy(sender: str, subject: str) -> services.rules.AttachmentPolicy:
+    """送信者に適用されるポリシーを返します (ルールに指定がない項目は既定値で補完)。"""
+    policy = None
+    rule_set = services.rules.get_active_rule_set()
+    if rule_set is not None:
+        rule = rule_set.match(sender, subject)
+        if rule is not None:
+            policy = rule.attachment_policy
+    policy = policy or services.rules.AttachmentPolicy()
+    return services.rules.AttachmentPolicy(
+        skip_inline_images=config.CLASSIFIER_SKIP_INLINE_IMAGES if policy.skip_inline_images is None else policy.skip_inline_images,
+        min_image_bytes=config.CLASSIFIER_MIN_IMAGE_BYTES if policy.min_image_bytes is None else policy.min_image_bytes,
+        archive_types=policy.archive_types,
+        skip_types=policy.skip_types or tuple(config.CLASSIFIER_SKIP_TYPES),
+        expand_archives=config.CLASSIFIER_EXPAND_ARCHIVES if policy.expand_archives is None else policy.expand_archives
+    )
+
+def classify(policy: services.rules.AttachmentPolicy, filename: str, mime_type: str, size: int,
+             inline: bool = False, head: Optional[bytes] = None) -> Classification:
+    """
+    添付ファイルを分類します。
+
+    Args:
+        policy: get_policy で取得したポリシー
+        head: 実データの先頭バイト (ダウンロード前は None。メタデータのみで判定)
+    """
+    declared = kind_from_metadata(filename, mime_type)
+    detected = detect_kind(head) if head else None
+    # 中身が分かる場合はマジックナンバーを優先 (invoice.pdf という名前の PNG など)
+    kind = detected or declared
+    if detected and declared not in ("unknown", detected):
+        logger.info(f"拡張子/MIMEと内容が一致しません: {filename} ({declared} -> {detected})")
+
+    if kind in policy.skip_types:
+        return Classification(SKIP, kind, "skip_type")
+    if kind in policy.archive_types:
+        return Classification(ARCHIVE, kind, "archive_type")
+
+    if kind in IMAGE_KINDS:
+        if policy.skip_inline_images and (inline or _INLINE_NAME_RE.match(filename)):
+            return Classification(SKIP, kind, "inline_image")
+        if size < policy.min_image_bytes:
+            return Classification(SKIP, kind, "small_image")
+
+    if kind == "zip" and os.path.splitext(filename)[1].lower() not in OOXML_EXTENSIONS:
+        if policy.expand_archives:
+            return Classification(EXPAND, kind, "archive")
+    return Classification(ARCHIVE, kind, "default")
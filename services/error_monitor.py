@@ -4,108 +4,197 @@
 
 - 通常時: 日次レポートのみ
 - 異常時: エラー率が閾値を超えたら即座にSlack通知（ただし1回だけ）
+- 集計: 固定幅バケットのリングバッファによるスライディングウィンドウ
+  (ステージ別・エラー種別ごとの内訳付き)
 """
 import time
 import logging
 import threading
+from collections import Counter
+from typing import Optional
 import config
 
 logger = logging.getLogger(__name__)
 
 # --- 設定値 ---
 ERROR_RATE_THRESHOLD = 0.05  # 5%を超えたらアラート
-CHECK_WINDOW_SECONDS = 1800  # 30分のウィンドウ
+CHECK_WINDOW_SECONDS = 1800  # 30分のスライディングウィンドウ
+BUCKET_SECONDS = 60  # ウィンドウを構成するバケット幅 (1分)
+MIN_VOLUME = 10  # 率を計算するのに必要な最低処理件数
 ALERT_COOLDOWN_SECONDS = 1800  # アラート後30分はクールダウン
 
+# エラー発生箇所 (process_email_task の各ステージ)
+STAGES = ("fetch", "download", "upload", "extract", "expand", "insert", "label")
+
+_NUM_BUCKETS = max(1, CHECK_WINDOW_SECONDS // BUCKET_SECONDS)
+
+class _Bucket:
+    """1バケット分 (BUCKET_SECONDS) の集計"""
+    __slots__ = ("epoch", "processed", "errors", "by_stage", "by_class")
+
+    def __init__(self):
+        self.epoch = -1
+        self.processed = 0
+        self.errors = 0
+        self.by_stage = Counter()
+        self.by_class = Counter()
+
 # --- 内部状態 ---
+# リングバッファ + ウィンドウ全体の累計 (記録・参照とも O(1))
 _lock = threading.Lock()
+_buckets = [_Bucket() for _ in range(_NUM_BUCKETS)]
+_head_epoch = int(time.time() // BUCKET_SECONDS)
 _processed_count = 0
 _error_count = 0
-_window_start_time = time.time()
+_stage_counts = Counter()
+_class_counts = Counter()
+_start_time = time.time()
 _last_alert_time = 0
 
 def record_success():
     """処理成功を記録"""
     global _processed_count
     with _lock:
-        _maybe_reset_window()
+        bucket = _advance(time.time())
+        bucket.processed += 1
         _processed_count += 1
 
-def record_error():
+def record_error(stage: Optional[str] = None, error_class: Optional[str] = None):
     """
     処理エラーを記録し、必要に応じてアラートを送信
+
+    Args:
+        stage: エラーが発生したステージ (STAGES のいずれか)
+        error_class: 例外クラス名 (例: "HttpError")
     """
     global _error_count
     with _lock:
-        _maybe_reset_window()
+        bucket = _advance(time.time())
+        bucket.errors += 1
         _error_count += 1
-        _check_and_alert()
+        if stage:
+            bucket.by_stage[stage] += 1
+            _stage_counts[stage] += 1
+        if error_class:
+            bucket.by_class[error_class] += 1
+            _class_counts[error_class] += 1
+        alert = _check_and_alert()
 
-def _maybe_reset_window():
-    """ウィンドウ期間が過ぎていたらカウンターをリセット"""
-    global _processed_count, _error_count, _window_start_time
-    now = time.time()
-    if now - _window_start_time > CHECK_WINDOW_SECONDS:
-        logger.debug(f"ウィンドウリセット: 処理={_processed_count}, エラー={_error_count}")
-        _processed_count = 0
-        _error_count = 0
-        _window_start_time = now
-
-def _check_and_alert():
-    """エラー率をチェックし、必要ならアラートを送信"""
+    # 送信はロックの外で行う (他のワーカーを待たせない)
+    if alert:
+        _send_threshold_alert(*alert)
+
+def _expire(bucket: _Bucket):
+    """バケットの値を累計から差し引いて空にする"""
+    global _processed_count, _error_count
+    _processed_count -= bucket.processed
+    _error_count -= bucket.errors
+    _stage_counts.subtract(bucket.by_stage)
+    _class_counts.subtract(bucket.by_class)
+    bucket.processed = 0
+    bucket.errors = 0
+    bucket.by_stage.clear()
+    bucket.by_class.clear()
+
+def _advance(now: float) -> _Bucket:
+    """
+    ウィンドウを現在時刻まで進め、ウィンドウ外になったバケットを失効させる。
+    各バケットは1回しか失効しないため、償却 O(1)。
+
+    Returns:
+        現在時刻に対応するバケット
+    """
+    global _head_epoch
+    epoch = int(now // BUCKET_SECONDS)
+    if epoch > _head_epoch:
+        for e in range(max(_head_epoch + 1, epoch - _NUM_BUCKETS + 1), epoch + 1):
+            bucket = _buckets[e % _NUM_BUCKETS]
+            _expire(bucket)
+            bucket.epoch = e
+        _head_epoch = epoch
+    return _buckets[_head_epoch % _NUM_BUCKETS]
+
+def _check_and_alert() -> Optional[tuple]:
+    """
+    エラー率をチェックし、アラートが必要なら送信内容を返す (_lock 保持中に呼ぶ)
+
+    Returns:
+        _send_threshold_alert の引数タプル (不要なら None)
+    """
     global _last_alert_time
     
     # 最低限の処理件数がないと率を計算しても意味がない
     total = _processed_count + _error_count
-    if total < 10:
-        return
+    if total < MIN_VOLUME:
+        return None
     
     error_rate = _error_count / total
     
     # 閾値を超えているか
     if error_rate < ERROR_RATE_THRESHOLD:
-        return
+        return None
     
     # クールダウン中か
     now = time.time()
     if now - _last_alert_time < ALERT_COOLDOWN_SECONDS:
-        return
+        return None
     
-    # アラート送信
+    # アラート送信 (クールダウンはここで確定させる)
     _last_alert_time = now
-    _send_threshold_alert(error_rate, _error_count, total)
+    return (error_rate, _error_count, total, dict(+_stage_counts), dict(+_class_counts))
+
+def _format_breakdown(counts: dict, total: int) -> str:
+    """内訳を件数の多い順に整形"""
+    if not counts:
+        return "  (なし)"
+    lines = []
+    for key, count in sorted(counts.items(), key=lambda kv: -kv[1]):
+        lines.append(f"  ◦ {key}: {count} 件 ({count / total:.1%})")
+    return "\n".join(lines)
 
-def _send_threshold_alert(error_rate: float, error_count: int, total: int):
+def _send_threshold_alert(error_rate: float, error_count: int, total: int,
+                          by_stage: Optional[dict] = None, by_class: Optional[dict] = None):
     """閾値超過アラートを送信"""
     try:
         import services.slack
         
         alert_msg = f"""*⚠️ エラー率異常検知*
 
-直近1時間の統計:
+直近{CHECK_WINDOW_SECONDS // 60}分間の統計:
 • 処理件数: {total} 件
 • エラー件数: {error_count} 件
 • エラー率: *{error_rate:.1%}* (閾値: {ERROR_RATE_THRESHOLD:.0%})
+• ステージ別:
+{_format_breakdown(by_stage or {}, total)}
+• エラー種別:
+{_format_breakdown(by_class or {}, total)}
 
 *システム障害の可能性があります。Cloud Loggingを確認してください。*
 
 <https://console.cloud.google.com/logs/query?project={config.PROJECT_ID}|🔗 Cloud Loggingを開く>
 <https://mail.google.com/mail/u/0/#search/label%3A{config.ERROR_LABEL_NAME}|🔗 Gmailでエラーを確認>"""
         
-        services.slack.send_slack_alert(alert_msg, level="error")
-        logger.warning(f"閾値アラートを送信しました: エラー率 {error_rate:.1%}")
+        services.slack.enqueue_slack_alert(alert_msg, level="error", dedup_key="error_rate_threshold")
+        logger.warning(f"閾値アラートを送信キューに登録しました: エラー率 {error_rate:.1%}")
         
     except Exception as e:
         logger.error(f"閾値アラートの送信に失敗: {e}")
 
 def get_current_stats() -> dict:
-    """現在のウィンドウ統計を取得（デバッグ用）"""
+    """現在のスライディングウィンドウ統計を取得（デバッグ・メトリクス用）"""
     with _lock:
+        now = time.time()
+        _advance(now)
         total = _processed_count + _error_count
         return {
             "processed": _processed_count,
             "errors": _error_count,
             "total": total,
             "error_rate": _error_count / total if total > 0 else 0,
-            "window_age_seconds": time.time() - _window_start_time
+            "errors_by_stage": dict(+_stage_counts),
+            "error_rate_by_stage": {k: v / total for k, v in (+_stage_counts).items()},
+            "errors_by_class": dict(+_class_counts),
+            "error_rate_by_class": {k: v / total for k, v in (+_class_counts).items()},
+            "window_seconds": CHECK_WINDOW_SECONDS,
+            "window_age_seconds": min(now - _start_time, CHECK_WINDOW_SECONDS)
         }
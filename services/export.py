@@ -0,0 +1,208 @@
+"""
+アーカイブ済み請求書のエクスポート (月次締め用)
+
+経理が月末締めで請求書を1件ずつダウンロードしたり、SQL の結果から GCS のリンクを辿ったりせずに済むよう、
+条件 (月、または期間と送信者) に一致する行を invoice_log から引き、
+元ファイルをまとめた ZIP と CSV の明細 (manifest) をバケット (ローカルでは local_storage) に書き出す。
+
+- 元ファイルはストレージアダプター経由で EXPORT_WORKERS 件ずつ並行して取得する
+  (取得した内容は一時ファイルにスプールし、メモリ上に溜めない)
+- ZIP はパイプ経由でアップロードしながら書き出す (バンドル全体をメモリにもディスクにも置かない)
+- 明細は ZIP の末尾 (manifest.csv) と、ZIP と同じ場所の .csv に書き出す
+- 取得できなかったファイルも明細に status 付きで記録し、エクスポート自体は続行する
+"""
+import io
+import os
+import re
+import csv
+import shutil
+import zipfile
+import logging
+import datetime
+import tempfile
+import threading
+import concurrent.futures
+from dataclasses import dataclass
+from typing import IO, Iterator, List, Optional, Tuple
+import services.metrics
+import adapters
+import config
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_NAME = "manifest.csv"
+MANIFEST_COLUMNS = ("zip_path", "status", "message_id", "received_at", "sender_name", "sender_address",
+                    "subject", "filename", "file_size_bytes", "invoice_total_amount", "gcs_path")
+# 取得した内容をメモリに置く上限 (超えた分は一時ファイルに書く)
+SPOOL_MAX_BYTES = 1024 * 1024
+COPY_CHUNK_BYTES = 1024 * 1024
+
+_UNSAFE_CHARS = re.compile(r'[\\/:*?"<>|\x00-\x1f]+')
+
+@dataclass(frozen=True)
+class ExportRequest:
+    start: datetime.date
+    end: datetime.date  # この日を含まない
+    sender: Optional[str] = None
+
+    @classmethod
+    def for_month(cls, month: str, sender: Optional[str] = None) -> "ExportRequest":
+        """YYYY-MM の1か月分"""
+        start = datetime.datetime.strptime(month, "%Y-%m").date()
+        end = (start.replace(day=28) + datetime.timedelta(days=4)).replace(day=1)
+        return cls(start, end, sender)
+
+    @property
+    def label(self) -> str:
+        last = self.end - datetime.timedelta(days=1)
+        if self.start.day == 1 and last.month == self.start.month and self.end.day == 1:
+            label = self.start.strftime("%Y-%m")
+        else:
+            label = f"{self.start.isoformat()}_{last.isoformat()}"
+        return f"{label}_{_safe_name(self.sender)}" if self.sender else label
+
+def _safe_name(value: str) -> str:
+    return _UNSAFE_CHARS.sub("_", value).strip(" .") or "_"
+
+def _parse_gcs_path(gcs_path: str) -> Tuple[str, str]:
+    """gs://bucket/path を (bucket, path) に分解します。"""
+    if not gcs_path or not gcs_path.startswith("gs://") or "/" not in gcs_path[5:]:
+        raise ValueError(f"不正な保存パスです: {gcs_path}")
+    bucket, path = gcs_path[5:].split("/", 1)
+    return bucket, path
+
+def _zip_paths(rows: List[dict]) -> List[str]:
+    """ZIP 内のパス: 受信日/送信者/ファイル名 (重複する場合は連番を付ける)"""
+    used = set()
+    paths = []
+    for row in rows:
+        date = (row.get("received_at") or "")[:10] or "unknown"
+        sender = _safe_name(row.get("sender_address") or "unknown")
+        base, ext = os.path.splitext(_safe_name(row.get("filename") or "attachment"))
+        path = f"{date}/{sender}/{base}{ext}"
+        n = 2
+        while path in used:
+            path = f"{date}/{sender}/{base}_{n}{ext}"
+            n += 1
+        used.add(path)
+        paths.append(path)
+    return paths
+
+def _fetch(storage, row: dict) -> IO[bytes]:
+    """元ファイルを一時ファイル (小さければメモリ) に取得します。"""
+    bucket, path = _parse_gcs_path(row.get("gcs_path"))
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        with storage.open_file(bucket, path) as src:
+            shutil.copyfileobj(src, spool, COPY_CHUNK_BYTES)
+        spool.seek(0)
+        return spool
+    except Exception:
+        spool.close()
+        raise
+
+def _fetch_in_order(storage, rows: List[dict], workers: int) -> Iterator[Tuple[dict, Optional[IO[bytes]], str]]:
+    """
+    元ファイルを最大 workers 件並行して取得し、行の順に (行, 内容 or None, status) を返します。
+    先読みは workers 件までに抑える (取得済みで書き出し待ちのファイルが溜まらないように)。
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="export") as pool:
+        futures = []
+        rows_iter = iter(rows)
+        for row in rows_iter:
+            futures.append((row, pool.submit(_fetch, storage, row)))
+            if len(futures) >= workers:
+                break
+        while futures:
+            row, future = futures.pop(0)
+            next_row = next(rows_iter, None)
+            if next_row is not None:
+                futures.append((next_row, pool.submit(_fetch, storage, next_row)))
+            try:
+                yield row, future.result(), "ok"
+            except Exception as e:
+                logger.error(f"元ファイルを取得できませんでした ({row.get('gcs_path')}): {e}")
+                yield row, None, "missing"
+
+def write_bundle(out: IO[bytes], storage, rows: List[dict], workers: int) -> Tuple[str, dict]:
+    """
+    ZIP を out に書き出します (out はシークできないストリームでもよい)。
+
+    Returns:
+        (明細 CSV の文字列, {"files": 件数, "missing": 件数, "bytes": 元ファイルの合計バイト数})
+    """
+    stats = {"files": 0, "missing": 0, "bytes": 0}
+    manifest = io.StringIO()
+    writer = csv.DictWriter(manifest, fieldnames=MANIFEST_COLUMNS, extrasaction="ignore")
+    writer.writeheader()
+    paths = _zip_paths(rows)
+    zip_path_of = {id(row): path for row, path in zip(rows, paths)}
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED, allowZip64=True) as bundle:
+        for row, content, status in _fetch_in_order(storage, rows, workers):
+            zip_path = zip_path_of[id(row)]
+            if content is not None:
+                with content, bundle.open(zip_path, "w", force_zip64=True) as dest:
+                    while True:
+                        chunk = content.read(COPY_CHUNK_BYTES)
+                        if not chunk:
+                            break
+                        dest.write(chunk)
+                        stats["bytes"] += len(chunk)
+                stats["files"] += 1
+            else:
+                stats["missing"] += 1
+            writer.writerow({**row, "zip_path": zip_path if content is not None else "", "status": status})
+        bundle.writestr(MANIFEST_NAME, manifest.getvalue().encode("utf-8-sig"))
+    return manifest.getvalue(), stats
+
+def run_export(request: ExportRequest, workers: int = None) -> dict:
+    """
+    エクスポートを実行し、ZIP と明細をバケットに書き出します。
+
+    Returns:
+        {"rows": 件数, "files": 件数, "missing": 件数, "bytes": バイト数, "zip_url": URL, "manifest_url": URL}
+    """
+    workers = workers or config.EXPORT_WORKERS
+    storage = adapters.get_storage_adapter()
+    bq = adapters.get_bigquery_adapter()
+    rows = list(bq.query_rows(config.BQ_TABLE_ID, request.start.isoformat(), request.end.isoformat(),
+                              request.sender))
+    logger.info(f"エクスポート対象: {len(rows)} 件 ({request.label})")
+
+    bucket_name = config.BUCKET_NAME_TEMPLATE.format(config.PROJECT_ID)
+    stamp = datetime.datetime.now().strftime("%Y%m%d%H%M%S")
+    base_path = f"{config.EXPORT_PREFIX}/{request.label}/invoices_{request.label}_{stamp}"
+
+    # ZIP はパイプで書き込み側 (別スレッド) とアップロード側をつなぐ
+    # (パイプはシークできずサイズも不明なため、GCS にはチャンク単位のレジューム可能アップロードで送られる)
+    read_fd, write_fd = os.pipe()
+    reader = os.fdopen(read_fd, "rb")
+    result = {}
+
+    def produce():
+        try:
+            with os.fdopen(write_fd, "wb") as out:
+                result["manifest"], result["stats"] = write_bundle(out, storage, rows, workers)
+        except Exception as e:
+            result["error"] = e
+
+    producer = threading.Thread(target=produce, name="export-zip", daemon=True)
+    producer.start()
+    try:
+        zip_url = storage.save_fileobj(bucket_name, f"{base_path}.zip", reader, content_type="application/zip")
+    finally:
+        # アップロードが失敗した場合も書き込み側を止める (BrokenPipe で終了させる)
+        reader.close()
+        producer.join()
+    if "error" in result:
+        logger.error(f"エクスポートに失敗しました。書き出した ZIP は不完全です: {zip_url}")
+        raise result["error"]
+
+    manifest_url = storage.save_file(bucket_name, f"{base_path}.csv", result["manifest"].encode("utf-8-sig"),
+                                     content_type="text/csv")
+    stats = result["stats"]
+    services.metrics.EXPORTED_FILES.inc(stats["files"], result="exported")
+    services.metrics.EXPORTED_FILES.inc(stats["missing"], result="missing")
+    summary = {"rows": len(rows), **stats, "zip_url": zip_url, "manifest_url": manifest_url}
+    logger.info(f"エクスポートが完了しました: {summary}")
+    return summary
@@ -0,0 +1,190 @@
+"""
+請求書フィールド抽出モジュール
+アーカイブした PDF からテキストを取り出し、経理で必要な項目を抽出する
+
+- 適格請求書発行事業者の登録番号 (T + 13桁)
+- 発行日 / 支払期限
+- 請求金額 (合計)
+
+PDF のテキスト抽出は CPU 負荷が高いため、プロセスプールで実行する
+(GIL や I/O 用スレッドと競合させない)。1文書ごとに時間制限を設ける。
+"""
+import io
+import re
+import signal
+import logging
+import datetime
+import threading
+import multiprocessing
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Optional
+import config
+
+# Optional import (only needed if extraction is enabled)
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+logger = logging.getLogger(__name__)
+
+# --- 抽出ルール ---
+
+# 登録番号: "T1234567890123" / "T-1234-5678-9012-3" など
+_REGISTRATION_RE = re.compile(r"T[\s\-]?((?:\d[\s\-]?){12}\d)(?!\d)")
+
+_DATE_PATTERNS = [
+    # 2025年1月31日
+    (re.compile(r"(\d{4})\s*年\s*(\d{1,2})\s*月\s*(\d{1,2})\s*日"), "western"),
+    # 令和7年1月31日
+    (re.compile(r"令和\s*(元|\d{1,2})\s*年\s*(\d{1,2})\s*月\s*(\d{1,2})\s*日"), "reiwa"),
+    # 2025/01/31, 2025-01-31, 2025.01.31
+    (re.compile(r"(\d{4})[/\-.](\d{1,2})[/\-.](\d{1,2})"), "western"),
+]
+
+_ISSUE_DATE_LABELS = re.compile(r"(発行日|請求日|発行年月日|請求年月日|Invoice\s*Date|Issue\s*Date|Date\s*of\s*Issue)", re.IGNORECASE)
+_DUE_DATE_LABELS = re.compile(r"(お?支払期限|お?支払期日|お?振込期限|お?支払日|Due\s*Date|Payment\s*Due)", re.IGNORECASE)
+_TOTAL_LABELS = re.compile(r"(ご請求金額|請求金額|ご請求額|請求額|合計金額|税込合計|総額|合計|Total\s*Amount|Amount\s*Due|Grand\s*Total|Total)", re.IGNORECASE)
+_AMOUNT_RE = re.compile(r"[¥￥]?\s*(\d{1,3}(?:[,，]\d{3})+|\d+)(?:\.\d+)?\s*(?:円|-|―)?")
+
+# ラベルの直後から値を探す範囲 (文字数)
+_LABEL_WINDOW = 60
+
+def _parse_date(text: str) -> Optional[datetime.date]:
+    """テキスト先頭付近の最初の日付を解釈します。"""
+    best = None
+    for pattern, era in _DATE_PATTERNS:
+        for m in pattern.finditer(text):
+            if best and m.start() >= best[0]:
+                break
+            year = m.group(1)
+            year = (2018 + (1 if year == "元" else int(year))) if era == "reiwa" else int(year)
+            try:
+                best = (m.start(), datetime.date(year, int(m.group(2)), int(m.group(3))))
+                break
+            except ValueError:
+                # 2025/13/40 のような日付として成立しないものは読み飛ばす
+                continue
+    return best[1] if best else None
+
+def _find_labeled_date(text: str, labels: re.Pattern) -> Optional[str]:
+    for m in labels.finditer(text):
+        date = _parse_date(text[m.end():m.end() + _LABEL_WINDOW])
+        if date:
+            return date.isoformat()
+    return None
+
+def _find_total_amount(text: str) -> Optional[int]:
+    # 後に出てくる「合計」ほど最終的な請求額である可能性が高い (小計 → 合計 の順に並ぶため)
+    # ただし「ご請求金額」など明示的なラベルがあればそれを優先する
+    candidates = []
+    for m in _TOTAL_LABELS.finditer(text):
+        window = text[m.end():m.end() + _LABEL_WINDOW]
+        # ラベル直後の日付や登録番号を金額と誤認しないよう除外
+        window = _REGISTRATION_RE.sub(" ", window)
+        for pattern, _ in _DATE_PATTERNS:
+            window = pattern.sub(" ", window)
+        amount = _AMOUNT_RE.search(window)
+        if amount:
+            value = int(re.sub(r"[,，]", "", amount.group(1)))
+            explicit = "請求" in m.group(1) or "due" in m.group(1).lower()
+            candidates.append((explicit, m.start(), value))
+    if not candidates:
+        return None
+    return max(candidates)[2]
+
+def parse_invoice_fields(text: str) -> Dict[str, object]:
+    """
+    請求書のテキストから項目を抽出します。見つからない項目は None になります。
+    """
+    registration = _REGISTRATION_RE.search(text)
+    return {
+        "invoice_registration_number": "T" + re.sub(r"[\s\-]", "", registration.group(1)) if registration else None,
+        "invoice_issue_date": _find_labeled_date(text, _ISSUE_DATE_LABELS),
+        "invoice_due_date": _find_labeled_date(text, _DUE_DATE_LABELS),
+        "invoice_total_amount": _find_total_amount(text),
+    }
+
+def extract_text(pdf_bytes: bytes, max_pages: int = 10) -> str:
+    """PDF からテキストを抽出します (先頭 max_pages ページのみ)。"""
+    if pypdf is None:
+        raise ImportError("pypdf is not installed.")
+    reader = pypdf.PdfReader(io.BytesIO(pdf_bytes))
+    return "\n".join((page.extract_text() or "") for page in reader.pages[:max_pages])
+
+class ExtractionTimeout(Exception):
+    pass
+
+def _on_alarm(signum, frame):
+    raise ExtractionTimeout()
+
+def _extract_worker(pdf_bytes: bytes, timeout_seconds: float, max_pages: int) -> Dict[str, object]:
+    """
+    プロセスプールのワーカーで実行される抽出処理。
+    ワーカーのメインスレッドで動くため、SIGALRM でワーカー側でも時間制限を掛ける。
+    """
+    use_alarm = hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        signal.signal(signal.SIGALRM, _on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout_seconds)
+    try:
+        return parse_invoice_fields(extract_text(pdf_bytes, max_pages))
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+# --- プロセスプール ---
+
+_executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def _get_executor() -> concurrent.futures.ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # スレッドを多数抱えたプロセスからの fork を避けるため spawn で起動する
+            _executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=config.EXTRACTION_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+def _reset_executor():
+    """壊れたプール (ワーカーの異常終了など) を破棄し、次回作り直す"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
+
+def is_extractable(filename: str, mime_type: str) -> bool:
+    """抽出対象 (PDF) かどうか"""
+    return mime_type == "application/pdf" or filename.lower().endswith(".pdf")
+
+def extract_invoice_fields(pdf_bytes: bytes) -> Dict[str, object]:
+    """
+    プロセスプールで PDF から請求書項目を抽出します。
+    時間切れ・失敗時は空の辞書を返し、呼び出し元の処理は止めません。
+    """
+    if pypdf is None:
+        logger.warning("pypdf がインストールされていないため、請求書項目の抽出をスキップします。")
+        return {}
+
+    timeout = config.EXTRACTION_TIMEOUT_SECONDS
+    try:
+        future = _get_executor().submit(_extract_worker, pdf_bytes, timeout, config.EXTRACTION_MAX_PAGES)
+        # ワーカー側の制限が効かなかった場合の保険として、少し長めに待つ
+        return future.result(timeout=timeout + 5)
+    except (ExtractionTimeout, concurrent.futures.TimeoutError):
+        logger.warning(f"請求書項目の抽出が時間切れになりました ({timeout} 秒)")
+        return {}
+    except BrokenProcessPool as e:
+        logger.error(f"抽出用プロセスプールが異常終了しました: {e}")
+        _reset_executor()
+        return {}
+    except Exception as e:
+        logger.warning(f"請求書項目の抽出に失敗しました: {e}")
+        return {}
+
+def shutdown():
+    """プロセスプールを停止します。"""
+    _reset_executor()
@@ -1,4 +1,6 @@
 import logging
+from typing import List, Tuple
+import services.rules
 import config
 
 logger = logging.getLogger(__name__)
@@ -7,7 +9,17 @@ def is_allowed_email(sender: str, subject: str) -> bool:
     """
     Checks if the email is allowed based on allowed domains and subject keywords.
     Logic is OR: Allowed if (Domain Match) OR (Subject Match).
+    When RULES_SOURCE is configured, the hot-reloaded rule set is used instead of
+    ALLOWED_DOMAINS / SUBJECT_KEYWORDS.
     """
+    rule_set = services.rules.get_active_rule_set()
+    if rule_set is not None:
+        return _is_allowed_by_rule_set(rule_set, sender, subject)
+    if services.rules.rules_unavailable():
+        # ルールを一度も読み込めていない間は遮断する (環境変数の条件で全て許可しないように)
+        logger.warning(f"Filtered out (rule set not loaded yet): {sender} | {subject}")
+        return False
+
     # Normalize to lowercase for case-insensitive check
     sender_lower = sender.lower()
     subject_lower = subject.lower()
@@ -36,3 +48,88 @@ def is_allowed_email(sender: str, subject: str) -> bool:
     # If we reached here, filtering is active but no criteria matched
     logger.info(f"Filtered out (No match for domain or subject): {sender} | {subject}")
     return False
+
+def _is_allowed_by_rule_set(rule_set: services.rules.RuleSet, sender: str, subject: str) -> bool:
+    # ルールが空の場合は全て許可 (環境変数が空の場合と同じ)
+    if not rule_set.rules:
+        return True
+
+    rule = rule_set.match(sender, subject)
+    if rule:
+        logger.info(f"Allowed by rule '{rule.name}' (v{rule_set.version}): {sender} | {subject}")
+        return True
+
+    logger.info(f"Filtered out by rule set v{rule_set.version}: {sender} | {subject}")
+    return False
+
+def is_allowed_attachment(sender: str, subject: str, filename: str, size: int) -> bool:
+    """
+    Checks per-rule attachment constraints (allowed extensions / max size).
+    Without a rule set, or if the email matched no specific rule, every attachment is allowed.
+    """
+    rule_set = services.rules.get_active_rule_set()
+    if rule_set is None:
+        return not services.rules.rules_unavailable()
+
+    rule = rule_set.match(sender, subject)
+    if rule is None or rule.allows_attachment(filename, size):
+        return True
+
+    logger.info(f"Attachment blocked by rule '{rule.name}': {filename} ({size} bytes)")
+    return False
+
+def _get_filter_terms() -> Tuple[List[str], List[str]]:
+    """有効なルールセット (なければ環境変数) からドメインとキーワードを取得"""
+    rule_set = services.rules.get_active_rule_set()
+    if rule_set is not None:
+        return rule_set.domains, rule_set.subject_keywords
+    return config.ALLOWED_DOMAINS, config.SUBJECT_KEYWORDS
+
+def _quote_query_term(value: str) -> str:
+    """Gmail検索語として安全な形に整形します (空白や記号を含む場合はダブルクォートで囲む)。"""
+    value = value.replace('"', ' ').strip()
+    if any(c.isspace() for c in value) or any(c in value for c in '{}()'):
+        return f'"{value}"'
+    return value
+
+def build_query_filters(max_length: int, include_subjects: bool = True) -> List[str]:
+    """
+    Builds Gmail search OR-groups from ALLOWED_DOMAINS and SUBJECT_KEYWORDS
+    (or from the active rule set).
+    Mirrors is_allowed_email: (Domain Match) OR (Subject Match).
+
+    Gmail's subject: operator matches whole words, while is_allowed_email matches
+    substrings, so a pushed-down keyword can miss mail the post-filter would accept
+    (e.g. "Invoice" vs "Invoices"). With include_subjects=False no filter is returned
+    when subject keywords are configured, since the domain terms alone would drop
+    subject-only matches.
+
+    Each returned group (e.g. '{from:example.com subject:請求書}') fits in max_length.
+    When the terms do not fit, they are split into several groups; the caller runs
+    one query per group and merges the results.
+    Returns an empty list when no filtering is configured (= allow all).
+    """
+    domains, keywords = _get_filter_terms()
+    if not include_subjects and any(k.strip() for k in keywords):
+        return []
+    terms = [f"from:{_quote_query_term(d)}" for d in domains if d.strip()]
+    terms += [f"subject:{_quote_query_term(k)}" for k in keywords if k.strip()]
+    if not terms:
+        return []
+
+    groups = []
+    current: List[str] = []
+    current_len = 2  # "{" と "}"
+    for term in terms:
+        added_len = len(term) + (1 if current else 0)
+        if current and current_len + added_len > max_length:
+            groups.append(current)
+            current, current_len = [], 2
+            added_len = len(term)
+        current.append(term)
+        current_len += added_len
+    if current:
+        groups.append(current)
+
+    # 1語だけのグループは波括弧なしで十分
+    return ["{" + " ".join(g) + "}" if len(g) > 1 else g[0] for g in groups]
@@ -1,27 +1,107 @@
 import google.auth
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+import time
+import threading
 import config
 import logging
+from typing import Dict, Optional, Tuple
+import services.accounts
+import services.metrics
+import services.tracing
+import services.circuit_breaker
+import services.ratelimit
 
 logger = logging.getLogger(__name__)
 
-_service = None
-_oauth_alert_sent = False  # 同じセッション中で重複アラートを防ぐフラグ
+# googleapiclient のサービス (内部の httplib2) はスレッドセーフではないため、スレッドごとに作る
+# 複数アカウントモードでは、サービス・認証情報・ラベルID・クォータをアカウントごとに持つ
+# (キーはアカウントのメールアドレス、単一アカウントモードでは None)
+_local = threading.local()
+_creds: Dict[Optional[str], object] = {}
+_creds_lock = threading.Lock()
+_oauth_alert_sent = set()  # 同じセッション中で重複アラートを防ぐ (アカウント単位)
+
+# ラベル名 -> ID のキャッシュ (ラベルはほぼ変わらないため、毎回 labels.list しない)
+_label_ids: Dict[Tuple[Optional[str], str], str] = {}
+_label_lock = threading.Lock()
+
+# メソッドごとのクォータユニット (https://developers.google.com/gmail/api/reference/quota)
+QUOTA_UNITS = {
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "messages.attachments.get": 5,
+    "history.list": 2,
+    "getProfile": 1,
+    "watch": 100,
+    "labels.list": 1,
+    "labels.get": 1,
+    "labels.create": 5,
+}
+# クォータはメールボックス (ユーザー) ごとのため、アカウントごとにトークンバケットを持つ
+_rate_limiter: Optional[services.ratelimit.TokenBucket] = None
+_account_limiters: Dict[str, Optional[services.ratelimit.TokenBucket]] = {}
+_limiter_lock = threading.Lock()
+
+def _account_key() -> Optional[str]:
+    account = services.accounts.current_account()
+    return account.key if account else None
+
+def set_rate_limiter(limiter: Optional[services.ratelimit.TokenBucket]):
+    """Gmail API 呼び出しのクォータ平準化を設定します (None で無効)。"""
+    global _rate_limiter
+    _rate_limiter = limiter
+
+if config.GMAIL_QUOTA_UNITS_PER_SECOND > 0:
+    set_rate_limiter(services.ratelimit.TokenBucket(config.GMAIL_QUOTA_UNITS_PER_SECOND))
+
+def _get_rate_limiter() -> Optional[services.ratelimit.TokenBucket]:
+    account = services.accounts.current_account()
+    if account is None:
+        return _rate_limiter
+    limiter = _account_limiters.get(account.key, False)
+    if limiter is not False:
+        return limiter
+    with _limiter_lock:
+        if account.key not in _account_limiters:
+            rate = account.quota_units_per_second
+            if rate is None:
+                rate = config.GMAIL_QUOTA_UNITS_PER_SECOND
+            _account_limiters[account.key] = services.ratelimit.TokenBucket(rate) if rate > 0 else None
+        return _account_limiters[account.key]
 
 def get_gmail_service():
     """
-    Lazy loads the Gmail API service.
+    Lazy loads the Gmail API service (one per thread and account).
     """
-    global _service, _oauth_alert_sent
-    if _service:
-        return _service
+    services_by_account = getattr(_local, "services", None)
+    if services_by_account is None:
+        services_by_account = _local.services = {}
+    key = _account_key()
+    service = services_by_account.get(key)
+    if service:
+        return service
+    service = build('gmail', 'v1', credentials=_get_credentials(), cache_discovery=False)
+    services_by_account[key] = service
+    return service
+
+def _get_credentials():
+    """認証情報を取得します (全スレッドで共有, アカウント単位)。"""
+    account = services.accounts.current_account()
+    key = account.key if account else None
+    if key in _creds:
+        return _creds[key]
         
     creds = None
     
     try:
+        if account is not None:
+            creds = _account_credentials(account)
+
         # 1. Try to use Refresh Token if available (Prioritize for Personal Gmail)
-        if config.GMAIL_REFRESH_TOKEN and config.GMAIL_CLIENT_ID and config.GMAIL_CLIENT_SECRET:
+        elif config.GMAIL_REFRESH_TOKEN and config.GMAIL_CLIENT_ID and config.GMAIL_CLIENT_SECRET:
             from google.oauth2.credentials import Credentials
             creds = Credentials(
                 None, # access_token (will be refreshed)
@@ -35,36 +115,100 @@ def get_gmail_service():
         # 2. Fallback to ADC (Service Account / gcloud auth application-default)
         if not creds:
             creds, project = google.auth.default(scopes=config.GMAIL_SCOPES)
-            
-        _service = build('gmail', 'v1', credentials=creds)
-        return _service
+
+        with _creds_lock:
+            _creds.setdefault(key, creds)
+        return _creds[key]
         
     except Exception as e:
         error_msg = str(e)
-        logger.error(f"Gmail API認証エラー: {error_msg}")
+        logger.error(f"Gmail API認証エラー{f' ({account.email})' if account else ''}: {error_msg}")
         
         # OAuthエラーの検知とSlack通知
-        if not _oauth_alert_sent:
+        if key not in _oauth_alert_sent:
             try:
-                import services.slack
-                alert_msg = f"Gmail API認証失敗 🚨\n```{error_msg}```\n\n*⚠️ OAuthトークンが無効化された可能性があります。手動でのトークン再取得が必要です。*"
-                services.slack.send_slack_alert(alert_msg, level="error")
-                _oauth_alert_sent = True
+                import services.slack as slack
+                mailbox = f" ({account.email})" if account else ""
+                alert_msg = f"Gmail API認証失敗{mailbox} 🚨\n```{error_msg}```\n\n*⚠️ OAuthトークンが無効化された可能性があります。手動でのトークン再取得が必要です。*"
+                # 認証処理中のワーカーをSlackの応答で待たせない
+                slack.enqueue_slack_alert(alert_msg, level="error", dedup_key=f"gmail_oauth_error:{key}" if key else "gmail_oauth_error")
+                _oauth_alert_sent.add(key)
             except:
                 pass  # Slack送信失敗しても元のエラーを投げる
         
         raise
 
+def _account_credentials(account: services.accounts.Account):
+    """複数アカウントモードのアカウント別認証情報"""
+    if account.delegated:
+        # ドメイン全体の委任: サービスアカウントでそのユーザーになりすます
+        creds, project = google.auth.default(scopes=config.GMAIL_SCOPES)
+        return creds.with_subject(account.email)
+    from google.oauth2.credentials import Credentials
+    return Credentials(
+        None,
+        refresh_token=account.refresh_token,
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=account.client_id or config.GMAIL_CLIENT_ID,
+        client_secret=account.client_secret or config.GMAIL_CLIENT_SECRET,
+        scopes=config.GMAIL_SCOPES
+    )
+
+def execute(request, method: str):
+    """
+    Gmail API リクエストを実行し、呼び出し回数・ステータス・レイテンシを記録します。
+
+    Args:
+        request: googleapiclient の HttpRequest (execute() を持つもの)
+        method: メトリクス用のメソッド名 (例: "messages.get")
+    """
+    limiter = _get_rate_limiter()
+    if limiter is not None:
+        limiter.acquire(QUOTA_UNITS.get(method, 5))
+    start = time.perf_counter()
+    status = "200"
+    try:
+        with services.tracing.span(f"gmail.{method}"), services.circuit_breaker.guard("gmail"):
+            return request.execute()
+    except HttpError as e:
+        status = str(getattr(e.resp, "status", "error"))
+        raise
+    except services.circuit_breaker.CircuitOpenError:
+        status = "circuit_open"
+        raise
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        services.metrics.GMAIL_SECONDS.observe(time.perf_counter() - start, method=method)
+        services.metrics.GMAIL_REQUESTS.inc(method=method, status=status)
+
 def get_or_create_label_id(label_name: str) -> str:
     """
     指定されたラベル名のIDを取得します。
     存在しない場合は新規作成してそのIDを返します。
     """
+    cache_key = (_account_key(), label_name)
+    label_id = _label_ids.get(cache_key)
+    if label_id:
+        return label_id
+    with _label_lock:
+        # 並行して作成しないよう、ロック内で再確認する
+        if cache_key not in _label_ids:
+            _label_ids[cache_key] = _resolve_label_id(label_name)
+        return _label_ids[cache_key]
+
+def clear_label_cache():
+    """ラベルIDのキャッシュを破棄します (ラベルを削除・再作成した場合など)。"""
+    with _label_lock:
+        _label_ids.clear()
+
+def _resolve_label_id(label_name: str) -> str:
     srv = get_gmail_service()
     
     try:
         # 1. 既存ラベルのリストを取得
-        results = srv.users().labels().list(userId='me').execute()
+        results = execute(srv.users().labels().list(userId='me'), "labels.list")
         labels = results.get('labels', [])
         
         # 2. 名前で検索
@@ -74,16 +218,61 @@ def get_or_create_label_id(label_name: str) -> str:
                 
         # 3. なければ作成
         print(f"Creating new label: {label_name}")
-        created_label = srv.users().labels().create(
+        created_label = execute(srv.users().labels().create(
             userId='me',
             body={
                 'name': label_name,
                 'labelListVisibility': 'labelShow',
                 'messageListVisibility': 'show'
             }
-        ).execute()
+        ), "labels.create")
         return created_label['id']
         
     except Exception as e:
         print(f"Error getting/creating label: {e}")
         raise
+
+class HistoryExpired(Exception):
+    """履歴IDが古すぎて history.list で差分を取得できない (全件の再確認が必要)"""
+
+def get_history_id() -> str:
+    """メールボックスの現在の履歴IDを取得します。"""
+    srv = get_gmail_service()
+    profile = execute(srv.users().getProfile(userId='me'), "getProfile")
+    return profile['historyId']
+
+def list_history(start_history_id: str, ignore_label_ids=()) -> tuple:
+    """
+    start_history_id 以降に追加されたメッセージ・ラベルの変更を数えます。
+    ignore_label_ids のラベルだけが付いた変更 (自身のロック・エラーラベル付与など) は数えません。
+
+    Returns:
+        (変更件数, 最新の履歴ID)
+
+    Raises:
+        HistoryExpired: 履歴IDが失効している場合 (HTTP 404)
+    """
+    srv = get_gmail_service()
+    changes = 0
+    history_id = start_history_id
+    page_token = None
+    while True:
+        try:
+            results = execute(srv.users().history().list(
+                userId='me',
+                startHistoryId=start_history_id,
+                historyTypes=['messageAdded', 'labelAdded'],
+                pageToken=page_token
+            ), "history.list")
+        except HttpError as e:
+            if getattr(e.resp, "status", None) == 404:
+                raise HistoryExpired(start_history_id) from e
+            raise
+        for record in results.get('history', []):
+            changes += len(record.get('messagesAdded', []))
+            changes += sum(1 for added in record.get('labelsAdded', [])
+                           if set(added.get('labelIds', [])) - set(ignore_label_ids))
+        history_id = results.get('historyId', history_id)
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return changes, history_id
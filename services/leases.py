@@ -0,0 +1,351 @@
+"""
+クレームのリース管理
+
+PROCESSED ラベルはロックと完了印を兼ねているため、処理中にインスタンスが落ちると
+アーカイブされないまま「処理済み」として残ってしまう。
+クレーム時にリース (所有者・有効期限) を記録し、処理中はハートビートで延長する。
+期限切れのリースはスイーパーが PROCESSED ラベルを外して再クレーム可能に戻す。
+
+- 状態ストアは LeaseStore (ローカルでは SQLite: LEASE_DB_PATH)
+- LEASES_ENABLED=false の場合は何もしない (従来どおり)
+"""
+import os
+import time
+import uuid
+import socket
+import logging
+import sqlite3
+import threading
+import contextlib
+import contextvars
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, Iterator, List, Optional, Tuple
+import services.metrics
+import config
+
+logger = logging.getLogger(__name__)
+
+# このプロセスの所有者ID (ホスト名:PID:乱数)
+OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+# batchModify の1回あたりの上限
+BATCH_MODIFY_LIMIT = 1000
+# クレームしてから処理を開始するまでハートビートで延長し続ける上限 (秒)
+# (処理されないまま残ったクレームは、これを過ぎると期限切れになりスイーパーに回収される)
+CLAIM_MAX_WAIT_SECONDS = 3600
+
+@dataclass(frozen=True)
+class Lease:
+    message_id: str
+    account: str  # 単一アカウントモードでは ""
+    owner: str
+    expires_at: float
+    acquired_at: float
+    renewals: int = 0
+
+class LeaseStore(ABC):
+    @abstractmethod
+    def acquire(self, message_id: str, account: str, owner: str, ttl: float, now: float = None) -> bool:
+        """
+        リースを取得します。他の所有者の有効なリースがある場合は False を返します。
+        (自分のリース・期限切れのリースは上書きする)
+        """
+        pass
+
+    @abstractmethod
+    def renew(self, keys: List[Tuple[str, str]], owner: str, ttl: float, now: float = None) -> int:
+        """自分が所有するリースの期限を延長し、延長できた件数を返します。"""
+        pass
+
+    @abstractmethod
+    def release(self, message_id: str, account: str, owner: str) -> bool:
+        """自分が所有するリースを削除します。"""
+        pass
+
+    @abstractmethod
+    def expired(self, now: float = None, limit: int = 500) -> List[Lease]:
+        """期限切れのリースを古い順に返します。"""
+        pass
+
+    @abstractmethod
+    def delete(self, leases: List[Lease]) -> int:
+        """指定したリースを削除します (期限が更新されたものは残す)。"""
+        pass
+
+    @abstractmethod
+    def count(self) -> int:
+        pass
+
+class SQLiteLeaseStore(LeaseStore):
+    """SQLite の状態ストア (接続はスレッドごと)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    message_id TEXT NOT NULL,
+                    account TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    acquired_at REAL NOT NULL,
+                    renewals INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (account, message_id)
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS leases_expires_at ON leases (expires_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def acquire(self, message_id, account, owner, ttl, now=None):
+        now = time.time() if now is None else now
+        cur = self._connect().execute("""
+            INSERT INTO leases (message_id, account, owner, expires_at, acquired_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (account, message_id) DO UPDATE SET
+                owner = excluded.owner, expires_at = excluded.expires_at,
+                acquired_at = excluded.acquired_at, renewals = 0
+            WHERE leases.owner = excluded.owner OR leases.expires_at < ?""",
+            (message_id, account, owner, now + ttl, now, now))
+        return cur.rowcount > 0
+
+    def renew(self, keys, owner, ttl, now=None):
+        if not keys:
+            return 0
+        now = time.time() if now is None else now
+        cur = self._connect().executemany("""
+            UPDATE leases SET expires_at = ?, renewals = renewals + 1
+            WHERE account = ? AND message_id = ? AND owner = ?""",
+            [(now + ttl, account, message_id, owner) for account, message_id in keys])
+        return cur.rowcount
+
+    def release(self, message_id, account, owner):
+        cur = self._connect().execute(
+            "DELETE FROM leases WHERE account = ? AND message_id = ? AND owner = ?",
+            (account, message_id, owner))
+        return cur.rowcount > 0
+
+    def expired(self, now=None, limit=500):
+        now = time.time() if now is None else now
+        rows = self._connect().execute("""
+            SELECT message_id, account, owner, expires_at, acquired_at, renewals
+            FROM leases WHERE expires_at < ? ORDER BY expires_at LIMIT ?""", (now, limit)).fetchall()
+        return [Lease(*row) for row in rows]
+
+    def delete(self, leases):
+        if not leases:
+            return 0
+        cur = self._connect().executemany(
+            "DELETE FROM leases WHERE account = ? AND message_id = ? AND owner = ? AND expires_at = ?",
+            [(l.account, l.message_id, l.owner, l.expires_at) for l in leases])
+        return cur.rowcount
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM leases").fetchone()[0]
+
+# --- 内部状態 ---
+_store: Optional[LeaseStore] = None
+_store_lock = threading.Lock()
+# ハートビート対象 (このプロセスが処理中のリース) -> 参照数
+_held: Dict[Tuple[str, str], int] = {}
+# クレーム済みで処理開始待ちのリース -> クレーム時刻 (処理開始までハートビートで延長する)
+_claimed: Dict[Tuple[str, str], float] = {}
+_held_lock = threading.Lock()
+_heartbeat_thread: Optional[threading.Thread] = None
+# 処理中のリース (処理失敗時に解放せず期限切れに任せる場合に使う)
+_current: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("lease", default=None)
+
+def get_store() -> Optional[LeaseStore]:
+    """リースの状態ストアを返します (LEASES_ENABLED=false の場合は None)。"""
+    global _store
+    if not config.LEASES_ENABLED:
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SQLiteLeaseStore(config.LEASE_DB_PATH)
+    return _store
+
+def set_store(store: Optional[LeaseStore]):
+    """状態ストアを差し替えます (テスト用, None で LEASE_DB_PATH から作り直す)。"""
+    global _store
+    with _store_lock:
+        _store = store
+
+def _account_key(account: Optional[str]) -> str:
+    return account.lower() if account else ""
+
+def acquire(message_id: str, account: Optional[str] = None) -> bool:
+    """
+    クレーム時にリースを取得します。無効時は常に True を返します。
+    取得したリースは、処理の開始 (hold) を待つ間もハートビートで延長する
+    (バックグラウンドタスクの順番待ちや優先度による後回しで期限切れにならないように)。
+    """
+    store = get_store()
+    if store is None:
+        return True
+    key = (_account_key(account), message_id)
+    if store.acquire(message_id, key[0], OWNER, config.LEASE_TTL_SECONDS):
+        with _held_lock:
+            _claimed[key] = time.monotonic()
+        _start_heartbeat()
+        services.metrics.LEASE_EVENTS.inc(event="acquired")
+        return True
+    services.metrics.LEASE_EVENTS.inc(event="conflict")
+    return False
+
+def release(message_id: str, account: Optional[str] = None):
+    """acquire で取得したリースを、処理を始めずに解放します (クレームのラベル付けに失敗した場合など)。"""
+    store = get_store()
+    if store is None:
+        return
+    key = (_account_key(account), message_id)
+    with _held_lock:
+        _claimed.pop(key, None)
+    if store.release(message_id, key[0], OWNER):
+        services.metrics.LEASE_EVENTS.inc(event="released")
+
+@contextlib.contextmanager
+def hold(message_id: str, account: Optional[str] = None) -> Iterator[Optional[dict]]:
+    """
+    処理中のリースを保持します。
+    - 処理中はハートビートで期限を延長する (長いダウンロード中に期限切れにならないように)
+    - 正常に抜けたら解放する。例外で抜けた場合、または keep() が呼ばれた場合は解放せず、
+      期限切れ後にスイーパーが再クレーム可能に戻す
+    - このプロセスがクレームしたメッセージのリースが他のワーカーに移っていた場合は
+      {"lost": True} を返す (呼び出し側は処理せずに抜けること)
+    """
+    store = get_store()
+    if store is None:
+        yield None
+        return
+    key = (_account_key(account), message_id)
+    with _held_lock:
+        claimed = _claimed.pop(key, None) is not None
+    # クレームを経ずに処理する場合 (バックフィル等) もリースを記録する
+    if not store.acquire(message_id, key[0], OWNER, config.LEASE_TTL_SECONDS):
+        services.metrics.LEASE_EVENTS.inc(event="conflict")
+        if claimed:
+            logger.warning("メッセージ %s のリースは他のワーカーに移っているため処理しません", message_id)
+            yield {"keep": True, "lost": True}
+            return
+        logger.warning(f"メッセージ {message_id} は他のワーカーがリース中です。処理を続行します。")
+    state = {"keep": False}
+    token = _current.set(state)
+    with _held_lock:
+        _held[key] = _held.get(key, 0) + 1
+    _start_heartbeat()
+    released = False
+    try:
+        yield state
+        if not state["keep"]:
+            store.release(message_id, key[0], OWNER)
+            services.metrics.LEASE_EVENTS.inc(event="released")
+            released = True
+    finally:
+        _current.reset(token)
+        with _held_lock:
+            _held[key] -= 1
+            if not _held[key]:
+                del _held[key]
+        if not released:
+            logger.warning(f"メッセージ {message_id} のリースを解放しません (期限切れ後に再処理されます)")
+
+def keep():
+    """処理中のリースを解放せず、期限切れ後の再処理に任せます (ラベルの整合が取れない場合など)。"""
+    state = _current.get()
+    if state is not None:
+        state["keep"] = True
+
+def heartbeat() -> int:
+    """このプロセスが処理中・処理開始待ちのリースを全て延長します。"""
+    store = get_store()
+    now = time.monotonic()
+    with _held_lock:
+        for key in [k for k, claimed_at in _claimed.items() if now - claimed_at > CLAIM_MAX_WAIT_SECONDS]:
+            # 処理されないまま残ったクレームは延長をやめ、スイーパーに任せる
+            del _claimed[key]
+        keys = list(_held) + [k for k in _claimed if k not in _held]
+    if store is None or not keys:
+        return 0
+    renewed = store.renew(keys, OWNER, config.LEASE_TTL_SECONDS)
+    services.metrics.LEASE_EVENTS.inc(renewed, event="renewed")
+    return renewed
+
+def _heartbeat_loop():
+    while True:
+        time.sleep(config.LEASE_HEARTBEAT_SECONDS)
+        try:
+            heartbeat()
+        except Exception as e:
+            logger.error(f"リースの延長に失敗しました: {e}")
+
+def _start_heartbeat():
+    global _heartbeat_thread
+    if _heartbeat_thread is not None:
+        return
+    with _held_lock:
+        if _heartbeat_thread is None:
+            _heartbeat_thread = threading.Thread(target=_heartbeat_loop, name="lease-heartbeat", daemon=True)
+            _heartbeat_thread.start()
+
+def sweep(limit: int = None) -> dict:
+    """
+    期限切れのリースを回収します。
+    対象メールの PROCESSED ラベルを (アカウントごとに batchModify でまとめて) 外し、
+    次のクレームで再処理されるようにします。
+
+    Returns:
+        {"expired": 件数, "reclaimed": 件数, "failed": 件数}
+    """
+    import services.gmail
+    import services.accounts
+
+    stats = {"expired": 0, "reclaimed": 0, "failed": 0}
+    store = get_store()
+    if store is None:
+        return stats
+    expired = store.expired(limit=limit or config.LEASE_SWEEP_BATCH)
+    stats["expired"] = len(expired)
+    by_account: Dict[str, List[Lease]] = {}
+    for lease in expired:
+        by_account.setdefault(lease.account, []).append(lease)
+
+    for account_key, leases in by_account.items():
+        account = services.accounts.get_account(account_key) if account_key else None
+        if account_key and account is None:
+            logger.warning(f"未登録のアカウントのリースを破棄します: {account_key} ({len(leases)} 件)")
+            store.delete(leases)
+            stats["failed"] += len(leases)
+            continue
+        reclaimed = 0
+        try:
+            with services.accounts.use_account(account):
+                srv = services.gmail.get_gmail_service()
+                processed_label_id = services.gmail.get_or_create_label_id(config.PROCESSED_LABEL_NAME)
+                for i in range(0, len(leases), BATCH_MODIFY_LIMIT):
+                    chunk = leases[i:i + BATCH_MODIFY_LIMIT]
+                    services.gmail.execute(srv.users().messages().batchModify(
+                        userId='me',
+                        body={'ids': [l.message_id for l in chunk], 'removeLabelIds': [processed_label_id]}
+                    ), "messages.batchModify")
+                    store.delete(chunk)
+                    reclaimed += len(chunk)
+        except Exception as e:
+            # 残りは期限切れのまま残し、次回のスイープで再試行する
+            logger.error(f"期限切れリースの回収に失敗しました ({account_key or 'me'}): {e}")
+            stats["failed"] += len(leases) - reclaimed
+        stats["reclaimed"] += reclaimed
+
+    if stats["expired"]:
+        logger.info(f"期限切れリースを回収しました: {stats}")
+        services.metrics.LEASE_EVENTS.inc(stats["reclaimed"], event="reclaimed")
+    return stats
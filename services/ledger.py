@@ -0,0 +1,160 @@
+"""
+アーカイブ済み添付ファイルの台帳 (冪等性の確保)
+
+部分的に失敗したメールを再処理すると、全ての添付ファイルを再ダウンロード・再アップロードし、
+BigQuery の insertId による重複排除 (ベストエフォート, 1分程度) に頼ることになる。
+添付ファイルごとに完了した手順 (upload / insert) を記録し、再処理では未完了の手順から再開する。
+
+- キー: (アカウント, 保存名, 内容のハッシュ)
+  保存名はメッセージID・添付連番 (ZIP メンバーは連番も) を含む (services.processor)
+- insert まで完了したものは、何時間後に再処理されても行を書き込まない
+- 状態ストアは LedgerStore (ローカルでは SQLite: LEDGER_DB_PATH)
+  主キーの B-tree に行を直接格納する (WITHOUT ROWID) ため、件数が増えても索引は1つで済む
+- LEDGER_ENABLED=false の場合は何もしない (従来どおり)
+"""
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Optional
+import services.metrics
+import config
+
+logger = logging.getLogger(__name__)
+
+UPLOADED = "uploaded"
+INSERTED = "inserted"
+
+@dataclass(frozen=True)
+class LedgerEntry:
+    account: str  # 単一アカウントモードでは ""
+    name: str
+    content_hash: str
+    gcs_url: str
+    gcs_path: str
+    uploaded_at: float
+    inserted_at: Optional[float] = None
+
+    @property
+    def inserted(self) -> bool:
+        return self.inserted_at is not None
+
+class LedgerStore(ABC):
+    @abstractmethod
+    def get(self, account: str, name: str, content_hash: str) -> Optional[LedgerEntry]:
+        pass
+
+    @abstractmethod
+    def record_upload(self, account: str, name: str, content_hash: str, gcs_url: str, gcs_path: str,
+                      now: float = None):
+        """アップロードの完了を記録します (insert 済みの記録は変更しない)。"""
+        pass
+
+    @abstractmethod
+    def record_insert(self, account: str, name: str, content_hash: str, now: float = None):
+        pass
+
+    @abstractmethod
+    def count(self) -> int:
+        pass
+
+class SQLiteLedgerStore(LedgerStore):
+    """SQLite の状態ストア (接続はスレッドごと)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute("""
+            CREATE TABLE IF NOT EXISTS ledger (
+                account TEXT NOT NULL,
+                name TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                gcs_url TEXT NOT NULL,
+                gcs_path TEXT NOT NULL,
+                uploaded_at REAL NOT NULL,
+                inserted_at REAL,
+                PRIMARY KEY (account, name, content_hash)
+            ) WITHOUT ROWID""")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, account, name, content_hash):
+        row = self._connect().execute("""
+            SELECT account, name, content_hash, gcs_url, gcs_path, uploaded_at, inserted_at
+            FROM ledger WHERE account = ? AND name = ? AND content_hash = ?""",
+            (account, name, content_hash)).fetchone()
+        return LedgerEntry(*row) if row else None
+
+    def record_upload(self, account, name, content_hash, gcs_url, gcs_path, now=None):
+        self._connect().execute("""
+            INSERT INTO ledger (account, name, content_hash, gcs_url, gcs_path, uploaded_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (account, name, content_hash) DO UPDATE SET
+                gcs_url = excluded.gcs_url, gcs_path = excluded.gcs_path, uploaded_at = excluded.uploaded_at
+            WHERE ledger.inserted_at IS NULL""",
+            (account, name, content_hash, gcs_url, gcs_path, time.time() if now is None else now))
+
+    def record_insert(self, account, name, content_hash, now=None):
+        self._connect().execute(
+            "UPDATE ledger SET inserted_at = ? WHERE account = ? AND name = ? AND content_hash = ?",
+            (time.time() if now is None else now, account, name, content_hash))
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM ledger").fetchone()[0]
+
+# --- 内部状態 ---
+_store: Optional[LedgerStore] = None
+_store_lock = threading.Lock()
+
+def get_store() -> Optional[LedgerStore]:
+    """台帳の状態ストアを返します (LEDGER_ENABLED=false の場合は None)。"""
+    global _store
+    if not config.LEDGER_ENABLED:
+        return None
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SQLiteLedgerStore(config.LEDGER_DB_PATH)
+    return _store
+
+def set_store(store: Optional[LedgerStore]):
+    """状態ストアを差し替えます (テスト用, None で LEDGER_DB_PATH から作り直す)。"""
+    global _store
+    with _store_lock:
+        _store = store
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+def _account_key(account: Optional[str]) -> str:
+    return account.lower() if account else ""
+
+def lookup(name: str, digest: str, account: Optional[str] = None) -> Optional[LedgerEntry]:
+    """完了済みの手順を返します (未記録・無効時は None)。"""
+    store = get_store()
+    if store is None:
+        return None
+    entry = store.get(_account_key(account), name, digest)
+    if entry is not None:
+        services.metrics.LEDGER_HITS.inc(step=INSERTED if entry.inserted else UPLOADED)
+    return entry
+
+def record_upload(name: str, digest: str, gcs_url: str, gcs_path: str, account: Optional[str] = None):
+    store = get_store()
+    if store is not None:
+        store.record_upload(_account_key(account), name, digest, gcs_url, gcs_path)
+
+def record_insert(name: str, digest: str, account: Optional[str] = None):
+    store = get_store()
+    if store is not None:
+        store.record_insert(_account_key(account), name, digest)
@@ -1,11 +1,48 @@
+import time
 import logging
+import itertools
 from typing import List, Dict, Any
 import services.gmail
+import services.accounts
+import services.leases
+import services.circuit_breaker
+import services.rules
+import services.metrics
+import services.tracing
+import services.profiling
+from services.filtering import build_query_filters
 import config
 
 logger = logging.getLogger(__name__)
 
-def lock_and_get_messages() -> List[Dict[str, Any]]:
+# 1回のクレームで取得する最大件数
+CLAIM_BATCH_SIZE = 10
+
+# 分割クエリの開始位置 (クレームごとにずらす)
+_query_rotation = itertools.count()
+
+class ClaimFailed(Exception):
+    """検索できなかった (依存サービスの障害中・API エラーなど) ため、対象の有無が分からない"""
+    pass
+
+def build_claim_queries() -> List[str]:
+    """
+    クレーム用の検索クエリを組み立てます。
+    FILTER_QUERY_PUSHDOWN が有効な場合は送信者/件名フィルタをクエリに含め、
+    長さ上限を超える場合は複数のクエリに分割して返します。
+    """
+    # TARGETラベルがあり、かつ「処理済み」でも「エラー」でもないメールを検索
+    base_query = f"label:{config.TARGET_LABEL} -label:{config.PROCESSED_LABEL_NAME} -label:{config.ERROR_LABEL_NAME}"
+    if not config.FILTER_QUERY_PUSHDOWN:
+        return [base_query]
+
+    filters = build_query_filters(config.GMAIL_QUERY_MAX_LENGTH - len(base_query) - 1,
+                                  include_subjects=config.FILTER_QUERY_PUSHDOWN_SUBJECTS)
+    if not filters:
+        return [base_query]
+    return [f"{base_query} {f}" for f in filters]
+
+def lock_and_get_messages(raise_errors: bool = False) -> List[Dict[str, Any]]:
     """
     【Claim Check パターン】の実装 (Label版):
     
@@ -13,11 +50,55 @@ def lock_and_get_messages() -> List[Dict[str, Any]]:
        (未読/既読は気にしません)
     2. ロック: 見つかったメールに「PROCESSED」ラベルを付与します。
     3. 返却: ラベル付与に成功したメールを返します。
+       複数アカウントモードでは、現在のアカウント (services.accounts.use_account) の
+       メールボックスを検索し、返すメールに 'account' (メールアドレス) を付与します。
     
+    Args:
+        raise_errors: 検索できなかった場合に ClaimFailed を送出する
+            (既定では空のリストを返すため「対象なし」と区別できない)
+
     Returns:
         List[Dict]: 処理対象となるメールのリスト
     """
+    with services.tracing.span_or_trace("claim") as claim_span, services.profiling.profile("claim"):
+        locked_messages = _lock_and_get_messages(raise_errors)
+        claim_span.set_attribute("locked_count", len(locked_messages))
+    return locked_messages
+
+def _enrich_metadata(srv, msg: Dict[str, Any]):
+    """
+    優先度の判定に使うメタデータ (サイズ・受信時刻・送信者) をメールに付与します。
+    取得できなくても処理は続ける (既定の優先度で扱う)。
+    """
+    try:
+        meta = services.gmail.execute(srv.users().messages().get(
+            userId='me', id=msg['id'], format='metadata', metadataHeaders=['From']), "messages.get")
+    except Exception as e:
+        logger.warning("メッセージ %s のメタデータを取得できませんでした: %s", msg['id'], e)
+        return
+    msg['sizeEstimate'] = meta.get('sizeEstimate')
+    msg['internalDate'] = meta.get('internalDate')
+    headers = meta.get('payload', {}).get('headers', [])
+    msg['sender'] = next((h['value'] for h in headers if h.get('name', '').lower() == 'from'), None)
+
+def _lock_and_get_messages(raise_errors: bool = False) -> List[Dict[str, Any]]:
     locked_messages = []
+    start = time.perf_counter()
+    account = services.accounts.current_account()
+
+    # 処理に必要な依存サービスが障害中 (ブレーカーが open) の間はクレームしない
+    open_dependencies = services.circuit_breaker.open_dependencies()
+    if open_dependencies:
+        logger.warning("依存サービスの障害中のためクレームを停止しています: %s", ', '.join(open_dependencies))
+        if raise_errors:
+            raise ClaimFailed(f"依存サービスの障害中です: {', '.join(open_dependencies)}")
+        return locked_messages
+    # フィルタルールを読み込めていない間はクレームしない (クレームしても遮断されて残るため)
+    if services.rules.rules_unavailable():
+        logger.warning("フィルタルールを読み込めていないためクレームを停止しています")
+        if raise_errors:
+            raise ClaimFailed("フィルタルールを読み込めていません")
+        return locked_messages
     
     try:
         srv = services.gmail.get_gmail_service()
@@ -26,18 +107,28 @@ def lock_and_get_messages() -> List[Dict[str, Any]]:
         processed_label_id = services.gmail.get_or_create_label_id(config.PROCESSED_LABEL_NAME)
         
         # 1. 検索 (Claim Check)
-        # TARGETラベルがあり、かつ「処理済み」でも「エラー」でもないメールを検索
-        query = f"label:{config.TARGET_LABEL} -label:{config.PROCESSED_LABEL_NAME} -label:{config.ERROR_LABEL_NAME}"
-        
-        results = srv.users().messages().list(
-            userId='me',
-            q=query,
-            maxResults=10
-        ).execute()
-        
-        messages = results.get('messages', [])
+        # フィルタ押し下げでクエリが分割された場合は、結果を重複なく結合する
+        # 先頭のクエリだけで上限に達して後ろのクエリが飢餓しないよう、開始位置を毎回ずらす
+        queries = build_claim_queries()
+        offset = next(_query_rotation) % len(queries)
+        messages = []
+        seen_ids = set()
+        for query in queries[offset:] + queries[:offset]:
+            remaining = CLAIM_BATCH_SIZE - len(messages)
+            if remaining <= 0:
+                break
+            results = services.gmail.execute(srv.users().messages().list(
+                userId='me',
+                q=query,
+                maxResults=remaining
+            ), "messages.list")
+            for msg in results.get('messages', []):
+                if msg['id'] not in seen_ids:
+                    seen_ids.add(msg['id'])
+                    messages.append(msg)
         
         if not messages:
+            services.metrics.CLAIM_SECONDS.observe(time.perf_counter() - start)
             return []
 
         # --- 2. ロック (Lock) ---
@@ -46,24 +137,39 @@ def lock_and_get_messages() -> List[Dict[str, Any]]:
             try:
                 # 処理済みラベル(PROCESSED)を付与することで「ロック」とする
                 # ついでに未読(UNREAD)も外してあげる（親切心）
-                srv.users().messages().modify(
+                services.gmail.execute(srv.users().messages().modify(
                     userId='me',
                     id=msg_id,
                     body={
                         'addLabelIds': [processed_label_id],
                         'removeLabelIds': ['UNREAD']
                     }
-                ).execute()
+                ), "messages.modify")
                 
-                logger.info(f"メッセージをロック(処理済ラベル付与)しました: {msg_id}")
+                logger.info("メッセージをロック(処理済ラベル付与)しました: %s", msg_id)
+                # リースを記録する (他のワーカーが同時にクレームした場合は譲る)
+                if not services.leases.acquire(msg_id, account.email if account else None):
+                    logger.warning("メッセージ %s は他のワーカーがリース中のためスキップします", msg_id)
+                    services.metrics.CLAIMED.inc(result="lease_conflict")
+                    continue
+                if account is not None:
+                    msg['account'] = account.email
+                if config.PRIORITY_SCHEDULING_ENABLED:
+                    _enrich_metadata(srv, msg)
                 locked_messages.append(msg)
+                services.metrics.CLAIMED.inc(result="locked")
                 
             except Exception as e:
                 # 競合などで失敗した場合はスキップ
-                logger.warning(f"メッセージ {msg_id} のロックに失敗しました: {e}")
+                logger.warning("メッセージ %s のロックに失敗しました: %s", msg_id, e)
+                services.metrics.CLAIMED.inc(result="lock_failed")
                 continue
                 
     except Exception as e:
-        logger.error(f"lock_and_get_messages でエラーが発生しました: {e}")
+        logger.error("lock_and_get_messages でエラーが発生しました: %s", e)
+        if raise_errors:
+            services.metrics.CLAIM_SECONDS.observe(time.perf_counter() - start)
+            raise ClaimFailed(str(e)) from e
         
+    services.metrics.CLAIM_SECONDS.observe(time.perf_counter() - start)
     return locked_messages
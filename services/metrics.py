@@ -0,0 +1,329 @@
+"""
+メトリクス収集モジュール
+Prometheus / OpenMetrics テキスト形式で /metrics から公開する
+
+- 依存ライブラリなしの軽量実装 (記録はロック1回 + dict更新のみ)
+- 他モジュールの統計 (error_monitor など) は、スクレイプ時にコレクター関数で取り込む
+"""
+import time
+import math
+import threading
+import logging
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# レイテンシ用の標準バケット (秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 受信からアーカイブまでの遅延用バケット (秒)
+LAG_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 21600, 86400)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+class _Metric(ABC):
+    type_name = ""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    @abstractmethod
+    def render(self) -> List[str]:
+        pass
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [bucket毎の件数..., sum, count]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        # 該当バケットのみ加算し、累積はレンダリング時に計算する
+        idx = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                idx = i
+                break
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            data[idx] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """with ブロックの所要時間を記録する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get_count(self, **labels) -> int:
+        data = self._values.get(self._key(labels))
+        return int(data[-1]) if data else 0
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = [(k, list(v)) for k, v in self._values.items()]
+        lines = []
+        for key, data in items:
+            cumulative = 0
+            for i, bound in enumerate(self.buckets + (math.inf,)):
+                cumulative += data[i]
+                le = _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', le))} {_format_value(cumulative)}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(data[-2])}")
+            lines.append(f"{self.name}_count{labels} {_format_value(data[-1])}")
+        return lines
+
+# --- レジストリ ---
+
+# コレクター: スクレイプ時に (name, type, help, [(labels dict, value), ...]) を返す関数
+Collector = Callable[[], Iterable[Tuple[str, str, str, List[Tuple[Dict[str, str], float]]]]]
+
+_registry: List[_Metric] = []
+_collectors: List[Collector] = []
+_registry_lock = threading.Lock()
+
+def _register(metric: _Metric) -> _Metric:
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+def counter(name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+    return _register(Counter(name, help_text, labelnames))
+
+def gauge(name: str, help_text: str, labelnames: Sequence[str] = ()) -> Gauge:
+    return _register(Gauge(name, help_text, labelnames))
+
+def histogram(name: str, help_text: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help_text, labelnames, buckets))
+
+def register_collector(collector: Collector):
+    """スクレイプ時に呼ばれる統計取得関数を登録"""
+    with _registry_lock:
+        _collectors.append(collector)
+
+def render() -> str:
+    """全メトリクスを Prometheus テキスト形式で出力"""
+    lines = []
+    for metric in list(_registry):
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type_name}")
+        lines.extend(metric.render())
+
+    for collector in list(_collectors):
+        try:
+            families = list(collector())
+        except Exception as e:
+            logger.warning(f"メトリクスコレクターの実行に失敗しました: {e}")
+            continue
+        for name, type_name, help_text, samples in families:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {type_name}")
+            for labels, value in samples:
+                names = tuple(labels.keys())
+                lines.append(f"{name}{_format_labels(names, tuple(labels[n] for n in names))} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+# --- アプリケーションのメトリクス定義 ---
+
+# process_email_task の各ステージ (fetch, parse, download, upload, extract, insert, label, total)
+STAGE_SECONDS = histogram(
+    "invoice_stage_duration_seconds", "Latency of each process_email_task stage.", ("stage",))
+STAGE_ERRORS = counter(
+    "invoice_stage_errors_total", "Errors raised in each process_email_task stage.", ("stage",))
+MESSAGES = counter(
+    "invoice_messages_total", "Messages handled by process_email_task by result.", ("result",))
+ATTACHMENTS = counter(
+    "invoice_attachments_total", "Attachments handled by result.", ("result",))
+
+# 添付ファイルの分類 (phase: pre_download / post_download)
+CLASSIFIED = counter(
+    "invoice_attachment_classifications_total", "Attachment classifier decisions.", ("decision", "reason", "phase"))
+BYTES_SKIPPED = counter(
+    "invoice_attachment_bytes_skipped_total", "Attachment bytes not archived because the classifier skipped them.")
+
+# lock_and_get_messages (クレームサイクル)
+CLAIM_SECONDS = histogram(
+    "invoice_claim_duration_seconds", "Latency of one lock_and_get_messages claim cycle.")
+CLAIMED = counter(
+    "invoice_claimed_messages_total", "Messages claimed by lock_and_get_messages by result.", ("result",))
+
+# クレームのリース (services.leases)
+LEASE_EVENTS = counter(
+    "invoice_lease_events_total", "Claim lease events (acquired, renewed, released, conflict, reclaimed).", ("event",))
+
+# INVOICE_ERROR の再処理 (services.retry)
+RETRIES = counter(
+    "invoice_error_retries_total", "Automatic retries of INVOICE_ERROR messages by result.", ("result",))
+
+# 添付ファイル処理のメモリ予算 (services.admission)
+MEMORY_RESERVED_BYTES = gauge(
+    "invoice_memory_reserved_bytes", "Bytes currently reserved against the attachment memory budget.")
+ADMISSION_WAIT_SECONDS = histogram(
+    "invoice_admission_wait_seconds", "Time spent waiting for the attachment memory budget.")
+
+# アーカイブ済み添付ファイルの台帳 (services.ledger)
+LEDGER_HITS = counter(
+    "invoice_ledger_hits_total", "Attachments found in the idempotency ledger by last completed step.", ("step",))
+
+# 請求書のエクスポート (services.export)
+EXPORTED_FILES = counter(
+    "invoice_exported_files_total", "Files written to export bundles (exported, missing).", ("result",))
+
+# ローカル検索インデックス (services.search_index)
+SEARCH_SECONDS = histogram(
+    "invoice_search_duration_seconds", "Latency of local search index queries.")
+
+# 依存サービスのサーキットブレーカー (services.circuit_breaker)
+CIRCUIT_STATE = gauge(
+    "invoice_circuit_state", "Circuit breaker state per dependency (0=closed, 1=half_open, 2=open).", ("dependency",))
+CIRCUIT_TRANSITIONS = counter(
+    "invoice_circuit_transitions_total", "Circuit breaker state transitions by dependency and new state.",
+    ("dependency", "state"))
+CIRCUIT_REJECTED = counter(
+    "invoice_circuit_rejected_total", "Calls rejected because the dependency's circuit is open.", ("dependency",))
+
+# ログ出力 (services.structured_logging)
+LOG_RECORDS_DROPPED = counter(
+    "invoice_log_records_dropped_total", "Log records not written (sampled, queue_full).", ("reason",))
+
+# watch_gmail (履歴IDの差分確認)
+WATCH_CHECKS = counter(
+    "invoice_watch_checks_total", "watch_gmail mailbox checks by result.", ("result",))
+WATCH_INTERVAL_SECONDS = gauge(
+    "invoice_watch_interval_seconds", "Current watch_gmail polling interval.")
+
+# Gmail API
+GMAIL_REQUESTS = counter(
+    "gmail_api_requests_total", "Gmail API calls by method and HTTP status.", ("method", "status"))
+GMAIL_SECONDS = histogram(
+    "gmail_api_request_duration_seconds", "Gmail API call latency by method.", ("method",))
+
+# 転送量
+BYTES_DOWNLOADED = counter(
+    "invoice_attachment_bytes_downloaded_total", "Attachment bytes downloaded from Gmail.")
+BYTES_UPLOADED = counter(
+    "invoice_attachment_bytes_uploaded_total", "Attachment bytes uploaded to storage.")
+
+# キュー
+TASKS_QUEUED = gauge(
+    "invoice_tasks_queued", "Claimed messages waiting for a background worker.")
+TASKS_IN_PROGRESS = gauge(
+    "invoice_tasks_in_progress", "Messages currently being processed.")
+
+# 受信 → アーカイブ完了までの遅延
+ARCHIVE_LAG_SECONDS = histogram(
+    "invoice_archive_lag_seconds", "End-to-end lag from Gmail receipt to archived row.", buckets=LAG_BUCKETS)
+
+def _collect_component_stats():
+    """error_monitor / ルールセット / Slackディスパッチャーの統計をスクレイプ時に取り込む"""
+    import services.error_monitor
+    import services.rules
+    import services.slack
+
+    stats = services.error_monitor.get_current_stats()
+    yield ("invoice_error_window_events", "gauge", "Events in the error_monitor sliding window.",
+           [({"result": "success"}, stats["processed"]), ({"result": "error"}, stats["errors"])])
+    yield ("invoice_error_window_rate", "gauge", "Error rate in the error_monitor sliding window.",
+           [({}, stats["error_rate"])])
+    yield ("invoice_error_window_errors_by_stage", "gauge", "Errors by stage in the sliding window.",
+           [({"stage": k}, v) for k, v in stats["errors_by_stage"].items()])
+    yield ("invoice_error_window_errors_by_class", "gauge", "Errors by exception class in the sliding window.",
+           [({"error_class": k}, v) for k, v in stats["errors_by_class"].items()])
+
+    rules = services.rules.get_reload_stats()
+    yield ("invoice_rules_reloads_total", "counter", "Successful filter rule reloads.",
+           [({}, rules["reload_count"])])
+    yield ("invoice_rules_reload_errors_total", "counter", "Failed filter rule reloads.",
+           [({}, rules["reload_errors"])])
+    yield ("invoice_rules_last_reload_timestamp_seconds", "gauge", "Time of the last successful rule reload.",
+           [({}, rules["last_reload_time"])])
+    yield ("invoice_rules_info", "gauge", "Active filter rule set version.",
+           [({"version": str(rules["version"])}, rules["rule_count"])] if rules["version"] else [])
+
+    slack = services.slack.get_dispatcher_stats()
+    yield ("slack_alerts_total", "counter", "Slack alerts handled by the dispatcher by outcome.",
+           [({"outcome": k}, slack[k]) for k in ("submitted", "sent", "coalesced", "dropped", "failed")])
+    yield ("slack_alert_queue_depth", "gauge", "Alerts waiting in the Slack dispatcher queue.",
+           [({}, slack["queue_depth"])])
+
+register_collector(_collect_component_stats)
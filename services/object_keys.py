@@ -0,0 +1,85 @@
+"""
+オブジェクトキー (GCS の保存パス) のレイアウト
+1日分の書き込みが辞書順で連続したプレフィックス (YYYY/MM/DD/) に集中すると、
+月末の請求書集中時やバックフィルで GCS のキー範囲分割が追いつかずスロットリングされる
+
+レイアウト (BLOB_KEY_LAYOUT):
+- date (既定・従来): YYYY/MM/DD/{name}
+- hash_prefix: {hash}/YYYY/MM/DD/{name}
+  キー全体がハッシュで分散するため、書き込みレートに応じてスケールする (日付での一覧は不可)
+- date_shard: YYYY/MM/DD/{shard}/{name}
+  日付での一覧性を保ちつつ、1日分の書き込みを BLOB_KEY_SHARDS 個の範囲に分散する
+
+いずれも name (メッセージID_連番_ファイル名) から決定的に求まるため、
+受信日時と name が分かれば、どのレイアウトで保存されたオブジェクトでも探せる (locate)。
+BigQuery に記録済みの gs:// パスは実際に保存したキーなので、レイアウトを切り替えても変わらない。
+"""
+import re
+import hashlib
+import datetime
+from typing import List, Optional, Tuple
+import config
+
+LAYOUTS = ("date", "hash_prefix", "date_shard")
+
+# 各レイアウトのキーから (日付, name) を取り出すパターン
+_KEY_PATTERNS = {
+    "date": re.compile(r"^(\d{4})/(\d{2})/(\d{2})/([^/]+)$"),
+    "hash_prefix": re.compile(r"^[0-9a-f]+/(\d{4})/(\d{2})/(\d{2})/([^/]+)$"),
+    "date_shard": re.compile(r"^(\d{4})/(\d{2})/(\d{2})/\d+/([^/]+)$"),
+}
+
+def _digest(name: str) -> str:
+    return hashlib.sha256(name.encode("utf-8")).hexdigest()
+
+def build_object_key(received_at: datetime.datetime, name: str, layout: Optional[str] = None) -> str:
+    """
+    文書の保存キーを返します。
+
+    Args:
+        received_at: メールの受信日時 (日付部分を使用)
+        name: メッセージID_連番_ファイル名 (重複挿入防止キーと同じ)
+        layout: 未指定時は BLOB_KEY_LAYOUT
+    """
+    layout = layout or config.BLOB_KEY_LAYOUT
+    date_path = received_at.strftime('%Y/%m/%d')
+    if layout == "date":
+        return f"{date_path}/{name}"
+    if layout == "hash_prefix":
+        return f"{_digest(name)[:config.BLOB_KEY_HASH_LENGTH]}/{date_path}/{name}"
+    if layout == "date_shard":
+        shard = int(_digest(name)[:8], 16) % config.BLOB_KEY_SHARDS
+        width = len(str(config.BLOB_KEY_SHARDS - 1))
+        return f"{date_path}/{shard:0{width}d}/{name}"
+    raise ValueError(f"Unknown BLOB_KEY_LAYOUT: {layout}")
+
+def parse_object_key(key: str) -> Optional[Tuple[str, datetime.date, str]]:
+    """
+    保存キーを (レイアウト, 受信日, name) に分解します。どのレイアウトにも一致しなければ None。
+    """
+    for layout, pattern in _KEY_PATTERNS.items():
+        m = pattern.match(key)
+        if m:
+            year, month, day, name = m.groups()
+            try:
+                return layout, datetime.date(int(year), int(month), int(day)), name
+            except ValueError:
+                return None
+    return None
+
+def candidate_keys(received_at: datetime.datetime, name: str) -> List[str]:
+    """現在のレイアウトを先頭に、全レイアウトでの候補キーを返します。"""
+    layouts = [config.BLOB_KEY_LAYOUT] + [l for l in LAYOUTS if l != config.BLOB_KEY_LAYOUT]
+    return [build_object_key(received_at, name, layout) for layout in layouts]
+
+def locate(storage_adapter, bucket_name: str, received_at: datetime.datetime, name: str) -> Optional[str]:
+    """
+    どのレイアウトで保存されたかに関わらず、文書の保存キーを探します (見つからなければ None)。
+
+    使い方:
+        key = object_keys.locate(adapters.get_storage_adapter(), bucket, received_at, "msg_1_invoice.pdf")
+    """
+    for key in candidate_keys(received_at, name):
+        if storage_adapter.exists(bucket_name, key):
+            return key
+    return None
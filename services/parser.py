@@ -1,21 +1,29 @@
+import io
 import email.utils
+import email.policy
+import email.generator
 import base64
 import datetime
+import functools
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 from dataclasses import dataclass
 
 logger = logging.getLogger(__name__)
 
-@dataclass
+@dataclass(slots=True)
 class Attachment:
     id: str
     filename: str
     mime_type: str
     size: int
     data_base64: Optional[str] = None 
+    # format='raw' で取得した場合は MIME パーツから直接取り出した実データ
+    data: Optional[bytes] = None
+    # Content-Disposition: inline (本文中の署名ロゴ・埋め込み画像など)
+    inline: bool = False
 
-@dataclass
+@dataclass(slots=True)
 class Email:
     id: str
     subject: str
@@ -24,12 +32,36 @@ class Email:
     received_at: datetime.datetime
     attachments: List[Attachment]
 
+# parse_message_detail が参照するヘッダー
+_WANTED_HEADERS = frozenset(('Subject', 'From'))
+
+def _index_headers(headers: List[Dict[str, str]], wanted: frozenset = _WANTED_HEADERS) -> Dict[str, Dict[str, str]]:
+    """
+    ヘッダーリストを1回だけ走査し、必要なヘッダー名 -> 最初に出現したヘッダーの辞書を作ります。
+    必要なヘッダーが揃った時点で走査を打ち切ります。
+    """
+    index = {}
+    for header in headers:
+        name = header.get('name')
+        if name in wanted and name not in index:
+            index[name] = header
+            if len(index) == len(wanted):
+                break
+    return index
+
 def _get_header_value(headers: List[Dict[str, str]], name: str, default: str = "") -> str:
     """ヘッダーリストから指定した名前の値を取得します。"""
-    for header in headers:
-        if header.get('name') == name:
-            return header.get('value', default)
-    return default
+    header = _index_headers(headers, frozenset((name,))).get(name)
+    return header.get('value', default) if header is not None else default
+
+@functools.lru_cache(maxsize=4096)
+def _parse_sender(raw_sender: str) -> Tuple[str, str]:
+    """
+    From ヘッダーを (名前, アドレス) に分解します。名前が空の場合はアドレスを名前にします。
+    送信元は取引先ごとにほぼ固定のため、結果をキャッシュします (parseaddr がパース時間の大半を占める)。
+    """
+    sender_name, sender_address = email.utils.parseaddr(raw_sender)
+    return (sender_name or sender_address), sender_address
 
 def _parse_gmail_date(internal_date_ms: str) -> datetime.datetime:
     """Gmailの internalDate (ミリ秒文字列) を datetime に変換します。"""
@@ -40,49 +72,60 @@ def _parse_gmail_date(internal_date_ms: str) -> datetime.datetime:
         logger.warning(f"日付変換失敗: {internal_date_ms}。現在時刻を使用します。")
         return datetime.datetime.now()
 
-def _find_attachments_recursive(parts_list: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """MIMEパーツから添付ファイルを再帰的に検索します。"""
+def _find_attachments(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    MIMEパーツツリーを明示的なスタックで走査し、添付ファイルのパーツを返します。
+    順序は再帰的な深さ優先 (行きがけ順) と同じです。
+    添付されたメール (message/rfc822) は、それ自体と中の添付ファイルの両方を返します。
+    """
     found = []
-    for part in parts_list:
+    stack = [payload]
+    while stack:
+        part = stack.pop()
         if part.get('filename') and part.get('body', {}).get('attachmentId'):
             found.append(part)
-        
-        if 'parts' in part:
-            found.extend(_find_attachments_recursive(part['parts']))
+        children = part.get('parts')
+        if children:
+            # 先頭の子から処理するため逆順に積む
+            stack.extend(reversed(children))
     return found
 
+def _is_inline(part_headers: List[Dict[str, str]]) -> bool:
+    """パーツの Content-Disposition が inline かどうか"""
+    disposition = _get_header_value(part_headers, 'Content-Disposition')
+    return disposition.strip().lower().startswith('inline')
+
 def parse_message_detail(msg_detail: Dict[str, Any]) -> Email:
     """
     Gmail API のメッセージ詳細JSONを解析し、扱いやすい Email オブジェクトに変換します。
     """
     msg_id = msg_detail.get('id')
     payload = msg_detail.get('payload', {})
-    headers = payload.get('headers', [])
+    headers = _index_headers(payload.get('headers', []))
     
     # 基本情報の抽出
-    subject = _get_header_value(headers, 'Subject', '(件名なし)')
+    subject_header = headers.get('Subject')
+    subject = subject_header.get('value', '(件名なし)') if subject_header is not None else '(件名なし)'
     
     # 送信者情報のパース (From: "Amazon <info@amazon.co.jp>" -> name="Amazon", addr="info@amazon.co.jp")
-    raw_sender = _get_header_value(headers, 'From', '(送信元不明)')
-    sender_name, sender_address = email.utils.parseaddr(raw_sender)
-    
+    from_header = headers.get('From')
+    raw_sender = from_header.get('value', '(送信元不明)') if from_header is not None else '(送信元不明)'
     # 名前が空の場合はアドレスを名前にする (検索のため)
-    if not sender_name:
-        sender_name = sender_address
+    sender_name, sender_address = _parse_sender(raw_sender)
 
     received_at = _parse_gmail_date(msg_detail.get('internalDate', '0'))
     
     # 添付ファイルの抽出
-    raw_attachments = _find_attachments_recursive([payload])
-    attachments = []
-    
-    for att in raw_attachments:
-        attachments.append(Attachment(
+    attachments = [
+        Attachment(
             id=att['body']['attachmentId'],
             filename=att['filename'],
             mime_type=att.get('mimeType', 'application/octet-stream'),
-            size=att['body'].get('size', 0)
-        ))
+            size=att['body'].get('size', 0),
+            inline=_is_inline(att.get('headers', []))
+        )
+        for att in _find_attachments(payload)
+    ]
         
     return Email(
         id=msg_id,
@@ -92,3 +135,57 @@ def parse_message_detail(msg_detail: Dict[str, Any]) -> Email:
         received_at=received_at,
         attachments=attachments
     )
+
+def _message_bytes(message, linesep: str) -> bytes:
+    """添付されたメールを元の形に近いバイト列に戻します (ヘッダーの折り返しはしない)。"""
+    buffer = io.BytesIO()
+    email.generator.BytesGenerator(buffer, mangle_from_=False, maxheaderlen=0).flatten(message, linesep=linesep)
+    return buffer.getvalue()
+
+def parse_raw_message(msg_raw: Dict[str, Any]) -> Email:
+    """
+    Gmail API の format='raw' のレスポンスを標準の email パッケージで解析し、
+    parse_message_detail と同じ Email オブジェクトに変換します。
+    添付ファイルの実データは Attachment.data に格納されるため、追加のダウンロードは不要です。
+    """
+    msg_id = msg_raw.get('id')
+    raw_bytes = base64.urlsafe_b64decode(msg_raw.get('raw', '').encode('ASCII'))
+    mime = email.message_from_bytes(raw_bytes, policy=email.policy.default)
+
+    # ヘッダーは policy.default により RFC2047 デコード済み (Gmail の format='full' と同じ)
+    subject = str(mime.get('Subject', '(件名なし)'))
+    sender_name, sender_address = _parse_sender(str(mime.get('From', '(送信元不明)')))
+
+    received_at = _parse_gmail_date(msg_raw.get('internalDate', '0'))
+
+    # Gmail の payload と同じ深さ優先の順序で、ファイル名付きのパーツを添付ファイルとする
+    # (添付されたメールは .eml として1つ、さらに中の添付ファイルもそれぞれ返す: format='full' と同じ)
+    linesep = "\r\n" if b"\r\n" in raw_bytes else "\n"
+    attachments = []
+    for index, part in enumerate(mime.walk()):
+        if part.is_multipart() and part.get_content_type() != 'message/rfc822':
+            continue
+        filename = part.get_filename()
+        if not filename:
+            continue
+        if part.get_content_type() == 'message/rfc822':
+            data = _message_bytes(part.get_payload(0), linesep)
+        else:
+            data = part.get_payload(decode=True) or b""
+        attachments.append(Attachment(
+            id=f"part-{index}",
+            filename=filename,
+            mime_type=part.get_content_type(),
+            size=len(data),
+            data=data,
+            inline=part.get_content_disposition() == 'inline'
+        ))
+
+    return Email(
+        id=msg_id,
+        subject=subject,
+        sender_name=sender_name,
+        sender_address=sender_address,
+        received_at=received_at,
+        attachments=attachments
+    )
@@ -1,113 +1,399 @@
 import base64
+import contextlib
 import datetime
 import logging
+import mimetypes
 import os
+import time
+import zipfile
 from typing import List, Optional, Dict, Any
 
 import services.gmail
+import services.accounts
+import services.leases
+import services.circuit_breaker
+import services.ledger
+import services.admission
+import services.search_index
 import services.parser
 import services.error_monitor
-from services.filtering import is_allowed_email
+import services.metrics
+import services.tracing
+import services.profiling
+import services.extraction
+import services.classifier
+import services.zip_expander
+import services.object_keys
+from services.filtering import is_allowed_email, is_allowed_attachment
 import adapters
 import config
 
 # ロガー設定
 logger = logging.getLogger(__name__)
 
-def process_email_task(message_data: dict):
+def _observe_stage(stage: str, start: float):
+    """ステージの所要時間をメトリクスに記録"""
+    services.metrics.STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+def _choose_ingest_mode(srv, message_data: dict) -> str:
+    """
+    取得モード (raw / full) を決定します。
+    auto の場合は sizeEstimate で判断し、クレーム時に分からなければ format='minimal' で確認します。
+    """
+    mode = config.INGEST_MODE
+    if mode != "auto":
+        return mode
+
+    size_estimate = message_data.get('sizeEstimate')
+    if size_estimate is None:
+        probe = services.gmail.execute(
+            srv.users().messages().get(userId='me', id=message_data.get('id'), format='minimal'), "messages.get")
+        size_estimate = probe.get('sizeEstimate')
+        # raw 取得時のメモリ予算の予約にも使う
+        message_data['sizeEstimate'] = size_estimate
+
+    if size_estimate is not None and int(size_estimate) <= config.RAW_FETCH_MAX_BYTES:
+        return "raw"
+    return "full"
+
+@contextlib.contextmanager
+def _reserve_member(member):
+    """
+    ZIP メンバーを読み込む分のメモリを追加で予約します。
+    ZIP 本体の予約を持ったまま待つため、予算が埋まっている場合はタイムアウトさせ (デッドロック回避)、
+    False を返す (呼び出し側は読み込まずにストリームのまま保存する)。
+    """
+    with contextlib.ExitStack() as stack:
+        try:
+            stack.enter_context(services.admission.reserve(
+                member.size, timeout=services.admission.NESTED_RESERVE_TIMEOUT_SECONDS))
+        except TimeoutError:
+            logger.warning("メモリ予算に空きがないため、抽出せずに保存します: %s", member.filename)
+            services.metrics.ATTACHMENTS.inc(result="extract_skipped_memory")
+            yield False
+            return
+        yield True
+
+def _classify(policy, att, file_data: Optional[bytes], phase: str):
+    """添付ファイルを分類し、判定をメトリクスに記録します (スキップ時は除外したバイト数も記録)。"""
+    head = file_data[:services.classifier.HEAD_BYTES] if file_data is not None else None
+    verdict = services.classifier.classify(policy, att.filename, att.mime_type, att.size, att.inline, head)
+    services.metrics.CLASSIFIED.inc(decision=verdict.decision, reason=verdict.reason, phase=phase)
+    if verdict.decision == services.classifier.SKIP:
+        logger.info("添付ファイルをスキップ: %s (%s, %s)", att.filename, verdict.kind, verdict.reason)
+        services.metrics.ATTACHMENTS.inc(result="skipped")
+        services.metrics.BYTES_SKIPPED.inc(len(file_data) if file_data is not None else att.size)
+    return verdict
+
+def process_email_task(message_data: dict) -> str:
     """
     1通のメール処理フローを実行します。
     1. 詳細取得 & パース (services.parser)
     2. 安全性フィルタリング
     3. 添付ファイルのアップロード (GCS)
     4. 処理結果の記録 (BigQuery)
+
+    Returns:
+        処理結果 ("success", "error", "filtered", "no_attachments", "parked", "lease_lost")
+        "parked": 依存サービスの障害中 (ブレーカーが open) のため処理せずに未処理へ戻した
+        "lease_lost": 処理開始前にリースが他のワーカーに移っていたため処理しなかった
+    """
+    start = time.perf_counter()
+    services.metrics.TASKS_IN_PROGRESS.inc()
+    try:
+        # 複数アカウントモード: クレームしたメールボックスの認証情報で処理する
+        account = services.accounts.account_for_message(message_data)
+        trace_attrs = {"account": account.email} if account else {}
+        with services.accounts.use_account(account), \
+                services.tracing.correlate(gmail_message_id=message_data.get('id'), **trace_attrs), \
+                services.leases.hold(message_data.get('id'), message_data.get('account')) as lease, \
+                services.tracing.start_trace("process_email", gmail_message_id=message_data.get('id'), **trace_attrs) as trace, \
+                services.profiling.profile("process_email_task"):
+            if lease is not None and lease.get("lost"):
+                result = "lease_lost"
+            else:
+                result = _run_task(message_data)
+            trace.set_attribute("result", result)
+    finally:
+        services.metrics.TASKS_IN_PROGRESS.dec()
+        _observe_stage("total", start)
+    services.metrics.MESSAGES.inc(result=result)
+    return result
+
+def _run_task(message_data: dict) -> str:
+    """
+    process_email_task の本体。
+
+    Returns:
+        処理結果 ("success", "error", "filtered", "no_attachments", "parked")
     """
     msg_id = message_data.get('id')
-    logger.info(f"メッセージを処理中: {msg_id}")
+    logger.info("メッセージを処理中: %s", msg_id)
+    # エラー発生時にどのステージで失敗したかを記録するため (error_monitor.STAGES)
+    stage = "fetch"
+    result = "success"
+    # raw モードでは MIME 全体 (全添付ファイル) が処理の終わりまでメモリに載るため、取得前にまとめて予約する
+    raw_reservation = contextlib.ExitStack()
     
     try:
         srv = services.gmail.get_gmail_service()
+        # 障害中の依存サービスがあれば、ダウンロードする前に戻す
+        services.circuit_breaker.check_available()
         
         # --- 1. メール詳細の取得 ---
-        # format='full' で本文やヘッダーを含む全データを取得
-        msg_detail = srv.users().messages().get(userId='me', id=msg_id, format='full').execute()
+        t0 = time.perf_counter()
+        ingest_mode = _choose_ingest_mode(srv, message_data)
+        if ingest_mode == "raw":
+            # sizeEstimate が分からない場合は raw で取得する上限で見積もる
+            raw_reservation.enter_context(services.admission.reserve(
+                int(message_data.get('sizeEstimate') or config.RAW_FETCH_MAX_BYTES)))
+            # format='raw' で MIME 全体を1回で取得 (添付ファイルの追加ダウンロード不要)
+            msg_raw = services.gmail.execute(
+                srv.users().messages().get(userId='me', id=msg_id, format='raw'), "messages.get")
+            services.metrics.BYTES_DOWNLOADED.inc(len(msg_raw.get('raw', '')))
+        else:
+            # format='full' で本文やヘッダーを含む全データを取得
+            msg_detail = services.gmail.execute(
+                srv.users().messages().get(userId='me', id=msg_id, format='full'), "messages.get")
+        _observe_stage("fetch", t0)
         
         # ★ パース処理を parser.py に委譲 ★
-        email = services.parser.parse_message_detail(msg_detail)
+        t0 = time.perf_counter()
+        if ingest_mode == "raw":
+            email = services.parser.parse_raw_message(msg_raw)
+        else:
+            email = services.parser.parse_message_detail(msg_detail)
+        _observe_stage("parse", t0)
         
         # --- 2. 安全性フィルタリング ---
         # 許可されていない送信者や件名の場合はスキップ
         if not is_allowed_email(email.sender_address, email.subject):
-            logger.info(f"メッセージ {msg_id} をスキップ: フィルターポリシーによりブロックされました。")
-            return
+            logger.info("メッセージ %s をスキップ: フィルターポリシーによりブロックされました。", msg_id)
+            return "filtered"
         
         # --- 3. 添付ファイルの有無チェック ---
         if not email.attachments:
-            logger.info(f"メッセージ {msg_id} に添付ファイルが見つかりません")
-            return
+            logger.info("メッセージ %s に添付ファイルが見つかりません", msg_id)
+            return "no_attachments"
+
+        # 台帳のアカウント (単一アカウントモードでは None)
+        account = message_data.get('account')
 
         # --- 4. アダプターの準備 ---
         storage_adapter = adapters.get_storage_adapter()
         bq_adapter = adapters.get_bigquery_adapter()
         bucket_name = config.BUCKET_NAME_TEMPLATE.format(config.PROJECT_ID)
+        # 添付ファイル分類ポリシー (送信者ごとの上書きを反映)
+        policy = services.classifier.get_policy(email.sender_address, email.subject) \
+            if config.ATTACHMENT_CLASSIFIER_ENABLED else None
+
+        def archive(name: str, filename: str, mime_type: str, size: int,
+                    data: Optional[bytes] = None, stream=None, extra: Optional[Dict[str, Any]] = None,
+                    digest: Optional[str] = None):
+            """
+            1文書をアップロードし、invoice_log に1行記録する (name は保存パスと重複挿入防止キーを兼ねる)
+            digest (添付ファイルの内容のハッシュ) があれば台帳 (services.ledger) で完了済みの手順を飛ばす
+            """
+            nonlocal stage
+            entry = services.ledger.lookup(name, digest, account) if digest else None
+            if entry is not None and entry.inserted:
+                logger.info("アーカイブ済みのためスキップ: %s", name)
+                services.metrics.ATTACHMENTS.inc(result="already_archived")
+                return
 
-        # --- 5. 文書の保存 & ログ記録 ---
-        for i, att in enumerate(email.attachments):
-            # 添付ファイルの実データをダウンロード
-            # (Emailオブジェクトにはメタデータしか入っていないため)
-            att_data_res = srv.users().messages().attachments().get(
-                userId='me', messageId=msg_id, id=att.id
-            ).execute()
-            
-            # Base64デコード
-            file_data = base64.urlsafe_b64decode(att_data_res['data'].encode('UTF-8'))
-            
             # GCS (またはローカル) へアップロード
-            # 保存パス形式:
-            # - 1つのみ: YYYY/MM/DD/メッセージID_ファイル名 (互換性維持)
-            # - 複数あり: YYYY/MM/DD/メッセージID_連番_ファイル名 (重複回避)
-            if len(email.attachments) > 1:
-                blob_path = f"{email.received_at.strftime('%Y/%m/%d')}/{msg_id}_{i+1}_{att.filename}"
+            stage = "upload"
+            t0 = time.perf_counter()
+            blob_path = services.object_keys.build_object_key(email.received_at, name)
+            if entry is not None:
+                # アップロード済み: 記録から再開する
+                gcs_url = entry.gcs_url
+                logger.info("アップロード済みのため記録から再開します: %s", gcs_url)
+            elif data is not None:
+                gcs_url = storage_adapter.save_file(
+                    bucket_name=bucket_name,
+                    file_path=blob_path,
+                    data=data,
+                    content_type=mime_type
+                )
             else:
-                blob_path = f"{email.received_at.strftime('%Y/%m/%d')}/{msg_id}_{att.filename}"
-            
-            gcs_url = storage_adapter.save_file(
-                bucket_name=bucket_name,
-                file_path=blob_path,
-                data=file_data,
-                content_type=att.mime_type
-            )
-            logger.info(f"Storage にアップロードしました: {gcs_url}")
+                # ZIP メンバーなどはストリームのままアップロード
+                gcs_url = storage_adapter.save_fileobj(
+                    bucket_name=bucket_name,
+                    file_path=blob_path,
+                    fileobj=stream,
+                    content_type=mime_type,
+                    size=size
+                )
+            if entry is None:
+                _observe_stage("upload", t0)
+                services.metrics.BYTES_UPLOADED.inc(len(data) if data is not None else size)
+                logger.info("Storage にアップロードしました: %s", gcs_url)
+                if digest:
+                    services.ledger.record_upload(name, digest, gcs_url, f"gs://{bucket_name}/{blob_path}", account)
+
+            # 請求書項目の抽出 (PDFのみ, プロセスプールで実行。失敗しても記録は続行)
+            fields = {}
+            if data is not None and config.EXTRACTION_ENABLED and services.extraction.is_extractable(filename, mime_type):
+                stage = "extract"
+                t0 = time.perf_counter()
+                with services.tracing.span("extract", filename=filename):
+                    fields = services.extraction.extract_invoice_fields(data)
+                _observe_stage("extract", t0)
             
             # BigQuery (またはローカルログ) へ記録
+            stage = "insert"
             row = {
                 "message_id": msg_id,
                 "received_at": email.received_at.isoformat(),
                 "sender_name": email.sender_name,           # 送信者名(New)
                 "sender_address": email.sender_address,     # アドレス(New)
                 "subject": email.subject,
-                "filename": att.filename,
-                "file_size_bytes": att.size,                # サイズ(New)
-                "content_type": att.mime_type,              # MIME(New)
-                "extension": os.path.splitext(att.filename)[1].lower(), # 拡張子(New)
+                "filename": filename,
+                "file_size_bytes": size,                    # サイズ(New)
+                "content_type": mime_type,                  # MIME(New)
+                "extension": os.path.splitext(filename)[1].lower(), # 拡張子(New)
                 "gcs_url": gcs_url,
                 "gcs_path": f"gs://{bucket_name}/{blob_path}",
-                "processed_at": datetime.datetime.now().isoformat()
+                "processed_at": datetime.datetime.now().isoformat(),
+                **({"mailbox": message_data['account']} if message_data.get('account') else {}),
+                **(extra or {}),
+                **fields
             }
             
             # 重複挿入の防止キー
-            if len(email.attachments) > 1:
-                insert_id = f"{msg_id}_{i+1}_{att.filename}"
-            else:
-                insert_id = f"{msg_id}_{att.filename}"
+            insert_id = name
+            t0 = time.perf_counter()
             errors = bq_adapter.insert_rows(config.BQ_TABLE_ID, [row], row_ids=[insert_id])
+            _observe_stage("insert", t0)
             
             if errors:
-                logger.error(f"BigQuery への挿入エラー: {errors}")
+                logger.error("BigQuery への挿入エラー: %s", errors)
+                services.metrics.ATTACHMENTS.inc(result="insert_failed")
             else:
-                logger.info(f"BigQuery に挿入しました: {insert_id}")
+                logger.info("BigQuery に挿入しました: %s", insert_id)
+                if digest:
+                    services.ledger.record_insert(name, digest, account)
+                services.search_index.index_row(insert_id, row)
+                services.metrics.ATTACHMENTS.inc(result="archived")
+                services.metrics.ARCHIVE_LAG_SECONDS.observe(
+                    (datetime.datetime.now() - email.received_at).total_seconds())
+
+        def expand(i: int, att, file_data: bytes, digest: Optional[str]) -> bool:
+            """
+            ZIP のメンバーを1件ずつ展開してアーカイブする。
+            制限超過・破損などで展開できない場合は False を返し、ZIP ごとアーカイブさせる。
+            """
+            nonlocal stage
+            stage = "expand"
+            try:
+                zip_file = services.zip_expander.open_archive(file_data)
+                members = services.zip_expander.list_members(zip_file, services.zip_expander.ZipLimits.from_config())
+            except (zipfile.BadZipFile, services.zip_expander.ZipLimitExceeded) as e:
+                logger.warning("ZIP を展開せずにアーカイブします: %s (%s)", att.filename, e)
+                services.metrics.ATTACHMENTS.inc(result="expand_rejected")
+                return False
+
+            with zip_file:
+                if not members:
+                    # 空の ZIP や __MACOSX/ だけの ZIP は、取りこぼさないよう ZIP ごとアーカイブする
+                    logger.warning("展開対象のメンバーがないため ZIP ごとアーカイブします: %s", att.filename)
+                    services.metrics.ATTACHMENTS.inc(result="expand_rejected")
+                    return False
+                logger.info("ZIP を展開します: %s (%s 件)", att.filename, len(members))
+                try:
+                    for member in members:
+                        stage = "expand"
+                        mime_type = mimetypes.guess_type(member.filename)[0] or "application/octet-stream"
+                        # 保存パス / 重複挿入の防止キー: メッセージID_添付連番_メンバー連番_ファイル名
+                        name = f"{msg_id}_{i+1}_{member.index}_{member.filename}"
+                        extra = {"source_archive": att.filename}
+                        with services.zip_expander.open_member(zip_file, member) as stream:
+                            if config.EXTRACTION_ENABLED and services.extraction.is_extractable(member.filename, mime_type):
+                                # 抽出には実データが必要なため、メンバーの分を追加で予約して読み込む
+                                with _reserve_member(member) as reserved:
+                                    if reserved:
+                                        archive(name, member.filename, mime_type, member.size, data=stream.read(),
+                                                extra=extra, digest=digest)
+                                    else:
+                                        archive(name, member.filename, mime_type, member.size, stream=stream,
+                                                extra=extra, digest=digest)
+                            else:
+                                archive(name, member.filename, mime_type, member.size, stream=stream, extra=extra,
+                                        digest=digest)
+                        services.metrics.ATTACHMENTS.inc(result="expanded_member")
+                except (zipfile.BadZipFile, services.zip_expander.ZipLimitExceeded) as e:
+                    # 読み出し中に実サイズが宣言サイズを超えた・CRC が合わないなど。
+                    # 展開済みのメンバーは残し、ZIP ごとのアーカイブも行う
+                    logger.warning("ZIP の展開を中断し、ZIP ごとアーカイブします: %s (%s)", att.filename, e)
+                    services.metrics.ATTACHMENTS.inc(result="expand_rejected")
+                    return False
+            return True
+
+        # --- 5. 文書の保存 & ログ記録 ---
+        for i, att in enumerate(email.attachments):
+            # ルールごとの添付ファイル制約 (拡張子・サイズ) を満たさないものはダウンロードしない
+            if not is_allowed_attachment(email.sender_address, email.subject, att.filename, att.size):
+                logger.info("添付ファイルをスキップ: %s (ルールの制約により対象外)", att.filename)
+                services.metrics.ATTACHMENTS.inc(result="blocked_by_rule")
+                continue
+
+            # メタデータだけで請求書でないと分かるもの (埋め込み画像・小さな画像など) はダウンロードしない
+            verdict = _classify(policy, att, None, "pre_download") if policy is not None else None
+            if verdict is not None and verdict.decision == services.classifier.SKIP:
+                continue
+
+            # ダウンロードからアップロードまでの間、メモリ予算を予約する (空きがなければ待つ)
+            # raw モードで取り出し済みの添付ファイルは、取得時の予約に含まれている
+            with services.admission.reserve(att.size) if att.data is None else contextlib.nullcontext():
+                stage = "download"
+                if att.data is not None:
+                    # raw モードでは MIME パーツから取り出し済み
+                    file_data = att.data
+                else:
+                    # 添付ファイルの実データをダウンロード
+                    # (Emailオブジェクトにはメタデータしか入っていないため)
+                    t0 = time.perf_counter()
+                    att_data_res = services.gmail.execute(srv.users().messages().attachments().get(
+                        userId='me', messageId=msg_id, id=att.id
+                    ), "messages.attachments.get")
+                
+                    # Base64デコード
+                    file_data = base64.urlsafe_b64decode(att_data_res['data'].encode('UTF-8'))
+                    _observe_stage("download", t0)
+                    services.metrics.BYTES_DOWNLOADED.inc(len(file_data))
+
+                # 台帳のキー (ZIP メンバーは元の ZIP の内容とメンバー連番で識別する)
+                digest = services.ledger.content_hash(file_data) if services.ledger.get_store() is not None else None
+
+                # 実データ先頭のマジックナンバーで判定を確定する
+                head = file_data[:services.classifier.HEAD_BYTES]
+                if policy is not None:
+                    verdict = _classify(policy, att, file_data, "post_download")
+                    if verdict.decision == services.classifier.SKIP:
+                        continue
+
+                # ZIP はメンバーごとに展開して保存 (分類器が無効の場合は中身で判定)
+                if config.ZIP_EXPANSION_ENABLED:
+                    if verdict is not None:
+                        should_expand = verdict.decision == services.classifier.EXPAND
+                    else:
+                        should_expand = services.zip_expander.is_expandable(att.filename, head)
+                    if should_expand and expand(i, att, file_data, digest):
+                        continue
+            
+                # 保存名 (保存キーの末尾。ディレクトリ部分は BLOB_KEY_LAYOUT による):
+                # - 1つのみ: メッセージID_ファイル名 (互換性維持)
+                # - 複数あり: メッセージID_連番_ファイル名 (重複回避)
+                if len(email.attachments) > 1:
+                    name = f"{msg_id}_{i+1}_{att.filename}"
+                else:
+                    name = f"{msg_id}_{att.filename}"
+                archive(name, att.filename, att.mime_type, att.size, data=file_data, digest=digest)
     
         # 6. ラベル変更（成功時：TARGET削除、PROCESSED追加）
+        stage = "label"
+        t0 = time.perf_counter()
         try:
             processed_label_id = services.gmail.get_or_create_label_id(config.PROCESSED_LABEL_NAME)
             target_label_id = services.gmail.get_or_create_label_id(config.TARGET_LABEL)
@@ -116,19 +402,39 @@ def process_email_task(message_data: dict):
                 'addLabelIds': [processed_label_id],
                 'removeLabelIds': [target_label_id]
             }
-            srv.users().messages().modify(userId='me', id=msg_id, body=body).execute()
-            logger.info(f"ラベルを変更しました: {config.TARGET_LABEL} -> {config.PROCESSED_LABEL_NAME}")
+            services.gmail.execute(
+                srv.users().messages().modify(userId='me', id=msg_id, body=body), "messages.modify")
+            logger.info("ラベルを変更しました: %s -> %s", config.TARGET_LABEL, config.PROCESSED_LABEL_NAME)
         except Exception as label_err:
-             logger.error(f"成功ラベルの付与に失敗しましたが、処理自体は完了しています: {label_err}")
+             logger.error("成功ラベルの付与に失敗しましたが、処理自体は完了しています: %s", label_err)
+        _observe_stage("label", t0)
 
         # 成功を記録（閾値監視用）
         services.error_monitor.record_success()
 
+    except services.circuit_breaker.CircuitOpenError as e:
+        # 依存サービスの障害中: エラー扱いにせず、PROCESSED を外して次のクレームに回す
+        logger.warning("メッセージ %s の処理を保留します: %s", msg_id, e)
+        result = "parked"
+        try:
+            processed_label_id = services.gmail.get_or_create_label_id(config.PROCESSED_LABEL_NAME)
+            services.gmail.execute(srv.users().messages().modify(
+                userId='me',
+                id=msg_id,
+                body={'removeLabelIds': [processed_label_id]}
+            ), "messages.modify")
+        except Exception as label_err:
+            logger.error("保留したメッセージのラベルを戻せませんでした: %s", label_err)
+            # PROCESSED のまま残るため、リースの期限切れ後に再処理させる
+            services.leases.keep()
+
     except Exception as e:
-        logger.error(f"メッセージ {msg_id} の処理中にエラーが発生しました: {e}")
+        logger.error("メッセージ %s の処理中にエラーが発生しました: %s", msg_id, e)
+        result = "error"
         
         # エラーを記録（閾値監視用）
-        services.error_monitor.record_error()
+        services.error_monitor.record_error(stage=stage, error_class=type(e).__name__)
+        services.metrics.STAGE_ERRORS.inc(stage=stage)
         
         # エラー発生時のラベル貼り替え処理
         try:
@@ -137,17 +443,23 @@ def process_email_task(message_data: dict):
             error_label_id = services.gmail.get_or_create_label_id(config.ERROR_LABEL_NAME)
             
             # 処理済みラベルを剥がし、エラーラベルを貼る
-            srv.users().messages().modify(
+            services.gmail.execute(srv.users().messages().modify(
                 userId='me',
                 id=msg_id,
                 body={
                     'removeLabelIds': [processed_label_id],
                     'addLabelIds': [error_label_id]
                 }
-            ).execute()
-            logger.info(f"メッセージ {msg_id} にエラーラベル({config.ERROR_LABEL_NAME})を付与しました。")
+            ), "messages.modify")
+            logger.info("メッセージ %s にエラーラベル(%s)を付与しました。", msg_id, config.ERROR_LABEL_NAME)
             
         except Exception as label_err:
-            logger.error(f"エラーラベルの付与にも失敗しました: {label_err}")
+            logger.error("エラーラベルの付与にも失敗しました: %s", label_err)
+            # PROCESSED のまま残るため、リースの期限切れ後に再処理させる
+            services.leases.keep()
+
+    finally:
+        raw_reservation.close()
 
-    logger.info(f"メッセージの処理が完了しました: {msg_id}")
+    logger.info("メッセージの処理が完了しました: %s", msg_id)
+    return result
@@ -0,0 +1,262 @@
+"""
+オンデマンド・プロファイリングモジュール
+Cloud Run ではプロファイラをアタッチできないため、処理パイプライン自体にプロファイラを組み込む
+
+- 有効化: 環境変数 PROFILING_ENABLED / 管理エンドポイント (/admin/profiling) / リクエストヘッダー
+  (管理エンドポイントとリクエストヘッダーは PROFILING_ADMIN_TOKEN を知っている呼び出し元だけが使える)
+- sampling: 別スレッドから一定間隔で対象スレッドのスタックを採取 (低オーバーヘッド)
+- deterministic: sys.setprofile で全関数呼び出しの自己時間を計測 (高精度・高コスト)
+- 出力: collapsed stacks 形式 ("a;b;c 件数") を Storage アダプター経由で保存
+  (flamegraph.pl / speedscope などでそのまま可視化できる)。定期的な保存はバックグラウンドのスレッドで行う
+"""
+import os
+import hmac
+import sys
+import time
+import datetime
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import nullcontext
+from typing import Dict, Optional
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- 内部状態 ---
+_runtime_enabled: Optional[bool] = None  # 管理エンドポイントによる上書き (None なら環境変数に従う)
+_runtime_until = 0.0  # 管理エンドポイントで有効化した場合の期限
+_request_enabled: contextvars.ContextVar[bool] = contextvars.ContextVar("profiling_request_enabled", default=False)
+
+_lock = threading.Lock()
+_stacks: Dict[str, Counter] = {}  # プロファイル名 -> collapsed stack -> 重み
+_last_flush_time = time.time()
+_sampler = None
+_flusher: Optional[threading.Thread] = None
+
+def authorize(token: Optional[str]) -> bool:
+    """管理用の共有シークレット (PROFILING_ADMIN_TOKEN) と一致するか (未設定なら常に False)"""
+    expected = config.PROFILING_ADMIN_TOKEN
+    return bool(expected) and isinstance(token, str) and hmac.compare_digest(token.encode(), expected.encode())
+
+def is_enabled() -> bool:
+    """現在のコンテキストでプロファイリングが有効か"""
+    if _request_enabled.get():
+        return True
+    if _runtime_enabled is not None:
+        if _runtime_until and time.time() > _runtime_until:
+            return bool(config.PROFILING_ENABLED)
+        return _runtime_enabled
+    return bool(config.PROFILING_ENABLED)
+
+def set_enabled(enabled: Optional[bool], duration_seconds: Optional[float] = None):
+    """
+    実行時にプロファイリングを切り替えます (管理エンドポイント用)。
+
+    Args:
+        enabled: True/False で上書き、None で環境変数の設定に戻す
+        duration_seconds: 指定した秒数が経過したら環境変数の設定に戻す
+    """
+    global _runtime_enabled, _runtime_until
+    _runtime_enabled = enabled
+    _runtime_until = time.time() + duration_seconds if (enabled is not None and duration_seconds) else 0.0
+
+def enable_for_request():
+    """現在のリクエスト (と、そこから起動されるバックグラウンド処理) だけプロファイリングを有効にする"""
+    _request_enabled.set(True)
+
+def _frame_label(frame) -> str:
+    return f"{frame.f_globals.get('__name__', '?')}:{frame.f_code.co_name}"
+
+def _collapse(frame) -> str:
+    parts = []
+    while frame is not None:
+        parts.append(_frame_label(frame))
+        frame = frame.f_back
+    parts.reverse()
+    return ";".join(parts)
+
+def _record(name: str, stack: str, weight: int):
+    with _lock:
+        counter = _stacks.get(name)
+        if counter is None:
+            counter = _stacks[name] = Counter()
+        counter[stack] += weight
+
+# --- Sampling Profiler ---
+
+class _Sampler:
+    """登録されたスレッドのスタックを一定間隔で採取するバックグラウンドスレッド"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.targets: Dict[int, str] = {}  # スレッドID -> プロファイル名
+        self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if not self.targets:
+                continue
+            frames = sys._current_frames()
+            for thread_id, name in list(self.targets.items()):
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    _record(name, _collapse(frame), 1)
+
+def _get_sampler() -> _Sampler:
+    global _sampler
+    with _lock:
+        if _sampler is None:
+            _sampler = _Sampler(config.PROFILING_INTERVAL_MS / 1000)
+        return _sampler
+
+class _SamplingRegion:
+    def __init__(self, name: str):
+        self.name = name
+        self.thread_id = threading.get_ident()
+        self.previous = None
+
+    def __enter__(self):
+        sampler = _get_sampler()
+        self.previous = sampler.targets.get(self.thread_id)
+        sampler.targets[self.thread_id] = self.name
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        sampler = _get_sampler()
+        if self.previous is None:
+            sampler.targets.pop(self.thread_id, None)
+        else:
+            sampler.targets[self.thread_id] = self.previous
+        _maybe_flush()
+        return False
+
+# --- Deterministic Profiler ---
+
+class _DeterministicRegion:
+    """sys.setprofile で関数ごとの自己時間 (マイクロ秒) を collapsed stack 単位で集計する"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.stack = []  # [(ラベル, 開始時刻, 子の合計時間)]
+        self.counts = Counter()
+        self.previous = None
+        self.base = ""
+
+    def _profile(self, frame, event, arg):
+        if event in ("call", "c_call"):
+            label = _frame_label(frame) if event == "call" else f"builtins:{getattr(arg, '__name__', '?')}"
+            self.stack.append([label, time.perf_counter(), 0.0])
+        elif event in ("return", "c_return", "c_exception") and self.stack:
+            label, start, child_time = self.stack.pop()
+            elapsed = time.perf_counter() - start
+            path = ";".join([self.base] + [s[0] for s in self.stack] + [label])
+            self.counts[path] += int((elapsed - child_time) * 1_000_000)
+            if self.stack:
+                self.stack[-1][2] += elapsed
+
+    def __enter__(self):
+        caller = sys._getframe(1)
+        self.base = _collapse(caller)
+        self.previous = sys.getprofile()
+        sys.setprofile(self._profile)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        sys.setprofile(self.previous)
+        with _lock:
+            counter = _stacks.setdefault(self.name, Counter())
+            counter.update({k: v for k, v in self.counts.items() if v > 0})
+        _maybe_flush()
+        return False
+
+# --- API ---
+
+def profile(name: str):
+    """
+    ブロックをプロファイリングします (無効時は何もしない)。
+
+    使い方:
+        with profiling.profile("process_email_task"):
+            ...
+    """
+    if not is_enabled():
+        return nullcontext()
+    if config.PROFILING_MODE == "deterministic":
+        return _DeterministicRegion(name)
+    return _SamplingRegion(name)
+
+def render_collapsed(name: str) -> str:
+    """集計済みのスタックを collapsed stacks 形式で返します。"""
+    with _lock:
+        counter = Counter(_stacks.get(name, {}))
+    return "".join(f"{stack} {count}\n" for stack, count in counter.most_common())
+
+def _maybe_flush():
+    """保存間隔を過ぎていたら、バックグラウンドのスレッドで保存します (処理中のスレッドを待たせない)。"""
+    global _flusher
+    if time.time() - _last_flush_time < config.PROFILING_FLUSH_SECONDS:
+        return
+    with _lock:
+        if _flusher is not None and _flusher.is_alive():
+            return
+        _flusher = threading.Thread(target=_flush_in_background, name="profiler-flush", daemon=True)
+        _flusher.start()
+
+def _flush_in_background():
+    try:
+        flush()
+    except Exception as e:
+        logger.error(f"プロファイルの保存に失敗しました: {e}")
+
+def flush() -> Dict[str, str]:
+    """
+    集計済みのプロファイルを Storage アダプターへ書き出し、集計をリセットします。
+
+    Returns:
+        プロファイル名 -> 保存先URL
+    """
+    global _last_flush_time
+    import adapters
+
+    with _lock:
+        snapshot = {name: counter for name, counter in _stacks.items() if counter}
+        _stacks.clear()
+        _last_flush_time = time.time()
+
+    if not snapshot:
+        return {}
+
+    bucket_name = config.PROFILING_BUCKET or config.BUCKET_NAME_TEMPLATE.format(config.PROJECT_ID)
+    timestamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    storage_adapter = adapters.get_storage_adapter()
+    saved = {}
+    for name, counter in snapshot.items():
+        data = "".join(f"{stack} {count}\n" for stack, count in counter.most_common())
+        path = f"{config.PROFILING_PREFIX}/{name}/{timestamp}-{os.getpid()}.collapsed"
+        try:
+            saved[name] = storage_adapter.save_file(
+                bucket_name=bucket_name,
+                file_path=path,
+                data=data.encode("utf-8"),
+                content_type="text/plain"
+            )
+            logger.info(f"プロファイルを保存しました: {saved[name]} ({len(counter)} スタック)")
+        except Exception as e:
+            logger.error(f"プロファイルの保存に失敗しました ({name}): {e}")
+    return saved
+
+def get_status() -> dict:
+    """プロファイリングの状態を取得"""
+    with _lock:
+        pending = {name: sum(c.values()) for name, c in _stacks.items()}
+    return {
+        "enabled": is_enabled(),
+        "mode": config.PROFILING_MODE,
+        "runtime_override": _runtime_enabled,
+        "runtime_until": _runtime_until or None,
+        "pending_samples": pending,
+    }
@@ -0,0 +1,60 @@
+"""
+レート制限モジュール
+Gmail API のクォータ (ユーザーあたりのクォータユニット/秒) を超えないよう、呼び出しを平準化する
+"""
+import time
+import threading
+
+class TokenBucket:
+    """
+    トークンバケット (スレッドセーフ)
+
+    rate: 1秒あたりに補充されるトークン数
+    capacity: 貯められるトークンの上限 (瞬間的なバーストの大きさ)
+    """
+
+    def __init__(self, rate: float, capacity: float = None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+        self.waited_seconds = 0.0
+
+    def _refill(self, now: float):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        """トークンが足りれば消費して True、足りなければ何もせず False を返します。"""
+        with self._lock:
+            self._refill(self._clock())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        トークンが貯まるまで待ってから消費します。
+
+        Returns:
+            待機した秒数
+        """
+        # 容量を超える要求は容量分で打ち切る (永久に待たないため)
+        tokens = min(tokens, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(self._clock())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    self.waited_seconds += waited
+                    return waited
+                wait = (tokens - self._tokens) / self.rate
+            self._sleep(wait)
+            waited += wait
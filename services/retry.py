@@ -0,0 +1,283 @@
+"""
+INVOICE_ERROR メールの自動再処理
+
+一時的な障害 (GCS 503, Gmail 429 など) で失敗したメールを、人手を介さずに再処理する。
+
+- 定期的に INVOICE_ERROR のメールを列挙し、メッセージごとの試行回数と次回試行時刻を状態ストアに記録する
+- 次回試行時刻を過ぎたメールを RETRY_BATCH_SIZE 件ずつ再クレームして再処理する
+- 失敗するたびに待ち時間を指数的に延ばす (ジッター付き: 一斉に再試行しないため)
+- RETRY_MAX_ATTEMPTS 回失敗したメールは INVOICE_DEAD_LETTER に移し (TARGET も外す)、以降は再処理しない
+- 再処理以外で INVOICE_ERROR から外れたメール (手動で再投入した等) の状態は、次の列挙時に削除する
+- RETRY_ENABLED=false の場合は何もしない
+"""
+import time
+import random
+import logging
+import sqlite3
+import threading
+import concurrent.futures
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import services.gmail
+import services.accounts
+import services.leases
+import services.circuit_breaker
+import services.metrics
+import config
+
+logger = logging.getLogger(__name__)
+
+# messages.list の1ページの件数
+LIST_PAGE_SIZE = 500
+
+@dataclass(frozen=True)
+class RetryState:
+    message_id: str
+    account: str  # 単一アカウントモードでは ""
+    attempts: int
+    next_attempt_at: float
+
+class RetryStore(ABC):
+    @abstractmethod
+    def get_many(self, account: str, message_ids: List[str]) -> Dict[str, RetryState]:
+        pass
+
+    @abstractmethod
+    def put(self, state: RetryState):
+        pass
+
+    @abstractmethod
+    def delete(self, account: str, message_id: str):
+        pass
+
+    @abstractmethod
+    def prune(self, account: str, keep_ids: List[str]) -> int:
+        """keep_ids 以外のメッセージの状態を削除し、削除件数を返します。"""
+        pass
+
+class SQLiteRetryStore(RetryStore):
+    """SQLite の状態ストア (接続はスレッドごと)"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._connect().execute("""
+            CREATE TABLE IF NOT EXISTS retries (
+                message_id TEXT NOT NULL,
+                account TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                next_attempt_at REAL NOT NULL,
+                PRIMARY KEY (account, message_id)
+            )""")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, account, message_ids):
+        states = {}
+        conn = self._connect()
+        # SQLite のプレースホルダ数の上限を超えないよう分割する
+        for i in range(0, len(message_ids), 500):
+            chunk = message_ids[i:i + 500]
+            rows = conn.execute(
+                f"SELECT message_id, account, attempts, next_attempt_at FROM retries "
+                f"WHERE account = ? AND message_id IN ({','.join('?' * len(chunk))})",
+                [account, *chunk]).fetchall()
+            states.update({row[0]: RetryState(*row) for row in rows})
+        return states
+
+    def put(self, state):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO retries (message_id, account, attempts, next_attempt_at) VALUES (?, ?, ?, ?)",
+            (state.message_id, state.account, state.attempts, state.next_attempt_at))
+
+    def delete(self, account, message_id):
+        self._connect().execute("DELETE FROM retries WHERE account = ? AND message_id = ?", (account, message_id))
+
+    def prune(self, account, keep_ids):
+        conn = self._connect()
+        keep = set(keep_ids)
+        stale = [row[0] for row in conn.execute("SELECT message_id FROM retries WHERE account = ?", (account,))
+                 if row[0] not in keep]
+        for i in range(0, len(stale), 500):
+            chunk = stale[i:i + 500]
+            conn.execute(f"DELETE FROM retries WHERE account = ? AND message_id IN ({','.join('?' * len(chunk))})",
+                         [account, *chunk])
+        return len(stale)
+
+# --- 内部状態 ---
+_store: Optional[RetryStore] = None
+_store_lock = threading.Lock()
+# 1プロセスで同時に複数の再処理サイクルを走らせない
+_cycle_lock = threading.Lock()
+
+def get_store() -> RetryStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = SQLiteRetryStore(config.RETRY_DB_PATH)
+    return _store
+
+def set_store(store: Optional[RetryStore]):
+    """状態ストアを差し替えます (テスト用, None で RETRY_DB_PATH から作り直す)。"""
+    global _store
+    with _store_lock:
+        _store = store
+
+def backoff_seconds(attempts: int, rng=None) -> float:
+    """
+    attempts 回目の失敗後の待ち時間 (指数バックオフ + ジッター)。
+    基準値 RETRY_BASE_DELAY_SECONDS * 2^(attempts-1) (上限 RETRY_MAX_DELAY_SECONDS) の 50〜100%。
+    """
+    delay = min(config.RETRY_MAX_DELAY_SECONDS, config.RETRY_BASE_DELAY_SECONDS * (2 ** max(attempts - 1, 0)))
+    return delay * (0.5 + (rng or random.random)() / 2)
+
+def _list_error_message_ids(srv) -> List[str]:
+    ids = []
+    page_token = None
+    query = f"label:{config.ERROR_LABEL_NAME} -label:{config.DEAD_LETTER_LABEL_NAME}"
+    while True:
+        results = services.gmail.execute(srv.users().messages().list(
+            userId='me',
+            q=query,
+            maxResults=LIST_PAGE_SIZE,
+            pageToken=page_token
+        ), "messages.list")
+        ids.extend(msg['id'] for msg in results.get('messages', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return ids
+
+def _plan(account_key: str, message_ids: List[str], now: float, limit: int):
+    """再処理する / デッドレターに移すメッセージを選びます (初めて見たメールは状態を記録するだけ)。"""
+    store = get_store()
+    pruned = store.prune(account_key, message_ids)
+    if pruned:
+        logger.info(f"{config.ERROR_LABEL_NAME} から外れたメール {pruned} 件の再処理状態を削除しました")
+    states = store.get_many(account_key, message_ids)
+    due, dead = [], []
+    for msg_id in message_ids:
+        state = states.get(msg_id)
+        if state is None:
+            # 元の処理で1回失敗している
+            store.put(RetryState(msg_id, account_key, 1, now + backoff_seconds(1)))
+            continue
+        if state.next_attempt_at > now:
+            continue
+        if state.attempts >= config.RETRY_MAX_ATTEMPTS:
+            dead.append(state)
+        elif len(due) < limit:
+            due.append(state)
+    return due, dead
+
+def _batch_modify(srv, ids: List[str], add: List[str], remove: List[str]):
+    for i in range(0, len(ids), services.leases.BATCH_MODIFY_LIMIT):
+        services.gmail.execute(srv.users().messages().batchModify(
+            userId='me',
+            body={'ids': ids[i:i + services.leases.BATCH_MODIFY_LIMIT], 'addLabelIds': add, 'removeLabelIds': remove}
+        ), "messages.batchModify")
+
+def _retry_account(account: Optional[services.accounts.Account], now: float, limit: int, stats: dict):
+    from services.processor import process_email_task
+
+    store = get_store()
+    account_key = account.key if account else ""
+    srv = services.gmail.get_gmail_service()
+    due, dead = _plan(account_key, _list_error_message_ids(srv), now, limit)
+
+    error_label_id = services.gmail.get_or_create_label_id(config.ERROR_LABEL_NAME)
+    if dead:
+        # TARGET も外して通常のクレームの対象からも外す (手動で再投入する場合は TARGET を付け直す)
+        dead_label_id = services.gmail.get_or_create_label_id(config.DEAD_LETTER_LABEL_NAME)
+        target_label_id = services.gmail.get_or_create_label_id(config.TARGET_LABEL)
+        _batch_modify(srv, [s.message_id for s in dead], add=[dead_label_id], remove=[error_label_id, target_label_id])
+        for state in dead:
+            store.delete(account_key, state.message_id)
+        logger.warning(f"{len(dead)} 件のメールを {config.DEAD_LETTER_LABEL_NAME} に移しました "
+                       f"({config.RETRY_MAX_ATTEMPTS} 回失敗)")
+        services.metrics.RETRIES.inc(len(dead), result="dead_letter")
+        stats["dead_lettered"] += len(dead)
+    if not due:
+        return
+
+    # 再クレーム: リースを取得できたメールだけ ERROR を外して PROCESSED (ロック) を付ける
+    # (取得できなかったメールは ERROR のまま残し、次のサイクルで再試行する)
+    email = account.email if account else None
+    acquired = [state for state in due if services.leases.acquire(state.message_id, email)]
+    if not acquired:
+        return
+    processed_label_id = services.gmail.get_or_create_label_id(config.PROCESSED_LABEL_NAME)
+    relabelled = []
+    try:
+        for i in range(0, len(acquired), services.leases.BATCH_MODIFY_LIMIT):
+            chunk = acquired[i:i + services.leases.BATCH_MODIFY_LIMIT]
+            _batch_modify(srv, [s.message_id for s in chunk], add=[processed_label_id], remove=[error_label_id])
+            relabelled.extend(chunk)
+    except Exception as e:
+        # 付け替えられなかったメールはリースを解放して ERROR のまま残す (付け替え済みの分は処理する)
+        logger.error(f"再クレームのラベル付けに失敗しました: {e}")
+        for state in acquired[len(relabelled):]:
+            services.leases.release(state.message_id, email)
+    messages = [({'id': state.message_id, 'account': email} if account else {'id': state.message_id}, state)
+                for state in relabelled]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=config.RETRY_WORKERS, thread_name_prefix="retry") as pool:
+        futures = {pool.submit(process_email_task, msg): state for msg, state in messages}
+        for future in concurrent.futures.as_completed(futures):
+            state = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"メッセージ {state.message_id} の再処理に失敗しました: {e}")
+                result = "error"
+            if result in ("parked", "lease_lost"):
+                # 依存サービスの障害中・他のワーカーが処理中で試行していないため、回数に数えない
+                continue
+            ok = result != "error"
+            if ok:
+                store.delete(account_key, state.message_id)
+                services.metrics.RETRIES.inc(result="recovered")
+                stats["recovered"] += 1
+            else:
+                attempts = state.attempts + 1
+                store.put(RetryState(state.message_id, account_key, attempts, time.time() + backoff_seconds(attempts)))
+                services.metrics.RETRIES.inc(result="failed")
+                stats["failed"] += 1
+
+def run_retry_cycle(limit: int = None, now: float = None) -> dict:
+    """
+    再処理を1サイクル実行します (アカウントごとに最大 limit 件)。
+
+    Returns:
+        {"recovered": 件数, "failed": 件数, "dead_lettered": 件数}
+    """
+    stats = {"recovered": 0, "failed": 0, "dead_lettered": 0}
+    if not config.RETRY_ENABLED:
+        return stats
+    open_dependencies = services.circuit_breaker.open_dependencies()
+    if open_dependencies:
+        logger.info(f"依存サービスの障害中のため再処理をスキップします: {', '.join(open_dependencies)}")
+        return stats
+    if not _cycle_lock.acquire(blocking=False):
+        logger.info("再処理サイクルは実行中です。スキップします。")
+        return stats
+    try:
+        for account in services.accounts.get_accounts() or [None]:
+            try:
+                with services.accounts.use_account(account):
+                    _retry_account(account, time.time() if now is None else now,
+                                   limit or config.RETRY_BATCH_SIZE, stats)
+            except Exception as e:
+                logger.error(f"エラーメールの再処理に失敗しました ({account.email if account else 'me'}): {e}")
+    finally:
+        _cycle_lock.release()
+    if any(stats.values()):
+        logger.info(f"エラーメールの再処理: {stats}")
+    return stats
@@ -0,0 +1,294 @@
+"""
+フィルタルールの動的読み込みモジュール
+
+- ルールはローカルファイル or GCSオブジェクト (gs://bucket/path.json) から読み込む
+- 変更はポーリング (RULES_POLL_SECONDS) または SIGHUP / /reload-rules で検知
+- コンパイル済みのルールセットは参照の差し替えで原子的に切り替える
+  (is_allowed_email 側はロックを取らないため、リロード中もブロックされない)
+- 初回の読み込みは1回だけ試みる。失敗した場合の再試行はウォッチャーに任せ、
+  一度も読み込めていない間は全て遮断する (rules_unavailable, fail-closed)
+
+ルールファイル形式 (JSON):
+{
+  "version": "2025-01-10",
+  "rules": [
+    {
+      "name": "amazon",
+      "domains": ["amazon.co.jp"],
+      "subject_keywords": ["請求書"],
+      "allowed_extensions": [".pdf"],
+      "max_attachment_bytes": 10485760,
+      "attachment_policy": {
+        "skip_inline_images": true,
+        "min_image_bytes": 20480,
+        "archive_types": ["pdf"],
+        "skip_types": ["html"],
+        "expand_archives": true
+      }
+    }
+  ]
+}
+"""
+import os
+import json
+import time
+import signal
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+import config
+
+# Optional imports for GCP (only needed if rules are stored in GCS)
+try:
+    from google.cloud import storage
+except ImportError:
+    storage = None
+
+logger = logging.getLogger(__name__)
+
+@dataclass(frozen=True)
+class AttachmentPolicy:
+    """
+    添付ファイル分類ポリシー (services.classifier が使用)
+    未指定の項目は環境変数の既定値 (CLASSIFIER_*) を使う
+    """
+    # 本文埋め込みの画像 (Content-Disposition: inline, image001.png など) をスキップ
+    skip_inline_images: Optional[bool] = None
+    # これより小さい画像は署名ロゴ・トラッキングピクセルとしてスキップ
+    min_image_bytes: Optional[int] = None
+    # 常にアーカイブ / 常にスキップする種別 (services.classifier.KINDS)
+    archive_types: Tuple[str, ...] = ()
+    skip_types: Tuple[str, ...] = ()
+    # ZIP などのアーカイブを展開するか
+    expand_archives: Optional[bool] = None
+
+@dataclass(frozen=True)
+class Rule:
+    name: str
+    domains: Tuple[str, ...] = ()
+    subject_keywords: Tuple[str, ...] = ()
+    # 空の場合は拡張子を制限しない
+    allowed_extensions: Tuple[str, ...] = ()
+    # None の場合はサイズを制限しない
+    max_attachment_bytes: Optional[int] = None
+    # None の場合は既定の分類ポリシー
+    attachment_policy: Optional[AttachmentPolicy] = None
+
+    def matches(self, sender_lower: str, subject_lower: str) -> bool:
+        """送信者ドメイン OR 件名キーワードのいずれかに一致するか"""
+        if any(d in sender_lower for d in self.domains):
+            return True
+        return any(k in subject_lower for k in self.subject_keywords)
+
+    def allows_attachment(self, filename: str, size: int) -> bool:
+        """添付ファイルの拡張子・サイズ制約を満たすか"""
+        if self.allowed_extensions:
+            ext = os.path.splitext(filename)[1].lower()
+            if ext not in self.allowed_extensions:
+                return False
+        if self.max_attachment_bytes is not None and size > self.max_attachment_bytes:
+            return False
+        return True
+
+@dataclass(frozen=True)
+class RuleSet:
+    version: str
+    rules: Tuple[Rule, ...]
+
+    def match(self, sender: str, subject: str) -> Optional[Rule]:
+        """最初に一致したルールを返す (一致なしは None)"""
+        sender_lower = sender.lower()
+        subject_lower = subject.lower()
+        for rule in self.rules:
+            if rule.matches(sender_lower, subject_lower):
+                return rule
+        return None
+
+    @property
+    def domains(self) -> List[str]:
+        return [d for r in self.rules for d in r.domains]
+
+    @property
+    def subject_keywords(self) -> List[str]:
+        return [k for r in self.rules for k in r.subject_keywords]
+
+def _compile_policy(item: Optional[dict]) -> Optional[AttachmentPolicy]:
+    if not item:
+        return None
+    min_bytes = item.get("min_image_bytes")
+    return AttachmentPolicy(
+        skip_inline_images=item.get("skip_inline_images"),
+        min_image_bytes=int(min_bytes) if min_bytes is not None else None,
+        archive_types=tuple(t.strip().lower() for t in item.get("archive_types", []) if t.strip()),
+        skip_types=tuple(t.strip().lower() for t in item.get("skip_types", []) if t.strip()),
+        expand_archives=item.get("expand_archives")
+    )
+
+def compile_rule_set(raw: bytes) -> RuleSet:
+    """ルールファイルの内容を検証・正規化して RuleSet を作成します。"""
+    doc = json.loads(raw.decode("utf-8"))
+    rules = []
+    for i, item in enumerate(doc.get("rules", [])):
+        extensions = tuple(
+            (e if e.startswith(".") else f".{e}").lower()
+            for e in item.get("allowed_extensions", []) if e.strip()
+        )
+        max_bytes = item.get("max_attachment_bytes")
+        rules.append(Rule(
+            name=item.get("name", f"rule_{i}"),
+            domains=tuple(d.strip().lower() for d in item.get("domains", []) if d.strip()),
+            subject_keywords=tuple(k.strip().lower() for k in item.get("subject_keywords", []) if k.strip()),
+            allowed_extensions=extensions,
+            max_attachment_bytes=int(max_bytes) if max_bytes is not None else None,
+            attachment_policy=_compile_policy(item.get("attachment_policy"))
+        ))
+    # バージョン未指定の場合は内容のハッシュをバージョンとする
+    version = str(doc.get("version") or hashlib.sha256(raw).hexdigest()[:12])
+    return RuleSet(version=version, rules=tuple(rules))
+
+# --- ルールソース ---
+
+def _read_local(path: str, last_fingerprint: Optional[str]) -> Tuple[str, Optional[bytes]]:
+    st = os.stat(path)
+    fingerprint = f"{st.st_mtime_ns}:{st.st_size}"
+    if fingerprint == last_fingerprint:
+        return fingerprint, None
+    with open(path, "rb") as f:
+        return fingerprint, f.read()
+
+def _read_gcs(uri: str, last_fingerprint: Optional[str]) -> Tuple[str, Optional[bytes]]:
+    if not storage:
+        raise ImportError("google-cloud-storage is not installed.")
+    bucket_name, _, blob_name = uri[len("gs://"):].partition("/")
+    blob = storage.Client().bucket(bucket_name).get_blob(blob_name)
+    if blob is None:
+        raise FileNotFoundError(uri)
+    # 世代番号 (generation) が変わっていなければダウンロードしない
+    fingerprint = str(blob.generation)
+    if fingerprint == last_fingerprint:
+        return fingerprint, None
+    return fingerprint, blob.download_as_bytes(if_generation_match=blob.generation)
+
+def _read_source(source: str, last_fingerprint: Optional[str]) -> Tuple[str, Optional[bytes]]:
+    """ルールソースを読み込みます。変更がなければ内容は None を返します。"""
+    if source.startswith("gs://"):
+        return _read_gcs(source, last_fingerprint)
+    return _read_local(source, last_fingerprint)
+
+# --- 内部状態 ---
+_active_rule_set: Optional[RuleSet] = None
+_fingerprint: Optional[str] = None
+_reload_lock = threading.Lock()
+# 初回の読み込みを試みたか (失敗しても呼び出し側では再試行しない)
+_initial_load_attempted = False
+_reload_requested = threading.Event()
+_watcher_thread: Optional[threading.Thread] = None
+_stats = {
+    "reload_count": 0,
+    "reload_errors": 0,
+    "last_reload_time": 0.0,
+    "last_check_time": 0.0,
+}
+
+def get_active_rule_set() -> Optional[RuleSet]:
+    """
+    現在有効なルールセットを返します。
+    RULES_SOURCE 未設定時は None (環境変数の ALLOWED_DOMAINS / SUBJECT_KEYWORDS を使用)。
+    RULES_SOURCE 設定時に一度も読み込めていない場合も None を返すため、
+    呼び出し側は rules_unavailable() で遮断すること。
+    """
+    if _active_rule_set is None and config.RULES_SOURCE and not _initial_load_attempted:
+        _initial_load()
+    return _active_rule_set
+
+def rules_unavailable() -> bool:
+    """RULES_SOURCE が設定されているのに、ルールセットを一度も読み込めていないか"""
+    return bool(config.RULES_SOURCE) and get_active_rule_set() is None
+
+def _initial_load():
+    """初回のみ同期的に読み込みます (以降の更新・失敗時の再試行はウォッチャーが行う)。"""
+    global _initial_load_attempted
+    with _reload_lock:
+        if _initial_load_attempted:
+            return
+        _initial_load_attempted = True
+    if not reload_rules():
+        _alert_unavailable()
+
+def _alert_unavailable():
+    import services.slack
+    message = (f"フィルタルールを読み込めませんでした ({config.RULES_SOURCE})。"
+               f"読み込めるまでメールのクレームを停止し、全て遮断します。")
+    logger.error(message)
+    services.slack.enqueue_slack_alert(message, level="error", dedup_key="rules_unavailable")
+
+def reload_rules(force: bool = False) -> bool:
+    """
+    ルールソースを確認し、変更があればコンパイルして差し替えます。
+    読み込みに失敗した場合は現在のルールセットを維持します。
+
+    Returns:
+        ルールセットを差し替えた場合は True
+    """
+    global _active_rule_set, _fingerprint
+    source = config.RULES_SOURCE
+    if not source:
+        return False
+
+    with _reload_lock:
+        _stats["last_check_time"] = time.time()
+        try:
+            fingerprint, raw = _read_source(source, None if force else _fingerprint)
+            if raw is None:
+                return False
+            rule_set = compile_rule_set(raw)
+        except Exception as e:
+            _stats["reload_errors"] += 1
+            logger.error(f"ルールの読み込みに失敗しました ({source}): {e}")
+            return False
+
+        previous = _active_rule_set.version if _active_rule_set else None
+        # 参照の代入は原子的なので、読み取り側はロック不要
+        _active_rule_set = rule_set
+        _fingerprint = fingerprint
+        _stats["reload_count"] += 1
+        _stats["last_reload_time"] = time.time()
+
+    logger.info(f"ルールセットを更新しました: {previous} -> {rule_set.version} ({len(rule_set.rules)} ルール)")
+    return True
+
+def request_reload():
+    """ウォッチャーに即時リロードを要求します (シグナルハンドラや管理エンドポイントから使用)。"""
+    _reload_requested.set()
+
+def _watch_loop():
+    while True:
+        _reload_requested.wait(timeout=config.RULES_POLL_SECONDS)
+        _reload_requested.clear()
+        reload_rules()
+
+def start_rule_watcher():
+    """ルールソースのポーリング用スレッドを起動します (RULES_SOURCE 設定時のみ)。"""
+    global _watcher_thread
+    if not config.RULES_SOURCE or _watcher_thread is not None:
+        return
+
+    get_active_rule_set()
+    _watcher_thread = threading.Thread(target=_watch_loop, name="rules-watcher", daemon=True)
+    _watcher_thread.start()
+
+    # SIGHUP でのリロード (メインスレッドからのみ登録可能)
+    if hasattr(signal, "SIGHUP") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, lambda signum, frame: request_reload())
+
+def get_reload_stats() -> dict:
+    """リロード状況の統計を取得"""
+    rule_set = _active_rule_set
+    return {
+        "source": config.RULES_SOURCE,
+        "version": rule_set.version if rule_set else None,
+        "rule_count": len(rule_set.rules) if rule_set else 0,
+        **_stats,
+    }
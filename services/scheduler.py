@@ -0,0 +1,125 @@
+"""
+処理待ちメールのスケジューリング
+
+複数アカウントモードでは、1つのワーカープールを全アカウントで共有する。
+アカウントごとのキューをラウンドロビンで取り出すことで、
+1つのメールボックスの大量の未処理メールが他のメールボックスの処理を止めないようにする。
+
+PRIORITY_SCHEDULING_ENABLED の場合、キーの中では到着順ではなく処理期限 (priority_deadline) の早い順に取り出す。
+大きなメール (添付ファイル10件・100MB など) が先頭にあっても、小さな請求書が後ろで待たされないようにする。
+"""
+import time
+import heapq
+import queue
+import itertools
+import threading
+from collections import OrderedDict, deque
+from email.utils import parseaddr
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+import config
+
+def is_priority_sender(sender: str) -> bool:
+    """主要な取引先 (PRIORITY_SENDERS のアドレス・ドメイン) からのメールか"""
+    address = parseaddr(sender or "")[1].lower()
+    return bool(address) and any(s.lower() in address for s in config.PRIORITY_SENDERS)
+
+def priority_deadline(msg: dict, now: float = None) -> float:
+    """
+    メールの処理期限 (UNIX 秒, 小さいほど先に処理する)。
+
+    受信時刻 (internalDate, 不明ならクレーム時刻) に、サイズに応じた猶予を足し、
+    主要な取引先なら PRIORITY_SENDER_ADVANTAGE_SECONDS を引く。
+    猶予は PRIORITY_MAX_DELAY_SECONDS で頭打ちにするため、大きなメールも後から届いたメールに
+    いつまでも追い越されることはない (飢餓の防止)。
+    """
+    received_at = int(msg['internalDate']) / 1000 if msg.get('internalDate') else (
+        time.time() if now is None else now)
+    size_mb = int(msg.get('sizeEstimate') or 0) / (1024 * 1024)
+    delay = min(size_mb * config.PRIORITY_SIZE_PENALTY_SECONDS_PER_MB, config.PRIORITY_MAX_DELAY_SECONDS)
+    if is_priority_sender(msg.get('sender')):
+        delay -= config.PRIORITY_SENDER_ADVANTAGE_SECONDS
+    return received_at + delay
+
+def sort_by_priority(messages: List[dict]) -> List[dict]:
+    """処理期限の早い順に並べ替えます (PRIORITY_SCHEDULING_ENABLED=false の場合はそのまま)。"""
+    if not config.PRIORITY_SCHEDULING_ENABLED:
+        return messages
+    now = time.time()
+    return sorted(messages, key=lambda msg: priority_deadline(msg, now))
+
+class _PriorityBucket:
+    """1キー分の優先度付きキュー (同じ優先度は到着順)"""
+
+    def __init__(self, priority: Callable[[Any], float]):
+        self._priority = priority
+        self._heap = []
+        self._seq = itertools.count()
+
+    def append(self, item: Any):
+        heapq.heappush(self._heap, (self._priority(item), next(self._seq), item))
+
+    def popleft(self) -> Any:
+        return heapq.heappop(self._heap)[2]
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+class FairQueue:
+    """
+    キーごとの FIFO をラウンドロビンで取り出すキュー (スレッドセーフ)
+    priority を指定した場合、キーの中では priority(item) の小さい順に取り出す。
+    """
+
+    def __init__(self, priority: Optional[Callable[[Any], float]] = None):
+        self._queues: "OrderedDict[Hashable, deque]" = OrderedDict()
+        self._priority = priority
+        self._size = 0
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+
+    def put(self, key: Hashable, item: Any):
+        with self._lock:
+            items = self._queues.get(key)
+            if items is None:
+                items = self._queues[key] = _PriorityBucket(self._priority) if self._priority else deque()
+            items.append(item)
+            self._size += 1
+            self._not_empty.notify()
+
+    def get(self, timeout: Optional[float] = None) -> Tuple[Hashable, Any]:
+        """
+        次のキーの先頭を取り出します。取り出したキーは順番の最後に回します。
+
+        Raises:
+            queue.Empty: timeout 秒待っても空の場合
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(lambda: self._size > 0, timeout):
+                raise queue.Empty
+            return self._pop()
+
+    def get_nowait(self) -> Tuple[Hashable, Any]:
+        with self._lock:
+            if not self._size:
+                raise queue.Empty
+            return self._pop()
+
+    def _pop(self) -> Tuple[Hashable, Any]:
+        key, items = next(iter(self._queues.items()))
+        item = items.popleft()
+        self._size -= 1
+        if items:
+            self._queues.move_to_end(key)
+        else:
+            del self._queues[key]
+        return key, item
+
+    def pending(self, key: Hashable = None) -> int:
+        """キュー待ちの件数 (key 指定時はそのキーの件数)"""
+        with self._lock:
+            if key is None:
+                return self._size
+            return len(self._queues.get(key, ()))
+
+    def __len__(self) -> int:
+        return self.pending()
@@ -0,0 +1,347 @@
+"""
+アーカイブ済み請求書のローカル検索インデックス
+
+「先月のあの取引先の請求書」を探すたびに BigQuery の SQL を書き、スキャン料金を払わずに済むよう、
+invoice_log に書き込んだ行を転置インデックスに追加し、/search で即座に検索できるようにする。
+
+- 対象: 送信者名・アドレス、件名、ファイル名、拡張子 (語)、受信日 (範囲)、金額 (抽出できた場合)
+- 語の区切りは英数字・かな漢字の連続 (\\w+)。末尾 * で前方一致 (例: "請求*", "acme*")
+  "field:語" でフィールドを限定できる (例: "subject:invoice", "extension:pdf")
+- 追加した行はまずメモリ上のバッファに入り (即座に検索可能)、SEARCH_INDEX_FLUSH_DOCS 件ごと
+  (または SEARCH_INDEX_FLUSH_SECONDS 経過後) に不変のセグメントファイル (gzip JSON) に書き出す
+- セグメントが SEARCH_INDEX_MAX_SEGMENTS を超えたら1つに併合する (同じ文書は新しい方を残す)
+- 書き出しと併合はバックグラウンドのスレッドで行う (処理ワーカーと /search を待たせない)
+- インデックスはインスタンスごと (SEARCH_INDEX_DIR)。SEARCH_INDEX_ENABLED=false の場合は何もしない
+"""
+import os
+import re
+import gzip
+import json
+import time
+import bisect
+import logging
+import datetime
+import threading
+from typing import Dict, Iterable, List, Optional, Set
+import services.metrics
+import config
+
+logger = logging.getLogger(__name__)
+
+# 語で検索できるフィールド
+FIELDS = ("sender_name", "sender_address", "subject", "filename", "extension")
+# 検索結果として返すフィールド
+STORED_FIELDS = FIELDS + ("message_id", "received_at", "invoice_total_amount", "gcs_url", "gcs_path", "mailbox")
+
+SEGMENT_VERSION = 1
+_SEGMENT_PATTERN = re.compile(r"^seg-(\d+)\.json\.gz$")
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+def tokenize(text) -> List[str]:
+    return _TOKEN_PATTERN.findall(str(text).lower()) if text else []
+
+def _doc_terms(doc: dict) -> Set[str]:
+    return {token for field in FIELDS for token in tokenize(doc.get(field))}
+
+class Segment:
+    """書き出し済みのセグメント (不変)。語は辞書順に並べ、前方一致は二分探索で引く。"""
+
+    def __init__(self, seq: int, docs: List[dict], postings: Dict[str, List[int]]):
+        self.seq = seq
+        self.docs = docs
+        self.doc_ids = {doc["id"] for doc in docs}
+        self._postings = postings
+        self._terms = sorted(postings)
+
+    def __len__(self) -> int:
+        return len(self.docs)
+
+    def match(self, token: str, prefix: bool) -> Set[int]:
+        if not prefix:
+            return set(self._postings.get(token, ()))
+        matched = set()
+        i = bisect.bisect_left(self._terms, token)
+        while i < len(self._terms) and self._terms[i].startswith(token):
+            matched.update(self._postings[self._terms[i]])
+            i += 1
+        return matched
+
+    @classmethod
+    def build(cls, seq: int, docs: List[dict]) -> "Segment":
+        postings: Dict[str, List[int]] = {}
+        for ordinal, doc in enumerate(docs):
+            for term in _doc_terms(doc):
+                postings.setdefault(term, []).append(ordinal)
+        return cls(seq, docs, postings)
+
+    def write(self, path: str):
+        """差分符号化した文書番号で書き出します (一時ファイルに書いてから置き換える)。"""
+        terms = []
+        for term in self._terms:
+            ordinals = self._postings[term]
+            terms.append([term, [b - a for a, b in zip([0] + ordinals, ordinals)]])
+        payload = {"version": SEGMENT_VERSION, "docs": self.docs, "terms": terms}
+        tmp_path = f"{path}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(payload, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def read(cls, seq: int, path: str) -> "Segment":
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            payload = json.load(f)
+        postings = {}
+        for term, deltas in payload["terms"]:
+            ordinals, total = [], 0
+            for delta in deltas:
+                total += delta
+                ordinals.append(total)
+            postings[term] = ordinals
+        return cls(seq, payload["docs"], postings)
+
+class _Query:
+    def __init__(self, text: str):
+        # (フィールド or None, 語, 前方一致か) の AND
+        self.clauses = []
+        for raw in (text or "").split():
+            field = None
+            if ":" in raw and raw.split(":", 1)[0] in FIELDS:
+                field, raw = raw.split(":", 1)
+            prefix = raw.endswith("*")
+            tokens = tokenize(raw.rstrip("*"))
+            for i, token in enumerate(tokens):
+                self.clauses.append((field, token, prefix and i == len(tokens) - 1))
+
+    def field_matches(self, doc: dict) -> bool:
+        for field, token, prefix in self.clauses:
+            if field is None:
+                continue
+            tokens = tokenize(doc.get(field))
+            if not any(t.startswith(token) if prefix else t == token for t in tokens):
+                return False
+        return True
+
+class SearchIndex:
+    def __init__(self, directory: str, flush_docs: int = 100, flush_seconds: float = 60.0,
+                 max_segments: int = 8, background: bool = True):
+        """
+        Args:
+            background: 書き出し・併合をバックグラウンドのスレッドで行う
+                (False の場合は add の中で同期的に行う)
+        """
+        self.directory = directory
+        self.flush_docs = flush_docs
+        self.flush_seconds = flush_seconds
+        self.max_segments = max_segments
+        self.background = background
+        # バッファ・セグメント一覧の参照と差し替え用 (ファイルの読み書き中は持たない)
+        self._lock = threading.RLock()
+        # 書き出し・併合を1つずつ行うためのロック
+        self._flush_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        # 未書き出しの文書 (文書ID -> 文書)
+        self._buffer: Dict[str, dict] = {}
+        # 書き出し中の文書 (書き出しが終わるまでは検索対象に含める)
+        self._flushing: Dict[str, dict] = {}
+        self._last_flush = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+        self._segments: List[Segment] = []
+        for name in sorted(os.listdir(directory)):
+            m = _SEGMENT_PATTERN.match(name)
+            if m:
+                self._segments.append(Segment.read(int(m.group(1)), os.path.join(directory, name)))
+        self._segments.sort(key=lambda s: s.seq)
+
+    def _path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"seg-{seq:08d}.json.gz")
+
+    def add(self, doc_id: str, row: dict):
+        """行を追加します (同じ文書IDは新しい内容で置き換える)。"""
+        doc = {"id": doc_id, **{field: row.get(field) for field in STORED_FIELDS if row.get(field) is not None}}
+        with self._lock:
+            self._buffer[doc_id] = doc
+            due = len(self._buffer) >= self.flush_docs or time.monotonic() - self._last_flush >= self.flush_seconds
+        if not due:
+            return
+        if self.background:
+            self._start_flusher()
+            self._flush_requested.set()
+        else:
+            self.flush()
+
+    def _start_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="search-index-flush", daemon=True)
+                self._flusher.start()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_requested.wait(timeout=self.flush_seconds)
+            self._flush_requested.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"検索インデックスの書き出しに失敗しました: {e}")
+
+    def flush(self):
+        """バッファをセグメントファイルに書き出します (セグメントが上限を超えたら併合する)。"""
+        with self._flush_lock:
+            with self._lock:
+                self._last_flush = time.monotonic()
+                if not self._buffer:
+                    return
+                self._flushing, self._buffer = self._buffer, {}
+                seq = self._segments[-1].seq + 1 if self._segments else 1
+            try:
+                segment = Segment.build(seq, list(self._flushing.values()))
+                segment.write(self._path(seq))
+            except Exception:
+                # 書き出せなかった文書はバッファに戻す (その後に追加された内容を優先する)
+                with self._lock:
+                    self._buffer = {**self._flushing, **self._buffer}
+                    self._flushing = {}
+                raise
+            with self._lock:
+                self._segments.append(segment)
+                self._flushing = {}
+                merge = len(self._segments) > self.max_segments
+            logger.info(f"検索インデックスのセグメントを書き出しました: {self._path(seq)} ({len(segment)} 件)")
+            if merge:
+                self._merge()
+
+    def _merge(self):
+        """
+        全セグメントを1つに併合します (同じ文書は新しいセグメントの内容を残す)。
+        _flush_lock の中で呼ぶため、併合中にセグメントが増えることはない。
+        """
+        with self._lock:
+            old = list(self._segments)
+        docs: Dict[str, dict] = {}
+        for segment in old:
+            for doc in segment.docs:
+                docs[doc["id"]] = doc
+        seq = old[-1].seq + 1
+        merged = Segment.build(seq, list(docs.values()))
+        merged.write(self._path(seq))
+        with self._lock:
+            self._segments = [merged]
+        for segment in old:
+            os.remove(self._path(segment.seq))
+        logger.info(f"検索インデックスのセグメントを併合しました: {len(old)} -> 1 ({len(merged)} 件)")
+
+    def __len__(self) -> int:
+        with self._lock:
+            ids = set(self._buffer) | set(self._flushing)
+            for segment in self._segments:
+                ids |= segment.doc_ids
+            return len(ids)
+
+    def search(self, query: str = "", date_from: Optional[datetime.date] = None,
+               date_to: Optional[datetime.date] = None, amount_min: Optional[int] = None,
+               amount_max: Optional[int] = None, limit: int = 50) -> dict:
+        """
+        語 (AND) と受信日・金額の範囲で検索し、受信日時の新しい順に返します。
+
+        Returns:
+            {"total": 件数, "results": [文書, ...]}
+        """
+        start = time.perf_counter()
+        parsed = _Query(query)
+        lower = date_from.isoformat() if date_from else None
+        upper = (date_to + datetime.timedelta(days=1)).isoformat() if date_to else None
+
+        def accept(doc: dict) -> bool:
+            received_at = doc.get("received_at") or ""
+            if (lower and received_at < lower) or (upper and received_at >= upper):
+                return False
+            amount = doc.get("invoice_total_amount")
+            if (amount_min is not None or amount_max is not None) and amount is None:
+                return False
+            if (amount_min is not None and amount < amount_min) or (amount_max is not None and amount > amount_max):
+                return False
+            return parsed.field_matches(doc)
+
+        with self._lock:
+            # 書き出し中の文書より、その後にバッファに追加された内容を優先する
+            buffer = {**self._flushing, **self._buffer}
+            segments = list(self._segments)
+
+        matched = []
+        # バッファ -> 新しいセグメントの順に見て、より新しい内容がある文書は古い方を返さない
+        newer_ids: List[Iterable[str]] = [buffer]
+        matched.extend(doc for doc in buffer.values()
+                       if all(self._buffer_match(doc, token, prefix) for _, token, prefix in parsed.clauses)
+                       and accept(doc))
+        for segment in reversed(segments):
+            ordinals = self._segment_candidates(segment, parsed)
+            for ordinal in sorted(ordinals):
+                doc = segment.docs[ordinal]
+                if any(doc["id"] in ids for ids in newer_ids):
+                    continue
+                if accept(doc):
+                    matched.append(doc)
+            newer_ids.append(segment.doc_ids)
+
+        matched.sort(key=lambda doc: doc.get("received_at") or "", reverse=True)
+        services.metrics.SEARCH_SECONDS.observe(time.perf_counter() - start)
+        return {"total": len(matched), "results": matched[:limit]}
+
+    @staticmethod
+    def _buffer_match(doc: dict, token: str, prefix: bool) -> bool:
+        terms = _doc_terms(doc)
+        return any(t.startswith(token) for t in terms) if prefix else token in terms
+
+    @staticmethod
+    def _segment_candidates(segment: Segment, parsed: _Query) -> Set[int]:
+        if not parsed.clauses:
+            return set(range(len(segment)))
+        candidates = None
+        # 完全一致の語から先に引く (前方一致は該当する語が多いため)
+        for _, token, prefix in sorted(parsed.clauses, key=lambda c: c[2]):
+            ordinals = segment.match(token, prefix)
+            candidates = ordinals if candidates is None else candidates & ordinals
+            if not candidates:
+                return set()
+        return candidates
+
+# --- 内部状態 ---
+_index: Optional[SearchIndex] = None
+_index_lock = threading.Lock()
+
+def get_index() -> Optional[SearchIndex]:
+    """検索インデックスを返します (SEARCH_INDEX_ENABLED=false の場合は None)。"""
+    global _index
+    if not config.SEARCH_INDEX_ENABLED:
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = SearchIndex(config.SEARCH_INDEX_DIR, config.SEARCH_INDEX_FLUSH_DOCS,
+                                     config.SEARCH_INDEX_FLUSH_SECONDS, config.SEARCH_INDEX_MAX_SEGMENTS)
+    return _index
+
+def set_index(index: Optional[SearchIndex]):
+    """インデックスを差し替えます (テスト用, None で SEARCH_INDEX_DIR から読み直す)。"""
+    global _index
+    with _index_lock:
+        _index = index
+
+def index_row(doc_id: str, row: dict):
+    """invoice_log に書き込んだ行をインデックスに追加します (失敗しても処理は止めない)。"""
+    index = get_index()
+    if index is None:
+        return
+    try:
+        index.add(doc_id, row)
+    except Exception as e:
+        logger.error(f"検索インデックスへの追加に失敗しました ({doc_id}): {e}")
+
+def flush():
+    """バッファを書き出します (シャットダウン時)。"""
+    index = get_index()
+    if index is not None:
+        index.flush()
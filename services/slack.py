@@ -1,13 +1,68 @@
 """
 Slack通知ユーティリティ
 システムアラートや日次レポートの送信に使用
+
+- send_slack_alert: 同期送信 (日次レポートなど、呼び出し元が結果を待てる場合)
+- enqueue_slack_alert: 非同期送信 (処理ワーカーから呼ぶ場合)
+  バックグラウンドのディスパッチャーが、リトライ・重複排除・集約を行う
 """
+import time
+import queue
+import random
+import threading
 import requests
 import logging
+from typing import Optional
+import services.circuit_breaker
 import config
 
 logger = logging.getLogger(__name__)
 
+# --- 設定値 ---
+REQUEST_TIMEOUT = (3.05, 10)  # (接続, 読み取り) タイムアウト秒
+MAX_QUEUE_SIZE = 100  # ディスパッチャーのキュー上限 (超えた分は破棄)
+MAX_RETRIES = 3  # 送信失敗時のリトライ回数
+RETRY_BACKOFF_SECONDS = 1.0  # リトライ間隔の基準値 (指数バックオフ)
+COALESCE_WINDOW_SECONDS = 300  # 同一アラートを重複とみなす期間
+SUPPRESSED_CHECK_SECONDS = 10.0  # 抑制期間が明けたアラートを確認する間隔の上限
+BATCH_DELAY_SECONDS = 2.0  # 最初のアラートから送信までの集約待ち時間
+MAX_BATCH_LINES = 10  # 集約メッセージに載せる最大件数
+
+LEVEL_SEVERITY = {"success": 0, "info": 1, "warning": 2, "error": 3}
+
+_session = None
+_session_lock = threading.Lock()
+
+def _get_session() -> requests.Session:
+    """HTTPセッションを使い回す (接続の再利用)"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+        return _session
+
+def _format_text(message: str, level: str) -> str:
+    # レベルに応じた絵文字
+    emoji_map = {
+        "info": "ℹ️",
+        "warning": "⚠️",
+        "error": "🚨",
+        "success": "✅"
+    }
+    emoji = emoji_map.get(level, "📢")
+    return f"{emoji} *[Invoice System Alert]*\n{message}"
+
+def _post(text: str) -> requests.Response:
+    """Webhook に1回送信します (サーキットブレーカーで保護し、5xx・429 は障害として数える)。"""
+    try:
+        with services.circuit_breaker.guard("slack"):
+            response = _get_session().post(config.SLACK_WEBHOOK_URL, json={"text": text}, timeout=REQUEST_TIMEOUT)
+            if response.status_code == 429 or response.status_code >= 500:
+                response.raise_for_status()
+            return response
+    except requests.HTTPError as e:
+        return e.response
+
 def send_slack_alert(message: str, level: str = "info") -> bool:
     """
     Slackにアラートを送信する。
@@ -23,25 +78,229 @@ def send_slack_alert(message: str, level: str = "info") -> bool:
         logger.warning("SLACK_WEBHOOK_URL が設定されていないため、アラート送信をスキップします。")
         return False
     
-    # レベルに応じた絵文字
-    emoji_map = {
-        "info": "ℹ️",
-        "warning": "⚠️",
-        "error": "🚨",
-        "success": "✅"
-    }
-    emoji = emoji_map.get(level, "📢")
-    
-    text = f"{emoji} *[Invoice System Alert]*\n{message}"
+    text = _format_text(message, level)
     
     try:
-        response = requests.post(config.SLACK_WEBHOOK_URL, json={"text": text})
+        response = _post(text)
         if response.status_code == 200:
             logger.info(f"Slackアラートを送信しました: {level}")
             return True
         else:
             logger.error(f"Slackアラート送信失敗 (HTTP {response.status_code}): {response.text}")
             return False
+    except services.circuit_breaker.CircuitOpenError as e:
+        logger.warning(f"Slackアラート送信をスキップします: {e}")
+        return False
     except Exception as e:
         logger.error(f"Slackアラート送信例外: {e}")
         return False
+
+
+# --- 非同期ディスパッチャー ---
+
+class _PendingAlert:
+    __slots__ = ("message", "level", "count")
+
+    def __init__(self, message: str, level: str):
+        self.message = message
+        self.level = level
+        self.count = 1
+
+class AlertDispatcher:
+    """
+    Slackアラートをバックグラウンドスレッドで送信するディスパッチャー。
+
+    - submit() はブロックしない (キューが満杯なら破棄してFalse)
+    - 同じキーのアラートは送信待ちの間は1件に集約し、送信後 COALESCE_WINDOW_SECONDS の間は抑制する
+      (抑制したアラートは、抑制期間が明けた時点で件数を添えて1通送る)
+    - 送信待ちが複数ある場合は1通のサマリーにまとめて送信する
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._pending = {}  # key -> _PendingAlert (送信待ち)
+        self._last_sent = {}  # key -> 最終送信時刻
+        self._suppressed = {}  # key -> _PendingAlert (抑制中の最新の内容と件数)
+        self._thread = None
+        self.stats = {"submitted": 0, "sent": 0, "coalesced": 0, "dropped": 0, "failed": 0}
+
+    def submit(self, message: str, level: str = "info", key: Optional[str] = None) -> bool:
+        key = key or message
+        with self._lock:
+            self.stats["submitted"] += 1
+            pending = self._pending.get(key)
+            if pending:
+                pending.count += 1
+                self.stats["coalesced"] += 1
+                return True
+
+            last_sent = self._last_sent.get(key)
+            if last_sent is not None and time.time() - last_sent < COALESCE_WINDOW_SECONDS:
+                suppressed = self._suppressed.get(key)
+                if suppressed:
+                    suppressed.message, suppressed.level = message, level
+                    suppressed.count += 1
+                else:
+                    self._suppressed[key] = _PendingAlert(message, level)
+                self.stats["coalesced"] += 1
+                return True
+
+            try:
+                self._queue.put_nowait(key)
+            except queue.Full:
+                self.stats["dropped"] += 1
+                logger.warning(f"Slackアラートキューが満杯のため破棄しました: {key[:50]}")
+                return False
+            self._pending[key] = _PendingAlert(message, level)
+            self._ensure_started()
+        return True
+
+    def _ensure_started(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="slack-dispatcher", daemon=True)
+            self._thread.start()
+
+    def _release_suppressed(self) -> float:
+        """
+        抑制期間が明けたアラートを送信待ちに戻し、次に期間が明けるまでの秒数を返します。
+        (抑制した件数は送信時に集約件数として添える)
+        """
+        now = time.time()
+        wait = SUPPRESSED_CHECK_SECONDS
+        with self._lock:
+            for key, suppressed in list(self._suppressed.items()):
+                remaining = self._last_sent.get(key, 0) + COALESCE_WINDOW_SECONDS - now
+                if remaining > 0:
+                    wait = min(wait, remaining)
+                    continue
+                if key in self._pending:
+                    continue
+                try:
+                    self._queue.put_nowait(key)
+                except queue.Full:
+                    break
+                self._pending[key] = self._suppressed.pop(key)
+        return wait
+
+    def _run(self):
+        while True:
+            try:
+                keys = [self._queue.get(timeout=self._release_suppressed())]
+            except queue.Empty:
+                continue
+            # 短時間待って、その間に届いたアラートをまとめて送る
+            deadline = time.time() + BATCH_DELAY_SECONDS
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    keys.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                self._dispatch(keys)
+            except Exception as e:
+                logger.error(f"Slackアラートのディスパッチに失敗しました: {e}")
+            finally:
+                for _ in keys:
+                    self._queue.task_done()
+
+    def _dispatch(self, keys):
+        now = time.time()
+        with self._lock:
+            alerts = []
+            for key in keys:
+                alert = self._pending.pop(key)
+                suppressed = self._suppressed.pop(key, None)
+                self._last_sent[key] = now
+                alerts.append((alert, alert.count - 1 + (suppressed.count if suppressed else 0)))
+            # 古い送信履歴を掃除
+            for key in [k for k, t in self._last_sent.items() if now - t >= COALESCE_WINDOW_SECONDS]:
+                if key not in self._suppressed:
+                    del self._last_sent[key]
+
+        if len(alerts) == 1:
+            alert, extra = alerts[0]
+            message = alert.message
+            if extra:
+                message += f"\n\n_(同一アラート {extra} 件を集約しました)_"
+            level = alert.level
+        else:
+            level = max((a.level for a, _ in alerts), key=lambda l: LEVEL_SEVERITY.get(l, 1))
+            lines = [f"*{len(alerts)} 件のアラートをまとめて通知します*"]
+            for alert, extra in alerts[:MAX_BATCH_LINES]:
+                first_line = alert.message.strip().splitlines()[0] if alert.message.strip() else ""
+                suffix = f" (×{extra + 1})" if extra else ""
+                lines.append(f"• {first_line}{suffix}")
+            if len(alerts) > MAX_BATCH_LINES:
+                lines.append(f"• ...他 {len(alerts) - MAX_BATCH_LINES} 件")
+            message = "\n".join(lines)
+
+        if self._post_with_retry(_format_text(message, level)):
+            self.stats["sent"] += 1
+        else:
+            self.stats["failed"] += 1
+
+    def _post_with_retry(self, text: str) -> bool:
+        if not config.SLACK_WEBHOOK_URL:
+            logger.warning("SLACK_WEBHOOK_URL が設定されていないため、アラート送信をスキップします。")
+            return False
+
+        for attempt in range(MAX_RETRIES + 1):
+            delay = RETRY_BACKOFF_SECONDS * (2 ** attempt) * (1 + random.random() * 0.1)
+            try:
+                response = _post(text)
+                if response.status_code == 200:
+                    return True
+                # 4xx (429以外) はリトライしても成功しない
+                if response.status_code != 429 and response.status_code < 500:
+                    logger.error(f"Slackアラート送信失敗 (HTTP {response.status_code}): {response.text}")
+                    return False
+                retry_after = response.headers.get("Retry-After")
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+                logger.warning(f"Slackアラート送信失敗 (HTTP {response.status_code})、リトライします ({attempt + 1}/{MAX_RETRIES + 1})")
+            except services.circuit_breaker.CircuitOpenError as e:
+                # 障害中はリトライで待たずにあきらめる
+                logger.warning(f"Slackアラート送信をスキップします: {e}")
+                return False
+            except Exception as e:
+                logger.warning(f"Slackアラート送信例外、リトライします ({attempt + 1}/{MAX_RETRIES + 1}): {e}")
+
+            if attempt < MAX_RETRIES:
+                time.sleep(delay)
+
+        logger.error("Slackアラートの送信をあきらめました (リトライ上限)")
+        return False
+
+    def flush(self, timeout: float = 30.0) -> bool:
+        """送信待ちのアラートがなくなるまで待つ (シャットダウン・テスト用)"""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+_dispatcher = AlertDispatcher()
+
+def enqueue_slack_alert(message: str, level: str = "info", dedup_key: Optional[str] = None) -> bool:
+    """
+    Slackアラートを非同期に送信する (呼び出し元はSlackの応答を待たない)。
+
+    Args:
+        message: 送信するメッセージ
+        level: "info", "warning", "error" のいずれか
+        dedup_key: 重複排除のキー (省略時はメッセージ本文)
+
+    Returns:
+        キューに受け付けた (または集約した) 場合True
+    """
+    return _dispatcher.submit(message, level=level, key=dedup_key)
+
+def get_dispatcher_stats() -> dict:
+    """ディスパッチャーの統計を取得"""
+    return {**_dispatcher.stats, "queue_depth": _dispatcher._queue.qsize()}
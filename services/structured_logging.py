@@ -0,0 +1,186 @@
+"""
+構造化ログ (Cloud Logging 向け JSON) の非同期出力とサンプリング
+
+処理の合間に書くログで処理スレッドが待たされないよう、LOG_FORMAT=json では
+ログをキューに積むだけにして、整形 (% の展開・JSON 化) と書き出しは専用スレッドで行う。
+
+- 各ログには呼び出し時点の相関ID (pubsub_message_id, gmail_message_id など) とトレースIDを付与する
+- 同じメッセージ (ロガー名 + 書式) の INFO 以下は、窓 (LOG_SAMPLE_WINDOW_SECONDS) ごとに最初の
+  LOG_SAMPLE_BURST 件を残し、以降は LOG_SAMPLE_RATE の割合だけ残す。WARNING 以上は常に残す
+- キュー (LOG_QUEUE_SIZE) が溢れた場合、INFO 以下は破棄し (呼び出し側を待たせない)、WARNING 以上は待って積む
+- LOG_FORMAT=text (既定) では従来どおり logging.basicConfig で出力する (サンプリングのみ適用)
+
+使い方 (エントリポイントで1回):
+    services.structured_logging.configure(logging.INFO)
+"""
+import sys
+import json
+import time
+import queue
+import atexit
+import logging
+import datetime
+import threading
+import logging.handlers
+from typing import Callable, Dict, Optional, TextIO, Tuple
+import services.metrics
+import services.tracing
+import config
+
+class CorrelationFilter(logging.Filter):
+    """呼び出し時点の相関IDとトレースIDをレコードに付与します (出力は別スレッドのため)。"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation = services.tracing.get_correlation()
+        span = services.tracing.current_span()
+        record.trace_id = getattr(span, "trace_id", None)
+        record.span_id = getattr(span, "span_id", None)
+        return True
+
+class SamplingFilter(logging.Filter):
+    """同じメッセージが大量に出る場合に INFO 以下を間引きます (WARNING 以上は常に残す)。"""
+
+    def __init__(self, rate: float, burst: int, window_seconds: float,
+                 clock: Callable[[], float] = time.monotonic):
+        super().__init__()
+        self.rate = max(0.0, min(1.0, rate))
+        self.burst = burst
+        self.window_seconds = window_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._window_start = clock()
+        # (ロガー名, 書式) -> [窓内の件数, 残す分の端数]
+        self._seen: Dict[Tuple[str, str], list] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or self.rate >= 1.0:
+            return True
+        key = (record.name, str(record.msg))
+        with self._lock:
+            now = self._clock()
+            if now - self._window_start >= self.window_seconds:
+                self._window_start = now
+                self._seen = {}
+            state = self._seen.setdefault(key, [0, 0.0])
+            state[0] += 1
+            if state[0] <= self.burst:
+                return True
+            # 乱数を使わずに一定の割合で残す (rate=0.1 なら10件に1件)
+            state[1] += self.rate
+            if state[1] >= 1.0:
+                state[1] -= 1.0
+                return True
+        services.metrics.LOG_RECORDS_DROPPED.inc(reason="sampled")
+        return False
+
+class JsonFormatter(logging.Formatter):
+    """Cloud Logging が解釈できる1行 JSON に整形します。"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "severity": record.levelname,
+            "message": record.getMessage(),
+            "time": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            "logger": record.name,
+            "thread": record.threadName,
+        }
+        entry.update(getattr(record, "correlation", None) or {})
+        trace_id = getattr(record, "trace_id", None)
+        if trace_id:
+            entry["trace_id"] = trace_id
+            if config.PROJECT_ID:
+                entry["logging.googleapis.com/trace"] = f"projects/{config.PROJECT_ID}/traces/{trace_id}"
+            entry["logging.googleapis.com/spanId"] = getattr(record, "span_id", None)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["message"] = f"{entry['message']}\n{record.exc_text}"
+        if record.levelno >= logging.ERROR:
+            entry["logging.googleapis.com/sourceLocation"] = {
+                "file": record.pathname, "line": record.lineno, "function": record.funcName}
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    レコードをキューに積むだけのハンドラー。
+    標準の QueueHandler と違い、メッセージの展開 (getMessage) は出力スレッドで行う。
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 例外のトレースバックは呼び出し時点で文字列にする (フレームを保持し続けないように)
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.WARNING:
+                self.queue.put(record)
+            else:
+                services.metrics.LOG_RECORDS_DROPPED.inc(reason="queue_full")
+
+# --- 内部状態 ---
+_listener: Optional[logging.handlers.QueueListener] = None
+_installed = []
+_lock = threading.Lock()
+
+def configure(level: int = logging.INFO, fmt: Optional[str] = None, stream: Optional[TextIO] = None):
+    """
+    ルートロガーの出力を設定します (エントリポイントで1回呼ぶ)。
+
+    Args:
+        level: ルートロガーのレベル
+        fmt: LOG_FORMAT=text の場合の書式 (logging.basicConfig の format)
+        stream: 出力先 (既定: json は stdout, text は stderr)
+    """
+    global _listener
+    with _lock:
+        _uninstall()
+        root = logging.getLogger()
+        root.setLevel(level)
+        sampling = SamplingFilter(config.LOG_SAMPLE_RATE, config.LOG_SAMPLE_BURST, config.LOG_SAMPLE_WINDOW_SECONDS)
+        if config.LOG_FORMAT.lower() != "json":
+            kwargs = {"level": level, "stream": stream}
+            if fmt:
+                kwargs["format"] = fmt
+            logging.basicConfig(**kwargs)
+            if sampling.rate < 1.0:
+                for handler in root.handlers:
+                    handler.addFilter(sampling)
+                    _installed.append((handler, sampling))
+            return
+
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(JsonFormatter())
+        handler = AsyncQueueHandler(queue.Queue(config.LOG_QUEUE_SIZE))
+        handler.addFilter(sampling)
+        handler.addFilter(CorrelationFilter())
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        _installed.append((handler, None))
+        _listener = logging.handlers.QueueListener(handler.queue, output)
+        _listener.start()
+
+def _uninstall():
+    global _listener
+    root = logging.getLogger()
+    for handler, sampling in _installed:
+        if sampling is None:
+            root.removeHandler(handler)
+        else:
+            handler.removeFilter(sampling)
+    _installed.clear()
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+def shutdown():
+    """キューに残っているログを書き出して出力スレッドを止めます。"""
+    with _lock:
+        _uninstall()
+
+atexit.register(shutdown)
@@ -0,0 +1,313 @@
+"""
+トレーシングモジュール
+外部呼び出し (Gmail / GCS / BigQuery) ごとのスパンを記録し、1通の処理時間の内訳を追えるようにする
+
+- トレースは Pub/Sub messageId と Gmail メッセージID で相関付けされる
+- エクスポーター: jsonl (ローカルファイル) / otlp (OTLP/HTTP JSON, 本番用) / none
+- TRACE_SAMPLE_RATE でトレース単位のサンプリング
+- 無効時・非サンプル時は共有の no-op スパンを返すだけなので、ほぼコストゼロ
+"""
+import os
+import json
+import time
+import queue
+import random
+import logging
+import threading
+import contextlib
+import contextvars
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional
+import config
+
+logger = logging.getLogger(__name__)
+
+# --- 設定値 ---
+EXPORT_BATCH_SIZE = 100  # 1回のエクスポートで送るスパン数の上限
+EXPORT_INTERVAL_SECONDS = 2.0  # エクスポートの間隔
+MAX_QUEUE_SIZE = 10000  # エクスポート待ちスパンの上限 (超えた分は破棄)
+
+class Span:
+    """1つの処理区間"""
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "start_ns", "end_ns",
+                 "attributes", "status", "error", "_token", "_correlation", "_correlation_token")
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any],
+                 correlation: Optional[Dict[str, str]] = None):
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = 0
+        self.end_ns = 0
+        self.attributes = attributes
+        self.status = "ok"
+        self.error = None
+        self._token = None
+        # ルートスパンの場合、スパンの間だけ有効にする相関ID
+        self._correlation = correlation
+        self._correlation_token = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._token = _current_span.set(self)
+        if self._correlation is not None:
+            self._correlation_token = _correlation.set(self._correlation)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        _current_span.reset(self._token)
+        if self._correlation_token is not None:
+            _correlation.reset(self._correlation_token)
+        if exc is not None:
+            self.status = "error"
+            self.error = f"{exc_type.__name__}: {exc}"
+        _processor.submit(self)
+        return False
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_ns / 1e9,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+class _NoopSpan:
+    """トレース無効時に返すスパン (何もしない)"""
+    __slots__ = ()
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+NOOP_SPAN = _NoopSpan()
+
+# 現在のスパンと相関ID (Pub/Sub messageId など)
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+_correlation: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar("correlation", default={})
+
+# --- エクスポーター ---
+
+class SpanExporter(ABC):
+    @abstractmethod
+    def export(self, spans: List[Span]):
+        """スパンのバッチを出力します。"""
+        pass
+
+class JsonlSpanExporter(SpanExporter):
+    """1スパン1行のJSONLファイルに追記 (ローカル用)"""
+
+    def __init__(self, path: str = "local_traces.jsonl"):
+        self.path = path
+
+    def export(self, spans: List[Span]):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for span in spans:
+                f.write(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+class OtlpHttpSpanExporter(SpanExporter):
+    """OTLP/HTTP (JSONエンコーディング) でコレクターへ送信 (本番用)"""
+
+    def __init__(self, endpoint: str, service_name: str = "invoice-processor", timeout: float = 5.0):
+        import requests
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    @staticmethod
+    def _attr(key: str, value: Any) -> dict:
+        if isinstance(value, bool):
+            return {"key": key, "value": {"boolValue": value}}
+        if isinstance(value, int):
+            return {"key": key, "value": {"intValue": str(value)}}
+        if isinstance(value, float):
+            return {"key": key, "value": {"doubleValue": value}}
+        return {"key": key, "value": {"stringValue": str(value)}}
+
+    def _to_otlp(self, span: Span) -> dict:
+        otlp = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [self._attr(k, v) for k, v in span.attributes.items()],
+            "status": {"code": 2, "message": span.error} if span.status == "error" else {"code": 1},
+        }
+        if span.parent_id:
+            otlp["parentSpanId"] = span.parent_id
+        return otlp
+
+    def export(self, spans: List[Span]):
+        body = {
+            "resourceSpans": [{
+                "resource": {"attributes": [self._attr("service.name", self.service_name)]},
+                "scopeSpans": [{
+                    "scope": {"name": "invoice.tracing"},
+                    "spans": [self._to_otlp(s) for s in spans],
+                }],
+            }]
+        }
+        response = self.session.post(self.endpoint, json=body, timeout=self.timeout)
+        if response.status_code >= 300:
+            raise RuntimeError(f"OTLP export failed (HTTP {response.status_code}): {response.text[:200]}")
+
+class _BatchProcessor:
+    """終了したスパンをキューに溜め、バックグラウンドでまとめてエクスポートする"""
+
+    def __init__(self):
+        self.exporter: Optional[SpanExporter] = None
+        self._queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.dropped = 0
+
+    def submit(self, span: Span):
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+            return
+        if self._thread is None:
+            self._start()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                self._thread.start()
+
+    def _drain(self, first: Optional[Span] = None) -> List[Span]:
+        batch = [first] if first else []
+        while len(batch) < EXPORT_BATCH_SIZE:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _export(self, batch: List[Span]):
+        try:
+            if batch and self.exporter is not None:
+                self.exporter.export(batch)
+        except Exception as e:
+            logger.warning(f"スパンのエクスポートに失敗しました ({len(batch)} 件): {e}")
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _run(self):
+        while True:
+            try:
+                first = self._queue.get(timeout=EXPORT_INTERVAL_SECONDS)
+            except queue.Empty:
+                continue
+            self._export(self._drain(first))
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """キューに残っているスパンのエクスポート完了を待つ (シャットダウン・テスト用)"""
+        deadline = time.time() + timeout
+        while self._queue.unfinished_tasks:
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+_processor = _BatchProcessor()
+
+def _build_exporter() -> Optional[SpanExporter]:
+    kind = (config.TRACE_EXPORTER or "none").lower()
+    if kind == "jsonl":
+        return JsonlSpanExporter(config.TRACE_JSONL_PATH)
+    if kind == "otlp":
+        return OtlpHttpSpanExporter(config.OTLP_TRACES_ENDPOINT)
+    return None
+
+def set_exporter(exporter: Optional[SpanExporter]):
+    """エクスポーターを差し替えます (None でトレース無効)。"""
+    _processor.exporter = exporter
+
+set_exporter(_build_exporter())
+
+# --- API ---
+
+def set_correlation(**ids: str):
+    """現在のコンテキストに相関ID (pubsub_message_id など) を追加します。"""
+    merged = dict(_correlation.get())
+    merged.update({k: v for k, v in ids.items() if v})
+    _correlation.set(merged)
+
+@contextlib.contextmanager
+def correlate(**ids: str):
+    """
+    ブロックの間だけ相関IDを追加します (トレースの有無・サンプリングに関係なく、ログにも付与される)。
+    ワーカースレッドは使い回されるため、1通ごとの ID は set_correlation ではなくこちらで付与する。
+    """
+    merged = dict(_correlation.get())
+    merged.update({k: str(v) for k, v in ids.items() if v})
+    token = _correlation.set(merged)
+    try:
+        yield
+    finally:
+        _correlation.reset(token)
+
+def get_correlation() -> Dict[str, str]:
+    """現在のコンテキストの相関IDを返します。"""
+    return _correlation.get()
+
+def start_trace(name: str, **attributes: Any):
+    """
+    新しいトレースのルートスパンを開始します (サンプリング判定はここで行う)。
+    attributes に渡した相関ID (gmail_message_id など) は、以降の子スパンにも付与されます。
+
+    使い方:
+        with tracing.start_trace("process_email", gmail_message_id=msg_id):
+            ...
+    """
+    if _processor.exporter is None:
+        return NOOP_SPAN
+    if config.TRACE_SAMPLE_RATE < 1.0 and random.random() >= config.TRACE_SAMPLE_RATE:
+        return NOOP_SPAN
+    correlation = {**_correlation.get(), **{k: str(v) for k, v in attributes.items() if k.endswith("_id") and v}}
+    return Span(name, os.urandom(16).hex(), None, {**correlation, **attributes}, correlation=correlation)
+
+def span(name: str, **attributes: Any):
+    """
+    現在のトレースに子スパンを追加します。
+    トレース外 (または非サンプル) の場合は no-op スパンを返します。
+    """
+    parent = _current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(name, parent.trace_id, parent.span_id, {**_correlation.get(), **attributes})
+
+def span_or_trace(name: str, **attributes: Any):
+    """トレース内なら子スパンを、トレース外なら新しいトレースを開始します。"""
+    if _current_span.get() is None:
+        return start_trace(name, **attributes)
+    return span(name, **attributes)
+
+def current_span():
+    """現在のスパン (なければ no-op スパン) を返します。"""
+    return _current_span.get() or NOOP_SPAN
+
+def flush(timeout: float = 10.0) -> bool:
+    """エクスポート待ちのスパンが書き出されるまで待ちます。"""
+    return _processor.flush(timeout)
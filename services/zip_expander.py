@@ -0,0 +1,142 @@
+"""
+ZIP 添付ファイルの展開モジュール
+月次請求書を ZIP にまとめて送ってくる取引先向けに、メンバーを1件ずつ取り出して個別にアーカイブする
+
+- メンバーは zipfile のストリーム (ZipExtFile) で逐次読み出すため、展開後のデータ全体をメモリに載せない
+- 展開前にセントラルディレクトリを検証し、ZIP bomb 対策の制限を掛ける
+  (メンバー数 / 展開後の合計サイズ / メンバーごとの圧縮率)
+- 読み出し中も実際のバイト数を数え、宣言サイズを超えたら中断する
+"""
+import io
+import os
+import zipfile
+from dataclasses import dataclass
+from typing import IO, List, Union
+import services.classifier
+import config
+
+# 展開しないメンバー (macOS の付加情報など)
+_IGNORED_PREFIXES = ("__MACOSX/",)
+_IGNORED_NAMES = frozenset((".DS_Store", "Thumbs.db", "desktop.ini"))
+
+class ZipLimitExceeded(Exception):
+    """展開制限 (メンバー数・サイズ・圧縮率) を超えた"""
+    pass
+
+@dataclass(frozen=True)
+class ZipLimits:
+    max_members: int
+    max_total_bytes: int
+    max_ratio: float
+
+    @classmethod
+    def from_config(cls) -> "ZipLimits":
+        return cls(
+            max_members=config.ZIP_MAX_MEMBERS,
+            max_total_bytes=config.ZIP_MAX_TOTAL_BYTES,
+            max_ratio=config.ZIP_MAX_COMPRESSION_RATIO
+        )
+
+@dataclass(frozen=True)
+class ZipMember:
+    # ZIP 内での連番 (1始まり, 展開対象のメンバーのみで数える)
+    index: int
+    # ディレクトリを除いたファイル名
+    filename: str
+    size: int
+    info: zipfile.ZipInfo
+
+def is_expandable(filename: str, head: bytes) -> bool:
+    """中身が ZIP で、Office 文書 (xlsx/docx) ではないか"""
+    ext = os.path.splitext(filename)[1].lower()
+    return services.classifier.detect_kind(head) == "zip" and ext not in services.classifier.OOXML_EXTENSIONS
+
+def _decode_name(info: zipfile.ZipInfo) -> str:
+    """
+    メンバー名を復元します。
+    UTF-8 フラグのない ZIP (Windows の標準機能で作成したものなど) は cp437 として
+    デコードされているため、Shift_JIS (cp932) として読み直す。
+    """
+    name = info.filename
+    if not info.flag_bits & 0x800:
+        try:
+            name = name.encode("cp437").decode("cp932")
+        except (UnicodeEncodeError, UnicodeDecodeError):
+            pass
+    return name
+
+def _is_ignored(name: str) -> bool:
+    return name.startswith(_IGNORED_PREFIXES) or os.path.basename(name) in _IGNORED_NAMES
+
+def list_members(archive: zipfile.ZipFile, limits: ZipLimits) -> List[ZipMember]:
+    """
+    展開対象のメンバーを列挙し、制限を検証します。
+
+    Raises:
+        ZipLimitExceeded: 制限を超えた場合 (1件も展開しない)
+    """
+    members = []
+    total = 0
+    for info in archive.infolist():
+        if info.is_dir():
+            continue
+        name = _decode_name(info)
+        if _is_ignored(name):
+            continue
+        if info.flag_bits & 0x1:
+            # 暗号化されたメンバーは展開できないため、ZIP ごとアーカイブする
+            raise ZipLimitExceeded(f"暗号化されたメンバーを含みます: {name}")
+
+        if len(members) >= limits.max_members:
+            raise ZipLimitExceeded(f"メンバー数が上限 ({limits.max_members}) を超えています")
+        total += info.file_size
+        if total > limits.max_total_bytes:
+            raise ZipLimitExceeded(f"展開後の合計サイズが上限 ({limits.max_total_bytes} bytes) を超えています")
+        if info.file_size > limits.max_ratio * max(info.compress_size, 1):
+            raise ZipLimitExceeded(
+                f"圧縮率が上限 ({limits.max_ratio}) を超えています: {name} "
+                f"({info.compress_size} -> {info.file_size} bytes)")
+
+        members.append(ZipMember(
+            index=len(members) + 1,
+            filename=os.path.basename(name),
+            size=info.file_size,
+            info=info
+        ))
+    return members
+
+class _LimitedReader(io.RawIOBase):
+    """メンバーのストリームを包み、宣言サイズを超えて読み出されたら中断する"""
+
+    def __init__(self, stream: IO[bytes], limit: int):
+        self._stream = stream
+        self._remaining = limit
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._stream.read(len(buffer))
+        if len(data) > self._remaining:
+            raise ZipLimitExceeded("メンバーの実サイズが宣言サイズを超えています")
+        self._remaining -= len(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._stream.close()
+        super().close()
+
+def open_member(archive: zipfile.ZipFile, member: ZipMember) -> IO[bytes]:
+    """メンバーを読み出し用のストリームとして開きます (呼び出し側で close すること)。"""
+    return io.BufferedReader(_LimitedReader(archive.open(member.info), member.size), buffer_size=64 * 1024)
+
+def open_archive(data: Union[bytes, IO[bytes]]) -> zipfile.ZipFile:
+    """
+    ZIP を開きます。bytes の場合は BytesIO で包むだけで、コピーは作りません。
+
+    Raises:
+        zipfile.BadZipFile: ZIP として読めない場合
+    """
+    fileobj = io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+    return zipfile.ZipFile(fileobj)
@@ -51,3 +51,27 @@ gcloud scheduler jobs create http $REPORT_JOB_NAME \
     --http-method=POST \
     --oidc-service-account-email=${SERVICE_ACCOUNT_NAME}@${PROJECT_ID}.iam.gserviceaccount.com \
     --location=$REGION
+
+# 6. 5分ごとに期限切れのリースを回収するジョブを作成 (LEASES_ENABLED=true の場合のみ)
+if [ "${LEASES_ENABLED}" = "true" ]; then
+  LEASE_JOB_NAME="sweep-expired-leases"
+  echo "Creating Lease Sweep Job..."
+  gcloud scheduler jobs create http $LEASE_JOB_NAME \
+      --schedule="*/5 * * * *" \
+      --uri="${SERVICE_URL}/sweep-leases" \
+      --http-method=POST \
+      --oidc-service-account-email=${SERVICE_ACCOUNT_NAME}@${PROJECT_ID}.iam.gserviceaccount.com \
+      --location=$REGION
+fi
+
+# 7. 15分ごとに INVOICE_ERROR のメールを再処理するジョブを作成 (RETRY_ENABLED=true の場合のみ)
+if [ "${RETRY_ENABLED}" = "true" ]; then
+  RETRY_JOB_NAME="retry-error-messages"
+  echo "Creating Retry Job..."
+  gcloud scheduler jobs create http $RETRY_JOB_NAME \
+      --schedule="*/15 * * * *" \
+      --uri="${SERVICE_URL}/retry-errors" \
+      --http-method=POST \
+      --oidc-service-account-email=${SERVICE_ACCOUNT_NAME}@${PROJECT_ID}.iam.gserviceaccount.com \
+      --location=$REGION
+fi
@@ -3,3 +3,113 @@ import os
 
 # プロジェクトルートディレクトリをパスに追加
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import pytest
+
+def pytest_addoption(parser):
+    parser.addoption("--run-benchmarks", action="store_true", default=False,
+                     help="benchmark フィクスチャを使うテスト (pytest-benchmark) も実行する")
+
+def pytest_collection_modifyitems(config, items):
+    """ベンチマークは既定では実行しない (CI の pytest tests/ では等価性テストのみ実行する)"""
+    if config.getoption("--run-benchmarks") or config.getoption("benchmark_only", default=False):
+        return
+    skip = pytest.mark.skip(reason="ベンチマークは --run-benchmarks または --benchmark-only 指定時のみ実行します")
+    for item in items:
+        if "benchmark" in getattr(item, "fixturenames", ()):
+            item.add_marker(skip)
+
+@pytest.fixture(autouse=True)
+def _clear_gmail_label_cache():
+    """ラベルIDのキャッシュにテスト間でモックのIDが残らないようにする"""
+    import services.gmail
+    services.gmail.clear_label_cache()
+    yield
+
+@pytest.fixture(autouse=True)
+def _reset_accounts():
+    """テストで設定したアカウント一覧を元に戻す (単一アカウントモード)"""
+    yield
+    import services.accounts
+    services.accounts.set_accounts(None)
+
+@pytest.fixture(autouse=True)
+def _reset_circuit_breakers():
+    """サーキットブレーカーの状態をテスト間で持ち越さない"""
+    yield
+    import services.circuit_breaker
+    services.circuit_breaker.reset()
+
+@pytest.fixture(autouse=True)
+def _reset_memory_budget():
+    """テストで設定したメモリ予算を持ち越さない"""
+    yield
+    import services.admission
+    services.admission.set_budget(None)
+
+class FakeGCSTransport:
+    """
+    GCS の JSON/アップロード API を模した HTTP トランスポート (google-cloud-storage の実装をそのまま通す)。
+    レジューム可能アップロードを受け付け、完了したオブジェクトを objects に保存する。
+    """
+    is_mtls = False
+
+    def __init__(self):
+        self.objects = {}  # オブジェクト名 -> 内容
+        self.requests = []  # (メソッド, URL)
+        self._sessions = {}  # セッションURL -> [オブジェクト名, 受信済みの内容]
+
+    def request(self, method, url, data=None, headers=None, timeout=None, **kwargs):
+        import json
+        import base64
+        import hashlib
+        import requests
+        import google_crc32c
+
+        self.requests.append((method, url))
+        body = data.read() if hasattr(data, "read") else (data or b"")
+        response = requests.Response()
+        response.request = requests.Request(method, url).prepare()
+        response.status_code = 200
+        if method == "POST" and "uploadType=resumable" in url:
+            session = f"https://upload.gcs.test/session/{len(self._sessions)}"
+            self._sessions[session] = [json.loads(body)["name"], b""]
+            response.headers["Location"] = session
+            return response
+        if method == "PUT" and url in self._sessions:
+            state = self._sessions[url]
+            state[1] += body
+            # Content-Range: bytes 開始-終了/全体 (全体が不明なら *)
+            total = headers["content-range"].rsplit("/", 1)[1]
+            if total == "*" or len(state[1]) < int(total):
+                response.status_code = 308
+                if state[1]:
+                    response.headers["Range"] = f"bytes=0-{len(state[1]) - 1}"
+                return response
+            name, content = self._sessions.pop(url)
+            self.objects[name] = content
+            response._content = json.dumps({
+                "name": name, "size": str(len(content)),
+                "crc32c": base64.b64encode(google_crc32c.Checksum(content).digest()).decode(),
+                "md5Hash": base64.b64encode(hashlib.md5(content).digest()).decode(),
+            }).encode()
+            return response
+        raise AssertionError(f"unexpected GCS request: {method} {url}")
+
+@pytest.fixture
+def gcs(monkeypatch):
+    """実際の GCPStorageAdapter を、モックしたトランスポートで動かす (チャンクは 256 KiB)"""
+    pytest.importorskip("google.cloud.storage")
+    import adapters
+    import google.cloud.storage.blob
+    from google.auth.credentials import AnonymousCredentials
+
+    transport = FakeGCSTransport()
+    monkeypatch.setattr(adapters, "GCS_UPLOAD_CHUNK_SIZE", 256 * 1024)
+    # 小さいオブジェクトもレジューム可能アップロードで送る (ストリームの扱いを検証するため)
+    monkeypatch.setattr(google.cloud.storage.blob, "_MAX_MULTIPART_SIZE", 0)
+    adapter = object.__new__(adapters.GCPStorageAdapter)
+    adapter.client = adapters.storage.Client(project="test-project", credentials=AnonymousCredentials(),
+                                             _http=transport)
+    adapter.transport = transport
+    return adapter
@@ -0,0 +1,110 @@
+import json
+import queue
+import base64
+import pytest
+from unittest.mock import MagicMock
+import services.accounts
+import services.gmail
+import services.locking
+import services.processor
+from services.accounts import Account
+from services.scheduler import FairQueue
+
+ACCOUNTS = [Account("ap@example.com", refresh_token="t1"),
+            Account("billing@example.com", refresh_token="t2", quota_units_per_second=50)]
+
+@pytest.fixture
+def accounts():
+    services.accounts.set_accounts(ACCOUNTS)
+    return ACCOUNTS
+
+def test_parse_accounts(monkeypatch):
+    monkeypatch.setenv("TOKEN_AP", "secret")
+    raw = json.dumps({"accounts": [
+        {"email": "ap@example.com", "refresh_token_env": "TOKEN_AP"},
+        {"email": "billing@example.com", "delegated": True, "quota_units_per_second": 100},
+    ]}).encode()
+    ap, billing = services.accounts.parse_accounts(raw)
+    assert ap.refresh_token == "secret" and not ap.delegated
+    assert billing.delegated and billing.quota_units_per_second == 100.0
+
+    with pytest.raises(ValueError):
+        services.accounts.parse_accounts(b'{"accounts": [{"email": "x@example.com"}]}')
+    with pytest.raises(ValueError):
+        services.accounts.parse_accounts(b'[{"email": "A@example.com", "delegated": true}, '
+                                         b'{"email": "a@example.com", "delegated": true}]')
+
+def test_load_from_accounts_file(tmp_path, monkeypatch):
+    path = tmp_path / "accounts.json"
+    path.write_text('{"accounts": [{"email": "AP@example.com", "refresh_token": "t"}]}')
+    monkeypatch.setattr("config.ACCOUNTS_FILE", str(path))
+    services.accounts.set_accounts(None)
+    assert services.accounts.is_multi_account()
+    assert services.accounts.get_account("ap@EXAMPLE.com").email == "AP@example.com"
+
+def test_single_account_mode_by_default():
+    assert services.accounts.get_accounts() == []
+    assert services.accounts.accounts_for_notification('{"emailAddress": "x@example.com"}') == [None]
+
+def test_notification_routing(accounts):
+    def payload(email):
+        return json.dumps({"emailAddress": email, "historyId": 1234})
+
+    assert services.accounts.accounts_for_notification(payload("Billing@example.com")) == [ACCOUNTS[1]]
+    assert services.accounts.accounts_for_notification(payload("other@example.com")) == []
+    # 読めない通知は全アカウントを確認する
+    assert services.accounts.accounts_for_notification(None) == ACCOUNTS
+    assert services.accounts.accounts_for_notification("not json") == ACCOUNTS
+
+def test_gmail_state_is_per_account(accounts, mocker):
+    build = mocker.patch("services.gmail.build", side_effect=lambda *a, **kw: MagicMock())
+    mocker.patch("services.gmail._account_credentials", side_effect=lambda account: f"creds:{account.email}")
+    mocker.patch.dict(services.gmail._creds, clear=True)
+    mocker.patch.dict(services.gmail._account_limiters, clear=True)
+    mocker.patch("services.gmail._resolve_label_id",
+                 side_effect=lambda name: f"{services.accounts.current_account().email}:{name}")
+    mocker.patch("config.GMAIL_QUOTA_UNITS_PER_SECOND", 0)
+
+    seen = {}
+    for account in accounts:
+        with services.accounts.use_account(account):
+            seen[account.email] = (services.gmail.get_gmail_service(),
+                                   services.gmail.get_or_create_label_id("INVOICE_PROCESSED"),
+                                   services.gmail._get_rate_limiter())
+            assert services.gmail.get_gmail_service() is seen[account.email][0]
+
+    ap, billing = seen["ap@example.com"], seen["billing@example.com"]
+    assert ap[0] is not billing[0]
+    assert [c.kwargs["credentials"] for c in build.call_args_list] == ["creds:ap@example.com", "creds:billing@example.com"]
+    assert (ap[1], billing[1]) == ("ap@example.com:INVOICE_PROCESSED", "billing@example.com:INVOICE_PROCESSED")
+    # クォータはアカウントごと (未指定のアカウントは GMAIL_QUOTA_UNITS_PER_SECOND=0 で無制限)
+    assert ap[2] is None and billing[2].rate == 50
+
+def test_claim_and_process_in_account_context(accounts, mocker):
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    mocker.patch("services.gmail.get_or_create_label_id", return_value="Label_processed")
+    mocker.patch("config.FILTER_QUERY_PUSHDOWN", False)
+    service.users().messages().list().execute.return_value = {'messages': [{'id': 'm1'}]}
+
+    with services.accounts.use_account(accounts[1]):
+        locked = services.locking.lock_and_get_messages()
+    assert locked == [{'id': 'm1', 'account': 'billing@example.com'}]
+
+    used = []
+    mocker.patch("services.processor._run_task",
+                 side_effect=lambda m: used.append(services.accounts.current_account()) or "success")
+    assert services.processor.process_email_task(locked[0]) == "success"
+    assert used == [accounts[1]]
+    assert services.accounts.current_account() is None
+
+def test_fair_queue_round_robin():
+    q = FairQueue()
+    for i in range(4):
+        q.put("big", f"b{i}")
+    q.put("small", "s0")
+    q.put("small", "s1")
+    assert q.pending() == 6 and q.pending("small") == 2
+    assert [q.get_nowait()[1] for _ in range(6)] == ["b0", "s0", "b1", "s1", "b2", "b3"]
+    with pytest.raises(queue.Empty):
+        q.get(timeout=0.01)
@@ -0,0 +1,26 @@
+import io
+import random
+import zipfile
+import services.zip_expander
+
+def zip_with(name, data):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr(name, data)
+    return zipfile.ZipFile(io.BytesIO(buffer.getvalue()))
+
+def test_gcs_streams_zip_member_in_chunks(gcs):
+    data = b"%PDF-1.4\n" + random.Random(0).randbytes(700 * 1024)  # 3チャンク分
+    archive = zip_with("請求書.pdf", data)
+    member = services.zip_expander.list_members(archive, services.zip_expander.ZipLimits.from_config())[0]
+
+    # ZIP メンバーのストリームはシークできない (tell() も使えない)
+    url = gcs.save_fileobj("bucket", "2024/03/01/請求書.pdf", services.zip_expander.open_member(archive, member),
+                           content_type="application/pdf", size=member.size)
+    assert url == "https://storage.cloud.google.com/bucket/2024/03/01/請求書.pdf"
+    assert gcs.transport.objects["2024/03/01/請求書.pdf"] == data
+    assert [m for m, _ in gcs.transport.requests].count("PUT") == 3
+
+def test_gcs_uploads_seekable_stream(gcs):
+    gcs.save_fileobj("bucket", "a.bin", io.BytesIO(b"abc"), size=3)
+    assert gcs.transport.objects["a.bin"] == b"abc"
@@ -0,0 +1,135 @@
+import threading
+import time
+import pytest
+import services.admission
+import services.processor
+from services.admission import MemoryBudget
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+def start(budget, nbytes, done):
+    thread = threading.Thread(target=lambda: done.append(budget.acquire(nbytes)), daemon=True)
+    thread.start()
+    return thread
+
+def test_large_waits_and_small_keeps_flowing():
+    budget = MemoryBudget(100, starvation_seconds=30, clock=Clock())
+    assert budget.acquire(60) == 60
+    large, small = [], []
+    start(budget, 80, large)
+    wait_until(lambda: len(budget._waiters) == 1)
+    # 空きに収まる小さな予約は、大きな予約の待ちを追い越す
+    start(budget, 30, small)
+    wait_until(lambda: small == [30])
+    assert large == []
+
+    budget.release(60)
+    budget.release(30)
+    wait_until(lambda: large == [80])
+    assert budget.reserved == 80
+
+def test_oversized_reservation_is_clamped_to_capacity():
+    budget = MemoryBudget(100)
+    assert budget.acquire(500) == 100
+    with pytest.raises(TimeoutError):
+        budget.acquire(1, timeout=0.05)
+    budget.release(100)
+    assert budget.reserved == 0
+
+def test_starving_waiter_blocks_newcomers():
+    clock = Clock()
+    budget = MemoryBudget(100, starvation_seconds=30, clock=clock)
+    budget.acquire(60)
+    large = []
+    start(budget, 80, large)
+    wait_until(lambda: len(budget._waiters) == 1)
+    clock.now = 31
+    # 長く待っている予約があれば、収まる予約でも追い越さない
+    with pytest.raises(TimeoutError):
+        budget.acquire(10, timeout=0.05)
+    budget.release(60)
+    wait_until(lambda: large == [80])
+
+def test_reserve_is_noop_when_disabled(monkeypatch):
+    monkeypatch.setattr("config.MEMORY_BUDGET_BYTES", 0)
+    with services.admission.reserve(10**9) as reserved:
+        assert reserved == 0
+
+def test_reserve_releases_after_block(monkeypatch):
+    monkeypatch.setattr("config.MEMORY_BUDGET_BYTES", 1000)
+    with pytest.raises(RuntimeError):
+        with services.admission.reserve(100) as reserved:
+            assert reserved == 250 and services.admission.get_budget().reserved == 250
+            raise RuntimeError("upload failed")
+    assert services.admission.get_budget().reserved == 0
+
+@pytest.fixture
+def raw_pipeline(monkeypatch, mocker):
+    """raw モードの処理パイプライン (各段階での予約済みバイト数を記録する)"""
+    import datetime
+    from services.parser import Email, Attachment
+    monkeypatch.setattr("config.MEMORY_BUDGET_BYTES", 10**6)
+    monkeypatch.setattr("config.INGEST_MODE", "raw")
+    monkeypatch.setattr("config.ZIP_EXPANSION_ENABLED", True)
+    monkeypatch.setattr("config.ZIP_MAX_COMPRESSION_RATIO", 1000)
+    monkeypatch.setattr("config.EXTRACTION_ENABLED", True)
+    mocker.patch("services.error_monitor.record_success")
+    mocker.patch("services.processor.is_allowed_email", return_value=True)
+    seen = {}
+    reserved = lambda: services.admission.get_budget().reserved
+    service = mocker.patch("services.gmail.get_gmail_service").return_value
+    service.users().messages().get().execute.side_effect = lambda: seen.setdefault("fetch", reserved()) and {}
+    storage = mocker.patch("adapters.get_storage_adapter").return_value
+    storage.save_file.side_effect = lambda **kwargs: seen.setdefault(kwargs["file_path"], reserved()) and "url"
+    storage.save_fileobj.side_effect = lambda **kwargs: seen.setdefault(kwargs["file_path"], -1) and "url"
+    mocker.patch("adapters.get_bigquery_adapter").return_value.insert_rows.return_value = []
+    mocker.patch("services.extraction.extract_invoice_fields",
+                 side_effect=lambda data: seen.setdefault("extract", reserved()) and {})
+
+    def run(data, filename):
+        mocker.patch("services.parser.parse_raw_message", return_value=Email(
+            id="m1", subject="Invoice", sender_name="A", sender_address="a@example.com",
+            received_at=datetime.datetime(2025, 1, 31),
+            attachments=[Attachment(id="p1", filename=filename, mime_type="application/octet-stream",
+                                    size=len(data), data=data)]))
+        assert services.processor.process_email_task({'id': 'm1', 'sizeEstimate': 1000}) == "success"
+        assert reserved() == 0
+        return seen
+    return run
+
+def test_raw_fetch_reserves_size_estimate_once(raw_pipeline):
+    seen = raw_pipeline(b"%PDF-1 invoice", "invoice.pdf")
+    # 取得前に sizeEstimate 分を予約し、取り出し済みの添付ファイルでは重ねて予約しない
+    assert seen["fetch"] == 2500
+    assert seen["extract"] == 2500
+
+def test_zip_members_read_for_extraction_are_reserved(raw_pipeline, monkeypatch):
+    import io, zipfile
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        zf.writestr("a.pdf", b"%PDF-" + b"a" * 995)
+    seen = raw_pipeline(buffer.getvalue(), "monthly.zip")
+    assert seen["extract"] == 2500 + 2500
+
+def test_zip_member_is_streamed_when_budget_is_full(raw_pipeline, monkeypatch):
+    import io, zipfile
+    monkeypatch.setattr("config.MEMORY_BUDGET_BYTES", 3000)
+    monkeypatch.setattr("services.admission.NESTED_RESERVE_TIMEOUT_SECONDS", 0.05)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as zf:
+        zf.writestr("a.pdf", b"%PDF-" + b"a" * 995)
+    seen = raw_pipeline(buffer.getvalue(), "monthly.zip")
+    # 予約できなければ抽出せずにストリームのまま保存する
+    assert "extract" not in seen
+    assert seen["2025/01/31/m1_1_1_a.pdf"] == -1
@@ -0,0 +1,125 @@
+import datetime
+import threading
+import pytest
+from unittest.mock import MagicMock
+import backfill
+import services.gmail
+from services.ratelimit import TokenBucket
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+def test_token_bucket_paces_to_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(rate=10, capacity=10, clock=clock, sleep=clock.sleep)
+    # 容量分はすぐに使える
+    for _ in range(10):
+        assert bucket.acquire(1) == 0
+    assert bucket.try_acquire(1) == False
+    # 以降は 1 トークンあたり 0.1 秒
+    bucket.acquire(5)
+    assert clock.now == pytest.approx(0.5)
+
+def test_gmail_execute_uses_quota_units():
+    limiter = MagicMock()
+    services.gmail.set_rate_limiter(limiter)
+    try:
+        services.gmail.execute(MagicMock(), "messages.get")
+        services.gmail.execute(MagicMock(), "history.list")
+    finally:
+        services.gmail.set_rate_limiter(None)
+    assert [c.args[0] for c in limiter.acquire.call_args_list] == [5, 2]
+
+def test_build_backfill_query(monkeypatch):
+    monkeypatch.setattr("config.RULES_SOURCE", None)
+    monkeypatch.setattr("config.ALLOWED_DOMAINS", ["example.com", "billing.jp"])
+    monkeypatch.setattr("config.SUBJECT_KEYWORDS", ["請求書"])
+    monkeypatch.setattr("config.FILTER_QUERY_PUSHDOWN_SUBJECTS", True)
+    query = backfill.build_backfill_query(datetime.date(2024, 1, 1), datetime.date(2024, 12, 31))
+    assert query == ("has:attachment after:2024/01/01 before:2025/01/01 "
+                     "-label:INVOICE_PROCESSED -label:INVOICE_ERROR -label:INVOICE_DEAD_LETTER "
+                     "{from:example.com from:billing.jp subject:請求書}")
+    assert backfill.build_backfill_query(query="from:a.com", include_processed=True, use_filters=False) == \
+        "has:attachment from:a.com"
+
+def test_backfill_query_leaves_subject_keywords_to_the_post_filter(monkeypatch):
+    # subject: の単語一致で部分一致のメールを取りこぼさないよう、既定では絞り込まない
+    monkeypatch.setattr("config.RULES_SOURCE", None)
+    monkeypatch.setattr("config.ALLOWED_DOMAINS", ["example.com"])
+    monkeypatch.setattr("config.SUBJECT_KEYWORDS", ["Invoice"])
+    monkeypatch.setattr("config.FILTER_QUERY_PUSHDOWN_SUBJECTS", False)
+    assert backfill.build_backfill_query(include_processed=True) == "has:attachment"
+
+    monkeypatch.setattr("config.SUBJECT_KEYWORDS", [])
+    assert backfill.build_backfill_query(include_processed=True) == "has:attachment from:example.com"
+
+@pytest.fixture
+def gmail_pages(mocker):
+    """3ページ・計5件の検索結果を返す Gmail サービス"""
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    pages = {
+        None: {'messages': [{'id': 'm1'}, {'id': 'm2'}], 'nextPageToken': 'p2', 'resultSizeEstimate': 5},
+        'p2': {'messages': [{'id': 'm3'}, {'id': 'm4'}], 'nextPageToken': 'p3'},
+        'p3': {'messages': [{'id': 'm5'}]},
+    }
+    service.users.return_value.messages.return_value.list.side_effect = \
+        lambda userId, q, maxResults, pageToken: MagicMock(execute=MagicMock(return_value=pages[pageToken]))
+    return service
+
+def test_backfill_resumes_from_checkpoint(tmp_path, gmail_pages, mocker):
+    path = str(tmp_path / "checkpoint.json")
+    stop = threading.Event()
+    processed = []
+
+    def first_run(message_data):
+        processed.append(message_data['id'])
+        if message_data['id'] == 'm2':
+            # m2 の処理中に中断要求 (実行中の処理は完了させる)
+            stop.set()
+        return "error" if message_data['id'] == 'm1' else "success"
+
+    mocker.patch("backfill.process_email_task", side_effect=first_run)
+    checkpoint = backfill.Checkpoint.load(path, "q")
+    progress = backfill.run_backfill(checkpoint, workers=1, stop=stop)
+    assert checkpoint.listing_done and checkpoint.ids == ['m1', 'm2', 'm3', 'm4', 'm5']
+    assert progress.failed == 1
+    first = list(processed)
+    assert first[:2] == ['m1', 'm2']
+
+    # 再開: 一覧は取り直さず、未処理のものだけを処理する
+    gmail_pages.users.return_value.messages.return_value.list.reset_mock()
+    processed.clear()
+    mocker.patch("backfill.process_email_task", side_effect=lambda m: processed.append(m['id']) or "success")
+    checkpoint = backfill.Checkpoint.load(path, "q")
+    backfill.run_backfill(checkpoint, workers=2)
+    gmail_pages.users.return_value.messages.return_value.list.assert_not_called()
+    assert sorted(processed + first) == ['m1', 'm2', 'm3', 'm4', 'm5']
+    assert checkpoint.failed == {'m1'}
+
+    # 失敗分の再処理
+    processed.clear()
+    backfill.run_backfill(backfill.Checkpoint.load(path, "q"), workers=2, retry_failed=True)
+    assert processed == ['m1']
+    assert backfill.Checkpoint.load(path, "q").failed == set()
+
+def test_checkpoint_rejects_other_query(tmp_path):
+    path = str(tmp_path / "checkpoint.json")
+    backfill.Checkpoint(path, "q1").save()
+    with pytest.raises(ValueError):
+        backfill.Checkpoint.load(path, "q2")
+
+def test_progress_reports_eta():
+    clock = FakeClock()
+    progress = backfill.ProgressReporter(total=100, clock=clock)
+    for _ in range(20):
+        progress.record(True)
+    clock.now = 10.0
+    assert progress.summary() == "20/100 件 (失敗 0) | 2.00 件/秒 | 残り約 0:00:40"
@@ -0,0 +1,146 @@
+import io
+import pytest
+from unittest.mock import MagicMock
+import services.circuit_breaker
+import services.locking
+import services.processor
+import services.slack
+from services.circuit_breaker import CircuitBreaker, CircuitOpenError, GuardedAdapter
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class HttpFailure(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.code = status
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr("config.CIRCUIT_BREAKER_ENABLED", True)
+    monkeypatch.setattr("config.CIRCUIT_FAILURE_THRESHOLD", 2)
+    monkeypatch.setattr("config.CIRCUIT_RESET_SECONDS", 30)
+
+def trip(name):
+    breaker = services.circuit_breaker.get_breaker(name)
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    assert breaker.is_open()
+
+def fail(breaker, exc):
+    with pytest.raises(type(exc)):
+        with breaker.guard():
+            raise exc
+
+def test_open_half_open_closed():
+    clock = Clock()
+    breaker = CircuitBreaker("storage", failure_threshold=3, reset_seconds=30, clock=clock)
+    for _ in range(2):
+        fail(breaker, HttpFailure(503))
+    assert breaker.state == "closed"
+    fail(breaker, ConnectionError("reset"))
+    assert breaker.state == "open"
+    with pytest.raises(CircuitOpenError):
+        with breaker.guard():
+            pytest.fail("open のブレーカーは呼び出しを通さない")
+
+    # 待機後は1件だけ試行を通し、失敗すれば再び open
+    clock.now = 30
+    assert breaker.state == "half_open"
+    assert breaker.allow() and not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.retry_after() == 30
+
+    clock.now = 60
+    with breaker.guard():
+        pass
+    assert breaker.state == "closed"
+
+def test_client_errors_do_not_trip():
+    breaker = CircuitBreaker("gmail", failure_threshold=1, reset_seconds=30, clock=Clock())
+    fail(breaker, HttpFailure(404))
+    assert breaker.state == "closed"
+    fail(breaker, HttpFailure(429))
+    assert breaker.state == "open"
+
+def test_disabled_is_passthrough():
+    adapter = MagicMock()
+    adapter.insert_rows.side_effect = HttpFailure(500)
+    guarded = GuardedAdapter(adapter, "bigquery")
+    for _ in range(10):
+        with pytest.raises(HttpFailure):
+            guarded.insert_rows("t", [])
+    assert services.circuit_breaker.open_dependencies() == []
+
+def test_guarded_adapter_rejects_when_open(enabled):
+    adapter = MagicMock()
+    adapter.save_file.side_effect = HttpFailure(503)
+    guarded = GuardedAdapter(adapter, "storage")
+    for _ in range(2):
+        with pytest.raises(HttpFailure):
+            guarded.save_file(bucket_name="b", file_path="p", data=b"")
+    with pytest.raises(CircuitOpenError):
+        guarded.save_file(bucket_name="b", file_path="p", data=b"")
+    assert adapter.save_file.call_count == 2
+    assert services.circuit_breaker.open_dependencies() == ["storage"]
+
+def test_guarded_adapter_counts_lazy_iteration_and_reads(enabled):
+    class Adapter:
+        def query_rows(self, table_id, start, end, sender=None):
+            yield {"message_id": "m1"}
+            raise HttpFailure(503)
+
+        def open_file(self, bucket_name, file_path):
+            class Download(io.RawIOBase):
+                def readable(self):
+                    return True
+
+                def readinto(self, buffer):
+                    raise HttpFailure(500)
+            return Download()
+
+    guarded = GuardedAdapter(Adapter(), "bigquery")
+    rows = guarded.query_rows("t", "2024-03-01", "2024-04-01")
+    assert next(rows) == {"message_id": "m1"}
+    # 呼び出し後のページ取得の失敗も数える
+    with pytest.raises(HttpFailure):
+        next(rows)
+    with guarded.open_file("b", "p") as src, pytest.raises(HttpFailure):
+        src.read(10)
+    assert services.circuit_breaker.open_dependencies() == ["bigquery"]
+    with pytest.raises(CircuitOpenError):
+        guarded.open_file("b", "p").read(10)
+
+def test_claims_pause_while_dependency_is_open(enabled, mocker):
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    trip("bigquery")
+
+    assert services.locking.lock_and_get_messages() == []
+    service.users().messages().list.assert_not_called()
+
+def test_claimed_message_is_parked_not_errored(enabled, mocker):
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    mocker.patch("services.gmail.get_or_create_label_id", side_effect=lambda name: f"Label_{name}")
+    record_error = mocker.patch("services.error_monitor.record_error")
+    trip("storage")
+
+    assert services.processor.process_email_task({'id': 'm1'}) == "parked"
+    service.users().messages().get.assert_not_called()
+    modify = service.users().messages().modify
+    assert modify.call_args.kwargs['body'] == {'removeLabelIds': ['Label_INVOICE_PROCESSED']}
+    record_error.assert_not_called()
+
+def test_slack_alert_skipped_while_open(enabled, monkeypatch, mocker):
+    monkeypatch.setattr("config.SLACK_WEBHOOK_URL", "https://hooks.slack.example/x")
+    session = MagicMock()
+    mocker.patch("services.slack._get_session", return_value=session)
+    trip("slack")
+
+    assert services.slack.send_slack_alert("test", "error") is False
+    session.post.assert_not_called()
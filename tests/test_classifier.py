@@ -0,0 +1,111 @@
+import datetime
+import json
+import pytest
+from unittest.mock import MagicMock
+import services.rules
+import services.classifier
+from services.classifier import classify, detect_kind, get_policy, ARCHIVE, SKIP, EXPAND
+from services.parser import Email, Attachment
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 32
+PDF = b"%PDF-1.7\n" + b"\x00" * 32
+ZIP = b"PK\x03\x04" + b"\x00" * 32
+
+@pytest.fixture
+def default_policy(monkeypatch):
+    monkeypatch.setattr(services.rules.config, "RULES_SOURCE", None)
+    monkeypatch.setattr(services.rules, "_active_rule_set", None)
+    return get_policy("a@example.com", "請求書")
+
+def test_detect_kind_by_magic_bytes():
+    assert detect_kind(PDF) == "pdf"
+    assert detect_kind(PNG) == "png"
+    assert detect_kind(ZIP) == "zip"
+    assert detect_kind(b"\xff\xd8\xff\xe0\x00\x10JFIF") == "jpeg"
+    assert detect_kind(b"\xef\xbb\xbf<?xml version='1.0'?>") == "xml"
+    assert detect_kind(b"  <!DOCTYPE html><html>") == "html"
+    assert detect_kind(b"hello") is None
+
+def test_default_policy_skips_logos_and_inline_images(default_policy):
+    # Outlook の埋め込み画像名・Content-Disposition: inline・小さな画像はスキップ
+    assert classify(default_policy, "image001.png", "image/png", 500_000).decision == SKIP
+    assert classify(default_policy, "scan.png", "image/png", 500_000, inline=True).reason == "inline_image"
+    assert classify(default_policy, "logo.gif", "image/gif", 43).reason == "small_image"
+    # 大きなスキャン画像や PDF は保存
+    assert classify(default_policy, "scan.jpg", "image/jpeg", 500_000).decision == ARCHIVE
+    assert classify(default_policy, "invoice.pdf", "application/pdf", 100).decision == ARCHIVE
+    # 招待状などは既定でスキップ
+    assert classify(default_policy, "invite.ics", "text/calendar", 2000).decision == SKIP
+
+def test_archives_are_expanded_but_office_files_are_not(default_policy):
+    assert classify(default_policy, "invoices.zip", "application/zip", 5000).decision == EXPAND
+    assert classify(default_policy, "invoice.xlsx", "application/octet-stream", 5000, head=ZIP).decision == ARCHIVE
+
+def test_magic_bytes_override_declared_type(default_policy):
+    # 拡張子は PDF でも中身が小さな PNG なら署名画像としてスキップ
+    verdict = classify(default_policy, "invoice.pdf", "application/pdf", 800, head=PNG)
+    assert (verdict.decision, verdict.kind) == (SKIP, "png")
+    # 拡張子が不明でも中身が PDF なら保存
+    assert classify(default_policy, "download", "application/octet-stream", 800, head=PDF).kind == "pdf"
+
+def test_per_sender_policy_from_rule_file(tmp_path, monkeypatch):
+    path = tmp_path / "rules.json"
+    path.write_text(json.dumps({"version": "v1", "rules": [
+        # この取引先は請求書を小さな PNG で送ってくる
+        {"name": "png-supplier", "domains": ["png.example"],
+         "attachment_policy": {"archive_types": ["png"], "expand_archives": False}},
+        {"name": "others", "domains": ["example.com"]}
+    ]}), encoding="utf-8")
+    monkeypatch.setattr(services.rules.config, "RULES_SOURCE", str(path))
+    monkeypatch.setattr(services.rules, "_active_rule_set", None)
+    monkeypatch.setattr(services.rules, "_fingerprint", None)
+
+    policy = get_policy("billing@png.example", "invoice")
+    assert classify(policy, "image001.png", "image/png", 500).decision == ARCHIVE
+    assert classify(policy, "bundle.zip", "application/zip", 500).decision == ARCHIVE
+    # 未指定の項目は既定値
+    assert policy.min_image_bytes == services.classifier.config.CLASSIFIER_MIN_IMAGE_BYTES
+
+    policy = get_policy("billing@example.com", "invoice")
+    assert classify(policy, "image001.png", "image/png", 500).decision == SKIP
+
+def test_processor_skips_before_download_and_after_magic_check(monkeypatch, mocker):
+    """埋め込み画像はダウンロードせず、中身が画像の .pdf はアップロードしない"""
+    import base64
+    import services.metrics
+    from services.processor import process_email_task
+
+    monkeypatch.setattr("config.ATTACHMENT_CLASSIFIER_ENABLED", True)
+    monkeypatch.setattr("config.RULES_SOURCE", None)
+    monkeypatch.setattr(services.rules, "_active_rule_set", None)
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    mocker.patch("services.error_monitor.record_success")
+    mocker.patch("services.processor.is_allowed_email", return_value=True)
+    storage = mocker.patch("adapters.get_storage_adapter").return_value
+    storage.save_file.return_value = "https://mock"
+    bq = mocker.patch("adapters.get_bigquery_adapter").return_value
+    bq.insert_rows.return_value = []
+    mocker.patch("services.parser.parse_message_detail", return_value=Email(
+        id="m1", subject="Invoice", sender_name="A", sender_address="a@example.com",
+        received_at=datetime.datetime(2025, 1, 31),
+        attachments=[
+            Attachment(id="att1", filename="image001.png", mime_type="image/png", size=3000, inline=True),
+            Attachment(id="att2", filename="invoice.pdf", mime_type="application/pdf", size=len(PDF)),
+            Attachment(id="att3", filename="fake.pdf", mime_type="application/pdf", size=len(PNG)),
+        ]))
+
+    def fake_attachment_get(userId, messageId, id):
+        data = {"att1": PNG, "att2": PDF, "att3": PNG}[id]
+        return MagicMock(execute=MagicMock(return_value={'data': base64.urlsafe_b64encode(data).decode()}))
+    service.users.return_value.messages.return_value.attachments.return_value.get.side_effect = fake_attachment_get
+    skipped_before = services.metrics.ATTACHMENTS.get(result="skipped")
+
+    process_email_task({'id': 'm1'})
+
+    downloaded = [c.kwargs['id'] for c in
+                  service.users.return_value.messages.return_value.attachments.return_value.get.call_args_list]
+    assert downloaded == ["att2", "att3"]
+    assert [c.kwargs['file_path'] for c in storage.save_file.call_args_list] == ["2025/01/31/m1_2_invoice.pdf"]
+    assert bq.insert_rows.call_count == 1
+    assert services.metrics.ATTACHMENTS.get(result="skipped") == skipped_before + 2
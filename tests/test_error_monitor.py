@@ -0,0 +1,90 @@
+import pytest
+import services.error_monitor as em
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    """error_monitor の内部状態を初期化し、時刻を固定"""
+    fake = FakeClock(1_000_000.0)
+    monkeypatch.setattr(em.time, "time", fake.time)
+    monkeypatch.setattr(em, "_buckets", [em._Bucket() for _ in range(em._NUM_BUCKETS)])
+    monkeypatch.setattr(em, "_head_epoch", int(fake.now // em.BUCKET_SECONDS))
+    monkeypatch.setattr(em, "_processed_count", 0)
+    monkeypatch.setattr(em, "_error_count", 0)
+    monkeypatch.setattr(em, "_stage_counts", em.Counter())
+    monkeypatch.setattr(em, "_class_counts", em.Counter())
+    monkeypatch.setattr(em, "_start_time", fake.now)
+    monkeypatch.setattr(em, "_last_alert_time", 0)
+    return fake
+
+def test_sliding_window_expires_old_buckets(clock, mocker):
+    mocker.patch.object(em, "_send_threshold_alert")
+    for _ in range(5):
+        em.record_success()
+    em.record_error(stage="upload", error_class="HttpError")
+
+    clock.now += em.CHECK_WINDOW_SECONDS / 2
+    em.record_success()
+    stats = em.get_current_stats()
+    assert stats["processed"] == 6
+    assert stats["errors"] == 1
+
+    # 最初のバケットだけがウィンドウから外れる (タンブリングのように全リセットしない)
+    clock.now += em.CHECK_WINDOW_SECONDS / 2
+    stats = em.get_current_stats()
+    assert stats["processed"] == 1
+    assert stats["errors"] == 0
+    assert stats["errors_by_stage"] == {}
+
+def test_spike_straddling_boundary_is_detected(clock, mocker):
+    """旧実装のリセット境界をまたぐエラー急増も検知できる"""
+    alert = mocker.patch.object(em, "_send_threshold_alert")
+    for _ in range(5):
+        em.record_error(stage="insert", error_class="GoogleAPIError")
+    clock.now += em.CHECK_WINDOW_SECONDS - em.BUCKET_SECONDS
+    for _ in range(5):
+        em.record_error(stage="insert", error_class="GoogleAPIError")
+
+    alert.assert_called_once()
+    args = alert.call_args.args
+    assert args[1] == 10 and args[2] == 10
+    assert args[3] == {"insert": 10}
+    assert args[4] == {"GoogleAPIError": 10}
+
+def test_min_volume_and_cooldown(clock, mocker):
+    alert = mocker.patch.object(em, "_send_threshold_alert")
+    for _ in range(em.MIN_VOLUME - 1):
+        em.record_error(stage="fetch")
+    alert.assert_not_called()
+
+    em.record_error(stage="fetch")
+    assert alert.call_count == 1
+
+    # クールダウン中は再送しない
+    clock.now += em.ALERT_COOLDOWN_SECONDS - 1
+    em.record_error(stage="fetch")
+    assert alert.call_count == 1
+
+    # クールダウン明けは、ウィンドウ内で再び最低件数に達した時点でアラート
+    clock.now += 2
+    for _ in range(em.MIN_VOLUME):
+        em.record_error(stage="fetch")
+    assert alert.call_count == 2
+
+def test_breakdown_rates(clock, mocker):
+    mocker.patch.object(em, "_send_threshold_alert")
+    for _ in range(8):
+        em.record_success()
+    em.record_error(stage="download", error_class="TimeoutError")
+    em.record_error(stage="label", error_class="HttpError")
+
+    stats = em.get_current_stats()
+    assert stats["error_rate"] == pytest.approx(0.2)
+    assert stats["error_rate_by_stage"] == {"download": pytest.approx(0.1), "label": pytest.approx(0.1)}
+    assert stats["errors_by_class"] == {"TimeoutError": 1, "HttpError": 1}
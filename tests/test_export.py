@@ -0,0 +1,105 @@
+import csv
+import io
+import random
+import datetime
+import zipfile
+import pytest
+import adapters
+import services.export
+from services.export import ExportRequest
+
+@pytest.fixture
+def local(tmp_path, monkeypatch):
+    storage = adapters.LocalStorageAdapter(str(tmp_path / "storage"))
+    bq = adapters.LocalBigQueryAdapter(str(tmp_path / "bq.jsonl"))
+    monkeypatch.setattr("adapters.get_storage_adapter", lambda: storage)
+    monkeypatch.setattr("adapters.get_bigquery_adapter", lambda: bq)
+    monkeypatch.setattr("config.PROJECT_ID", "proj")
+    monkeypatch.setattr("config.BUCKET_NAME_TEMPLATE", "{}-invoices")
+    monkeypatch.setattr("config.BQ_TABLE_ID", "proj.invoice_data.invoice_log")
+    return storage, bq
+
+def archive(storage, bq, msg_id, received_at, filename, data, sender="billing@acme.example", row_id=None):
+    path = f"{received_at[:10].replace('-', '/')}/{msg_id}_{filename}"
+    if data is not None:
+        storage.save_file("proj-invoices", path, data)
+    bq.insert_rows("proj.invoice_data.invoice_log", [{
+        "message_id": msg_id, "received_at": received_at, "sender_name": "ACME", "sender_address": sender,
+        "subject": "Invoice", "filename": filename, "file_size_bytes": len(data or b""),
+        "gcs_path": f"gs://proj-invoices/{path}"}], row_ids=[row_id or f"{msg_id}_{filename}"])
+
+def read_export(storage, url):
+    return zipfile.ZipFile(url[len("file://"):])
+
+def test_month_request_bounds():
+    request = ExportRequest.for_month("2024-12")
+    assert (request.start, request.end, request.label) == (datetime.date(2024, 12, 1), datetime.date(2025, 1, 1), "2024-12")
+    assert ExportRequest(datetime.date(2024, 1, 5), datetime.date(2024, 2, 1), "a@b.example").label == \
+        "2024-01-05_2024-01-31_a@b.example"
+
+def test_export_month_bundle_with_manifest(local):
+    storage, bq = local
+    big = bytes(range(256)) * 20000  # スプールの上限を超える
+    archive(storage, bq, "m1", "2024-03-01T09:00:00", "invoice.pdf", b"%PDF-1 one")
+    archive(storage, bq, "m2", "2024-03-01T10:00:00", "invoice.pdf", b"%PDF-1 two")
+    archive(storage, bq, "m2", "2024-03-01T10:00:00", "invoice.pdf", b"%PDF-1 two")  # 重複挿入
+    archive(storage, bq, "m3", "2024-03-15T10:00:00", "bundle.bin", big, sender="ap@other.example")
+    archive(storage, bq, "m4", "2024-03-20T10:00:00", "gone.pdf", None)
+    archive(storage, bq, "m5", "2024-04-01T00:00:00", "april.pdf", b"%PDF-1 april")
+
+    summary = services.export.run_export(ExportRequest.for_month("2024-03"), workers=2)
+
+    assert (summary["rows"], summary["files"], summary["missing"]) == (4, 3, 1)
+    assert summary["bytes"] == len(big) + 20
+    with read_export(storage, summary["zip_url"]) as bundle:
+        assert bundle.namelist() == ["2024-03-01/billing@acme.example/invoice.pdf",
+                                     "2024-03-01/billing@acme.example/invoice_2.pdf",
+                                     "2024-03-15/ap@other.example/bundle.bin",
+                                     "manifest.csv"]
+        assert bundle.read("2024-03-01/billing@acme.example/invoice_2.pdf") == b"%PDF-1 two"
+        assert bundle.read("2024-03-15/ap@other.example/bundle.bin") == big
+        in_zip = bundle.read("manifest.csv").decode("utf-8-sig")
+    with open(summary["manifest_url"][len("file://"):], encoding="utf-8-sig", newline="") as f:
+        assert f.read() == in_zip
+    manifest = list(csv.DictReader(io.StringIO(in_zip)))
+    assert [(r["message_id"], r["status"]) for r in manifest] == [("m1", "ok"), ("m2", "ok"), ("m3", "ok"), ("m4", "missing")]
+    assert manifest[3]["zip_path"] == ""
+
+def test_export_filters_by_sender(local):
+    storage, bq = local
+    archive(storage, bq, "m1", "2024-03-01T09:00:00", "a.pdf", b"a")
+    archive(storage, bq, "m2", "2024-03-02T09:00:00", "b.pdf", b"b", sender="ap@other.example")
+
+    summary = services.export.run_export(
+        ExportRequest(datetime.date(2024, 3, 1), datetime.date(2024, 3, 3), "OTHER.example"))
+
+    assert summary["files"] == 1
+    assert "/2024-03-01_2024-03-02_OTHER.example/" in summary["zip_url"]
+    with read_export(storage, summary["zip_url"]) as bundle:
+        assert bundle.namelist() == ["2024-03-02/ap@other.example/b.pdf", "manifest.csv"]
+
+def test_upload_failure_stops_the_writer(local, mocker):
+    storage, bq = local
+    archive(storage, bq, "m1", "2024-03-01T09:00:00", "a.pdf", b"a" * 10**6)
+    mocker.patch.object(storage, "save_fileobj", side_effect=OSError("503"))
+
+    with pytest.raises(OSError):
+        services.export.run_export(ExportRequest.for_month("2024-03"))
+
+def test_export_streams_zip_to_gcs_through_the_pipe(local, gcs, monkeypatch):
+    storage, bq = local
+    big = random.Random(0).randbytes(600 * 1024)  # 複数チャンクになる
+    archive(storage, bq, "m1", "2024-03-01T09:00:00", "invoice.pdf", b"%PDF-1 one")
+    archive(storage, bq, "m2", "2024-03-02T09:00:00", "bundle.bin", big)
+    # 元ファイルの読み出しはローカル、書き出しは GCS アダプター (サイズ不明のパイプをそのまま渡す)
+    monkeypatch.setattr(gcs, "open_file", storage.open_file)
+    monkeypatch.setattr("adapters.get_storage_adapter", lambda: gcs)
+
+    summary = services.export.run_export(ExportRequest.for_month("2024-03"), workers=2)
+
+    zip_name = summary["zip_url"].split("/proj-invoices/", 1)[1]
+    assert zip_name.endswith(".zip")
+    with zipfile.ZipFile(io.BytesIO(gcs.transport.objects[zip_name])) as bundle:
+        assert bundle.read("2024-03-02/billing@acme.example/bundle.bin") == big
+        assert bundle.read("manifest.csv") == gcs.transport.objects[zip_name[:-len(".zip")] + ".csv"]
+    assert [m for m, _ in gcs.transport.requests].count("PUT") >= 3
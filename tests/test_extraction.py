@@ -0,0 +1,188 @@
+"""
+請求書項目抽出のテスト & スループットベンチマーク
+
+- テキストからの項目抽出 (日本語/英語の請求書)
+- 生成した PDF をプロセスプール経由で抽出
+- ベンチマーク: EXTRACTION_CORPUS_DIR にサンプル PDF を置けばそれを使い、
+  なければ合成 PDF で逐次実行とプロセスプールのスループットを比較する
+  (例: EXTRACTION_CORPUS_DIR=./samples pytest tests/test_extraction.py --benchmark-only --benchmark-group-by=group)
+"""
+import os
+import glob
+import time
+import pytest
+import services.extraction
+from services.extraction import parse_invoice_fields
+
+try:
+    import pytest_benchmark  # noqa: F401
+    HAS_BENCHMARK = True
+except ImportError:
+    HAS_BENCHMARK = False
+
+requires_pypdf = pytest.mark.skipif(services.extraction.pypdf is None, reason="pypdf is not installed")
+
+def make_pdf(lines) -> bytes:
+    """Helvetica でテキストを描画しただけの最小構成の PDF を作ります (ASCII のみ)。"""
+    def escape(text):
+        return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+    stream = "BT /F1 11 Tf 14 TL 50 780 Td " + " ".join(f"({escape(line)}) Tj T*" for line in lines) + " ET"
+    objects = [
+        "<< /Type /Catalog /Pages 2 0 R >>",
+        "<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        "<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents 4 0 R /Resources << /Font << /F1 5 0 R >> >> >>",
+        f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream",
+        "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for i, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += f"{i} 0 obj\n{body}\nendobj\n".encode("latin-1")
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    out += "".join(f"{o:010d} 00000 n \n" for o in offsets).encode()
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    return out
+
+SAMPLE_LINES = [
+    "INVOICE",
+    "Registration No. T1234567890123",
+    "Invoice Date: 2025/01/31",
+    "Due Date: 2025-02-28",
+    "Subtotal 100,000",
+    "Tax 10,000",
+    "Total Amount 110,000 JPY",
+]
+
+@pytest.fixture(autouse=True)
+def _shutdown_pool():
+    yield
+    services.extraction.shutdown()
+
+def test_parse_japanese_invoice_text():
+    text = """
+    請求書
+    株式会社サンプル 御中
+    登録番号：T-1234-5678-9012-3
+    請求日 2025年1月31日
+    小計 ¥100,000
+    消費税 ¥10,000
+    ご請求金額 ￥110,000-
+    お支払期限：令和7年2月28日
+    """
+    assert parse_invoice_fields(text) == {
+        "invoice_registration_number": "T1234567890123",
+        "invoice_issue_date": "2025-01-31",
+        "invoice_due_date": "2025-02-28",
+        "invoice_total_amount": 110000,
+    }
+
+def test_parse_prefers_explicit_billing_amount_over_totals():
+    text = "合計 5,000円\n税込合計 5,500円\nご請求金額 16,500円\n合計 11,000円"
+    assert parse_invoice_fields(text)["invoice_total_amount"] == 16500
+
+def test_parse_missing_fields_are_none():
+    fields = parse_invoice_fields("領収書\nお問い合わせ: 03-1234-5678")
+    assert fields == {
+        "invoice_registration_number": None,
+        "invoice_issue_date": None,
+        "invoice_due_date": None,
+        "invoice_total_amount": None,
+    }
+
+def test_parse_ignores_invalid_dates():
+    assert parse_invoice_fields("発行日 2025/13/40 2025/02/01")["invoice_issue_date"] == "2025-02-01"
+
+@requires_pypdf
+def test_extract_invoice_fields_via_process_pool():
+    fields = services.extraction.extract_invoice_fields(make_pdf(SAMPLE_LINES))
+    assert fields == {
+        "invoice_registration_number": "T1234567890123",
+        "invoice_issue_date": "2025-01-31",
+        "invoice_due_date": "2025-02-28",
+        "invoice_total_amount": 110000,
+    }
+
+@requires_pypdf
+def test_broken_pdf_returns_empty():
+    assert services.extraction.extract_invoice_fields(b"%PDF-1.4 not really a pdf") == {}
+
+def test_worker_time_limit(monkeypatch):
+    """ワーカー内の制限時間を超えたら ExtractionTimeout で打ち切る"""
+    def slow_extract(pdf_bytes, max_pages):
+        time.sleep(5)
+        return ""
+    monkeypatch.setattr(services.extraction, "extract_text", slow_extract)
+
+    start = time.perf_counter()
+    with pytest.raises(services.extraction.ExtractionTimeout):
+        services.extraction._extract_worker(b"", 0.1, 1)
+    assert time.perf_counter() - start < 2
+
+def test_processor_adds_extracted_columns(monkeypatch, mocker):
+    """EXTRACTION_ENABLED の場合、PDF の抽出結果が invoice_log の行に追加される"""
+    import datetime
+    from services.parser import Email, Attachment
+    from services.processor import process_email_task
+
+    mocker.patch("services.gmail.get_gmail_service")
+    mocker.patch("services.error_monitor.record_success")
+    mocker.patch("services.processor.is_allowed_email", return_value=True)
+    mocker.patch("adapters.get_storage_adapter").return_value.save_file.return_value = "https://mock"
+    bq = mocker.patch("adapters.get_bigquery_adapter").return_value
+    bq.insert_rows.return_value = []
+    mocker.patch("services.parser.parse_raw_message", return_value=Email(
+        id="m1", subject="Invoice", sender_name="A", sender_address="a@example.com",
+        received_at=datetime.datetime(2025, 1, 31),
+        attachments=[
+            Attachment(id="p1", filename="invoice.pdf", mime_type="application/pdf", size=3, data=b"pdf"),
+            Attachment(id="p2", filename="photo.jpg", mime_type="image/jpeg", size=3, data=b"jpg"),
+        ]))
+    extract = mocker.patch("services.extraction.extract_invoice_fields",
+                           return_value={"invoice_total_amount": 110000})
+    monkeypatch.setattr("config.INGEST_MODE", "raw")
+    monkeypatch.setattr("config.EXTRACTION_ENABLED", True)
+
+    process_email_task({'id': 'm1'})
+
+    extract.assert_called_once_with(b"pdf")
+    rows = [c.args[1][0] for c in bq.insert_rows.call_args_list]
+    assert rows[0]["invoice_total_amount"] == 110000
+    assert "invoice_total_amount" not in rows[1]
+
+# --- ベンチマーク ---
+
+def _load_corpus():
+    corpus_dir = os.getenv("EXTRACTION_CORPUS_DIR")
+    if corpus_dir:
+        paths = sorted(glob.glob(os.path.join(corpus_dir, "**", "*.pdf"), recursive=True))
+        if paths:
+            return [open(p, "rb").read() for p in paths]
+    lines = SAMPLE_LINES + [f"Item {i:03d} Service fee 1,000" for i in range(40)]
+    return [make_pdf(lines) for _ in range(32)]
+
+@requires_pypdf
+@pytest.mark.skipif(not HAS_BENCHMARK, reason="pytest-benchmark is not installed")
+def test_benchmark_extraction_serial(benchmark):
+    benchmark.group = "extraction"
+    corpus = _load_corpus()
+    benchmark.extra_info["documents"] = len(corpus)
+    benchmark(lambda: [parse_invoice_fields(services.extraction.extract_text(pdf)) for pdf in corpus])
+
+@requires_pypdf
+@pytest.mark.skipif(not HAS_BENCHMARK, reason="pytest-benchmark is not installed")
+def test_benchmark_extraction_process_pool(benchmark):
+    import concurrent.futures
+    benchmark.group = "extraction"
+    corpus = _load_corpus()
+    benchmark.extra_info["documents"] = len(corpus)
+    # プールの起動コストは計測に含めない
+    services.extraction.extract_invoice_fields(corpus[0])
+
+    def run():
+        # processor と同様に I/O ワーカー (スレッド) から並行に投入する
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as pool:
+            return list(pool.map(services.extraction.extract_invoice_fields, corpus))
+    benchmark(run)
@@ -53,3 +53,27 @@ def test_case_insensitivity(mock_config):
     # 大文字小文字の無視
     assert services.filtering.is_allowed_email("user@EXAMPLE.COM", "Invoice") == True
     assert services.filtering.is_allowed_email("u@x.com", "INVOICE") == True
+
+def test_build_query_filters(mock_config):
+    # ドメインとキーワードが1つの ORグループにまとまる
+    filters = services.filtering.build_query_filters(1000)
+    assert filters == ["{from:example.com from:trusted.org subject:invoice subject:bill subject:請求書}"]
+
+def test_build_query_filters_split(mock_config):
+    # 長さ上限を超える場合は複数グループに分割される
+    filters = services.filtering.build_query_filters(40)
+    assert len(filters) > 1
+    assert all(len(f) <= 40 for f in filters)
+    joined = " ".join(filters)
+    for term in ["from:example.com", "from:trusted.org", "subject:invoice", "subject:bill", "subject:請求書"]:
+        assert term in joined
+
+def test_build_query_filters_quotes_phrases(mock_config):
+    services.filtering.config.SUBJECT_KEYWORDS = ["monthly bill"]
+    services.filtering.config.ALLOWED_DOMAINS = []
+    assert services.filtering.build_query_filters(1000) == ['subject:"monthly bill"']
+
+def test_build_query_filters_no_config(mock_config):
+    services.filtering.config.ALLOWED_DOMAINS = []
+    services.filtering.config.SUBJECT_KEYWORDS = []
+    assert services.filtering.build_query_filters(1000) == []
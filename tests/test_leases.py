@@ -0,0 +1,153 @@
+import time
+import pytest
+from unittest.mock import MagicMock
+import services.leases
+import services.locking
+import services.processor
+import services.accounts
+from services.leases import SQLiteLeaseStore
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr("config.LEASES_ENABLED", True)
+    monkeypatch.setattr("config.LEASE_TTL_SECONDS", 60)
+    store = SQLiteLeaseStore(str(tmp_path / "leases.sqlite3"))
+    services.leases.set_store(store)
+    yield store
+    services.leases.set_store(None)
+    services.leases._claimed.clear()
+
+def test_acquire_renew_release(store):
+    assert store.acquire("m1", "", "a", ttl=60, now=0)
+    # 有効なリースは他の所有者に渡さない (自分なら取り直せる)
+    assert not store.acquire("m1", "", "b", ttl=60, now=30)
+    assert store.acquire("m1", "", "a", ttl=60, now=30)
+    assert store.renew([("", "m1")], "a", ttl=60, now=80) == 1
+    assert store.renew([("", "m1")], "b", ttl=60, now=80) == 0
+    assert store.expired(now=100) == []
+    # 期限切れなら他の所有者が取得できる
+    assert store.acquire("m1", "", "b", ttl=60, now=200)
+    assert not store.release("m1", "", "a")
+    assert store.release("m1", "", "b")
+    assert store.count() == 0
+
+def test_expired_and_delete_skips_renewed(store):
+    store.acquire("m1", "", "a", ttl=10, now=0)
+    store.acquire("m2", "x@example.com", "a", ttl=20, now=0)
+    store.acquire("m3", "", "a", ttl=100, now=0)
+    expired = store.expired(now=50)
+    assert [(l.message_id, l.account) for l in expired] == [("m1", ""), ("m2", "x@example.com")]
+    # 取得後に延長されたリースは削除しない
+    store.renew([("", "m1")], "a", ttl=100, now=50)
+    assert store.delete(expired) == 1
+    assert store.count() == 2
+
+def test_hold_releases_on_success_and_keeps_on_failure(store):
+    with services.leases.hold("m1"):
+        assert store.count() == 1
+        assert services.leases._held == {("", "m1"): 1}
+        assert services.leases.heartbeat() == 1
+    assert store.count() == 0 and services.leases._held == {}
+
+    # 例外で抜けた場合は解放しない (期限切れ後に回収される)
+    with pytest.raises(RuntimeError):
+        with services.leases.hold("m2"):
+            raise RuntimeError("killed")
+    with services.leases.hold("m3"):
+        services.leases.keep()
+    assert sorted(l.message_id for l in store.expired(now=10**10)) == ["m2", "m3"]
+
+def test_disabled_is_noop(monkeypatch):
+    monkeypatch.setattr("config.LEASES_ENABLED", False)
+    assert services.leases.acquire("m1")
+    with services.leases.hold("m1") as state:
+        assert state is None
+    assert services.leases.sweep() == {"expired": 0, "reclaimed": 0, "failed": 0}
+
+def test_claim_records_lease_and_skips_conflicts(store, mocker):
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    mocker.patch("services.gmail.get_or_create_label_id", return_value="Label_processed")
+    mocker.patch("config.FILTER_QUERY_PUSHDOWN", False)
+    service.users().messages().list().execute.return_value = {'messages': [{'id': 'm1'}, {'id': 'm2'}]}
+    store.acquire("m2", "", "other-worker", ttl=60)
+
+    locked = services.locking.lock_and_get_messages()
+    assert [m['id'] for m in locked] == ['m1']
+    assert store.acquire("m1", "", "other-worker", ttl=60) is False
+
+def test_error_label_failure_keeps_lease(store, mocker):
+    """エラーラベルも付けられずに PROCESSED のまま残る場合は、リースを残して再処理させる"""
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    mocker.patch("services.gmail.get_or_create_label_id", return_value="Label_x")
+    service.users().messages().get().execute.side_effect = Exception("503")
+    service.users().messages().modify().execute.side_effect = Exception("503")
+
+    assert services.processor.process_email_task({'id': 'm1'}) == "error"
+    assert [l.message_id for l in store.expired(now=10**10)] == ["m1"]
+
+def test_sweep_reclaims_in_batches_per_account(store, mocker, monkeypatch):
+    monkeypatch.setattr("services.leases.BATCH_MODIFY_LIMIT", 2)
+    services.accounts.set_accounts([services.accounts.Account("ap@example.com", refresh_token="t")])
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    mocker.patch("services.gmail.get_or_create_label_id", return_value="Label_processed")
+    for i in range(3):
+        store.acquire(f"m{i}", "", "dead-worker", ttl=1, now=0)
+    store.acquire("a1", "ap@example.com", "dead-worker", ttl=1, now=0)
+    store.acquire("live", "", "live-worker", ttl=10**10, now=0)
+
+    stats = services.leases.sweep()
+
+    assert stats == {"expired": 4, "reclaimed": 4, "failed": 0}
+    bodies = [c.kwargs['body'] for c in service.users().messages().batchModify.call_args_list]
+    assert [b['ids'] for b in bodies] == [['m0', 'm1'], ['m2'], ['a1']]
+    assert all(b['removeLabelIds'] == ['Label_processed'] for b in bodies)
+    assert store.count() == 1
+
+def test_sweep_keeps_leases_when_gmail_fails(store, mocker):
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    mocker.patch("services.gmail.get_or_create_label_id", return_value="Label_processed")
+    service.users().messages().batchModify().execute.side_effect = Exception("429")
+    store.acquire("m1", "", "dead-worker", ttl=1, now=0)
+
+    assert services.leases.sweep() == {"expired": 1, "reclaimed": 0, "failed": 1}
+    assert store.count() == 1
+
+def test_claimed_lease_is_renewed_until_the_task_starts(store, mocker, monkeypatch):
+    """クレーム後に処理の開始を待つ間も延長され、スイープで回収されない"""
+    monkeypatch.setattr("config.LEASE_TTL_SECONDS", 0.3)
+    mocker.patch("services.gmail.get_gmail_service")
+    mocker.patch("services.gmail.get_or_create_label_id", return_value="Label_processed")
+    run = mocker.patch("services.processor._run_task", return_value="success")
+    assert services.leases.acquire("m1")
+
+    time.sleep(0.2)
+    assert services.leases.heartbeat() == 1
+    time.sleep(0.2)  # クレーム時の期限は過ぎている
+    assert services.leases.sweep()["expired"] == 0
+
+    assert services.processor.process_email_task({'id': 'm1'}) == "success"
+    run.assert_called_once()
+    assert store.count() == 0
+
+def test_task_skips_message_whose_lease_moved(store, mocker, monkeypatch):
+    """期限切れで他のワーカーに再クレームされたメッセージは、遅れて開始したタスクでは処理しない"""
+    monkeypatch.setattr("config.LEASE_TTL_SECONDS", 0.1)
+    run = mocker.patch("services.processor._run_task", return_value="success")
+    assert services.leases.acquire("m1")
+    time.sleep(0.2)
+    assert store.acquire("m1", "", "other-worker", ttl=60)
+
+    assert services.processor.process_email_task({'id': 'm1'}) == "lease_lost"
+    run.assert_not_called()
+    assert store.acquire("m1", "", "other-worker", ttl=60)
+    assert not store.acquire("m1", "", services.leases.OWNER, ttl=60)
+
+def test_unclaimed_callers_proceed_on_conflict(store):
+    """クレームを経ない処理 (バックフィル等) は従来どおり続行する"""
+    store.acquire("m1", "", "other-worker", ttl=60)
+    with services.leases.hold("m1") as state:
+        assert not state.get("lost")
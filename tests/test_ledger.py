@@ -0,0 +1,81 @@
+import datetime
+import pytest
+from unittest.mock import MagicMock
+import services.ledger
+import services.processor
+from services.ledger import SQLiteLedgerStore
+from services.parser import Email, Attachment
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr("config.LEDGER_ENABLED", True)
+    store = SQLiteLedgerStore(str(tmp_path / "ledger.sqlite3"))
+    services.ledger.set_store(store)
+    yield store
+    services.ledger.set_store(None)
+
+@pytest.fixture
+def deps(mocker):
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    mocker.patch("services.gmail.get_or_create_label_id", side_effect=lambda name: f"Label_{name}")
+    mocker.patch("services.processor.is_allowed_email", return_value=True)
+    mocker.patch("services.error_monitor.record_success")
+    mocker.patch("services.error_monitor.record_error")
+    mocker.patch("config.INGEST_MODE", "full")
+    mocker.patch("services.parser.parse_message_detail", return_value=Email(
+        id="m1", subject="Invoice", sender_name="Vendor", sender_address="billing@example.com",
+        received_at=datetime.datetime(2024, 1, 1, 9, 0, 0),
+        attachments=[Attachment(id="a1", filename="a.pdf", mime_type="application/pdf", size=4),
+                     Attachment(id="a2", filename="b.pdf", mime_type="application/pdf", size=4)]))
+    service.users().messages().attachments().get().execute.return_value = {'data': 'QUFBQQ=='}
+    storage = MagicMock()
+    storage.save_file.side_effect = lambda **kw: f"https://storage/{kw['file_path']}"
+    bq = MagicMock()
+    mocker.patch("adapters.get_storage_adapter", return_value=storage)
+    mocker.patch("adapters.get_bigquery_adapter", return_value=bq)
+    return service, storage, bq
+
+def test_store_keeps_inserted_entries(store):
+    store.record_upload("", "m1_a.pdf", "h1", "url1", "gs://b/p1", now=1)
+    assert not store.get("", "m1_a.pdf", "h1").inserted
+    store.record_insert("", "m1_a.pdf", "h1", now=2)
+    # insert 済みの記録はアップロードの再記録で上書きしない
+    store.record_upload("", "m1_a.pdf", "h1", "url2", "gs://b/p2", now=3)
+    entry = store.get("", "m1_a.pdf", "h1")
+    assert (entry.gcs_url, entry.inserted_at) == ("url1", 2)
+    # 内容が変われば別の記録
+    assert store.get("", "m1_a.pdf", "h2") is None
+    assert store.get("x@example.com", "m1_a.pdf", "h1") is None
+
+def test_rerun_resumes_at_first_incomplete_step(store, deps):
+    service, storage, bq = deps
+    # 1回目: 1件目は記録まで完了、2件目はアップロード後に BigQuery が失敗
+    bq.insert_rows.side_effect = [[], Exception("503")]
+    assert services.processor.process_email_task({'id': 'm1'}) == "error"
+    assert storage.save_file.call_count == 2
+
+    bq.insert_rows.side_effect = None
+    bq.insert_rows.return_value = []
+    storage.reset_mock()
+    bq.reset_mock()
+    assert services.processor.process_email_task({'id': 'm1'}) == "success"
+    # 2件目のみ、アップロードを飛ばして記録から再開する
+    storage.save_file.assert_not_called()
+    assert bq.insert_rows.call_count == 1
+    row = bq.insert_rows.call_args.args[1][0]
+    assert row['filename'] == "b.pdf" and row['gcs_url'].endswith("m1_2_b.pdf")
+
+    # 以降は何度再処理しても行を書き込まない
+    bq.reset_mock()
+    assert services.processor.process_email_task({'id': 'm1'}) == "success"
+    bq.insert_rows.assert_not_called()
+    assert store.count() == 2
+
+def test_disabled_is_noop(deps, monkeypatch):
+    monkeypatch.setattr("config.LEDGER_ENABLED", False)
+    service, storage, bq = deps
+    bq.insert_rows.return_value = []
+    for _ in range(2):
+        services.processor.process_email_task({'id': 'm1'})
+    assert storage.save_file.call_count == 4 and bq.insert_rows.call_count == 4
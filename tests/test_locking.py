@@ -0,0 +1,84 @@
+import itertools
+import pytest
+from unittest.mock import MagicMock
+import services.locking
+
+@pytest.fixture
+def mock_service(mocker):
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    mocker.patch("services.gmail.get_or_create_label_id", return_value="Label_processed")
+    return service
+
+def test_lock_without_pushdown(mock_service, monkeypatch):
+    """押し下げ無効時は従来どおりラベル条件のみで検索する"""
+    monkeypatch.setattr(services.locking.config, "FILTER_QUERY_PUSHDOWN", False)
+    mock_service.users().messages().list().execute.return_value = {'messages': [{'id': 'm1'}]}
+
+    locked = services.locking.lock_and_get_messages()
+
+    assert [m['id'] for m in locked] == ['m1']
+    q = mock_service.users().messages().list.call_args.kwargs['q']
+    assert "from:" not in q and "subject:" not in q
+
+def test_lock_with_pushdown_split_queries(mock_service, monkeypatch):
+    """押し下げ有効時は分割クエリを発行し、結果を重複なく結合する"""
+    monkeypatch.setattr(services.locking.config, "FILTER_QUERY_PUSHDOWN", True)
+    monkeypatch.setattr(services.locking.config, "FILTER_QUERY_PUSHDOWN_SUBJECTS", True)
+    monkeypatch.setattr(services.locking, "_query_rotation", itertools.count())
+    monkeypatch.setattr(services.locking.config, "ALLOWED_DOMAINS", ["example.com", "trusted.org"])
+    monkeypatch.setattr(services.locking.config, "SUBJECT_KEYWORDS", ["invoice"])
+    monkeypatch.setattr(services.locking.config, "GMAIL_QUERY_MAX_LENGTH", 100)
+
+    queries = services.locking.build_claim_queries()
+    assert len(queries) > 1
+    assert all(len(q) <= 100 for q in queries)
+
+    mock_service.users().messages().list().execute.side_effect = [
+        {'messages': [{'id': 'm1'}, {'id': 'm2'}]},
+        {'messages': [{'id': 'm2'}, {'id': 'm3'}]},
+        {'messages': []},
+    ]
+    locked = services.locking.lock_and_get_messages()
+
+    assert [m['id'] for m in locked] == ['m1', 'm2', 'm3']
+    assert mock_service.users().messages().modify.call_count >= 3
+
+def test_subject_keywords_disable_pushdown_unless_allowed(monkeypatch):
+    """件名キーワードは語単位の一致になるため、許可しない限り押し下げない"""
+    monkeypatch.setattr(services.locking.config, "FILTER_QUERY_PUSHDOWN", True)
+    monkeypatch.setattr(services.locking.config, "FILTER_QUERY_PUSHDOWN_SUBJECTS", False)
+    monkeypatch.setattr(services.locking.config, "ALLOWED_DOMAINS", ["example.com"])
+    monkeypatch.setattr(services.locking.config, "SUBJECT_KEYWORDS", ["invoice"])
+    assert ["from:" in q or "subject:" in q for q in services.locking.build_claim_queries()] == [False]
+
+    monkeypatch.setattr(services.locking.config, "SUBJECT_KEYWORDS", [])
+    assert services.locking.build_claim_queries()[0].endswith(" from:example.com")
+
+def test_split_queries_rotate_between_claims(mock_service, monkeypatch):
+    """先頭のグループが常に上限に達しても、後ろのグループが順にクレームされる"""
+    monkeypatch.setattr(services.locking, "build_claim_queries", lambda: ["q1", "q2", "q3"])
+    monkeypatch.setattr(services.locking, "_query_rotation", itertools.count())
+    mock_service.users().messages().list().execute.return_value = {
+        'messages': [{'id': f'm{i}'} for i in range(services.locking.CLAIM_BATCH_SIZE)]}
+    mock_service.users().messages().list.reset_mock()
+
+    for _ in range(3):
+        services.locking.lock_and_get_messages()
+
+    assert [c.kwargs['q'] for c in mock_service.users().messages().list.call_args_list] == ["q1", "q2", "q3"]
+
+def test_lock_enriches_metadata_for_priority(mock_service, monkeypatch):
+    """優先度付きスケジューリングが有効な場合は、サイズ・受信時刻・送信者を付与する"""
+    monkeypatch.setattr(services.locking.config, "FILTER_QUERY_PUSHDOWN", False)
+    monkeypatch.setattr(services.locking.config, "PRIORITY_SCHEDULING_ENABLED", True)
+    mock_service.users().messages().list().execute.return_value = {'messages': [{'id': 'm1'}]}
+    mock_service.users().messages().get().execute.return_value = {
+        'id': 'm1', 'sizeEstimate': 2048, 'internalDate': '1700000000000',
+        'payload': {'headers': [{'name': 'From', 'value': 'Vendor <billing@vendor.example>'}]}}
+
+    locked = services.locking.lock_and_get_messages()
+
+    assert locked == [{'id': 'm1', 'sizeEstimate': 2048, 'internalDate': '1700000000000',
+                       'sender': 'Vendor <billing@vendor.example>'}]
+    assert mock_service.users().messages().get.call_args.kwargs['format'] == 'metadata'
@@ -0,0 +1,48 @@
+import pytest
+from unittest.mock import MagicMock
+import services.metrics
+import services.gmail
+from services.metrics import Counter, Gauge, Histogram
+
+def test_counter_and_gauge_render():
+    c = Counter("test_requests_total", "help", ("method",))
+    c.inc(method="get")
+    c.inc(2, method="get")
+    assert c.render() == ['test_requests_total{method="get"} 3']
+
+    g = Gauge("test_depth", "help")
+    g.inc()
+    g.inc()
+    g.dec()
+    assert g.render() == ["test_depth 1"]
+
+def test_histogram_cumulative_buckets():
+    h = Histogram("test_seconds", "help", ("stage",), buckets=(0.1, 1.0))
+    h.observe(0.05, stage="fetch")
+    h.observe(0.5, stage="fetch")
+    h.observe(5, stage="fetch")
+    lines = h.render()
+    assert 'test_seconds_bucket{stage="fetch",le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{stage="fetch",le="1"} 2' in lines
+    assert 'test_seconds_bucket{stage="fetch",le="+Inf"} 3' in lines
+    assert 'test_seconds_count{stage="fetch"} 3' in lines
+    assert 'test_seconds_sum{stage="fetch"} 5.55' in lines
+
+def test_gmail_execute_records_method_and_status():
+    before_ok = services.metrics.GMAIL_REQUESTS.get(method="test.ok", status="200")
+    request = MagicMock()
+    request.execute.return_value = {"id": "x"}
+    assert services.gmail.execute(request, "test.ok") == {"id": "x"}
+    assert services.metrics.GMAIL_REQUESTS.get(method="test.ok", status="200") == before_ok + 1
+
+    request.execute.side_effect = RuntimeError("boom")
+    with pytest.raises(RuntimeError):
+        services.gmail.execute(request, "test.fail")
+    assert services.metrics.GMAIL_REQUESTS.get(method="test.fail", status="error") == 1
+
+def test_render_includes_application_metrics():
+    text = services.metrics.render()
+    for name in ["invoice_stage_duration_seconds", "gmail_api_requests_total",
+                 "invoice_claim_duration_seconds", "invoice_archive_lag_seconds",
+                 "invoice_error_window_rate", "slack_alert_queue_depth", "invoice_rules_reloads_total"]:
+        assert f"# TYPE {name}" in text
@@ -0,0 +1,76 @@
+import datetime
+import pytest
+import adapters
+import services.object_keys
+from services.object_keys import build_object_key, parse_object_key, locate
+
+RECEIVED = datetime.datetime(2025, 1, 31, 10, 0, 0)
+
+@pytest.mark.parametrize("layout", services.object_keys.LAYOUTS)
+def test_keys_are_deterministic_and_parseable(layout):
+    key = build_object_key(RECEIVED, "18d0c0ffee_1_invoice.pdf", layout)
+    assert key == build_object_key(RECEIVED, "18d0c0ffee_1_invoice.pdf", layout)
+    assert parse_object_key(key) == (layout, RECEIVED.date(), "18d0c0ffee_1_invoice.pdf")
+
+def test_layout_shapes(monkeypatch):
+    monkeypatch.setattr("config.BLOB_KEY_SHARDS", 16)
+    monkeypatch.setattr("config.BLOB_KEY_HASH_LENGTH", 4)
+    assert build_object_key(RECEIVED, "m_a.pdf", "date") == "2025/01/31/m_a.pdf"
+    assert build_object_key(RECEIVED, "m_a.pdf", "hash_prefix").endswith("/2025/01/31/m_a.pdf")
+    assert len(build_object_key(RECEIVED, "m_a.pdf", "hash_prefix").split("/")[0]) == 4
+
+    # 連続したメッセージIDでも、シャード/ハッシュで分散する
+    names = [f"18d0c{i:05x}_invoice.pdf" for i in range(200)]
+    shards = {build_object_key(RECEIVED, n, "date_shard").split("/")[3] for n in names}
+    prefixes = {build_object_key(RECEIVED, n, "hash_prefix")[:1] for n in names}
+    assert len(shards) == 16
+    assert len(prefixes) == 16
+
+def test_unknown_layout_is_rejected():
+    with pytest.raises(ValueError):
+        build_object_key(RECEIVED, "m_a.pdf", "random")
+
+def test_locate_and_migrate_keep_old_objects(tmp_path, monkeypatch):
+    import migrate_object_keys
+    storage = adapters.LocalStorageAdapter(base_dir=str(tmp_path))
+    monkeypatch.setattr(adapters, "get_storage_adapter", lambda: storage)
+    monkeypatch.setattr("config.BLOB_KEY_LAYOUT", "hash_prefix")
+    old_key = build_object_key(RECEIVED, "m1_invoice.pdf", "date")
+    storage.save_file("bucket", old_key, b"%PDF-")
+    storage.save_file("bucket", "2025/02/01/m2_invoice.pdf", b"%PDF-")
+
+    # 旧レイアウトのオブジェクトも探せる
+    assert locate(storage, "bucket", RECEIVED, "m1_invoice.pdf") == old_key
+    assert locate(storage, "bucket", RECEIVED, "missing.pdf") is None
+
+    stats = migrate_object_keys.migrate("bucket", RECEIVED.date(), RECEIVED.date(), "hash_prefix")
+    assert stats["copied"] == 1 and stats["failed"] == 0
+    new_key = build_object_key(RECEIVED, "m1_invoice.pdf", "hash_prefix")
+    assert locate(storage, "bucket", RECEIVED, "m1_invoice.pdf") == new_key
+    # 元のオブジェクト (BigQuery に記録済みのパス) は残る
+    assert storage.exists("bucket", old_key)
+    # 再実行しても重複コピーしない
+    assert migrate_object_keys.migrate("bucket", RECEIVED.date(), RECEIVED.date(), "hash_prefix")["skipped"] == 1
+
+def test_processor_records_actual_key(monkeypatch, mocker):
+    from services.parser import Email, Attachment
+    from services.processor import process_email_task
+    monkeypatch.setattr("config.BLOB_KEY_LAYOUT", "date_shard")
+    monkeypatch.setattr("config.INGEST_MODE", "raw")
+    mocker.patch("services.gmail.get_gmail_service")
+    mocker.patch("services.error_monitor.record_success")
+    mocker.patch("services.processor.is_allowed_email", return_value=True)
+    storage = mocker.patch("adapters.get_storage_adapter").return_value
+    bq = mocker.patch("adapters.get_bigquery_adapter").return_value
+    bq.insert_rows.return_value = []
+    mocker.patch("services.parser.parse_raw_message", return_value=Email(
+        id="m1", subject="Invoice", sender_name="A", sender_address="a@example.com", received_at=RECEIVED,
+        attachments=[Attachment(id="p1", filename="invoice.pdf", mime_type="application/pdf", size=5, data=b"%PDF-")]))
+
+    process_email_task({'id': 'm1'})
+
+    key = storage.save_file.call_args.kwargs['file_path']
+    assert key == build_object_key(RECEIVED, "m1_invoice.pdf", "date_shard")
+    row = bq.insert_rows.call_args.args[1][0]
+    assert row["gcs_path"].endswith(f"/{key}")
+    assert bq.insert_rows.call_args.kwargs['row_ids'] == ["m1_invoice.pdf"]
@@ -59,3 +59,121 @@ def test_parse_attachments():
     assert email.attachments[0].filename == 'invoice.pdf'
     assert email.attachments[0].size == 5000
     assert email.attachments[0].mime_type == 'application/pdf'
+
+def _build_mime_and_full_payload():
+    """同じメールを raw (MIME) と format='full' (Gmail payload) の両形式で作る"""
+    import base64
+    from email.message import EmailMessage
+
+    pdf = b"%PDF-1.4 test invoice"
+    png = b"\x89PNG\r\n\x1a\n logo"
+    mime = EmailMessage()
+    mime['Subject'] = '【請求書】12月分のご案内'
+    mime['From'] = 'Amazon <info@amazon.co.jp>'
+    mime.set_content('本文です')
+    mime.add_attachment(pdf, maintype='application', subtype='pdf', filename='請求書_12月.pdf')
+    mime.add_attachment(png, maintype='image', subtype='png', filename='logo.png')
+
+    raw = {
+        'id': 'msg_raw',
+        'internalDate': '1678886400000',
+        'sizeEstimate': len(mime.as_bytes()),
+        'raw': base64.urlsafe_b64encode(mime.as_bytes()).decode('ASCII'),
+    }
+    full = {
+        'id': 'msg_raw',
+        'internalDate': '1678886400000',
+        'payload': {
+            'mimeType': 'multipart/mixed',
+            'filename': '',
+            'headers': [
+                {'name': 'Subject', 'value': '【請求書】12月分のご案内'},
+                {'name': 'From', 'value': 'Amazon <info@amazon.co.jp>'},
+            ],
+            'body': {'size': 0},
+            'parts': [
+                {'mimeType': 'text/plain', 'filename': '', 'body': {'size': 13}},
+                {'mimeType': 'application/pdf', 'filename': '請求書_12月.pdf',
+                 'body': {'attachmentId': 'att1', 'size': len(pdf)}},
+                {'mimeType': 'image/png', 'filename': 'logo.png',
+                 'body': {'attachmentId': 'att2', 'size': len(png)}},
+            ],
+        },
+    }
+    return raw, full, [pdf, png]
+
+def test_parse_raw_message_matches_full():
+    """raw 形式の解析結果が format='full' の解析結果と一致する"""
+    from services.parser import parse_raw_message
+    raw, full, contents = _build_mime_and_full_payload()
+
+    from_raw = parse_raw_message(raw)
+    from_full = parse_message_detail(full)
+
+    for field in ('id', 'subject', 'sender_name', 'sender_address', 'received_at'):
+        assert getattr(from_raw, field) == getattr(from_full, field)
+    assert [(a.filename, a.mime_type, a.size) for a in from_raw.attachments] == \
+        [(a.filename, a.mime_type, a.size) for a in from_full.attachments]
+    assert [a.data for a in from_raw.attachments] == contents
+
+def test_parse_inline_disposition():
+    """Content-Disposition: inline の添付ファイル (埋め込み画像) を判別できる"""
+    msg_detail = {
+        'id': 'msg_inline',
+        'internalDate': '1678886400000',
+        'payload': {
+            'headers': [{'name': 'Subject', 'value': 'Invoice'}],
+            'parts': [
+                {'filename': 'image001.png', 'mimeType': 'image/png', 'body': {'attachmentId': 'a1', 'size': 10},
+                 'headers': [{'name': 'Content-Disposition', 'value': 'inline; filename="image001.png"'}]},
+                {'filename': 'invoice.pdf', 'mimeType': 'application/pdf', 'body': {'attachmentId': 'a2', 'size': 10},
+                 'headers': [{'name': 'Content-Disposition', 'value': 'attachment; filename="invoice.pdf"'}]},
+            ]
+        }
+    }
+    email = parse_message_detail(msg_detail)
+    assert [a.inline for a in email.attachments] == [True, False]
+
+def test_forwarded_message_and_its_attachments_match_in_both_modes():
+    """添付されたメール (.eml) は、それ自体と中の添付ファイルの両方を両モードで同じ順序で返す"""
+    import base64
+    from email.message import EmailMessage
+    from services.parser import parse_raw_message
+
+    inner = EmailMessage()
+    inner['Subject'] = 'Invoice'
+    inner['From'] = 'billing@vendor.example'
+    inner.set_content('see attached')
+    inner.add_attachment(b"%PDF-1.4 inner", maintype='application', subtype='pdf', filename='inner.pdf')
+    mime = EmailMessage()
+    mime['Subject'] = 'Fwd: Invoice'
+    mime['From'] = 'Boss <boss@example.com>'
+    mime.set_content('転送します')
+    mime.add_attachment(inner, filename='forwarded.eml')
+    eml = mime.get_payload()[1].get_payload(0).as_bytes()
+
+    raw = {'id': 'm1', 'internalDate': '1678886400000',
+           'raw': base64.urlsafe_b64encode(mime.as_bytes()).decode('ASCII')}
+    full = {'id': 'm1', 'internalDate': '1678886400000', 'payload': {
+        'mimeType': 'multipart/mixed', 'filename': '', 'headers': [], 'body': {'size': 0},
+        'parts': [
+            {'mimeType': 'text/plain', 'filename': '', 'body': {'size': 10}},
+            {'mimeType': 'message/rfc822', 'filename': 'forwarded.eml',
+             'body': {'attachmentId': 'att1', 'size': len(eml)},
+             'parts': [
+                 {'mimeType': 'multipart/mixed', 'filename': '', 'body': {'size': 0}, 'parts': [
+                     {'mimeType': 'text/plain', 'filename': '', 'body': {'size': 12}},
+                     {'mimeType': 'application/pdf', 'filename': 'inner.pdf',
+                      'body': {'attachmentId': 'att2', 'size': 14}},
+                 ]},
+             ]},
+        ]}}
+
+    from_raw = parse_raw_message(raw)
+    from_full = parse_message_detail(full)
+
+    assert [(a.filename, a.mime_type, a.size) for a in from_raw.attachments] == \
+        [(a.filename, a.mime_type, a.size) for a in from_full.attachments] == \
+        [('forwarded.eml', 'message/rfc822', len(eml)), ('inner.pdf', 'application/pdf', 14)]
+    assert from_raw.attachments[0].data == eml
+    assert from_raw.attachments[1].data == b"%PDF-1.4 inner"
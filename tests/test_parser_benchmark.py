@@ -0,0 +1,156 @@
+"""
+パーサーのベンチマーク & 等価性テスト
+
+- 合成した Gmail payload (深さ・ヘッダー数・添付数を変化) で、
+  最適化後のパーサーが旧実装と同じ結果を返すことを検証する
+- pytest-benchmark がインストールされていれば、--run-benchmarks / --benchmark-only 指定時にベンチマークも実行する
+  (例: pytest tests/test_parser_benchmark.py --benchmark-only --benchmark-group-by=param:shape)
+"""
+import email.utils
+import random
+import pytest
+import services.parser
+from services.parser import parse_message_detail
+
+try:
+    import pytest_benchmark  # noqa: F401
+    HAS_BENCHMARK = True
+except ImportError:
+    HAS_BENCHMARK = False
+
+# --- 旧実装 (比較用のリファレンス) ---
+
+def _legacy_get_header_value(headers, name, default=""):
+    for header in headers:
+        if header.get('name') == name:
+            return header.get('value', default)
+    return default
+
+def _legacy_find_attachments_recursive(parts_list):
+    found = []
+    for part in parts_list:
+        if part.get('filename') and part.get('body', {}).get('attachmentId'):
+            found.append(part)
+        if 'parts' in part:
+            found.extend(_legacy_find_attachments_recursive(part['parts']))
+    return found
+
+def _legacy_parse(msg_detail):
+    payload = msg_detail.get('payload', {})
+    headers = payload.get('headers', [])
+    subject = _legacy_get_header_value(headers, 'Subject', '(件名なし)')
+    sender_name, sender_address = email.utils.parseaddr(_legacy_get_header_value(headers, 'From', '(送信元不明)'))
+    if not sender_name:
+        sender_name = sender_address
+    return {
+        "id": msg_detail.get('id'),
+        "subject": subject,
+        "sender_name": sender_name,
+        "sender_address": sender_address,
+        "received_at": services.parser._parse_gmail_date(msg_detail.get('internalDate', '0')),
+        "attachments": [
+            (a['body']['attachmentId'], a['filename'], a.get('mimeType', 'application/octet-stream'), a['body'].get('size', 0))
+            for a in _legacy_find_attachments_recursive([payload])
+        ],
+    }
+
+def _as_dict(parsed):
+    return {
+        "id": parsed.id,
+        "subject": parsed.subject,
+        "sender_name": parsed.sender_name,
+        "sender_address": parsed.sender_address,
+        "received_at": parsed.received_at,
+        "attachments": [(a.id, a.filename, a.mime_type, a.size) for a in parsed.attachments],
+    }
+
+# --- 合成データ ---
+
+def make_payload(depth: int, n_headers: int, n_attachments: int, seed: int = 0) -> dict:
+    """
+    Gmail の format='full' に似た合成 payload を作ります。
+
+    Args:
+        depth: multipart のネストの深さ
+        n_headers: ヘッダー数 (Subject/From は末尾付近に置き、線形探索の最悪ケースに近づける)
+        n_attachments: 添付ファイル数 (各階層にばらまく)
+    """
+    rng = random.Random(seed)
+    headers = [{'name': f'X-Header-{i}', 'value': f'value-{i}'} for i in range(max(0, n_headers - 3))]
+    headers += [
+        {'name': 'Subject', 'value': f'請求書 #{seed}'},
+        {'name': 'From', 'value': f'Supplier {seed} <billing{seed}@example.com>'},
+        # 重複ヘッダーは最初のものが採用される
+        {'name': 'Subject', 'value': 'duplicate'},
+    ]
+
+    def leaf(i):
+        return {
+            'mimeType': rng.choice(['application/pdf', 'image/png', 'application/zip']),
+            'filename': f'file_{i}.pdf',
+            'body': {'attachmentId': f'att{i}', 'size': rng.randint(1_000, 5_000_000)},
+        }
+
+    levels = [[] for _ in range(depth)]
+    for i in range(n_attachments):
+        levels[i % depth].append(leaf(i))
+
+    node = {'mimeType': 'multipart/mixed', 'filename': '', 'body': {'size': 0},
+            'parts': [{'mimeType': 'text/plain', 'filename': '', 'body': {'size': 10}}] + levels[depth - 1]}
+    for d in range(depth - 2, -1, -1):
+        node = {'mimeType': 'multipart/mixed', 'filename': '', 'body': {'size': 0},
+                'parts': [node] + levels[d] + [{'mimeType': 'text/html', 'filename': '', 'body': {'size': 20}}]}
+
+    node['headers'] = headers
+    return {'id': f'msg{seed}', 'internalDate': str(1678886400000 + seed), 'payload': node}
+
+SHAPES = {
+    "small": dict(depth=1, n_headers=15, n_attachments=1),
+    "typical": dict(depth=3, n_headers=40, n_attachments=3),
+    "deep": dict(depth=12, n_headers=80, n_attachments=20),
+    "many_headers": dict(depth=2, n_headers=400, n_attachments=2),
+}
+
+@pytest.mark.parametrize("shape", SHAPES)
+@pytest.mark.parametrize("seed", range(5))
+def test_optimised_parser_matches_legacy(shape, seed):
+    payload = make_payload(seed=seed, **SHAPES[shape])
+    assert _as_dict(parse_message_detail(payload)) == _legacy_parse(payload)
+
+def test_forwarded_message_matches_legacy():
+    # 添付されたメール (message/rfc822) の中の添付ファイルも旧実装と同じ順序で返す
+    inner = make_payload(depth=2, n_headers=5, n_attachments=3, seed=1)['payload']
+    forwarded = {'mimeType': 'message/rfc822', 'filename': 'forwarded.eml',
+                 'body': {'attachmentId': 'att-eml', 'size': 4096}, 'parts': [inner]}
+    payload = make_payload(depth=2, n_headers=10, n_attachments=2)
+    payload['payload']['parts'].insert(1, forwarded)
+    parsed = _as_dict(parse_message_detail(payload))
+    assert parsed == _legacy_parse(payload)
+    # .eml 自体 + 中の3件 + 外側の2件
+    assert [a[1] for a in parsed["attachments"]].count('forwarded.eml') == 1
+    assert len(parsed["attachments"]) == 6
+
+def test_missing_headers_and_parts_match_legacy():
+    for payload in [{'id': 'x'}, {'id': 'y', 'payload': {}}, {'id': 'z', 'payload': {'headers': [{'name': 'Subject'}]}}]:
+        assert _as_dict(parse_message_detail(payload)) == _legacy_parse(payload)
+
+def test_slotted_dataclasses():
+    parsed = parse_message_detail(make_payload(**SHAPES["small"]))
+    assert not hasattr(parsed, "__dict__")
+    assert not hasattr(parsed.attachments[0], "__dict__")
+
+# --- ベンチマーク ---
+
+@pytest.mark.skipif(not HAS_BENCHMARK, reason="pytest-benchmark is not installed")
+@pytest.mark.parametrize("shape", SHAPES)
+def test_benchmark_parser(benchmark, shape):
+    benchmark.group = f"parser:{shape}"
+    payloads = [make_payload(seed=s, **SHAPES[shape]) for s in range(20)]
+    benchmark(lambda: [parse_message_detail(p) for p in payloads])
+
+@pytest.mark.skipif(not HAS_BENCHMARK, reason="pytest-benchmark is not installed")
+@pytest.mark.parametrize("shape", SHAPES)
+def test_benchmark_legacy_parser(benchmark, shape):
+    benchmark.group = f"parser:{shape}"
+    payloads = [make_payload(seed=s, **SHAPES[shape]) for s in range(20)]
+    benchmark(lambda: [_legacy_parse(p) for p in payloads])
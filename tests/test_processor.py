@@ -243,3 +243,85 @@ def test_process_email_error_handling(mock_dependencies, mocker):
     # 6. ラベル変更 (ERROR_LABEL への変更) が呼ばれたか
     # modify は例外後のエラーハンドリングで呼ばれる
     service.users().messages.return_value.modify.assert_called()
+
+def test_process_email_records_stage_metrics(mock_dependencies, mocker):
+    """ステージ別レイテンシと転送量がメトリクスに記録されるか"""
+    import services.metrics
+    service = mock_dependencies['service']
+    mocker.patch("services.parser.parse_message_detail", return_value=Email(
+        id="msg_metrics", subject="Invoice", sender_name="Amazon", sender_address="info@amazon.com",
+        received_at=datetime.datetime.now(),
+        attachments=[Attachment(id="att1", filename="invoice.pdf", mime_type="application/pdf", size=14)]
+    ))
+    service.users().messages().attachments().get().execute.return_value = {'data': 'VGhpcyBpcyBhIHRlc3Q='}
+
+    before = {s: services.metrics.STAGE_SECONDS.get_count(stage=s) for s in ["fetch", "download", "upload", "insert", "label"]}
+    bytes_before = services.metrics.BYTES_DOWNLOADED.get()
+    success_before = services.metrics.MESSAGES.get(result="success")
+
+    process_email_task({'id': 'msg_metrics'})
+
+    for stage, count in before.items():
+        assert services.metrics.STAGE_SECONDS.get_count(stage=stage) == count + 1
+    assert services.metrics.BYTES_DOWNLOADED.get() == bytes_before + 14
+    assert services.metrics.MESSAGES.get(result="success") == success_before + 1
+
+def _run_with_mode(mock_dependencies, monkeypatch, mode, raw, full, contents):
+    import base64
+    service = mock_dependencies['service']
+    monkeypatch.setattr("config.INGEST_MODE", mode)
+    monkeypatch.setattr("config.RAW_FETCH_MAX_BYTES", 10 * 1024 * 1024)
+
+    def fake_get(userId, id, format):
+        return MagicMock(execute=MagicMock(return_value={
+            'raw': raw, 'full': full, 'minimal': {'id': id, 'sizeEstimate': raw['sizeEstimate']}
+        }[format]))
+    service.users.return_value.messages.return_value.get.side_effect = fake_get
+
+    def fake_attachment_get(userId, messageId, id):
+        data = contents[int(id[-1]) - 1]
+        return MagicMock(execute=MagicMock(return_value={'data': base64.urlsafe_b64encode(data).decode()}))
+    service.users.return_value.messages.return_value.attachments.return_value.get.side_effect = fake_attachment_get
+
+    mock_dependencies['storage'].reset_mock()
+    mock_dependencies['bq'].reset_mock()
+    process_email_task({'id': raw['id']})
+
+    rows = [c.args[1][0] for c in mock_dependencies['bq'].insert_rows.call_args_list]
+    for row in rows:
+        row.pop('processed_at')
+    ids = [c.kwargs['row_ids'] for c in mock_dependencies['bq'].insert_rows.call_args_list]
+    saved = [(c.kwargs['file_path'], c.kwargs['data']) for c in mock_dependencies['storage'].save_file.call_args_list]
+    attachment_calls = service.users.return_value.messages.return_value.attachments.return_value.get.call_count
+    formats = [c.kwargs['format'] for c in service.users.return_value.messages.return_value.get.call_args_list]
+    return rows, ids, saved, attachment_calls, formats
+
+def test_raw_ingest_produces_identical_rows(mock_dependencies, monkeypatch):
+    """raw モードでも full モードと同じアーカイブ行が作られ、Gmail 呼び出しは1回になる"""
+    from tests.test_parser import _build_mime_and_full_payload
+    raw, full, contents = _build_mime_and_full_payload()
+
+    full_result = _run_with_mode(mock_dependencies, monkeypatch, "full", raw, full, contents)
+    mock_dependencies['service'].users.return_value.messages.return_value.attachments.return_value.get.reset_mock()
+    mock_dependencies['service'].users.return_value.messages.return_value.get.reset_mock()
+    raw_result = _run_with_mode(mock_dependencies, monkeypatch, "raw", raw, full, contents)
+
+    assert raw_result[:3] == full_result[:3]
+    assert len(full_result[0]) == 2
+    assert full_result[3] == 2 and full_result[4] == ['full']
+    assert raw_result[3] == 0 and raw_result[4] == ['raw']
+
+def test_auto_ingest_mode_uses_size_estimate(mock_dependencies, monkeypatch):
+    """auto モードは sizeEstimate を見て raw / full を切り替える"""
+    import services.processor
+    monkeypatch.setattr("config.INGEST_MODE", "auto")
+    monkeypatch.setattr("config.RAW_FETCH_MAX_BYTES", 1000)
+    srv = MagicMock()
+
+    assert services.processor._choose_ingest_mode(srv, {'id': 'm', 'sizeEstimate': 999}) == "raw"
+    assert services.processor._choose_ingest_mode(srv, {'id': 'm', 'sizeEstimate': 5000}) == "full"
+    srv.users().messages().get.assert_not_called()
+
+    # クレーム時にサイズが分からない場合は format='minimal' で確認する
+    srv.users().messages().get().execute.return_value = {'id': 'm', 'sizeEstimate': 10}
+    assert services.processor._choose_ingest_mode(srv, {'id': 'm'}) == "raw"
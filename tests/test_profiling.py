@@ -0,0 +1,104 @@
+import time
+import threading
+import contextvars
+import pytest
+from unittest.mock import MagicMock
+import services.profiling
+
+def _busy_work(seconds):
+    end = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < end:
+        total += sum(range(200))
+    return total
+
+@pytest.fixture
+def storage(mocker, monkeypatch):
+    monkeypatch.setattr(services.profiling.config, "PROFILING_ENABLED", False)
+    monkeypatch.setattr(services.profiling.config, "PROFILING_FLUSH_SECONDS", 3600)
+    monkeypatch.setattr(services.profiling.config, "PROFILING_INTERVAL_MS", 1)
+    services.profiling.set_enabled(None)
+    services.profiling._stacks.clear()
+    mock_storage = MagicMock()
+    mock_storage.save_file.return_value = "https://mock-storage-url"
+    mocker.patch("adapters.get_storage_adapter", return_value=mock_storage)
+    yield mock_storage
+    services.profiling.set_enabled(None)
+    services.profiling._stacks.clear()
+
+def test_disabled_by_default(storage):
+    with services.profiling.profile("process_email_task"):
+        _busy_work(0.01)
+    assert services.profiling.render_collapsed("process_email_task") == ""
+    assert services.profiling.flush() == {}
+
+def test_sampling_profile_and_flush(storage, monkeypatch):
+    monkeypatch.setattr(services.profiling.config, "PROFILING_MODE", "sampling")
+    services.profiling.set_enabled(True)
+    with services.profiling.profile("process_email_task"):
+        _busy_work(0.2)
+
+    collapsed = services.profiling.render_collapsed("process_email_task")
+    assert "_busy_work" in collapsed
+    # "stack count" 形式
+    stack, count = collapsed.splitlines()[0].rsplit(" ", 1)
+    assert int(count) > 0
+
+    saved = services.profiling.flush()
+    assert saved == {"process_email_task": "https://mock-storage-url"}
+    kwargs = storage.save_file.call_args.kwargs
+    assert kwargs["file_path"].startswith("_profiles/process_email_task/")
+    assert kwargs["file_path"].endswith(".collapsed")
+    assert b"_busy_work" in kwargs["data"]
+    assert services.profiling.render_collapsed("process_email_task") == ""
+
+def test_deterministic_profile(storage, monkeypatch):
+    monkeypatch.setattr(services.profiling.config, "PROFILING_MODE", "deterministic")
+    services.profiling.set_enabled(True)
+    with services.profiling.profile("claim"):
+        _busy_work(0.01)
+    collapsed = services.profiling.render_collapsed("claim")
+    assert any("_busy_work" in line for line in collapsed.splitlines())
+
+def test_enable_for_request_only_affects_context(storage):
+    def request():
+        services.profiling.enable_for_request()
+        return services.profiling.is_enabled()
+
+    assert contextvars.copy_context().run(request) == True
+    assert services.profiling.is_enabled() == False
+
+def test_runtime_override_expires(storage):
+    services.profiling.set_enabled(True, duration_seconds=0.01)
+    assert services.profiling.is_enabled() == True
+    time.sleep(0.02)
+    assert services.profiling.is_enabled() == False
+
+def test_periodic_flush_runs_in_background(storage, monkeypatch):
+    monkeypatch.setattr(services.profiling.config, "PROFILING_MODE", "deterministic")
+    monkeypatch.setattr(services.profiling.config, "PROFILING_FLUSH_SECONDS", 0)
+    uploading, release = threading.Event(), threading.Event()
+
+    def slow_save(**kwargs):
+        uploading.set()
+        release.wait(5)
+        return "https://mock-storage-url"
+    storage.save_file.side_effect = slow_save
+    services.profiling.set_enabled(True)
+    with services.profiling.profile("claim"):
+        _busy_work(0.01)
+
+    # 処理中のスレッドはアップロードを待たない
+    assert uploading.wait(5)
+    assert services.profiling._flusher.name == "profiler-flush"
+    release.set()
+    services.profiling._flusher.join(5)
+    assert storage.save_file.call_args.kwargs["file_path"].startswith("_profiles/claim/")
+
+def test_authorize_requires_configured_token(monkeypatch):
+    monkeypatch.setattr(services.profiling.config, "PROFILING_ADMIN_TOKEN", "")
+    assert not services.profiling.authorize("")
+    monkeypatch.setattr(services.profiling.config, "PROFILING_ADMIN_TOKEN", "s3cret")
+    assert services.profiling.authorize("s3cret")
+    assert not services.profiling.authorize("wrong")
+    assert not services.profiling.authorize(None)
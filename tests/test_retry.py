@@ -0,0 +1,104 @@
+import pytest
+from unittest.mock import MagicMock
+import services.retry
+from services.retry import RetryState, SQLiteRetryStore
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    monkeypatch.setattr("config.RETRY_ENABLED", True)
+    monkeypatch.setattr("config.RETRY_MAX_ATTEMPTS", 3)
+    monkeypatch.setattr("config.RETRY_BASE_DELAY_SECONDS", 100)
+    monkeypatch.setattr("config.RETRY_MAX_DELAY_SECONDS", 1000)
+    monkeypatch.setattr("config.LEASES_ENABLED", False)
+    store = SQLiteRetryStore(str(tmp_path / "retry.sqlite3"))
+    services.retry.set_store(store)
+    yield store
+    services.retry.set_store(None)
+
+@pytest.fixture
+def gmail(mocker):
+    """INVOICE_ERROR の検索結果を返す Gmail サービス"""
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    mocker.patch("services.gmail.get_or_create_label_id", side_effect=lambda name: f"Label_{name}")
+    service.error_ids = []
+    service.users().messages().list.side_effect = lambda **kw: MagicMock(
+        execute=MagicMock(return_value={'messages': [{'id': i} for i in service.error_ids]}))
+    return service
+
+def batch_modify_bodies(service):
+    return [c.kwargs['body'] for c in service.users().messages().batchModify.call_args_list]
+
+def test_backoff_is_exponential_with_jitter(store):
+    assert [services.retry.backoff_seconds(n, rng=lambda: 1.0) for n in (1, 2, 3, 4, 5)] == [100, 200, 400, 800, 1000]
+    assert services.retry.backoff_seconds(3, rng=lambda: 0.0) == 200
+
+def test_disabled_is_noop(monkeypatch, gmail):
+    monkeypatch.setattr("config.RETRY_ENABLED", False)
+    assert services.retry.run_retry_cycle() == {"recovered": 0, "failed": 0, "dead_lettered": 0}
+    gmail.users().messages().list.assert_not_called()
+
+def test_retry_lifecycle(store, gmail, mocker, monkeypatch):
+    monkeypatch.setattr("random.random", lambda: 1.0)
+    results = {"m1": "success", "m2": "error"}
+    process = mocker.patch("services.processor.process_email_task", side_effect=lambda m: results[m['id']])
+    gmail.error_ids = ["m1", "m2"]
+
+    # 初めて見たメールは次回試行時刻を記録するだけ
+    assert services.retry.run_retry_cycle(now=0) == {"recovered": 0, "failed": 0, "dead_lettered": 0}
+    assert {k: (s.attempts, s.next_attempt_at) for k, s in store.get_many("", ["m1", "m2"]).items()} == \
+        {"m1": (1, 100), "m2": (1, 100)}
+    assert services.retry.run_retry_cycle(now=50)["recovered"] == 0
+    process.assert_not_called()
+
+    # 時刻を過ぎたら ERROR -> PROCESSED に付け替えて再処理する
+    assert services.retry.run_retry_cycle(now=100) == {"recovered": 1, "failed": 1, "dead_lettered": 0}
+    assert batch_modify_bodies(gmail) == [{'ids': ['m1', 'm2'], 'addLabelIds': ['Label_INVOICE_PROCESSED'],
+                                           'removeLabelIds': ['Label_INVOICE_ERROR']}]
+    states = store.get_many("", ["m1", "m2"])
+    assert "m1" not in states and states["m2"].attempts == 2
+
+    # 上限 (3回) に達したらデッドレターに移す
+    gmail.error_ids = ["m2"]
+    store.put(RetryState("m2", "", 2, 0))
+    services.retry.run_retry_cycle(now=1)
+    store.put(RetryState("m2", "", 3, 0))
+    assert services.retry.run_retry_cycle(now=1) == {"recovered": 0, "failed": 0, "dead_lettered": 1}
+    assert batch_modify_bodies(gmail)[-1] == {'ids': ['m2'], 'addLabelIds': ['Label_INVOICE_DEAD_LETTER'],
+                                              'removeLabelIds': ['Label_INVOICE_ERROR', 'Label_TARGET']}
+    assert store.get_many("", ["m2"]) == {}
+    assert process.call_count == 3
+
+def test_batch_size_bounds_each_cycle(store, gmail, mocker):
+    process = mocker.patch("services.processor.process_email_task", return_value="success")
+    gmail.error_ids = [f"m{i}" for i in range(5)]
+    for msg_id in gmail.error_ids:
+        store.put(RetryState(msg_id, "", 1, 0))
+
+    assert services.retry.run_retry_cycle(limit=2, now=10)["recovered"] == 2
+    assert sorted(c.args[0]['id'] for c in process.call_args_list) == ["m0", "m1"]
+
+def test_only_leased_messages_are_relabelled(store, gmail, mocker):
+    process = mocker.patch("services.processor.process_email_task", return_value="success")
+    mocker.patch("services.leases.acquire", side_effect=lambda msg_id, account: msg_id != "m1")
+    gmail.error_ids = ["m0", "m1"]
+    for msg_id in gmail.error_ids:
+        store.put(RetryState(msg_id, "", 1, 0))
+
+    assert services.retry.run_retry_cycle(now=10)["recovered"] == 1
+    # リースを取得できなかったメールは ERROR のまま、状態も変えずに次のサイクルに回す
+    assert batch_modify_bodies(gmail) == [{'ids': ['m0'], 'addLabelIds': ['Label_INVOICE_PROCESSED'],
+                                           'removeLabelIds': ['Label_INVOICE_ERROR']}]
+    assert [c.args[0]['id'] for c in process.call_args_list] == ["m0"]
+    assert store.get_many("", ["m1"])["m1"].attempts == 1
+
+def test_states_of_messages_no_longer_in_error_are_pruned(store, gmail, mocker):
+    mocker.patch("services.processor.process_email_task", return_value="success")
+    store.put(RetryState("m1", "", 2, 1000))
+    store.put(RetryState("m2", "", 2, 1000))
+    store.put(RetryState("other", "user@example.com", 2, 1000))
+    gmail.error_ids = ["m2"]
+
+    services.retry.run_retry_cycle(now=10)
+    assert set(store.get_many("", ["m1", "m2"])) == {"m2"}
+    assert set(store.get_many("user@example.com", ["other"])) == {"other"}
@@ -0,0 +1,93 @@
+import json
+import os
+import pytest
+import services.rules
+import services.filtering
+
+@pytest.fixture
+def rules_file(tmp_path, monkeypatch):
+    """一時ルールファイルを RULES_SOURCE に設定"""
+    path = tmp_path / "rules.json"
+
+    def write(doc):
+        path.write_text(json.dumps(doc, ensure_ascii=False), encoding="utf-8")
+        # mtime の分解能に依存しないよう、書き込みごとに mtime を進める
+        st = path.stat()
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+    write({"version": "v1", "rules": [
+        {"name": "supplier", "domains": ["example.com"], "allowed_extensions": ["pdf"], "max_attachment_bytes": 1000},
+        {"name": "keyword", "subject_keywords": ["請求書"]}
+    ]})
+    monkeypatch.setattr(services.rules.config, "RULES_SOURCE", str(path))
+    monkeypatch.setattr(services.rules, "_active_rule_set", None)
+    monkeypatch.setattr(services.rules, "_fingerprint", None)
+    monkeypatch.setattr(services.rules, "_initial_load_attempted", False)
+    return write
+
+def test_rule_set_filters_email(rules_file):
+    assert services.filtering.is_allowed_email("a@example.com", "hello") == True
+    assert services.filtering.is_allowed_email("a@other.com", "[請求書] 12月分") == True
+    assert services.filtering.is_allowed_email("a@other.com", "hello") == False
+    assert services.rules.get_active_rule_set().version == "v1"
+
+def test_attachment_constraints(rules_file):
+    assert services.filtering.is_allowed_attachment("a@example.com", "x", "invoice.PDF", 500) == True
+    assert services.filtering.is_allowed_attachment("a@example.com", "x", "logo.png", 500) == False
+    assert services.filtering.is_allowed_attachment("a@example.com", "x", "big.pdf", 5000) == False
+    # 制約のないルールに一致した場合は全て許可
+    assert services.filtering.is_allowed_attachment("a@other.com", "請求書", "logo.png", 5000) == True
+
+def test_reload_swaps_version(rules_file):
+    services.rules.get_active_rule_set()
+    # 変更がなければ差し替えない
+    assert services.rules.reload_rules() == False
+
+    rules_file({"version": "v2", "rules": [{"name": "new", "domains": ["other.com"]}]})
+    assert services.rules.reload_rules() == True
+    assert services.rules.get_active_rule_set().version == "v2"
+    assert services.filtering.is_allowed_email("a@other.com", "hello") == True
+    assert services.filtering.is_allowed_email("a@example.com", "hello") == False
+
+def test_reload_failure_keeps_current(rules_file, tmp_path):
+    services.rules.get_active_rule_set()
+    errors_before = services.rules.get_reload_stats()["reload_errors"]
+
+    (tmp_path / "rules.json").write_text("{ broken json", encoding="utf-8")
+    assert services.rules.reload_rules(force=True) == False
+    assert services.rules.get_active_rule_set().version == "v1"
+    assert services.rules.get_reload_stats()["reload_errors"] == errors_before + 1
+
+def test_query_filters_use_rule_set(rules_file):
+    filters = services.filtering.build_query_filters(1000)
+    assert filters == ["{from:example.com subject:請求書}"]
+
+def test_failed_initial_load_fails_closed_without_rereading(rules_file, tmp_path, mocker, monkeypatch):
+    """初回の読み込みに失敗したら、ホットパスでは再試行せずに遮断し、ウォッチャーの再読み込みで復旧する"""
+    monkeypatch.setattr(services.rules.config, "ALLOWED_DOMAINS", [])
+    monkeypatch.setattr(services.rules.config, "SUBJECT_KEYWORDS", [])
+    (tmp_path / "rules.json").write_text("{ broken json", encoding="utf-8")
+    alert = mocker.patch("services.slack.enqueue_slack_alert")
+    read = mocker.spy(services.rules, "_read_source")
+
+    assert services.filtering.is_allowed_email("a@example.com", "請求書") == False
+    assert services.filtering.is_allowed_attachment("a@example.com", "請求書", "a.pdf", 1) == False
+    assert services.filtering.is_allowed_email("a@other.com", "hello") == False
+    assert read.call_count == 1
+    alert.assert_called_once()
+    assert alert.call_args.kwargs["dedup_key"] == "rules_unavailable"
+    assert services.rules.rules_unavailable()
+
+    rules_file({"version": "v3", "rules": [{"name": "new", "domains": ["example.com"]}]})
+    assert services.rules.reload_rules() == True
+    assert services.filtering.is_allowed_email("a@example.com", "hello") == True
+    assert not services.rules.rules_unavailable()
+
+def test_claims_stop_while_rules_are_unavailable(rules_file, tmp_path, mocker):
+    import services.locking
+    (tmp_path / "rules.json").unlink()
+    mocker.patch("services.slack.enqueue_slack_alert")
+    gmail = mocker.patch("services.gmail.get_gmail_service")
+
+    assert services.locking.lock_and_get_messages() == []
+    gmail.assert_not_called()
@@ -0,0 +1,45 @@
+import pytest
+import services.scheduler
+from services.scheduler import FairQueue, priority_deadline
+
+MB = 1024 * 1024
+
+@pytest.fixture
+def priority(monkeypatch):
+    monkeypatch.setattr("config.PRIORITY_SCHEDULING_ENABLED", True)
+    monkeypatch.setattr("config.PRIORITY_SENDERS", ["keysupplier.example"])
+    monkeypatch.setattr("config.PRIORITY_SENDER_ADVANTAGE_SECONDS", 300)
+    monkeypatch.setattr("config.PRIORITY_SIZE_PENALTY_SECONDS_PER_MB", 30)
+    monkeypatch.setattr("config.PRIORITY_MAX_DELAY_SECONDS", 900)
+
+def msg(msg_id, received, size=0, sender="billing@vendor.example"):
+    return {'id': msg_id, 'internalDate': str(received * 1000), 'sizeEstimate': size, 'sender': sender}
+
+def test_deadline_combines_age_size_and_sender(priority):
+    assert priority_deadline(msg("a", 1000, size=2 * MB)) == 1060
+    # 猶予は上限で頭打ち (大きなメールも飢餓にならない)
+    assert priority_deadline(msg("b", 1000, size=100 * MB)) == 1900
+    assert priority_deadline(msg("c", 1000, sender="Key <ap@keysupplier.example>")) == 700
+    # 受信時刻が不明ならクレーム時刻
+    assert priority_deadline({'id': "d"}, now=5000) == 5000
+
+def test_bulk_mail_does_not_block_small_invoices(priority):
+    bulk = msg("bulk", 1000, size=100 * MB)
+    small = [msg(f"s{i}", 1000 + i * 60, size=50 * 1024) for i in range(5)]
+    key = msg("key", 1400, sender="ap@keysupplier.example")
+    late = msg("late", 2000)
+    ordered = services.scheduler.sort_by_priority([bulk, *small, key, late])
+    assert [m['id'] for m in ordered] == ["s0", "s1", "key", "s2", "s3", "s4", "bulk", "late"]
+
+def test_sort_is_noop_when_disabled(monkeypatch):
+    monkeypatch.setattr("config.PRIORITY_SCHEDULING_ENABLED", False)
+    messages = [msg("b", 2000), msg("a", 1000)]
+    assert services.scheduler.sort_by_priority(messages) == messages
+
+def test_fair_queue_orders_within_key_by_priority(priority):
+    q = FairQueue(priority=priority_deadline)
+    q.put("x", msg("x-bulk", 1000, size=100 * MB))
+    q.put("x", msg("x-small", 1100))
+    q.put("y", msg("y-1", 1200))
+    q.put("x", msg("x-tie", 1100))
+    assert [q.get_nowait()[1]['id'] for _ in range(4)] == ["x-small", "y-1", "x-tie", "x-bulk"]
@@ -0,0 +1,97 @@
+import datetime
+import os
+import threading
+import pytest
+import services.search_index
+from services.search_index import SearchIndex
+
+def row(msg_id, received_at, sender_name="ACME Corp", sender_address="billing@acme.example",
+        subject="Invoice March", filename="invoice.pdf", amount=None):
+    r = {"message_id": msg_id, "received_at": received_at, "sender_name": sender_name,
+         "sender_address": sender_address, "subject": subject, "filename": filename,
+         "extension": os.path.splitext(filename)[1].lower(), "gcs_url": f"https://storage/{msg_id}"}
+    if amount is not None:
+        r["invoice_total_amount"] = amount
+    return r
+
+def ids(result):
+    return [doc["id"] for doc in result["results"]]
+
+@pytest.fixture
+def index(tmp_path):
+    index = SearchIndex(str(tmp_path / "index"), flush_docs=2, flush_seconds=3600, max_segments=3,
+                        background=False)
+    index.add("m1_invoice.pdf", row("m1", "2024-03-05T10:00:00", amount=11000))
+    index.add("m2_請求書.pdf", row("m2", "2024-03-20T09:00:00", sender_name="株式会社テスト",
+                                   sender_address="ap@test.example", subject="3月分 請求書", filename="請求書.pdf"))
+    index.add("m3_receipt.xlsx", row("m3", "2024-04-02T12:00:00", subject="Receipt", filename="receipt.xlsx",
+                                     amount=500))
+    return index
+
+def test_term_prefix_and_field_queries(index):
+    assert ids(index.search("acme")) == ["m3_receipt.xlsx", "m1_invoice.pdf"]
+    assert ids(index.search("acme invoice")) == ["m1_invoice.pdf"]
+    assert ids(index.search("請求*")) == ["m2_請求書.pdf"]
+    assert ids(index.search("rece*")) == ["m3_receipt.xlsx"]
+    assert ids(index.search("extension:xlsx")) == ["m3_receipt.xlsx"]
+    # フィールドを限定すると他のフィールドの一致は数えない
+    assert ids(index.search("filename:acme")) == []
+    assert ids(index.search("ap@test.example")) == ["m2_請求書.pdf"]
+    assert index.search("nothing")["total"] == 0
+
+def test_date_and_amount_filters(index):
+    march = index.search("", date_from=datetime.date(2024, 3, 1), date_to=datetime.date(2024, 3, 31))
+    assert ids(march) == ["m2_請求書.pdf", "m1_invoice.pdf"]
+    assert ids(index.search("acme", date_to=datetime.date(2024, 3, 5))) == ["m1_invoice.pdf"]
+    assert ids(index.search("", amount_min=1000)) == ["m1_invoice.pdf"]
+    assert index.search("", limit=1)["total"] == 3
+
+def test_segments_persist_and_newer_versions_win(index, tmp_path):
+    # 1件はバッファに残っている (検索はできる)
+    index.add("m1_invoice.pdf", row("m1", "2024-03-05T10:00:00", subject="Invoice March revised"))
+    assert ids(index.search("revised")) == ["m1_invoice.pdf"]
+    assert ids(index.search("march")) == ["m1_invoice.pdf"]
+    index.flush()
+
+    reopened = SearchIndex(str(tmp_path / "index"), flush_docs=2, flush_seconds=3600, max_segments=3,
+                        background=False)
+    assert len(reopened) == 3
+    assert ids(reopened.search("revised")) == ["m1_invoice.pdf"]
+    # 古い版の金額では一致しない
+    assert ids(reopened.search("", amount_min=1000)) == []
+
+    # セグメント数が上限を超えたら1つに併合する
+    for i in range(4):
+        reopened.add(f"n{i}", row(f"n{i}", "2024-05-01T00:00:00"))
+    assert len(os.listdir(tmp_path / "index")) == 1
+    assert len(reopened) == 7
+
+def test_background_flush_does_not_block_add_or_search(tmp_path, mocker):
+    index = SearchIndex(str(tmp_path / "index"), flush_docs=2, flush_seconds=3600, max_segments=3)
+    release, written = threading.Event(), threading.Event()
+    write = services.search_index.Segment.write
+
+    def slow_write(segment, path):
+        release.wait(5)
+        write(segment, path)
+        written.set()
+    mocker.patch.object(services.search_index.Segment, "write", slow_write)
+
+    index.add("m1_invoice.pdf", row("m1", "2024-03-05T10:00:00"))
+    index.add("m2_invoice.pdf", row("m2", "2024-03-06T10:00:00"))
+    # 書き出し中も追加・検索は待たされず、書き出し中の文書も検索できる
+    index.add("m3_invoice.pdf", row("m3", "2024-03-07T10:00:00", subject="Invoice April"))
+    assert ids(index.search("invoice")) == ["m3_invoice.pdf", "m2_invoice.pdf", "m1_invoice.pdf"]
+    assert not written.is_set()
+
+    release.set()
+    assert written.wait(5)
+    index.flush()
+    assert len(SearchIndex(str(tmp_path / "index"), background=False)) == 3
+
+def test_index_row_is_noop_when_disabled(monkeypatch, tmp_path):
+    monkeypatch.setattr("config.SEARCH_INDEX_ENABLED", False)
+    monkeypatch.setattr("config.SEARCH_INDEX_DIR", str(tmp_path / "index"))
+    services.search_index.index_row("m1", row("m1", "2024-03-05T10:00:00"))
+    assert services.search_index.get_index() is None
+    assert not (tmp_path / "index").exists()
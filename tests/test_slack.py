@@ -0,0 +1,99 @@
+import time
+import threading
+import pytest
+from unittest.mock import MagicMock
+import services.slack
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    """テスト用の新しいディスパッチャーと、モックしたHTTPセッション"""
+    monkeypatch.setattr(services.slack.config, "SLACK_WEBHOOK_URL", "https://hooks.slack.test/x")
+    monkeypatch.setattr(services.slack, "BATCH_DELAY_SECONDS", 0.2)
+    monkeypatch.setattr(services.slack, "RETRY_BACKOFF_SECONDS", 0.01)
+    session = MagicMock()
+    session.post.return_value = MagicMock(status_code=200, headers={})
+    monkeypatch.setattr(services.slack, "_session", session)
+    d = services.slack.AlertDispatcher()
+    monkeypatch.setattr(services.slack, "_dispatcher", d)
+    return d, session
+
+def test_enqueue_does_not_wait_for_slack(dispatcher):
+    d, session = dispatcher
+    release = threading.Event()
+    session.post.side_effect = lambda *a, **kw: (release.wait(5), MagicMock(status_code=200, headers={}))[1]
+
+    # Slackが応答しなくても呼び出し側は即座に戻る
+    assert services.slack.enqueue_slack_alert("slow", level="error") == True
+    release.set()
+    assert d.flush(5)
+    assert session.post.call_args.kwargs["timeout"] == services.slack.REQUEST_TIMEOUT
+
+def test_identical_alerts_are_coalesced(dispatcher):
+    d, session = dispatcher
+    for _ in range(20):
+        services.slack.enqueue_slack_alert("DB down", level="error", dedup_key="db")
+    assert d.flush(5)
+
+    assert session.post.call_count == 1
+    text = session.post.call_args.kwargs["json"]["text"]
+    assert "DB down" in text
+    assert "19 件" in text
+
+    # 送信後の抑制期間中は送らない
+    services.slack.enqueue_slack_alert("DB down", level="error", dedup_key="db")
+    assert d.flush(5)
+    assert session.post.call_count == 1
+    assert d.stats["coalesced"] == 20
+
+def test_suppressed_count_is_sent_when_the_window_expires(dispatcher, monkeypatch):
+    d, session = dispatcher
+    monkeypatch.setattr(services.slack, "COALESCE_WINDOW_SECONDS", 0.5)
+    monkeypatch.setattr(services.slack, "SUPPRESSED_CHECK_SECONDS", 0.05)
+    services.slack.enqueue_slack_alert("DB down", level="error", dedup_key="db")
+    assert d.flush(5)
+    for _ in range(3):
+        services.slack.enqueue_slack_alert("DB still down", level="error", dedup_key="db")
+    assert session.post.call_count == 1
+
+    # 後続のアラートが来なくても、抑制期間が明けたら抑制した分を1通で知らせる
+    deadline = time.time() + 5
+    while session.post.call_count < 2 and time.time() < deadline:
+        time.sleep(0.05)
+    assert session.post.call_count == 2
+    text = session.post.call_args.kwargs["json"]["text"]
+    assert "DB still down" in text
+    assert "2 件" in text
+    assert not d._suppressed
+
+def test_storm_is_summarised(dispatcher):
+    d, session = dispatcher
+    for i in range(15):
+        services.slack.enqueue_slack_alert(f"alert {i}", level="warning" if i else "error")
+    assert d.flush(5)
+
+    assert session.post.call_count == 1
+    text = session.post.call_args.kwargs["json"]["text"]
+    assert "15 件のアラート" in text
+    assert text.startswith("🚨")
+
+def test_retry_with_backoff(dispatcher, caplog):
+    d, session = dispatcher
+    session.post.side_effect = [
+        MagicMock(status_code=503, headers={}, text="unavailable"),
+        Exception("connection reset"),
+        MagicMock(status_code=200, headers={}),
+    ]
+    services.slack.enqueue_slack_alert("flaky")
+    assert d.flush(5)
+    assert session.post.call_count == 3
+    assert d.stats["sent"] == 1
+    # 試行回数は初回を含めて数える
+    assert "(1/4)" in caplog.text and "(2/4)" in caplog.text
+
+def test_queue_full_drops(dispatcher, monkeypatch):
+    d, session = dispatcher
+    d._queue = services.slack.queue.Queue(maxsize=1)
+    monkeypatch.setattr(d, "_ensure_started", lambda: None)
+    assert services.slack.enqueue_slack_alert("a") == True
+    assert services.slack.enqueue_slack_alert("b") == False
+    assert d.stats["dropped"] == 1
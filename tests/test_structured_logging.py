@@ -0,0 +1,84 @@
+import io
+import json
+import queue
+import logging
+import pytest
+import services.metrics
+import services.tracing
+import services.structured_logging
+from services.structured_logging import SamplingFilter
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def record(msg, level=logging.INFO, args=()):
+    return logging.LogRecord("services.processor", level, __file__, 1, msg, args, None)
+
+@pytest.fixture
+def json_logs(monkeypatch):
+    monkeypatch.setattr("config.LOG_FORMAT", "json")
+    monkeypatch.setattr("config.LOG_SAMPLE_RATE", 1.0)
+    monkeypatch.setattr("config.PROJECT_ID", "proj")
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    out = io.StringIO()
+    services.structured_logging.configure(logging.INFO, stream=out)
+
+    def read():
+        services.structured_logging.shutdown()
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+    yield read
+    services.structured_logging.shutdown()
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+def test_sampling_keeps_burst_then_rate_and_all_warnings():
+    clock = FakeClock()
+    sampling = SamplingFilter(rate=0.25, burst=2, window_seconds=60, clock=clock)
+    before = services.metrics.LOG_RECORDS_DROPPED.get(reason="sampled")
+
+    kept = [sampling.filter(record("メッセージを処理中: %s")) for _ in range(10)]
+    assert kept == [True, True, False, False, False, True, False, False, False, True]
+    assert all(sampling.filter(record("メッセージを処理中: %s", logging.WARNING)) for _ in range(5))
+    # 書式が異なるメッセージは別に数える
+    assert sampling.filter(record("BigQuery に挿入しました: %s"))
+    assert services.metrics.LOG_RECORDS_DROPPED.get(reason="sampled") - before == 6
+
+    clock.now = 61
+    assert sampling.filter(record("メッセージを処理中: %s"))
+
+def test_json_output_carries_correlation_ids(json_logs):
+    logger = logging.getLogger("services.processor")
+    services.tracing.set_correlation(pubsub_message_id="ps-1")
+    with services.tracing.correlate(gmail_message_id="m1"):
+        logger.info("メッセージを処理中: %s", "m1")
+        try:
+            raise ValueError("boom")
+        except ValueError:
+            logger.exception("失敗しました: %s", "m1")
+    logger.info("after")
+
+    entries = json_logs()
+    assert entries[0]["message"] == "メッセージを処理中: m1"
+    assert (entries[0]["severity"], entries[0]["logger"]) == ("INFO", "services.processor")
+    assert (entries[0]["pubsub_message_id"], entries[0]["gmail_message_id"]) == ("ps-1", "m1")
+    assert entries[1]["severity"] == "ERROR"
+    assert "ValueError: boom" in entries[1]["message"]
+    assert entries[1]["logging.googleapis.com/sourceLocation"]["function"] == "test_json_output_carries_correlation_ids"
+    # ブロックを抜けたら gmail_message_id は付かない
+    assert "gmail_message_id" not in entries[2]
+
+def test_full_queue_drops_info_but_keeps_errors():
+    handler = services.structured_logging.AsyncQueueHandler(queue.Queue(1))
+    before = services.metrics.LOG_RECORDS_DROPPED.get(reason="queue_full")
+    handler.handle(record("first"))
+    handler.handle(record("dropped"))
+    assert services.metrics.LOG_RECORDS_DROPPED.get(reason="queue_full") - before == 1
+    assert handler.queue.get_nowait().getMessage() == "first"
+    handler.handle(record("kept", logging.ERROR))
+    assert handler.queue.get_nowait().msg == "kept"
@@ -0,0 +1,96 @@
+import json
+import contextvars
+import pytest
+import services.tracing
+
+class CollectingExporter(services.tracing.SpanExporter):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+@pytest.fixture
+def exporter(monkeypatch):
+    exp = CollectingExporter()
+    monkeypatch.setattr(services.tracing.config, "TRACE_SAMPLE_RATE", 1.0)
+    services.tracing.set_exporter(exp)
+    yield exp
+    services.tracing.set_exporter(None)
+
+def test_disabled_tracing_returns_noop():
+    services.tracing.set_exporter(None)
+    assert services.tracing.start_trace("x") is services.tracing.NOOP_SPAN
+    # トレース外の子スパンも no-op
+    assert services.tracing.span("y") is services.tracing.NOOP_SPAN
+
+def test_spans_are_correlated(exporter):
+    def run():
+        services.tracing.set_correlation(pubsub_message_id="ps-1")
+        with services.tracing.start_trace("process_email", gmail_message_id="msg-1"):
+            with services.tracing.span("gmail.messages.get"):
+                pass
+            with pytest.raises(ValueError):
+                with services.tracing.span("gcs.upload", bytes=10):
+                    raise ValueError("boom")
+        # ルートスパン終了後は Gmail メッセージIDの相関が残らない
+        assert services.tracing.get_correlation() == {"pubsub_message_id": "ps-1"}
+
+    # リクエストごとのコンテキストを模擬 (他のテストに相関IDを残さない)
+    contextvars.copy_context().run(run)
+    assert services.tracing.flush()
+
+    by_name = {s.name: s for s in exporter.spans}
+    root = by_name["process_email"]
+    assert root.parent_id is None
+    for child in ("gmail.messages.get", "gcs.upload"):
+        assert by_name[child].trace_id == root.trace_id
+        assert by_name[child].parent_id == root.span_id
+        assert by_name[child].attributes["gmail_message_id"] == "msg-1"
+        assert by_name[child].attributes["pubsub_message_id"] == "ps-1"
+    assert by_name["gcs.upload"].status == "error"
+    assert "ValueError" in by_name["gcs.upload"].error
+
+def test_sampling_zero_drops_trace(exporter, monkeypatch):
+    monkeypatch.setattr(services.tracing.config, "TRACE_SAMPLE_RATE", 0.0)
+    with services.tracing.start_trace("process_email") as root:
+        assert root is services.tracing.NOOP_SPAN
+        assert services.tracing.span("child") is services.tracing.NOOP_SPAN
+
+def test_jsonl_exporter(tmp_path):
+    path = tmp_path / "traces.jsonl"
+    services.tracing.set_exporter(services.tracing.JsonlSpanExporter(str(path)))
+    try:
+        with services.tracing.start_trace("claim", gmail_message_id="m1"):
+            pass
+        assert services.tracing.flush()
+    finally:
+        services.tracing.set_exporter(None)
+    record = json.loads(path.read_text(encoding="utf-8").splitlines()[0])
+    assert record["name"] == "claim"
+    assert record["attributes"]["gmail_message_id"] == "m1"
+
+def test_otlp_payload_format():
+    exp = services.tracing.OtlpHttpSpanExporter("http://collector/v1/traces")
+    span = services.tracing.Span("gmail.messages.get", "a" * 32, "b" * 16, {"bytes": 3, "gmail_message_id": "m1"})
+    otlp = exp._to_otlp(span)
+    assert otlp["traceId"] == "a" * 32
+    assert otlp["parentSpanId"] == "b" * 16
+    assert {"key": "bytes", "value": {"intValue": "3"}} in otlp["attributes"]
+
+def test_process_email_task_emits_trace(exporter, mocker):
+    """process_email_task がルートスパンと Gmail 呼び出しのスパンを出力する"""
+    from unittest.mock import MagicMock
+    import services.processor
+    mocker.patch("services.gmail.get_gmail_service", return_value=MagicMock())
+    mocker.patch("services.processor.is_allowed_email", return_value=False)
+    mocker.patch("services.parser.parse_message_detail")
+
+    services.processor.process_email_task({'id': 'msg-trace'})
+    assert services.tracing.flush()
+
+    names = [s.name for s in exporter.spans]
+    assert "process_email" in names
+    assert "gmail.messages.get" in names
+    root = next(s for s in exporter.spans if s.name == "process_email")
+    assert root.attributes["result"] == "filtered"
@@ -0,0 +1,203 @@
+import threading
+import pytest
+from unittest.mock import MagicMock
+import services.gmail
+import services.accounts
+import services.locking
+import watch_gmail
+from watch_gmail import AdaptiveInterval, Watcher
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+def step(watcher, clock):
+    """1サイクル実行し、待機時間ぶん時計を進める"""
+    wait = watcher.run_once()
+    clock.now += wait
+    return wait
+
+@pytest.fixture
+def gmail(mocker):
+    mocker.patch("services.gmail.get_or_create_label_id", side_effect=lambda name: f"Label_{name}")
+    mocker.patch("services.gmail.get_history_id", return_value="100")
+    return mocker.patch("services.gmail.list_history", return_value=(0, "100"))
+
+def make_watcher(clock=None, **kwargs):
+    kwargs.setdefault("workers", 2)
+    kwargs.setdefault("accounts", [None])
+    return Watcher(min_interval=5, max_interval=40, full_sync_seconds=600, clock=clock or FakeClock(), **kwargs)
+
+def test_adaptive_interval():
+    interval = AdaptiveInterval(5, 60)
+    assert [interval.idle() for _ in range(5)] == [10, 20, 40, 60, 60]
+    assert interval.busy() == 5
+
+def test_idle_backoff_and_wake_on_history_change(gmail, mocker):
+    claim = mocker.patch("watch_gmail.lock_and_get_messages", return_value=[])
+    mocker.patch("watch_gmail.process_email_task")
+    clock = FakeClock()
+    watcher = make_watcher(clock)
+    mailbox = watcher.mailboxes[0]
+
+    # 初回は差分の起点を取ってから全件確認する
+    assert step(watcher, clock) == 10
+    assert claim.call_count == 1 and mailbox.history_id == "100"
+
+    # 変化が無ければクレームせずに間隔を延ばす
+    assert [step(watcher, clock) for _ in range(3)] == [20, 40, 40]
+    assert claim.call_count == 1
+    assert gmail.call_args.args == ("100", {"Label_INVOICE_PROCESSED", "Label_INVOICE_ERROR"})
+
+    # 新着があればクレームし、最短間隔に戻す
+    gmail.return_value = (1, "105")
+    claim.return_value = [{'id': 'm1'}]
+    assert step(watcher, clock) == 5
+    assert claim.call_count == 2 and mailbox.history_id == "105"
+    watcher.shutdown()
+
+def test_expired_history_and_periodic_full_sync(gmail, mocker):
+    claim = mocker.patch("watch_gmail.lock_and_get_messages", return_value=[])
+    clock = FakeClock()
+    watcher = make_watcher(clock)
+    step(watcher, clock)
+
+    gmail.side_effect = services.gmail.HistoryExpired("100")
+    services.gmail.get_history_id.return_value = "200"
+    step(watcher, clock)
+    assert claim.call_count == 2 and watcher.mailboxes[0].history_id == "200"
+
+    gmail.side_effect = None
+    gmail.return_value = (0, "200")
+    step(watcher, clock)
+    assert claim.call_count == 2
+    clock.now += 600
+    step(watcher, clock)
+    assert claim.call_count == 3
+    watcher.shutdown()
+
+def test_failed_claim_retries_without_waiting_for_full_sync(gmail, mocker):
+    """差分の起点を進めた後にクレームが失敗したら、次のサイクルで (差分がなくても) やり直す"""
+    claim = mocker.patch("watch_gmail.lock_and_get_messages", return_value=[])
+    clock = FakeClock()
+    watcher = make_watcher(clock)
+    mailbox = watcher.mailboxes[0]
+    step(watcher, clock)
+
+    gmail.return_value = (1, "105")
+    claim.side_effect = services.locking.ClaimFailed("503")
+    assert step(watcher, clock) == 5
+    assert mailbox.history_id == "105" and mailbox.backlog
+
+    gmail.return_value = (0, "105")
+    claim.side_effect = None
+    claim.return_value = [{'id': 'm1'}]
+    step(watcher, clock)
+    assert claim.call_count == 3 and not mailbox.backlog
+    assert claim.call_args.kwargs == {"raise_errors": True}
+    watcher.shutdown()
+
+def test_claim_failures_are_raised_on_request(mocker):
+    mocker.patch("services.gmail.get_gmail_service", side_effect=Exception("503"))
+    assert services.locking.lock_and_get_messages() == []
+    with pytest.raises(services.locking.ClaimFailed):
+        services.locking.lock_and_get_messages(raise_errors=True)
+
+def test_claims_only_while_workers_are_free(gmail, mocker):
+    """処理中がワーカー数に達したらクレームを止め、空いたら続きをクレームする"""
+    release = threading.Event()
+    processed = []
+
+    def process(msg):
+        release.wait(5)
+        processed.append(msg['id'])
+
+    batches = iter([[{'id': f'm{i}'} for i in range(10)], [{'id': 'm10'}]])
+    claim = mocker.patch("watch_gmail.lock_and_get_messages", side_effect=lambda **kwargs: next(batches, []))
+    mocker.patch("watch_gmail.process_email_task", side_effect=process)
+    mocker.patch("watch_gmail.CLAIM_BATCH_SIZE", 10)
+    watcher = make_watcher()
+
+    watcher.run_once()
+    assert claim.call_count == 1 and watcher.mailboxes[0].backlog
+
+    release.set()
+    watcher.shutdown()
+    assert sorted(processed) == sorted(f'm{i}' for i in range(10))
+
+    # 次のサイクルは差分に関係なく続きをクレームする
+    watcher = make_watcher()
+    mailbox = watcher.mailboxes[0]
+    mailbox.history_id = "100"
+    mailbox.last_full_sync = 0
+    mailbox.backlog = True
+    watcher.run_once()
+    watcher.shutdown()
+    assert claim.call_count == 2 and 'm10' in processed
+    gmail.assert_not_called()
+
+def test_failed_check_backs_off(gmail, mocker):
+    mocker.patch("watch_gmail.lock_and_get_messages", return_value=[])
+    services.gmail.get_history_id.side_effect = Exception("network")
+    watcher = make_watcher()
+    assert watcher.run_once() == 10
+    assert watcher.mailboxes[0].history_id is None
+    watcher.shutdown()
+
+def test_list_history_counts_external_changes(mocker):
+    service = MagicMock()
+    mocker.patch("services.gmail.get_gmail_service", return_value=service)
+    service.users().history().list().execute.side_effect = [
+        {'history': [{'messagesAdded': [{'message': {'id': 'm1'}}]},
+                     {'labelsAdded': [{'labelIds': ['Label_processed']}]}],
+         'historyId': '110', 'nextPageToken': 'p2'},
+        {'history': [{'labelsAdded': [{'labelIds': ['Label_target']}]}], 'historyId': '120'},
+    ]
+    assert services.gmail.list_history("100", {"Label_processed"}) == (2, "120")
+
+def test_multi_account_shares_pool_fairly(gmail, mocker):
+    """大量の未処理があるアカウントがあっても、他のアカウントの処理が後回しにならない"""
+    accounts = [services.accounts.Account("big@example.com", refresh_token="t1"),
+                services.accounts.Account("small@example.com", refresh_token="t2")]
+    order = []
+    gate = threading.Event()
+
+    def claim(**kwargs):
+        account = services.accounts.current_account()
+        n = 6 if account.email == "big@example.com" else 2
+        return [{'id': f'{account.email[0]}{i}', 'account': account.email} for i in range(n)]
+
+    def process(msg):
+        gate.wait(5)
+        order.append(msg['id'])
+
+    mocker.patch("watch_gmail.lock_and_get_messages", side_effect=claim)
+    mocker.patch("watch_gmail.process_email_task", side_effect=process)
+    watcher = make_watcher(accounts=accounts, workers=1)
+    watcher.run_once()
+    assert [m.outstanding for m in watcher.mailboxes] == [6, 2]
+    gate.set()
+    watcher.shutdown()
+    # 1件目の処理中に small のメールがキューに入り、以降は交互に処理される
+    assert order[:5] == ['b0', 'b1', 's0', 'b2', 's1']
+
+def test_lease_sweep_triggers_claim(gmail, mocker, monkeypatch):
+    """期限切れリースを回収したら、差分に関係なくすぐにクレームする"""
+    monkeypatch.setattr("config.LEASES_ENABLED", True)
+    monkeypatch.setattr("config.LEASE_SWEEP_SECONDS", 300)
+    sweep = mocker.patch("services.leases.sweep", return_value={"expired": 0, "reclaimed": 0, "failed": 0})
+    claim = mocker.patch("watch_gmail.lock_and_get_messages", return_value=[])
+    clock = FakeClock()
+    watcher = make_watcher(clock)
+    step(watcher, clock)
+    step(watcher, clock)
+    assert sweep.call_count == 1 and claim.call_count == 1
+
+    sweep.return_value = {"expired": 2, "reclaimed": 2, "failed": 0}
+    clock.now = 300
+    step(watcher, clock)
+    assert sweep.call_count == 2 and claim.call_count == 2
+    watcher.shutdown()
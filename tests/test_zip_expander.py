@@ -0,0 +1,122 @@
+import io
+import struct
+import zipfile
+import datetime
+import pytest
+from services.zip_expander import ZipLimits, ZipLimitExceeded, list_members, open_archive, open_member
+from services.parser import Email, Attachment
+
+LIMITS = ZipLimits(max_members=10, max_total_bytes=1024 * 1024, max_ratio=100)
+
+def make_zip(files, compression=zipfile.ZIP_DEFLATED) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", compression) as zf:
+        for name, data in files:
+            zf.writestr(name, data)
+    return buffer.getvalue()
+
+def test_members_are_listed_and_streamed():
+    data = make_zip([
+        ("2025-01/invoice_a.pdf", b"%PDF-a" * 10),
+        ("__MACOSX/._invoice_a.pdf", b"junk"),
+        ("2025-01/", b""),
+        ("invoice_b.pdf", b"%PDF-b" * 10),
+    ])
+    with open_archive(data) as archive:
+        members = list_members(archive, LIMITS)
+        assert [(m.index, m.filename, m.size) for m in members] == [(1, "invoice_a.pdf", 60), (2, "invoice_b.pdf", 60)]
+        with open_member(archive, members[1]) as stream:
+            assert stream.read(6) == b"%PDF-b"
+            assert len(stream.read()) == 54
+
+def test_cp932_member_names_are_decoded():
+    # Windows の「圧縮フォルダー」と同様に、UTF-8 フラグなし・Shift_JIS のファイル名にする
+    sjis = "請求書".encode("cp932")
+    data = make_zip([("X" * len(sjis) + ".pdf", b"%PDF-")]).replace(b"X" * len(sjis), sjis)
+    with open_archive(data) as archive:
+        assert list_members(archive, LIMITS)[0].filename == "請求書.pdf"
+
+@pytest.mark.parametrize("files, limits, message", [
+    ([(f"{i}.pdf", b"x") for i in range(11)], LIMITS, "メンバー数"),
+    ([("a.pdf", b"x" * 600_000), ("b.pdf", b"y" * 600_000)],
+     ZipLimits(max_members=10, max_total_bytes=1024 * 1024, max_ratio=10_000), "合計サイズ"),
+    # 高圧縮率のメンバー (ZIP bomb)
+    ([("bomb.pdf", b"\0" * 500_000)], LIMITS, "圧縮率"),
+])
+def test_limits_reject_archive(files, limits, message):
+    with open_archive(make_zip(files)) as archive:
+        with pytest.raises(ZipLimitExceeded, match=message):
+            list_members(archive, limits)
+
+@pytest.fixture
+def pipeline(monkeypatch, mocker):
+    """raw モードの処理パイプライン (保存内容と BigQuery のモックを返す)"""
+    monkeypatch.setattr("config.ZIP_EXPANSION_ENABLED", True)
+    monkeypatch.setattr("config.ZIP_MAX_COMPRESSION_RATIO", 100)
+    monkeypatch.setattr("config.INGEST_MODE", "raw")
+    mocker.patch("services.gmail.get_gmail_service")
+    mocker.patch("services.error_monitor.record_success")
+    mocker.patch("services.processor.is_allowed_email", return_value=True)
+    storage = mocker.patch("adapters.get_storage_adapter").return_value
+    saved = {}
+    storage.save_fileobj.side_effect = lambda bucket_name, file_path, fileobj, content_type, size=None: \
+        saved.setdefault(file_path, fileobj.read()) and f"https://mock/{file_path}"
+    storage.save_file.side_effect = lambda bucket_name, file_path, data, content_type: \
+        saved.setdefault(file_path, data) and f"https://mock/{file_path}"
+    bq = mocker.patch("adapters.get_bigquery_adapter").return_value
+    bq.insert_rows.return_value = []
+    return saved, bq
+
+def run_with(mocker, *zips):
+    from services.processor import process_email_task
+    mocker.patch("services.parser.parse_raw_message", return_value=Email(
+        id="m1", subject="Invoice", sender_name="A", sender_address="a@example.com",
+        received_at=datetime.datetime(2025, 1, 31),
+        attachments=[Attachment(id=f"p{n}", filename=name, mime_type="application/zip", size=len(data), data=data)
+                     for n, (name, data) in enumerate(zips, 1)]))
+    return process_email_task({'id': 'm1'})
+
+def test_processor_archives_each_member(pipeline, mocker):
+    """ZIP のメンバーがそれぞれ別のオブジェクト・行・挿入IDで保存され、制限超過の ZIP はそのまま保存される"""
+    saved, bq = pipeline
+    monthly = make_zip([("jan/invoice_a.pdf", b"%PDF-a"), ("invoice_b.pdf", b"%PDF-b")])
+    bomb = make_zip([("bomb.pdf", b"\0" * 500_000)])
+
+    run_with(mocker, ("monthly.zip", monthly), ("bomb.zip", bomb))
+
+    assert saved == {
+        "2025/01/31/m1_1_1_invoice_a.pdf": b"%PDF-a",
+        "2025/01/31/m1_1_2_invoice_b.pdf": b"%PDF-b",
+        "2025/01/31/m1_2_bomb.zip": bomb,
+    }
+    ids = [c.kwargs['row_ids'][0] for c in bq.insert_rows.call_args_list]
+    assert ids == ["m1_1_1_invoice_a.pdf", "m1_1_2_invoice_b.pdf", "m1_2_bomb.zip"]
+    rows = [c.args[1][0] for c in bq.insert_rows.call_args_list]
+    assert rows[0]["source_archive"] == "monthly.zip"
+    assert rows[0]["content_type"] == "application/pdf"
+    assert rows[0]["file_size_bytes"] == 6
+    assert "source_archive" not in rows[2]
+
+@pytest.mark.parametrize("files", [[], [("__MACOSX/._a.pdf", b"junk"), (".DS_Store", b"junk")]])
+def test_processor_archives_zip_without_members_as_is(pipeline, mocker, files):
+    saved, bq = pipeline
+    empty = make_zip(files)
+
+    assert run_with(mocker, ("empty.zip", empty)) == "success"
+
+    assert saved == {"2025/01/31/m1_empty.zip": empty}
+    assert [c.kwargs['row_ids'][0] for c in bq.insert_rows.call_args_list] == ["m1_empty.zip"]
+
+def test_processor_falls_back_when_member_size_mismatches(pipeline, mocker):
+    """宣言サイズより実データが大きいメンバーがあれば、展開を中断して ZIP ごとアーカイブする"""
+    saved, bq = pipeline
+    data = bytearray(make_zip([("a.pdf", b"%PDF-a"), ("b.pdf", b"%PDF-b" * 100)]))
+    # 2件目のセントラルディレクトリの展開後サイズを偽る
+    central = data.rfind(b"PK\x01\x02")
+    struct.pack_into("<I", data, central + 24, 10)
+    data = bytes(data)
+
+    assert run_with(mocker, ("monthly.zip", data)) == "success"
+
+    assert saved["2025/01/31/m1_monthly.zip"] == data
+    assert [c.kwargs['row_ids'][0] for c in bq.insert_rows.call_args_list] == ["m1_1_1_a.pdf", "m1_monthly.zip"]
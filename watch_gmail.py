@@ -1,41 +1,276 @@
+"""
+Gmail 監視モード (ローカル/常駐ワーカー)
+
+- 履歴ID (history.list) の差分で新着を確認し、変化があったときだけクレーム (検索+ロック) する
+- 確認間隔は新着があれば最短 (WATCH_MIN_INTERVAL_SECONDS)、無ければ倍々に最長 (WATCH_MAX_INTERVAL_SECONDS) まで延ばす
+- 履歴IDが失効した場合と WATCH_FULL_SYNC_SECONDS ごとに、差分に関係なく検索で全件確認する
+- クレームしたメールはワーカープール (WATCH_WORKERS) で並行処理する
+- 複数アカウントモード (ACCOUNTS_FILE) では全メールボックスを監視し、ワーカープールを公平に共有する
+- LEASES_ENABLED の場合は LEASE_SWEEP_SECONDS ごとに期限切れのリースを回収する
+- RETRY_ENABLED の場合は RETRY_INTERVAL_SECONDS ごとに INVOICE_ERROR のメールを再処理する
+- Ctrl+C / SIGTERM ではクレーム済みのメールを処理し終えてから停止する
+"""
 import time
+import signal
 import logging
-from services.locking import lock_and_get_messages
+import threading
+import queue
+import concurrent.futures
+from typing import List, Optional
+import services.gmail
+import services.accounts
+import services.leases
+import services.retry
+import services.metrics
+import services.scheduler
+import services.search_index
+import services.structured_logging
+from services.locking import lock_and_get_messages, ClaimFailed, CLAIM_BATCH_SIZE
 from services.processor import process_email_task
+import config
 
 # ログ設定
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
+services.structured_logging.configure(logging.INFO, fmt='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+class AdaptiveInterval:
+    """新着があれば最短間隔に戻し、無ければ factor 倍ずつ最長間隔まで延ばす"""
+
+    def __init__(self, minimum: float, maximum: float, factor: float = 2.0):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.factor = factor
+        self.current = minimum
+
+    def busy(self) -> float:
+        self.current = self.minimum
+        return self.current
+
+    def idle(self) -> float:
+        self.current = min(self.maximum, self.current * self.factor)
+        return self.current
+
+class Mailbox:
+    """アカウントごとの監視状態 (差分の起点・確認間隔・処理待ち件数)"""
+
+    def __init__(self, account: Optional[services.accounts.Account], interval: AdaptiveInterval):
+        self.account = account
+        self.name = account.email if account else "me"
+        self.interval = interval
+        self.history_id: Optional[str] = None
+        self.last_full_sync: Optional[float] = None
+        # 空き待ちでクレームを打ち切った (まだ対象が残っている可能性がある)
+        self.backlog = False
+        self.next_check = 0.0
+        # キュー待ち + 処理中の件数
+        self.outstanding = 0
+
+class Watcher:
+    """
+    履歴IDの差分確認 → クレーム → 並行処理 を繰り返すワーカー
+
+    - 複数アカウントモードでは、アカウントごとに差分の起点と確認間隔を持ち、
+      1つのワーカープールを共有する (キューはアカウント間でラウンドロビン)
+    - クレームしたメールには PROCESSED ラベルが付き、以降の検索に掛からなくなるため、
+      処理待ちを溜め込まないよう、アカウントごとの処理待ちがワーカー数未満のときだけクレームする
+    """
+
+    def __init__(self, accounts: List[Optional[services.accounts.Account]] = None, workers: int = None,
+                 min_interval: float = None, max_interval: float = None,
+                 full_sync_seconds: float = None, clock=time.monotonic):
+        self.workers = workers or config.WATCH_WORKERS
+        min_interval = config.WATCH_MIN_INTERVAL_SECONDS if min_interval is None else min_interval
+        max_interval = config.WATCH_MAX_INTERVAL_SECONDS if max_interval is None else max_interval
+        if accounts is None:
+            accounts = services.accounts.get_accounts() or [None]
+        self.mailboxes = [Mailbox(a, AdaptiveInterval(min_interval, max_interval)) for a in accounts]
+        self.full_sync_seconds = config.WATCH_FULL_SYNC_SECONDS if full_sync_seconds is None else full_sync_seconds
+        self.stop = threading.Event()
+        self.queue = services.scheduler.FairQueue(
+            priority=(lambda item: services.scheduler.priority_deadline(item[1]))
+            if config.PRIORITY_SCHEDULING_ENABLED else None)
+        self._clock = clock
+        self._last_sweep: Optional[float] = None
+        self._last_retry: Optional[float] = None
+        self._retry_thread: Optional[threading.Thread] = None
+        self._running = 0
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="watch")
+
+    def _ignored_label_ids(self):
+        # 自身が付けるラベル (ロック・エラー) の変更では起こさない
+        return {services.gmail.get_or_create_label_id(config.PROCESSED_LABEL_NAME),
+                services.gmail.get_or_create_label_id(config.ERROR_LABEL_NAME)}
+
+    def check(self, mailbox: Mailbox) -> bool:
+        """新着の可能性があれば True を返します (その場合はクレームする)。"""
+        now = self._clock()
+        if mailbox.history_id is None:
+            # 初回: 差分の起点を取ってから全件確認する (間に届いたメールは次回の差分に現れる)
+            mailbox.history_id = services.gmail.get_history_id()
+            mailbox.last_full_sync = now
+            services.metrics.WATCH_CHECKS.inc(result="full_sync")
+            return True
+
+        try:
+            changes, mailbox.history_id = services.gmail.list_history(mailbox.history_id, self._ignored_label_ids())
+        except services.gmail.HistoryExpired:
+            logger.warning(f"[{mailbox.name}] 履歴ID {mailbox.history_id} が失効しています。全件確認します。")
+            mailbox.history_id = services.gmail.get_history_id()
+            mailbox.last_full_sync = now
+            services.metrics.WATCH_CHECKS.inc(result="expired")
+            return True
+
+        if changes:
+            services.metrics.WATCH_CHECKS.inc(result="changed")
+            return True
+        if now - mailbox.last_full_sync >= self.full_sync_seconds:
+            mailbox.last_full_sync = now
+            services.metrics.WATCH_CHECKS.inc(result="full_sync")
+            return True
+        services.metrics.WATCH_CHECKS.inc(result="idle")
+        return False
+
+    def claim(self, mailbox: Mailbox) -> int:
+        """処理待ちに空きがある間クレームを繰り返し、キューに入れます。"""
+        claimed = 0
+        mailbox.backlog = False
+        while not self.stop.is_set():
+            if mailbox.outstanding >= self.workers:
+                # 差分の起点は進んでいるため、空きが出たら次のサイクルで続きをクレームする
+                mailbox.backlog = True
+                break
+            try:
+                batch = lock_and_get_messages(raise_errors=True)
+            except ClaimFailed as e:
+                # 差分の起点は進んでいるため、検索できるまで差分の有無に関係なくクレームをやり直す
+                logger.warning(f"[{mailbox.name}] クレームに失敗しました。次のサイクルで再試行します: {e}")
+                mailbox.backlog = True
+                break
+            with self._lock:
+                mailbox.outstanding += len(batch)
+            for msg in batch:
+                self.queue.put(mailbox.name, (mailbox, msg))
+            claimed += len(batch)
+            self._dispatch()
+            if len(batch) < CLAIM_BATCH_SIZE:
+                break
+        if claimed:
+            logger.info(f"[{mailbox.name}] {claimed} 件のメールをクレームしました (処理待ち {mailbox.outstanding} 件)")
+        return claimed
+
+    def _dispatch(self):
+        """ワーカーの空きの分だけキューから取り出して投入します。"""
+        with self._lock:
+            while self._running < self.workers:
+                try:
+                    _, (mailbox, msg) = self.queue.get_nowait()
+                except queue.Empty:
+                    return
+                self._running += 1
+                self._pool.submit(self._process, mailbox, msg)
+
+    def _process(self, mailbox: Mailbox, msg: dict):
+        try:
+            process_email_task(msg)
+        except Exception as e:
+            logger.error(f"[{mailbox.name}] メッセージ {msg.get('id')} の処理に失敗しました: {e}")
+        finally:
+            with self._lock:
+                self._running -= 1
+                mailbox.outstanding -= 1
+                self._idle.notify_all()
+            self._dispatch()
+
+    def sweep_leases(self):
+        """期限切れのリースを回収し、再クレーム可能に戻ったメールをすぐにクレームさせます。"""
+        if not config.LEASES_ENABLED:
+            return
+        now = self._clock()
+        if self._last_sweep is not None and now - self._last_sweep < config.LEASE_SWEEP_SECONDS:
+            return
+        self._last_sweep = now
+        try:
+            stats = services.leases.sweep()
+        except Exception as e:
+            logger.error(f"期限切れリースの回収に失敗しました: {e}")
+            return
+        if stats["reclaimed"]:
+            # ラベルを外した変更は履歴の差分 (追加のみを見ている) に現れないため
+            for mailbox in self.mailboxes:
+                mailbox.backlog = True
+                mailbox.next_check = now
+
+    def retry_errors(self):
+        """RETRY_INTERVAL_SECONDS ごとに INVOICE_ERROR のメールを再処理します (別スレッド)。"""
+        if not config.RETRY_ENABLED:
+            return
+        now = self._clock()
+        if self._last_retry is not None and now - self._last_retry < config.RETRY_INTERVAL_SECONDS:
+            return
+        if self._retry_thread is not None and self._retry_thread.is_alive():
+            return
+        self._last_retry = now
+        self._retry_thread = threading.Thread(target=services.retry.run_retry_cycle, name="retry-errors", daemon=True)
+        self._retry_thread.start()
+
+    def run_once(self) -> float:
+        """確認時刻が来たメールボックスを1巡し、次の確認までの待機秒数を返します。"""
+        self.sweep_leases()
+        self.retry_errors()
+        for mailbox in self.mailboxes:
+            if self.stop.is_set():
+                break
+            if self._clock() < mailbox.next_check:
+                continue
+            busy = mailbox.outstanding > 0
+            try:
+                with services.accounts.use_account(mailbox.account):
+                    if mailbox.backlog or self.check(mailbox):
+                        busy = self.claim(mailbox) > 0 or busy
+            except Exception as e:
+                logger.error(f"[{mailbox.name}] 新着の確認に失敗しました: {e}")
+            # クレームをやり直す場合は確認間隔を延ばさない
+            busy = busy or mailbox.backlog
+            wait = mailbox.interval.busy() if busy else mailbox.interval.idle()
+            mailbox.next_check = self._clock() + wait
+        wait = max(0.0, min(m.next_check for m in self.mailboxes) - self._clock())
+        services.metrics.WATCH_INTERVAL_SECONDS.set(wait)
+        return wait
+
+    def run(self):
+        while not self.stop.is_set():
+            self.stop.wait(self.run_once())
+        self.shutdown()
+
+    def shutdown(self):
+        """クレーム済みのメールを全て処理し終えてからプールを閉じます。"""
+        self.stop.set()
+        with self._idle:
+            if self._running or len(self.queue):
+                logger.info(f"処理待ちの {self._running + len(self.queue)} 件の完了を待っています...")
+            self._idle.wait_for(lambda: not self._running and not len(self.queue))
+        self._pool.shutdown(wait=True)
+        if self._retry_thread is not None:
+            self._retry_thread.join()
+        services.search_index.flush()
+
 def watch_gmail():
-    print("--- Gmail 監視モードを開始します (Ctrl+C で停止) ---")
-    print("60秒ごとに新規メール('TARGET'ラベル & 未処理)をチェックします...")
-
-    try:
-        while True:
-            # 1. チェック (Claim Check)
-            print("\n[チェック中...]")
-            locked_msgs = lock_and_get_messages()
-            
-            if not locked_msgs:
-                print(">> 新規メールはありません。")
-            else:
-                print(f">> {len(locked_msgs)} 件のメールを発見！処理を開始します。")
-                
-                # 2. 処理 (Process)
-                for msg in locked_msgs:
-                    process_email_task(msg)
-                
-                print(">> 全件処理完了。")
-
-            # 60秒待機
-            time.sleep(60)
-
-    except KeyboardInterrupt:
-        print("\n\n--- 監視を停止しました ---")
+    watcher = Watcher()
+    logger.info("--- Gmail 監視モードを開始します (Ctrl+C で停止) ---")
+    interval = watcher.mailboxes[0].interval
+    logger.info(f"確認間隔 {interval.minimum:g}〜{interval.maximum:g} 秒 / ワーカー {watcher.workers} / "
+                f"メールボックス {', '.join(m.name for m in watcher.mailboxes)}")
+
+    def request_stop(signum, frame):
+        logger.info("停止要求を受け付けました。")
+        watcher.stop.set()
+    signal.signal(signal.SIGINT, request_stop)
+    signal.signal(signal.SIGTERM, request_stop)
+
+    watcher.run()
+    logger.info("--- 監視を停止しました ---")
 
 if __name__ == "__main__":
     watch_gmail()